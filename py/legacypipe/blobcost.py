@@ -0,0 +1,194 @@
+'''
+A model of how much CPU time fitting each blob will take, used to
+start the most expensive blobs first (so that a few huge blobs that
+start late don't leave most cores idle at the end of a brick).
+
+The model is log-linear in the blob's features:
+
+  log(cpu) = c0 + c1 log(npix) + c2 log(nsrcs) + c3 log(ntims)
+                + c4 (has reference source) + c5 (has large galaxy)
+
+with default coefficients that can be re-fit to the "cpu_blob" times
+recorded in checkpointed results.
+'''
+
+import numpy as np
+
+import logging
+logger = logging.getLogger('legacypipe.blobcost')
+def info(*args):
+    from legacypipe.utils import log_info
+    log_info(logger, args)
+def debug(*args):
+    from legacypipe.utils import log_debug
+    log_debug(logger, args)
+
+feature_names = ['const', 'log_npix', 'log_nsrcs', 'log_ntims', 'ref', 'largegal']
+
+# Rough defaults; these are also the prior that calibration shrinks towards.
+default_coeffs = np.array([-9., 1.0, 1.0, 0.5, 0.5, 1.5])
+
+class BlobCostModel(object):
+    '''
+    Predicts the CPU time for fitting blobs; see the module docstring.
+
+    *min_samples*: number of checkpointed blob results needed before
+    the coefficients are re-fit.
+    *prior_weight*: ridge-regression weight pulling the fit coefficients
+    towards *default_coeffs*.
+    *max_samples*: keep at most this many (the most recent) calibration
+    samples.
+    '''
+    def __init__(self, coeffs=None, min_samples=20, prior_weight=1.,
+                 max_samples=10000):
+        if coeffs is None:
+            coeffs = default_coeffs
+        self.coeffs = np.array(coeffs, dtype=float)
+        self.min_samples = min_samples
+        self.prior_weight = prior_weight
+        self.max_samples = max_samples
+        # calibration samples
+        self.X = []
+        self.logcpu = []
+
+    def __str__(self):
+        return 'BlobCostModel(%s; %i samples)' % (
+            ', '.join(['%s=%.3g' % (n,c) for n,c in zip(feature_names, self.coeffs)]),
+            len(self.X))
+
+    @staticmethod
+    def features(npix, nsrcs, ntims, ref, largegal):
+        '''
+        Returns the (N x 6) design matrix for the given per-blob arrays.
+        '''
+        npix = np.atleast_1d(npix)
+        N = len(npix)
+        X = np.zeros((N, len(feature_names)))
+        X[:,0] = 1.
+        X[:,1] = np.log(np.maximum(npix, 1))
+        X[:,2] = np.log(np.maximum(nsrcs, 1))
+        X[:,3] = np.log(np.maximum(ntims, 1))
+        X[:,4] = ref
+        X[:,5] = largegal
+        return X
+
+    def predict(self, npix, nsrcs, ntims, ref, largegal):
+        '''
+        Returns the predicted CPU seconds for each blob.
+        '''
+        X = self.features(npix, nsrcs, ntims, ref, largegal)
+        return np.exp(np.dot(X, self.coeffs))
+
+    def add_results(self, R, T):
+        '''
+        Adds calibration samples from checkpointed results *R* (a list
+        of dicts with 'result' a table from one_blob, as in the
+        checkpoint files) for the brick whose sources table is *T*.
+        '''
+        n = 0
+        for r in R:
+            B = r.get('result', None)
+            if B is None or len(B) == 0:
+                continue
+            cols = B.get_columns()
+            if not ('cpu_blob' in cols and 'blob_npix' in cols and
+                    'blob_nimages' in cols):
+                continue
+            cpu = B.cpu_blob[0]
+            if not cpu > 0:
+                continue
+            I = B.Isrcs[B.Isrcs >= 0]
+            ref,largegal = _ref_flags(T, I)
+            self.X.append(self.features(B.blob_npix[0], len(B), B.blob_nimages[0],
+                                        ref, largegal)[0])
+            self.logcpu.append(np.log(cpu))
+            n += 1
+        if len(self.X) > self.max_samples:
+            del self.X[:-self.max_samples]
+            del self.logcpu[:-self.max_samples]
+        return n
+
+    def calibrate(self):
+        '''
+        Re-fits the coefficients to the calibration samples (if there
+        are enough), returning True if they were updated.
+        '''
+        if len(self.X) < self.min_samples:
+            return False
+        X = np.array(self.X)
+        y = np.array(self.logcpu)
+        # Ridge regression towards the default coefficients:
+        # minimize |X c - y|^2 + w |c - c_default|^2
+        nf = X.shape[1]
+        w = self.prior_weight
+        A = np.dot(X.T, X) + w * np.eye(nf)
+        b = np.dot(X.T, y) + w * default_coeffs
+        try:
+            self.coeffs = np.linalg.solve(A, b)
+        except np.linalg.LinAlgError:
+            return False
+        debug('Calibrated', self)
+        return True
+
+def _ref_flags(T, I):
+    ref = largegal = False
+    if T is None or len(I) == 0:
+        return ref, largegal
+    cols = T.get_columns()
+    I = I[I < len(T)]
+    if 'ref_cat' in cols:
+        ref = np.any(np.array([r.strip() != '' for r in T.ref_cat[I]]))
+    if 'islargegalaxy' in cols:
+        largegal = np.any(T.islargegalaxy[I])
+    return ref, largegal
+
+def blob_features(blobslices, blobsrcs, blobmap, T, tims, targetwcs):
+    '''
+    Returns (npix, nsrcs, ntims, ref, largegal) arrays, one element per
+    blob, for BlobCostModel.predict.  *ntims* counts the tims whose
+    bounding box (in brick pixels) overlaps the blob's bounding box.
+    '''
+    nb = len(blobslices)
+    npix = np.bincount(blobmap[blobmap >= 0].ravel(), minlength=nb)[:nb]
+    nsrcs = np.array([len(I) for I in blobsrcs])
+    ref = np.zeros(nb, bool)
+    largegal = np.zeros(nb, bool)
+    for i,I in enumerate(blobsrcs):
+        ref[i],largegal[i] = _ref_flags(T, np.atleast_1d(I))
+
+    bx0 = np.array([sx.start for _,sx in blobslices])
+    bx1 = np.array([sx.stop  for _,sx in blobslices])
+    by0 = np.array([sy.start for sy,_ in blobslices])
+    by1 = np.array([sy.stop  for sy,_ in blobslices])
+    ntims = np.zeros(nb, int)
+    for tim in (tims or []):
+        h,w = tim.shape
+        rr,dd = tim.subwcs.pixelxy2radec(np.array([1,w,w,1]), np.array([1,1,h,h]))[-2:]
+        _,x,y = targetwcs.radec2pixelxy(rr, dd)
+        x -= 1.
+        y -= 1.
+        ntims += ((bx1 > x.min()) * (bx0 < x.max()) *
+                  (by1 > y.min()) * (by0 < y.max()))
+    return npix, nsrcs, ntims, ref, largegal
+
+def blob_costs(model, blobslices, blobsrcs, blobmap, T, tims, targetwcs):
+    '''
+    Returns the predicted CPU time for each blob (zero for blobs with
+    no pixels in *blobmap*).
+    '''
+    if len(blobslices) == 0:
+        return np.zeros(0)
+    F = blob_features(blobslices, blobsrcs, blobmap, T, tims, targetwcs)
+    costs = model.predict(*F)
+    npix = F[0]
+    costs[npix == 0] = 0.
+    return costs
+
+def cost_order(costs):
+    '''
+    Returns the indices of blobs with non-zero cost, most expensive first.
+    '''
+    costs = np.asarray(costs)
+    # stable, so that equal-cost blobs stay in index order
+    I = np.argsort(-costs, kind='stable')
+    return I[costs[I] > 0]
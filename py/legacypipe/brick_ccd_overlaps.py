@@ -0,0 +1,347 @@
+'''
+The complete (sparse) brick <-> CCD overlap matrix of a data release,
+computed once and stored, so that planning tools (queue_calibs,
+depthcut, ...) don't redo the geometry one brick at a time.
+
+Run as a script to compute it from the survey's bricks and CCDs tables:
+
+    python -m legacypipe.brick_ccd_overlaps --threads 32
+
+The CCD footprints (see ccdfootprints.py; read from the kd-tree files
+when present) are tested against the bricks in parallel RA stripes.
+The result, by default $LEGACY_SURVEY_DIR/survey-brick-ccd-overlaps.fits,
+holds the overlaps in both directions (compressed sparse rows): the
+CCDs of each brick and the bricks of each CCD.  CCDs are identified by
+(camera, expnum, ccdname) and by their row in the CCDs-table file they
+came from, so that the CCDs of a brick can be read directly.
+
+LegacySurveyData.get_brick_ccd_overlaps() loads the file, and
+LegacySurveyData.ccds_touching_brick() uses it.
+'''
+
+import os
+import sys
+
+import numpy as np
+
+import logging
+logger = logging.getLogger('legacypipe.brick_ccd_overlaps')
+def info(*args):
+    from legacypipe.utils import log_info
+    log_info(logger, args)
+def debug(*args):
+    from legacypipe.utils import log_debug
+    log_debug(logger, args)
+
+class BrickCcdOverlaps(object):
+    '''
+    The overlaps between a set of bricks and a set of CCDs; see the
+    module docstring.
+
+    *bricknames*: array of brick names.
+    *camera*, *expnum*, *ccdname*: arrays identifying the CCDs.
+    *ccd_file*, *ccd_row*: which of the CCDs-table files *filenames*
+    (base names), and which row of it, each CCD came from.
+    *IB*, *IC*: index arrays of the overlapping (brick, CCD) pairs.
+    *W*, *H*, *pixscale*: the brick geometry.
+    '''
+    def __init__(self, bricknames, camera, expnum, ccdname, ccd_file, ccd_row,
+                 filenames, IB, IC, W=3600, H=3600, pixscale=0.262):
+        self.bricknames = np.asarray(bricknames)
+        self.camera = np.asarray(camera)
+        self.expnum = np.asarray(expnum)
+        self.ccdname = np.asarray(ccdname)
+        self.ccd_file = np.asarray(ccd_file)
+        self.ccd_row = np.asarray(ccd_row)
+        self.filenames = list(filenames)
+        self.W = W
+        self.H = H
+        self.pixscale = pixscale
+        nb = len(self.bricknames)
+        nc = len(self.expnum)
+        IB = np.asarray(IB, np.int64)
+        IC = np.asarray(IC, np.int64)
+        I = np.lexsort((IC, IB))
+        self.brick_ccds = IC[I].astype(np.int32)
+        self.brick_offset = _offsets(IB[I], nb)
+        I = np.lexsort((IB, IC))
+        self.ccd_bricks = IB[I].astype(np.int32)
+        self.ccd_offset = _offsets(IC[I], nc)
+        self._brick_index = None
+        self._ccd_index = None
+
+    def __str__(self):
+        return 'BrickCcdOverlaps(%i bricks, %i CCDs, %i overlaps)' % (
+            len(self.bricknames), len(self.expnum), len(self.brick_ccds))
+
+    def pairs(self):
+        '''
+        Returns (IB, IC), index arrays of all the overlapping (brick,
+        CCD) pairs, sorted by brick.
+        '''
+        IB = np.repeat(np.arange(len(self.bricknames)), np.diff(self.brick_offset))
+        return IB, self.brick_ccds.astype(int)
+
+    def brick_index(self, brickname):
+        '''
+        Returns the index of brick *brickname*, or None if it is not
+        in this set.
+        '''
+        if self._brick_index is None:
+            self._brick_index = dict([(b,i) for i,b in enumerate(self.bricknames)])
+        return self._brick_index.get(brickname)
+
+    def ccd_index(self, camera, expnum, ccdname):
+        '''
+        Returns the index of the given CCD, or None.
+        '''
+        if self._ccd_index is None:
+            self._ccd_index = dict([(k,i) for i,k in enumerate(
+                zip(self.camera, self.expnum, self.ccdname))])
+        return self._ccd_index.get((camera.strip(), expnum, ccdname.strip()))
+
+    def match_ccds(self, ccds):
+        '''
+        Returns, for each row of CCDs table *ccds*, the index of that
+        CCD here, or -1.
+        '''
+        I = [self.ccd_index(c, e, n) for c,e,n in zip(ccds.camera, ccds.expnum, ccds.ccdname)]
+        return np.array([-1 if i is None else i for i in I], int)
+
+    def match_bricks(self, bricks):
+        '''
+        Returns, for each row of bricks table *bricks*, the index of that
+        brick here, or -1.
+        '''
+        I = [self.brick_index(b) for b in bricks.brickname]
+        return np.array([-1 if i is None else i for i in I], int)
+
+    def ccds_for_brick(self, brickname):
+        '''
+        Returns the indices of the CCDs overlapping brick *brickname*, or
+        None if the brick is not in this set.
+        '''
+        i = self.brick_index(brickname)
+        if i is None:
+            return None
+        return self.brick_ccds[self.brick_offset[i]:self.brick_offset[i+1]].astype(int)
+
+    def bricks_for_ccd(self, i):
+        '''
+        Returns the indices of the bricks overlapped by CCD index *i*.
+        '''
+        return self.ccd_bricks[self.ccd_offset[i]:self.ccd_offset[i+1]].astype(int)
+
+    def writeto(self, fn):
+        import fitsio
+        hdr = fitsio.FITSHDR()
+        hdr.add_record(dict(name='BRICK_W', value=self.W, comment='Brick width (pixels)'))
+        hdr.add_record(dict(name='BRICK_H', value=self.H, comment='Brick height (pixels)'))
+        hdr.add_record(dict(name='PIXSCALE', value=self.pixscale,
+                            comment='Brick pixel scale (arcsec/pixel)'))
+        hdr.add_record(dict(name='NCCDFN', value=len(self.filenames),
+                            comment='Number of CCDs-table files'))
+        for i,f in enumerate(self.filenames):
+            hdr.add_record(dict(name='CCDFN%i' % i, value=f))
+        tmpfn = os.path.join(os.path.dirname(fn), 'tmp-' + os.path.basename(fn))
+        with fitsio.FITS(tmpfn, 'rw', clobber=True) as F:
+            F.write([self.bricknames.astype('S'), self.brick_offset[:-1]],
+                    names=['brickname', 'ccd_offset'], header=hdr, extname='BRICKS')
+            F.write([self.camera.astype('S'), self.expnum, self.ccdname.astype('S'),
+                     self.ccd_file, self.ccd_row, self.ccd_offset[:-1]],
+                    names=['camera', 'expnum', 'ccdname', 'ccd_file', 'ccd_row',
+                           'brick_offset'], extname='CCDS')
+            F.write([self.brick_ccds], names=['ccd'], extname='BRICK_CCDS')
+            F.write([self.ccd_bricks], names=['brick'], extname='CCD_BRICKS')
+        os.rename(tmpfn, fn)
+
+    @staticmethod
+    def read(fn):
+        import fitsio
+        with fitsio.FITS(fn) as F:
+            hdr = F['BRICKS'].read_header()
+            B = F['BRICKS'].read()
+            C = F['CCDS'].read()
+            bc = F['BRICK_CCDS'].read()['ccd']
+            cb = F['CCD_BRICKS'].read()['brick']
+        filenames = [hdr['CCDFN%i' % i] for i in range(hdr['NCCDFN'])]
+        ov = BrickCcdOverlaps.__new__(BrickCcdOverlaps)
+        ov.bricknames = _strings(B['brickname'])
+        ov.camera = _strings(C['camera'])
+        ov.expnum = C['expnum']
+        ov.ccdname = _strings(C['ccdname'])
+        ov.ccd_file = C['ccd_file']
+        ov.ccd_row = C['ccd_row']
+        ov.filenames = filenames
+        ov.W = hdr['BRICK_W']
+        ov.H = hdr['BRICK_H']
+        ov.pixscale = hdr['PIXSCALE']
+        # (the offset arrays are stored without their final element)
+        ov.brick_ccds = bc
+        ov.brick_offset = np.append(B['ccd_offset'], len(bc))
+        ov.ccd_bricks = cb
+        ov.ccd_offset = np.append(C['brick_offset'], len(cb))
+        ov._brick_index = None
+        ov._ccd_index = None
+        return ov
+
+# Per-process cache for read_overlaps: filename -> BrickCcdOverlaps
+_overlaps_cache = {}
+
+def read_overlaps(fn):
+    '''
+    Returns the BrickCcdOverlaps in file *fn*, read once per process
+    (LegacySurveyData objects are pickled without it, eg, to the workers
+    of depthcut.py).
+    '''
+    ov = _overlaps_cache.get(fn)
+    if ov is None:
+        debug('Reading brick-CCD overlaps from', fn)
+        ov = BrickCcdOverlaps.read(fn)
+        _overlaps_cache[fn] = ov
+    return ov
+
+def _offsets(I, n):
+    # Offsets (length n+1) of the runs of each value 0..n-1 in sorted array I.
+    return np.searchsorted(I, np.arange(n+1)).astype(np.int64)
+
+def _strings(a):
+    return np.array([s.decode() if isinstance(s, bytes) else s for s in a]).astype(str)
+
+def _stripe_ccds(fp, ralo, rahi, pad):
+    '''
+    Returns the indices of the CCD footprints *fp* that may come
+    within *pad* degrees of the RA range [*ralo*, *rahi*].
+    '''
+    rad = np.deg2rad(np.minimum(fp.cap_radius + pad, 90.))
+    x = np.sin(rad) / np.maximum(np.cos(np.deg2rad(fp.cap_dec)), 1e-12)
+    dra = np.rad2deg(np.arcsin(np.minimum(x, 1.)))
+    # RA distance from the stripe
+    mid = (ralo + rahi) / 2.
+    d = np.abs((fp.cap_ra - mid + 180.) % 360. - 180.) - (rahi - ralo) / 2.
+    return np.flatnonzero((x >= 1.) | (d <= dra))
+
+def compute_overlaps(bricks, fp, W=3600, H=3600, pixscale=0.262,
+                     stripe_width=5., nprocs=1):
+    '''
+    Finds the overlapping (brick, CCD) pairs of the *bricks* table and
+    CcdFootprints *fp*, in parallel RA stripes of *stripe_width* degrees.
+
+    Returns (IB, IC) index arrays.
+    '''
+    from legacypipe.utils import fork_map
+    s = pixscale / 3600.
+    brad = np.rad2deg(np.arctan(np.deg2rad(np.hypot(W/2., H/2.) * s)))
+    stripe = np.floor((bricks.ra % 360.) / stripe_width).astype(int)
+    stripes = np.unique(stripe)
+
+    def one_stripe(k):
+        J = np.flatnonzero(stripe == k)
+        I = _stripe_ccds(fp, k * stripe_width, (k+1) * stripe_width, brad)
+        if len(I) == 0:
+            return np.zeros(0, int), np.zeros(0, int)
+        ib,ic = fp[I].touching_bricks(bricks[J], W=W, H=H, pixscale=pixscale)
+        debug('RA stripe', k * stripe_width, ':', len(J), 'bricks,', len(I), 'nearby CCDs,',
+              len(ib), 'overlaps')
+        return J[ib], I[ic]
+
+    if nprocs > 1:
+        R = fork_map(one_stripe, [(k,) for k in stripes], nprocs)
+    else:
+        R = [one_stripe(k) for k in stripes]
+    if len(R) == 0:
+        return np.zeros(0, int), np.zeros(0, int)
+    IB = np.hstack([ib for ib,_ in R])
+    IC = np.hstack([ic for _,ic in R])
+    return IB, IC
+
+def read_ccd_footprints(fns):
+    '''
+    Reads the CCD identifiers and footprints from CCDs-table files
+    *fns* (kd-tree files, using their stored footprints if present).
+
+    Returns (ccds, footprints), where *ccds* is a table with camera,
+    expnum, ccdname, ccd_file and ccd_row columns.
+    '''
+    from astrometry.util.fits import fits_table, merge_tables
+    from legacypipe.ccdfootprints import CcdFootprints, read_footprints
+    TT = []
+    FP = []
+    wcscols = ['crval1', 'crval2', 'crpix1', 'crpix2',
+               'cd1_1', 'cd1_2', 'cd2_1', 'cd2_2', 'width', 'height']
+    for i,fn in enumerate(fns):
+        fp = None
+        if fn.endswith('.kd.fits'):
+            fp = read_footprints(fn)
+        cols = ['camera', 'expnum', 'ccdname']
+        if fp is None:
+            cols += wcscols
+        T = fits_table(fn, columns=cols)
+        info('Read', len(T), 'CCDs from', fn)
+        if fp is None:
+            fp = CcdFootprints.from_ccds(T)
+            for c in wcscols:
+                T.delete_column(c)
+        T.camera = np.array([c.strip() for c in T.camera])
+        T.ccdname = np.array([c.strip() for c in T.ccdname])
+        T.ccd_file = np.zeros(len(T), np.int16) + i
+        T.ccd_row = np.arange(len(T))
+        TT.append(T)
+        FP.append(fp)
+    return merge_tables(TT), CcdFootprints.concatenate(FP)
+
+def main():
+    import argparse
+    from astrometry.util.fits import fits_table
+    from legacypipe.survey import LegacySurveyData
+    parser = argparse.ArgumentParser(description='Compute the brick <-> CCD overlaps of a data release.')
+    parser.add_argument('--survey-dir', help='Override $LEGACY_SURVEY_DIR')
+    parser.add_argument('--bricks', help='Bricks table; default the survey\'s')
+    parser.add_argument('-o', '--out', help='Output filename; default survey-brick-ccd-overlaps.fits in the survey directory')
+    parser.add_argument('--threads', type=int, default=1, help='Number of processes')
+    parser.add_argument('--stripe-width', type=float, default=5.,
+                        help='Width of RA stripes processed in parallel, in degrees')
+    parser.add_argument('--width', type=int, default=3600, help='Brick width in pixels')
+    parser.add_argument('--height', type=int, default=3600, help='Brick height in pixels')
+    parser.add_argument('--pixscale', type=float, default=0.262,
+                        help='Brick pixel scale in arcsec/pixel')
+    parser.add_argument('-v', '--verbose', dest='verbose', action='count',
+                        default=0, help='Make more verbose')
+    opt = parser.parse_args()
+
+    if opt.verbose:
+        lvl = logging.DEBUG
+    else:
+        lvl = logging.INFO
+    logging.basicConfig(level=lvl, format='%(message)s', stream=sys.stdout)
+
+    survey = LegacySurveyData(survey_dir=opt.survey_dir)
+    if opt.bricks is not None:
+        B = fits_table(opt.bricks)
+    else:
+        B = survey.get_bricks_readonly()
+    info(len(B), 'bricks')
+
+    fns = survey.filter_ccd_kd_files(survey.find_file('ccd-kds'))
+    if len(fns) == 0:
+        fns = survey.filter_ccds_files(sorted(survey.find_file('ccds')))
+    if len(fns) == 0:
+        raise RuntimeError('No survey-ccds files')
+    T,fp = read_ccd_footprints(fns)
+    info(len(T), 'CCDs')
+
+    IB,IC = compute_overlaps(B, fp, W=opt.width, H=opt.height, pixscale=opt.pixscale,
+                             stripe_width=opt.stripe_width, nprocs=opt.threads)
+    ov = BrickCcdOverlaps(B.brickname, T.camera, T.expnum, T.ccdname, T.ccd_file,
+                          T.ccd_row, [os.path.basename(fn) for fn in fns], IB, IC,
+                          W=opt.width, H=opt.height, pixscale=opt.pixscale)
+    info(ov)
+    outfn = opt.out
+    if outfn is None:
+        outfn = survey.find_file('brick-ccd-overlaps', use_cache=False)
+    ov.writeto(outfn)
+    info('Wrote', outfn)
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
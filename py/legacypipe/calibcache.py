@@ -0,0 +1,117 @@
+import os
+from collections import OrderedDict
+
+import numpy as np
+
+import logging
+logger = logging.getLogger('legacypipe.calibcache')
+def debug(*args):
+    from legacypipe.utils import log_debug
+    log_debug(logger, args)
+
+class CalibTableCache(object):
+    '''
+    A cache of merged (per-exposure) calibration tables -- the
+    "-splinesky.fits" and "-psfex.fits" files that contain one row per
+    CCD.
+
+    Without this, each LegacySurveyImage reads the whole merged file
+    and scans every row looking for its (expnum, ccdname); a DECam
+    exposure has ~60 CCDs, so the same file gets read and scanned
+    dozens of times per brick.  Here, each file is read once, indexed
+    by (expnum, ccdname), and kept in memory until evicted (least
+    recently used first) by the *max_files* / *max_bytes* limits.
+
+    Rows are returned as views into the cached table -- callers must
+    not modify the array values in-place.
+    '''
+    def __init__(self, max_files=64, max_bytes=1024*1024*1024):
+        self.max_files = max_files
+        self.max_bytes = max_bytes
+        # filename -> (stat key, table, index, nbytes)
+        self.tables = OrderedDict()
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.bytes_read = 0
+
+    def __str__(self):
+        return ('CalibTableCache: %i files (%.1f MB) cached; %i hits, %i misses, %i evictions, %.1f MB read' %
+                (len(self.tables), self.nbytes/1e6, self.hits, self.misses,
+                 self.evictions, self.bytes_read/1e6))
+
+    def clear(self):
+        self.tables.clear()
+        self.nbytes = 0
+
+    def get_table(self, fn):
+        '''
+        Returns (T, index) for the given merged calib file *fn*, where
+        *index* is a dict from (expnum, ccdname) to a list of row
+        numbers.  Re-reads the file if it has changed on disk since it
+        was cached.
+        '''
+        from astrometry.util.fits import fits_table
+        st = os.stat(fn)
+        key = (st.st_mtime, st.st_size)
+        cached = self.tables.get(fn)
+        if cached is not None:
+            ckey,T,index,nb = cached
+            if ckey == key:
+                self.hits += 1
+                self.tables.move_to_end(fn)
+                return T,index
+            # stale
+            del self.tables[fn]
+            self.nbytes -= nb
+
+        self.misses += 1
+        T = fits_table(fn)
+        self.bytes_read += st.st_size
+        index = {}
+        for i,(e,c) in enumerate(zip(T.expnum, T.ccdname)):
+            index.setdefault((int(e), c.strip()), []).append(i)
+        nb = sum([T.get(c).nbytes for c in T.get_columns()
+                  if isinstance(T.get(c), np.ndarray)])
+        self.tables[fn] = (key, T, index, nb)
+        self.nbytes += nb
+        self._evict()
+        debug(self)
+        return T,index
+
+    def get_rows(self, fn, expnum, ccdname):
+        '''
+        Returns (T, I): the (cached, shared) merged table from file
+        *fn* and the list of rows within it matching *expnum*,
+        *ccdname*.
+        '''
+        T,index = self.get_table(fn)
+        I = index.get((int(expnum), ccdname.strip()), [])
+        return T, I
+
+    def _evict(self):
+        # Always keep the most recently added table.
+        while len(self.tables) > 1 and (len(self.tables) > self.max_files or
+                                        self.nbytes > self.max_bytes):
+            fn,(_,_,_,nb) = self.tables.popitem(last=False)
+            self.nbytes -= nb
+            self.evictions += 1
+            debug('Evicting', fn, 'from calib cache')
+
+# singleton
+calib_cache = None
+def get_calib_cache():
+    '''
+    Returns the process-wide CalibTableCache.  Its size limits can be
+    set via the $LEGACYPIPE_CALIB_CACHE_FILES and
+    $LEGACYPIPE_CALIB_CACHE_MB environment variables.
+    '''
+    global calib_cache
+    if calib_cache is not None:
+        return calib_cache
+    nfiles = int(os.environ.get('LEGACYPIPE_CALIB_CACHE_FILES', 64))
+    mb = float(os.environ.get('LEGACYPIPE_CALIB_CACHE_MB', 1024))
+    calib_cache = CalibTableCache(max_files=nfiles,
+                                  max_bytes=int(mb * 1024 * 1024))
+    return calib_cache
@@ -0,0 +1,252 @@
+'''
+Sky footprints of CCDs -- each CCD's four corners, and a bounding cap
+(a circle on the sky containing them) -- for fast "which CCDs overlap
+this region" queries.
+
+create_kdtrees.py appends them to the survey-ccds-*.kd.fits files, as
+a table extension named "ccd_footprints" with one row per row of the
+kd-tree's CCDs table.  LegacySurveyData.ccds_touching_wcs uses them to
+test the CCDs near a region before reading their rows, and
+LegacySurveyData.ccds_touching_bricks answers the question for many
+bricks at once.  Instead of building a Tan WCS and corner polygon per
+CCD in Python, the footprints are projected into the region's pixel
+space and tested against it with vectorized separating-axis tests
+(both are convex quadrilaterals).
+'''
+
+import numpy as np
+
+import logging
+logger = logging.getLogger('legacypipe.ccdfootprints')
+def info(*args):
+    from legacypipe.utils import log_info
+    log_info(logger, args)
+def debug(*args):
+    from legacypipe.utils import log_debug
+    log_debug(logger, args)
+
+footprint_ext = 'ccd_footprints'
+_columns = ['corner_ra', 'corner_dec', 'cap_ra', 'cap_dec', 'cap_radius']
+
+def radec_to_xyz(ra, dec):
+    '''
+    Returns unit vectors, shape ra.shape + (3,), for *ra*, *dec* in degrees.
+    '''
+    ra = np.deg2rad(ra)
+    dec = np.deg2rad(dec)
+    cd = np.cos(dec)
+    return np.stack([cd * np.cos(ra), cd * np.sin(ra), np.sin(dec)], axis=-1)
+
+def xyz_to_radec(xyz):
+    '''
+    Returns RA,Dec in degrees of (not necessarily unit) vectors *xyz*
+    (last axis).
+    '''
+    x,y,z = xyz[...,0], xyz[...,1], xyz[...,2]
+    ra = np.rad2deg(np.arctan2(y, x)) % 360.
+    dec = np.rad2deg(np.arctan2(z, np.hypot(x, y)))
+    return ra, dec
+
+def _tangent_basis(ra, dec):
+    # Unit vectors of the tangent point, and East and North there.
+    r = radec_to_xyz(ra, dec)
+    ra = np.deg2rad(ra)
+    dec = np.deg2rad(dec)
+    e = np.stack([-np.sin(ra), np.cos(ra), np.zeros_like(ra)], axis=-1)
+    n = np.stack([-np.sin(dec) * np.cos(ra), -np.sin(dec) * np.sin(ra),
+                  np.cos(dec)], axis=-1)
+    return r, e, n
+
+def ccd_corners(ccds):
+    '''
+    Returns RA,Dec arrays, shape (N,4), of the outer corners of the
+    CCDs in table *ccds* (with TAN WCS columns crval1,crval2,
+    crpix1,crpix2, cd1_1,cd1_2,cd2_1,cd2_2, width,height): pixels (0.5,0.5),
+    (W+0.5,0.5), (W+0.5,H+0.5), (0.5,H+0.5), as in ccds_touching_wcs.
+    '''
+    W = np.asarray(ccds.width, float)[:,np.newaxis]
+    H = np.asarray(ccds.height, float)[:,np.newaxis]
+    lo = 0.5 + np.zeros_like(W)
+    px = np.hstack([lo, W+0.5, W+0.5, lo])
+    py = np.hstack([lo, lo, H+0.5, H+0.5])
+    col = lambda c: np.asarray(c, float)[:,np.newaxis]
+    dx = px - col(ccds.crpix1)
+    dy = py - col(ccds.crpix2)
+    xi  = np.deg2rad(col(ccds.cd1_1) * dx + col(ccds.cd1_2) * dy)
+    eta = np.deg2rad(col(ccds.cd2_1) * dx + col(ccds.cd2_2) * dy)
+    r,e,n = _tangent_basis(np.asarray(ccds.crval1, float),
+                           np.asarray(ccds.crval2, float))
+    p = (r[:,np.newaxis,:] + xi[:,:,np.newaxis] * e[:,np.newaxis,:] +
+         eta[:,:,np.newaxis] * n[:,np.newaxis,:])
+    return xyz_to_radec(p)
+
+def _bounding_caps(cr, cd):
+    xyz = radec_to_xyz(cr, cd)
+    c = xyz.sum(axis=1)
+    c /= np.linalg.norm(c, axis=1)[:,np.newaxis]
+    cosd = np.clip(np.sum(xyz * c[:,np.newaxis,:], axis=2), -1., 1.)
+    # (plus a little, for roundoff)
+    rad = np.rad2deg(np.arccos(cosd.min(axis=1))) + 1e-9
+    ra,dec = xyz_to_radec(c)
+    return ra, dec, rad
+
+def read_footprints(fn, rows=None):
+    '''
+    Returns the CcdFootprints stored in (kd-tree) file *fn*, for the
+    given *rows* (default all), or None if it has none.
+    '''
+    import fitsio
+    with fitsio.FITS(fn) as F:
+        if not footprint_ext in F:
+            return None
+        if rows is not None and len(rows) == 0:
+            return CcdFootprints(np.zeros((0,4)), np.zeros((0,4)), np.zeros(0),
+                                 np.zeros(0), np.zeros(0))
+        d = F[footprint_ext].read(rows=rows)
+    return CcdFootprints(*[d[c] for c in _columns])
+
+def write_footprints(fn, ccds):
+    '''
+    Appends the footprints of the CCDs in table *ccds* to FITS file
+    *fn* (eg, a kd-tree file whose CCD table is *ccds*).
+    '''
+    import fitsio
+    fp = CcdFootprints.from_ccds(ccds)
+    fitsio.write(fn, [getattr(fp, c) for c in _columns], names=_columns,
+                 extname=footprint_ext)
+
+def convex_polygons_overlap(ax, ay, bx, by):
+    '''
+    Separating-axis test for pairs of convex polygons, with vertex
+    coordinates *ax*, *ay* (shape (N, na), in order) and *bx*, *by*
+    (shape (N, nb), or (nb,) for the same polygon in every pair).
+    Returns a boolean array, shape (N,): does each pair overlap?
+    '''
+    ax = np.asarray(ax, float)
+    ay = np.asarray(ay, float)
+    bx = np.broadcast_to(bx, (ax.shape[0],) + np.shape(bx)[-1:])
+    by = np.broadcast_to(by, bx.shape)
+    overlap = np.ones(ax.shape[0], bool)
+    for px,py in [(ax,ay), (bx,by)]:
+        # edge normals
+        nx = -(np.roll(py, -1, axis=1) - py)
+        ny =  (np.roll(px, -1, axis=1) - px)
+        pa = ax[:,np.newaxis,:] * nx[:,:,np.newaxis] + ay[:,np.newaxis,:] * ny[:,:,np.newaxis]
+        pb = bx[:,np.newaxis,:] * nx[:,:,np.newaxis] + by[:,np.newaxis,:] * ny[:,:,np.newaxis]
+        sep = ((pa.max(axis=2) < pb.min(axis=2)) | (pb.max(axis=2) < pa.min(axis=2)))
+        overlap &= np.logical_not(np.any(sep, axis=1))
+    return overlap
+
+class CcdFootprints(object):
+    '''
+    The footprints of a set of CCDs: *corner_ra*, *corner_dec* (shape
+    (N,4), degrees; see ccd_corners) and bounding caps *cap_ra*,
+    *cap_dec*, *cap_radius* (degrees); see the module docstring.
+    '''
+    def __init__(self, corner_ra, corner_dec, cap_ra, cap_dec, cap_radius):
+        self.corner_ra = np.asarray(corner_ra, float).reshape(-1,4)
+        self.corner_dec = np.asarray(corner_dec, float).reshape(-1,4)
+        self.cap_ra = np.asarray(cap_ra, float)
+        self.cap_dec = np.asarray(cap_dec, float)
+        self.cap_radius = np.asarray(cap_radius, float)
+        self.cap_xyz = radec_to_xyz(self.cap_ra, self.cap_dec)
+
+    @staticmethod
+    def from_ccds(ccds):
+        '''
+        Computes the footprints of the CCDs in table *ccds*.
+        '''
+        cr,cd = ccd_corners(ccds)
+        return CcdFootprints(cr, cd, *_bounding_caps(cr, cd))
+
+    def __len__(self):
+        return len(self.cap_ra)
+
+    def __getitem__(self, I):
+        return CcdFootprints(self.corner_ra[I], self.corner_dec[I], self.cap_ra[I],
+                             self.cap_dec[I], self.cap_radius[I])
+
+    @staticmethod
+    def concatenate(fps):
+        return CcdFootprints(*[np.concatenate([getattr(f, c) for f in fps])
+                               for c in _columns])
+
+    def near(self, ra, dec, radius):
+        '''
+        Returns the indices of the CCDs whose bounding caps come within
+        *radius* degrees of *ra*, *dec*.
+        '''
+        c = radec_to_xyz(ra, dec)
+        cosd = self.cap_xyz.dot(c)
+        return np.flatnonzero(cosd > np.cos(np.deg2rad(np.minimum(radius + self.cap_radius, 180.))))
+
+    def touching_wcs(self, wcs, polygons=True):
+        '''
+        Returns the indices of the CCDs overlapping the image described
+        by *wcs* (an astrometry.net Tan or similar); as the function
+        legacypipe.survey.ccds_touching_wcs.  If not *polygons*, just
+        tests the bounding caps.
+        '''
+        r,d = wcs.radec_center()
+        I = self.near(r, d, wcs.radius())
+        if not polygons or len(I) == 0:
+            return I
+        _,x,y = wcs.radec2pixelxy(self.corner_ra[I].ravel(), self.corner_dec[I].ravel())
+        x = np.reshape(x, (len(I), 4))
+        y = np.reshape(y, (len(I), 4))
+        tw,th = wcs.get_width(), wcs.get_height()
+        keep = convex_polygons_overlap(x, y, np.array([0.5, tw+0.5, tw+0.5, 0.5]),
+                                       np.array([0.5, 0.5, th+0.5, th+0.5]))
+        return I[keep]
+
+    def touching_bricks(self, bricks, W=3600, H=3600, pixscale=0.262,
+                        chunk=10000):
+        '''
+        Finds the CCDs overlapping each of many bricks, as
+        touching_wcs(wcs_for_brick(brick, W, H, pixscale)) would.
+
+        *bricks*: table (or object) with *ra*, *dec* arrays of brick centers.
+
+        Returns (IB, IC): index arrays of the overlapping (brick, CCD)
+        pairs, sorted by brick.
+        '''
+        from astrometry.libkd.spherematch import match_radec
+        bra = np.atleast_1d(np.asarray(bricks.ra, float))
+        bdec = np.atleast_1d(np.asarray(bricks.dec, float))
+        s = pixscale / 3600.
+        # brick radius: center to corner pixel
+        brad = np.rad2deg(np.arctan(np.deg2rad(np.hypot(W/2., H/2.) * s)))
+        IB,IC = [],[]
+        if len(self) == 0:
+            return np.zeros(0, int), np.zeros(0, int)
+        maxrad = brad + self.cap_radius.max()
+        for j in range(0, len(bra), chunk):
+            ib,ic,_ = match_radec(bra[j:j+chunk], bdec[j:j+chunk],
+                                  self.cap_ra, self.cap_dec, maxrad)
+            ib = np.atleast_1d(ib) + j
+            ic = np.atleast_1d(ic)
+            if len(ib) == 0:
+                continue
+            r,e,n = _tangent_basis(bra[ib], bdec[ib])
+            # bounding caps
+            keep = np.sum(r * self.cap_xyz[ic], axis=1) > np.cos(np.deg2rad(
+                np.minimum(brad + self.cap_radius[ic], 180.)))
+            ib,ic,r,e,n = ib[keep],ic[keep],r[keep],e[keep],n[keep]
+            # project the CCD corners into the brick's pixel space
+            p = radec_to_xyz(self.corner_ra[ic], self.corner_dec[ic])
+            pr = np.sum(p * r[:,np.newaxis,:], axis=2)
+            xi  = np.rad2deg(np.sum(p * e[:,np.newaxis,:], axis=2) / pr)
+            eta = np.rad2deg(np.sum(p * n[:,np.newaxis,:], axis=2) / pr)
+            x = (W/2. + 0.5) - xi / s
+            y = (H/2. + 0.5) + eta / s
+            keep = (np.all(pr > 0, axis=1) *
+                    convex_polygons_overlap(x, y, np.array([0.5, W+0.5, W+0.5, 0.5]),
+                                            np.array([0.5, 0.5, H+0.5, H+0.5])))
+            IB.append(ib[keep])
+            IC.append(ic[keep])
+        if len(IB) == 0:
+            return np.zeros(0, int), np.zeros(0, int)
+        IB = np.hstack(IB)
+        IC = np.hstack(IC)
+        I = np.lexsort((IC, IB))
+        return IB[I], IC[I]
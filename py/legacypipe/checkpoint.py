@@ -0,0 +1,187 @@
+'''
+Append-only checkpoint files for the fitblobs stage (and farm.py).
+
+Checkpoint files used to be a single pickled list of per-blob result
+dicts, {brickname, iblob, result}, re-written in full at each
+checkpoint -- so the cost of writing a checkpoint grew with the number
+of blobs done.  The log format here is a header followed by
+length-prefixed pickled records, one per blob, so that writing a
+checkpoint only appends the results that finished since the last one.
+The file is re-written in full ("compacted") only when the set of
+records changes otherwise (eg, when stale results are dropped on
+restart).
+
+A truncated final record (eg, if we were killed while appending) is
+ignored on reading and chopped off before appending.
+
+read_checkpoint() reads both formats.
+'''
+
+import os
+import pickle
+import struct
+
+import logging
+logger = logging.getLogger('legacypipe.checkpoint')
+def info(*args):
+    from legacypipe.utils import log_info
+    log_info(logger, args)
+def debug(*args):
+    from legacypipe.utils import log_debug
+    log_debug(logger, args)
+
+magic = b'LPCKLOG1'
+_length = struct.Struct('<Q')
+
+def is_checkpoint_log(fn):
+    with open(fn, 'rb') as f:
+        return f.read(len(magic)) == magic
+
+def iter_checkpoint_log(f):
+    '''
+    Yields (record, end offset) for the records in open file *f*,
+    positioned just after the header; stops at a truncated record.
+    '''
+    while True:
+        hdr = f.read(_length.size)
+        if len(hdr) < _length.size:
+            return
+        n, = _length.unpack(hdr)
+        data = f.read(n)
+        if len(data) < n:
+            return
+        yield pickle.loads(data), f.tell()
+
+def iter_checkpoint(fn):
+    '''
+    Yields the records in checkpoint file *fn*, streaming them one at
+    a time if it is in the log format.
+    '''
+    if not is_checkpoint_log(fn):
+        from astrometry.util.file import unpickle_from_file
+        for r in unpickle_from_file(fn):
+            yield r
+        return
+    with open(fn, 'rb') as f:
+        f.seek(len(magic))
+        for r,_ in iter_checkpoint_log(f):
+            yield r
+
+def read_checkpoint(fn):
+    '''
+    Returns the list of records in checkpoint file *fn* (in either the
+    log format or the old pickled-list format).
+    '''
+    return list(iter_checkpoint(fn))
+
+class CheckpointLog(object):
+    '''
+    An append-only checkpoint file.  Typical use:
+
+        ckpt = CheckpointLog(fn)
+        R = ckpt.read()   # (if the file exists)
+        ...
+        ckpt.update(R)    # appends any records added to R since the last call
+
+    *update* assumes that *R* is only ever appended to; if records have
+    been removed from it, the file is compacted (re-written with
+    exactly *R*).
+    '''
+    def __init__(self, filename):
+        self.filename = filename
+        # Number of records in the file, or None if unknown (eg, old format)
+        self.nrecords = None
+        # The last record written (or read), to check that the records
+        # before it have not been changed.
+        self.last = None
+        # Offset of the end of the last complete record
+        self.good_end = None
+        self.f = None
+
+    def read(self):
+        '''
+        Reads and returns the list of records.
+        '''
+        self.close()
+        if not is_checkpoint_log(self.filename):
+            from astrometry.util.file import unpickle_from_file
+            R = unpickle_from_file(self.filename)
+            self.nrecords = self.good_end = None
+            return R
+        R = []
+        end = len(magic)
+        with open(self.filename, 'rb') as f:
+            f.seek(end)
+            for r,end in iter_checkpoint_log(f):
+                R.append(r)
+        self.nrecords = len(R)
+        self.good_end = end
+        self.last = R[-1] if len(R) else None
+        return R
+
+    def write(self, R):
+        '''
+        Compaction: (re-)writes the file with exactly the records in *R*.
+        '''
+        from astrometry.util.file import trymakedirs
+        self.close()
+        d = os.path.dirname(self.filename)
+        if len(d) and not os.path.exists(d):
+            trymakedirs(d)
+        fn = self.filename + '.tmp'
+        with open(fn, 'wb') as f:
+            f.write(magic)
+            for r in R:
+                self._write_record(f, r)
+            end = f.tell()
+        os.rename(fn, self.filename)
+        self.nrecords = len(R)
+        self.good_end = end
+        self.last = R[-1] if len(R) else None
+        debug('Wrote checkpoint to', self.filename, ':', len(R), 'records')
+
+    def append(self, records):
+        '''
+        Appends the given records to the file.
+        '''
+        if self.nrecords is None or not os.path.exists(self.filename):
+            raise RuntimeError('CheckpointLog: must read() or write() %s before appending'
+                               % self.filename)
+        if self.f is None:
+            self.f = open(self.filename, 'r+b')
+            # Drop any truncated record at the end.
+            self.f.truncate(self.good_end)
+            self.f.seek(self.good_end)
+        for r in records:
+            self._write_record(self.f, r)
+        self.f.flush()
+        self.nrecords += len(records)
+        if len(records):
+            self.last = records[-1]
+        self.good_end = self.f.tell()
+        debug('Appended', len(records), 'records to checkpoint', self.filename)
+
+    def update(self, R):
+        '''
+        Makes the file contain the records in list *R*, appending those
+        past the number already written, or compacting if that's not
+        possible (including when records have been dropped from *R*:
+        then the last record written is no longer in its place).
+        '''
+        if (self.nrecords is None or len(R) < self.nrecords or
+            not os.path.exists(self.filename) or
+            (self.nrecords > 0 and R[self.nrecords-1] is not self.last)):
+            self.write(R)
+        elif len(R) > self.nrecords:
+            self.append(R[self.nrecords:])
+
+    def close(self):
+        if self.f is not None:
+            self.f.close()
+            self.f = None
+
+    @staticmethod
+    def _write_record(f, r):
+        data = pickle.dumps(r, -1)
+        f.write(_length.pack(len(data)))
+        f.write(data)
@@ -1,9 +1,12 @@
+import os
+
 import numpy as np
 import fitsio
 from astrometry.util.fits import fits_table
 from astrometry.util.resample import resample_with_wcs, OverlapError
 from legacypipe.bits import DQ_BITS
 from legacypipe.survey import tim_get_resamp
+from legacypipe.resampcache import resample_tim
 from legacypipe.utils import copy_header_with_wcs
 
 import logging
@@ -213,7 +216,16 @@ def make_coadds(tims, bands, targetwcs,
                 callback=None, callback_args=None,
                 plots=False, ps=None,
                 lanczos=True, mp=None,
-                satur_val=10.):
+                satur_val=10.,
+                nprocs=0, max_partial_bytes=None):
+    # With *nprocs* > 1, each band's tims are resampled and accumulated
+    # in that many forked processes, each into its own partial set of
+    # coadd maps for a run of consecutive tims, which are merged here
+    # in tim order (see _CoaddPartial).  The integer, mask, MJD and max
+    # maps are identical to the serial ones; the floating-point sums
+    # are added in a different order, so may differ by rounding.  The
+    # number of processes is limited so that the partial sets (the
+    # children's, plus the merged one) fit in *max_partial_bytes*.
     from astrometry.util.ttime import Time
     t0 = Time()
 
@@ -249,7 +261,7 @@ def make_coadds(tims, bands, targetwcs,
         C.allmasks = []
     if anymasks:
         C.anymasks = []
-    if max:
+    if get_max:
         C.maximgs = []
     if psf_images:
         C.psf_imgs = []
@@ -277,9 +289,24 @@ def make_coadds(tims, bands, targetwcs,
         # surface-brightness correction
         tim.sbscale = (targetwcs.pixel_scale() / tim.subwcs.pixel_scale())**2
 
+    partargs = dict(mods=(mods is not None), blobmods=(blobmods is not None),
+                    detmaps=detmaps, ngood=ngood,
+                    masks=bool(xy or allmasks or anymasks),
+                    nobs=bool(xy or allmasks), nsatur=bool(nsatur),
+                    psfsize=psfsize, psf_images=psf_images,
+                    maximg=get_max, mjds=bool(xy), satur_val=satur_val)
+    nchild = 0
+    if nprocs > 1 and not plots and hasattr(os, 'fork'):
+        nchild = nprocs
+        if max_partial_bytes is not None:
+            setbytes = H * W * _CoaddPartial(1, 1, **partargs).nbytes()
+            nchild = min(nchild, int(max_partial_bytes // setbytes) - 1)
+
     # We create one iterator per band to do the tim resampling.  These all run in
-    # parallel when multi-processing.
+    # parallel when multi-processing.  (Bands accumulated in forked
+    # processes get None.)
     imaps = []
+    bandargs = []
     for band in bands:
         args = []
         for itim,tim in enumerate(tims):
@@ -294,7 +321,10 @@ def make_coadds(tims, bands, targetwcs,
             else:
                 bmo = blobmods[itim]
             args.append((itim,tim,mo,bmo,lanczos,targetwcs,sbscale))
-        if mp is not None:
+        bandargs.append(args)
+        if min(nchild, len(args)) > 1:
+            imaps.append(None)
+        elif mp is not None:
             imaps.append(mp.imap_unordered(_resample_one, args))
         else:
             imaps.append(map(_resample_one, args))
@@ -319,238 +349,73 @@ def make_coadds(tims, bands, targetwcs,
     for iband,(band,timiter) in enumerate(zip(bands, imaps)):
         debug('Computing coadd for band', band)
 
-        # coadded weight map (moo)
-        cow    = np.zeros((H,W), np.float32)
-        # coadded weighted image map
-        cowimg = np.zeros((H,W), np.float32)
-
+        if xy:
+            part = _CoaddPartial(H, W, mjd_args=(mjd_argmins, mjd_argmaxs),
+                                 **partargs)
+        else:
+            part = _CoaddPartial(H, W, **partargs)
+        if timiter is None:
+            _fork_coadd_partials(part, bandargs[iband], tims, targetwcs,
+                                 partargs, (mjds if xy else None),
+                                 min(nchild, len(bandargs[iband])))
+        else:
+            plotargs = None
+            if plots:
+                plotargs = (band, mods, allresids, ps)
+            for R in timiter:
+                if R is None:
+                    continue
+                part.add(R, tims[R[0]], targetwcs,
+                         mjds=(mjds if xy else None), plotargs=plotargs)
+
+        maps = part.maps
+        cow    = maps['cow']
+        cowimg = maps['cowimg']
         kwargs = dict(cowimg=cowimg, cow=cow)
-
         if detmaps:
-            # detection map inverse-variance (depth map)
-            psfdetiv = np.zeros((H,W), np.float32)
+            psfdetiv = maps['psfdetiv']
             C.psfdetivs.append(psfdetiv)
             kwargs.update(psfdetiv=psfdetiv)
-            # galaxy detection map inverse-variance (galdepth map)
-            galdetiv = np.zeros((H,W), np.float32)
+            galdetiv = maps['galdetiv']
             C.galdetivs.append(galdetiv)
             kwargs.update(galdetiv=galdetiv)
-
         if mods is not None:
-            # model image
-            cowmod = np.zeros((H,W), np.float32)
-            # chi-squared image
-            cochi2 = np.zeros((H,W), np.float32)
+            cowmod = maps['cowmod']
+            cochi2 = maps['cochi2']
             kwargs.update(cowmod=cowmod, cochi2=cochi2)
-
         if blobmods is not None:
-            # model image
-            cowblobmod = np.zeros((H,W), np.float32)
+            cowblobmod = maps['cowblobmod']
             kwargs.update(cowblobmod=cowblobmod)
-
         if unweighted:
-            # unweighted image
-            coimg  = np.zeros((H,W), np.float32)
+            coimg = maps['coimg']
             if mods is not None:
-                # unweighted model
-                comod  = np.zeros((H,W), np.float32)
+                comod = maps['comod']
             if blobmods is not None:
-                coblobmod  = np.zeros((H,W), np.float32)
-            # number of exposures
-            con    = np.zeros((H,W), np.int16)
+                coblobmod = maps['coblobmod']
+            con = maps['con']
             kwargs.update(coimg=coimg)
-
-        # We have *three* counters for the number of pixels
-        # overlapping each coadd brick pixel:
-        #
-        # - "con" counts the pixels included in the unweighted coadds.
-        #   This map is not passed outside this function or used
-        #   anywhere else.
-        #
-        # - "congood" counts pixels with (iv > 0).  This gets passed
-        #   to the *write_coadd_images* function, where it gets
-        #   written to the *nexp* maps.
-        #
-        # - "nobs" counts all pixels, regardless of masks.  This gets
-        #   sampled at *xy* positions, and ends up in the tractor
-        #   catalog "nobs" column.
-        #
-        # (you want to know the number of observations within the
-        # source footprint, not just the peak pixel which may be
-        # saturated, etc.)
-
         if ngood:
-            congood = np.zeros((H,W), np.int16)
+            congood = maps['congood']
             kwargs.update(congood=congood)
-
         if xy or allmasks or anymasks:
-            # These match the type of the "DQ" images.
-            # "any" mask
-            ormask  = np.zeros((H,W), np.int16)
-            # "all" mask
-            andmask = np.empty((H,W), np.int16)
-            from functools import reduce
-            allbits = reduce(np.bitwise_or, DQ_BITS.values())
-            andmask[:,:] = allbits
+            ormask  = maps['ormask']
+            andmask = maps['andmask']
             kwargs.update(ormask=ormask, andmask=andmask)
         if xy or allmasks:
-            # number of observations
-            nobs = np.zeros((H,W), np.int16)
-
+            nobs = maps['nobs']
         if nsatur:
-            satmap = np.zeros((H,W), np.int16)
-
+            satmap = maps['satmap']
         if psfsize:
-            psfsizemap = np.zeros((H,W), np.float32)
-            # like "cow", but constant invvar per-CCD;
-            # only required for psfsizemap
-            flatcow = np.zeros((H,W), np.float32)
+            psfsizemap = maps['psfsizemap']
+            flatcow = maps['flatcow']
             kwargs.update(psfsize=psfsizemap)
-
-        if max:
-            maximg = np.zeros((H,W), np.float32)
+        if get_max:
+            maximg = maps['maximg']
             C.maximgs.append(maximg)
-
         if psf_images:
-            psf_img = 0.
+            psf_img = part.psf_img
+        del maps, part
 
-        for R in timiter:
-            if R is None:
-                continue
-            itim,Yo,Xo,iv,im,mo,bmo,dq = R
-            tim = tims[itim]
-
-            if plots:
-                _make_coadds_plots_1(im, band, mods, mo, iv, unweighted,
-                                     dq, satur_val, allresids, ps, H, W,
-                                     tim, Yo, Xo)
-            # invvar-weighted image
-            cowimg[Yo,Xo] += iv * im
-            cow   [Yo,Xo] += iv
-
-            goodpix = None
-            if unweighted:
-                if dq is None:
-                    goodpix = 1
-                else:
-                    # include SATUR pixels if no other pixels exists
-                    okbits = np.uint16(0)
-                    for bitname in ['satur']:
-                        okbits |= DQ_BITS[bitname]
-                    brightpix = ((dq & okbits) != 0)
-                    if satur_val is not None:
-                        # HACK -- force SATUR pix to be bright
-                        im[brightpix] = satur_val
-                    # Include these pixels if none other exist??
-                    for bitname in ['interp']:
-                        okbits |= DQ_BITS[bitname]
-                    goodpix = ((dq & ~okbits) == 0)
-
-                coimg[Yo,Xo] += goodpix * im
-                con  [Yo,Xo] += goodpix
-
-            if xy or allmasks or anymasks:
-                if dq is not None:
-                    ormask [Yo,Xo] |= dq
-                    andmask[Yo,Xo] &= dq
-            if xy or allmasks:
-                # raw exposure count
-                nobs[Yo,Xo] += 1
-            if xy:
-                # mjd_min/max
-                update = np.logical_or(mjd_argmins[Yo,Xo] == -1,
-                                       (mjd_argmins[Yo,Xo] > -1) *
-                                       (mjds[itim] < mjds[mjd_argmins[Yo,Xo]]))
-                mjd_argmins[Yo[update],Xo[update]] = itim
-                update = np.logical_or(mjd_argmaxs[Yo,Xo] == -1,
-                                       (mjd_argmaxs[Yo,Xo] > -1) *
-                                       (mjds[itim] > mjds[mjd_argmaxs[Yo,Xo]]))
-                mjd_argmaxs[Yo[update],Xo[update]] = itim
-                del update
-
-            if nsatur and dq is not None:
-                satmap[Yo,Xo] += (1*((dq & DQ_BITS['satur'])>0))
-
-            if psfsize:
-                # psfnorm is in units of 1/pixels.
-                # (eg, psfnorm for a gaussian is 1./(2.*sqrt(pi) * psf_sigma) )
-                # Neff is in pixels**2
-                neff = 1./tim.psfnorm**2
-                # Narcsec is in arcsec**2
-                narcsec = neff * tim.wcs.pixel_scale()**2
-                # Make smooth maps -- don't ignore CRs, saturated pix, etc
-                iv1 = 1./tim.sig1**2
-                psfsizemap[Yo,Xo] += iv1 * (1. / narcsec)
-                flatcow   [Yo,Xo] += iv1
-
-            if psf_images:
-                from astrometry.util.util import lanczos3_interpolate
-                h,w = tim.shape
-                patch = tim.psf.getPointSourcePatch(w//2, h//2).patch
-                patch /= np.sum(patch)
-                # In case the tim and coadd have different pixel scales,
-                # resample the PSF stamp.
-                ph,pw = patch.shape
-                pscale = tim.imobj.pixscale / targetwcs.pixel_scale()
-                coph = int(np.ceil(ph * pscale))
-                copw = int(np.ceil(pw * pscale))
-                coph = 2 * (coph//2) + 1
-                copw = 2 * (copw//2) + 1
-                # want input image pixel coords that change by 1/pscale
-                # and are centered on pw//2, ph//2
-                cox = np.arange(copw) * 1./pscale
-                cox += pw//2 - cox[copw//2]
-                coy = np.arange(coph) * 1./pscale
-                coy += ph//2 - coy[coph//2]
-                fx,fy = np.meshgrid(cox,coy)
-                fx = fx.ravel()
-                fy = fy.ravel()
-                ix = (fx + 0.5).astype(np.int32)
-                iy = (fy + 0.5).astype(np.int32)
-                dx = (fx - ix).astype(np.float32)
-                dy = (fy - iy).astype(np.float32)
-                copsf = np.zeros(coph*copw, np.float32)
-                lanczos3_interpolate(ix, iy, dx, dy, [copsf], [patch])
-                copsf = copsf.reshape((coph,copw))
-                copsf /= copsf.sum()
-                if plots:
-                    _make_coadds_plots_2(patch, copsf, psf_img, tim, band, ps)
-
-                psf_img += copsf / tim.sig1**2
-
-            if detmaps:
-                # point-source depth
-                detsig1 = tim.sig1 / tim.psfnorm
-                psfdetiv[Yo,Xo] += (iv > 0) * (1. / detsig1**2)
-                # Galaxy detection map
-                gdetsig1 = tim.sig1 / tim.galnorm
-                galdetiv[Yo,Xo] += (iv > 0) * (1. / gdetsig1**2)
-
-            if ngood:
-                congood[Yo,Xo] += (iv > 0)
-
-            if mods is not None:
-                # straight-up
-                comod[Yo,Xo] += goodpix * mo
-                # invvar-weighted
-                cowmod[Yo,Xo] += iv * mo
-                # chi-squared
-                cochi2[Yo,Xo] += iv * (im - mo)**2
-                del mo
-
-            if blobmods is not None:
-                # straight-up
-                coblobmod[Yo,Xo] += goodpix * bmo
-                # invvar-weighted
-                cowblobmod[Yo,Xo] += iv * bmo
-                del bmo
-            del goodpix
-
-            if max:
-                maximg[Yo,Xo] = np.maximum(maximg[Yo,Xo], im * (iv>0))
-
-            del Yo,Xo,im,iv
-            # END of loop over tims
         # Per-band:
         cowimg /= np.maximum(cow, tinyw)
         C.coimgs.append(cowimg)
@@ -728,6 +593,321 @@ def make_coadds(tims, bands, targetwcs,
 
     return C
 
+class _CoaddPartial(object):
+    '''
+    The per-band accumulator maps of make_coadds, for some set of tims.
+    Partials for disjoint sets of tims can be merged: the maps are
+    sums, bitwise-ors or -ands, or maxima over tims, plus the
+    per-pixel indices of the earliest and latest tims.
+
+    *mjd_args*: (argmin, argmax) int16 maps of tim indices to update,
+    shared between bands; by default, new ones if *mjds*.
+    '''
+    def __init__(self, H, W, mods=False, blobmods=False, detmaps=False,
+                 ngood=False, masks=False, nobs=False, nsatur=False,
+                 psfsize=False, psf_images=False, maximg=False, mjds=False,
+                 mjd_args=None, satur_val=10.):
+        self.mods = mods
+        self.blobmods = blobmods
+        self.detmaps = detmaps
+        self.ngood = ngood
+        self.masks = masks
+        self.nobs = nobs
+        self.nsatur = nsatur
+        self.psfsize = psfsize
+        self.psf_images = psf_images
+        self.maximg = maximg
+        self.satur_val = satur_val
+        self.psf_img = 0.
+        f = lambda: np.zeros((H,W), np.float32)
+        i = lambda: np.zeros((H,W), np.int16)
+        # coadded weight map (moo), and invvar-weighted image
+        maps = dict(cow=f(), cowimg=f())
+        if detmaps:
+            # detection map inverse-variances (depth maps)
+            maps.update(psfdetiv=f(), galdetiv=f())
+        if mods:
+            # weighted model image, chi-squared image
+            maps.update(cowmod=f(), cochi2=f())
+        if blobmods:
+            maps.update(cowblobmod=f())
+        # unweighted image (& models), and their number of exposures.
+        #
+        # We have *three* counters for the number of pixels
+        # overlapping each coadd brick pixel:
+        #
+        # - "con" counts the pixels included in the unweighted coadds.
+        #   This map is not passed outside make_coadds or used
+        #   anywhere else.
+        #
+        # - "congood" counts pixels with (iv > 0).  This gets passed
+        #   to the *write_coadd_images* function, where it gets
+        #   written to the *nexp* maps.
+        #
+        # - "nobs" counts all pixels, regardless of masks.  This gets
+        #   sampled at *xy* positions, and ends up in the tractor
+        #   catalog "nobs" column.
+        #
+        # (you want to know the number of observations within the
+        # source footprint, not just the peak pixel which may be
+        # saturated, etc.)
+        maps.update(coimg=f(), con=i())
+        if mods:
+            maps.update(comod=f())
+        if blobmods:
+            maps.update(coblobmod=f())
+        if ngood:
+            maps.update(congood=i())
+        if masks:
+            # These match the type of the "DQ" images.
+            # "any" mask, and "all" mask
+            from functools import reduce
+            andmask = i()
+            andmask[:,:] = reduce(np.bitwise_or, DQ_BITS.values())
+            maps.update(ormask=i(), andmask=andmask)
+        if nobs:
+            # number of observations
+            maps.update(nobs=i())
+        if nsatur:
+            maps.update(satmap=i())
+        if psfsize:
+            # psfsizemap is like "cow", but constant invvar per-CCD
+            maps.update(psfsizemap=f(), flatcow=f())
+        if maximg:
+            maps.update(maximg=f())
+        if mjds and mjd_args is None:
+            mjd_args = (i() - 1, i() - 1)
+        if mjd_args is not None:
+            maps.update(mjd_argmin=mjd_args[0], mjd_argmax=mjd_args[1])
+        self.maps = maps
+
+    def nbytes(self):
+        return sum([m.nbytes for m in self.maps.values()])
+
+    def add(self, R, tim, targetwcs, mjds=None, plotargs=None):
+        '''
+        Accumulates *R*, the result of _resample_one for *tim*.
+        *mjds*: the tims' MJDs, with 0 appended, if tracking them.
+        *plotargs*: (band, mods, allresids, ps) to make plots.
+        '''
+        itim,Yo,Xo,iv,im,mo,bmo,dq = R
+        m = self.maps
+        H,W = m['cow'].shape
+        satur_val = self.satur_val
+        if plotargs is not None:
+            band,mods,allresids,ps = plotargs
+            _make_coadds_plots_1(im, band, mods, mo, iv, True,
+                                 dq, satur_val, allresids, ps, H, W,
+                                 tim, Yo, Xo)
+        # invvar-weighted image
+        m['cowimg'][Yo,Xo] += iv * im
+        m['cow']   [Yo,Xo] += iv
+
+        if dq is None:
+            goodpix = 1
+        else:
+            # include SATUR pixels if no other pixels exists
+            okbits = np.uint16(0)
+            for bitname in ['satur']:
+                okbits |= DQ_BITS[bitname]
+            brightpix = ((dq & okbits) != 0)
+            if satur_val is not None:
+                # HACK -- force SATUR pix to be bright
+                im[brightpix] = satur_val
+            # Include these pixels if none other exist??
+            for bitname in ['interp']:
+                okbits |= DQ_BITS[bitname]
+            goodpix = ((dq & ~okbits) == 0)
+
+        m['coimg'][Yo,Xo] += goodpix * im
+        m['con']  [Yo,Xo] += goodpix
+
+        if self.masks and dq is not None:
+            m['ormask'] [Yo,Xo] |= dq
+            m['andmask'][Yo,Xo] &= dq
+        if self.nobs:
+            # raw exposure count
+            m['nobs'][Yo,Xo] += 1
+        if mjds is not None:
+            # mjd_min/max
+            argmins = m['mjd_argmin']
+            argmaxs = m['mjd_argmax']
+            update = np.logical_or(argmins[Yo,Xo] == -1,
+                                   (argmins[Yo,Xo] > -1) *
+                                   (mjds[itim] < mjds[argmins[Yo,Xo]]))
+            argmins[Yo[update],Xo[update]] = itim
+            update = np.logical_or(argmaxs[Yo,Xo] == -1,
+                                   (argmaxs[Yo,Xo] > -1) *
+                                   (mjds[itim] > mjds[argmaxs[Yo,Xo]]))
+            argmaxs[Yo[update],Xo[update]] = itim
+            del update
+
+        if self.nsatur and dq is not None:
+            m['satmap'][Yo,Xo] += (1*((dq & DQ_BITS['satur'])>0))
+
+        if self.psfsize:
+            # psfnorm is in units of 1/pixels.
+            # (eg, psfnorm for a gaussian is 1./(2.*sqrt(pi) * psf_sigma) )
+            # Neff is in pixels**2
+            neff = 1./tim.psfnorm**2
+            # Narcsec is in arcsec**2
+            narcsec = neff * tim.wcs.pixel_scale()**2
+            # Make smooth maps -- don't ignore CRs, saturated pix, etc
+            iv1 = 1./tim.sig1**2
+            m['psfsizemap'][Yo,Xo] += iv1 * (1. / narcsec)
+            m['flatcow']   [Yo,Xo] += iv1
+
+        if self.psf_images:
+            from astrometry.util.util import lanczos3_interpolate
+            h,w = tim.shape
+            patch = tim.psf.getPointSourcePatch(w//2, h//2).patch
+            patch /= np.sum(patch)
+            # In case the tim and coadd have different pixel scales,
+            # resample the PSF stamp.
+            ph,pw = patch.shape
+            pscale = tim.imobj.pixscale / targetwcs.pixel_scale()
+            coph = int(np.ceil(ph * pscale))
+            copw = int(np.ceil(pw * pscale))
+            coph = 2 * (coph//2) + 1
+            copw = 2 * (copw//2) + 1
+            # want input image pixel coords that change by 1/pscale
+            # and are centered on pw//2, ph//2
+            cox = np.arange(copw) * 1./pscale
+            cox += pw//2 - cox[copw//2]
+            coy = np.arange(coph) * 1./pscale
+            coy += ph//2 - coy[coph//2]
+            fx,fy = np.meshgrid(cox,coy)
+            fx = fx.ravel()
+            fy = fy.ravel()
+            ix = (fx + 0.5).astype(np.int32)
+            iy = (fy + 0.5).astype(np.int32)
+            dx = (fx - ix).astype(np.float32)
+            dy = (fy - iy).astype(np.float32)
+            copsf = np.zeros(coph*copw, np.float32)
+            lanczos3_interpolate(ix, iy, dx, dy, [copsf], [patch])
+            copsf = copsf.reshape((coph,copw))
+            copsf /= copsf.sum()
+            if plotargs is not None:
+                _make_coadds_plots_2(patch, copsf, self.psf_img, tim, band, ps)
+
+            self.psf_img = self.psf_img + copsf / tim.sig1**2
+
+        if self.detmaps:
+            # point-source depth
+            detsig1 = tim.sig1 / tim.psfnorm
+            m['psfdetiv'][Yo,Xo] += (iv > 0) * (1. / detsig1**2)
+            # Galaxy detection map
+            gdetsig1 = tim.sig1 / tim.galnorm
+            m['galdetiv'][Yo,Xo] += (iv > 0) * (1. / gdetsig1**2)
+
+        if self.ngood:
+            m['congood'][Yo,Xo] += (iv > 0)
+
+        if self.mods:
+            # straight-up
+            m['comod'][Yo,Xo] += goodpix * mo
+            # invvar-weighted
+            m['cowmod'][Yo,Xo] += iv * mo
+            # chi-squared
+            m['cochi2'][Yo,Xo] += iv * (im - mo)**2
+
+        if self.blobmods:
+            # straight-up
+            m['coblobmod'][Yo,Xo] += goodpix * bmo
+            # invvar-weighted
+            m['cowblobmod'][Yo,Xo] += iv * bmo
+
+        if self.maximg:
+            m['maximg'][Yo,Xo] = np.maximum(m['maximg'][Yo,Xo], im * (iv>0))
+
+    def merge(self, maps, psf_img, mjds=None):
+        '''
+        Adds in the *maps* and *psf_img* of another partial (for other
+        tims).
+        '''
+        for name,mine in self.maps.items():
+            other = maps[name]
+            if name == 'ormask':
+                np.bitwise_or(mine, other, out=mine)
+            elif name == 'andmask':
+                np.bitwise_and(mine, other, out=mine)
+            elif name == 'maximg':
+                np.maximum(mine, other, out=mine)
+            elif name in ['mjd_argmin', 'mjd_argmax']:
+                # (the same rule as in add)
+                if name == 'mjd_argmin':
+                    better = (mjds[other] < mjds[mine])
+                else:
+                    better = (mjds[other] > mjds[mine])
+                update = (other > -1) * np.logical_or(mine == -1, better)
+                mine[update] = other[update]
+                del better, update
+            else:
+                mine += other
+        self.psf_img = self.psf_img + psf_img
+
+def _split_tims(args, n):
+    # Splits the _resample_one *args* into (at most) *n* runs of
+    # consecutive tims with about equal numbers of tim pixels, so that
+    # the partial coadds are accumulated, and merged, in tim order.
+    npix = np.array([a[1].shape[0] * a[1].shape[1] for a in args], float)
+    start = np.cumsum(npix) - npix
+    igroup = np.minimum(n-1, (n * start / max(1., np.sum(npix))).astype(int))
+    return [[a for a,g in zip(args, igroup) if g == i]
+            for i in range(n) if np.any(igroup == i)]
+
+def _accumulate_partial(args, tims, targetwcs, partargs, mjds, tmpdir, tag):
+    # Runs in a forked child: resamples and accumulates the tims of
+    # *args*, and writes the maps to *tmpdir*.  Returns the
+    # (map name -> filename) dict and the PSF image.
+    H = int(targetwcs.get_height())
+    W = int(targetwcs.get_width())
+    part = _CoaddPartial(H, W, **partargs)
+    for a in args:
+        R = _resample_one(a)
+        if R is None:
+            continue
+        part.add(R, tims[R[0]], targetwcs, mjds=mjds)
+        del R
+    files = {}
+    for name,m in part.maps.items():
+        fn = os.path.join(tmpdir, '%s-%s.npy' % (tag, name))
+        np.save(fn, m)
+        files[name] = fn
+    return files, part.psf_img
+
+def _fork_coadd_partials(part, args, tims, targetwcs, partargs, mjds, nchild):
+    '''
+    Accumulates the tims of the _resample_one *args* into
+    _CoaddPartial *part*, in *nchild* forked processes, each
+    accumulating its share into its own partial maps; these are
+    passed back through files in shared memory (/dev/shm, if it
+    exists), memory-mapped, and merged in tim order.
+    '''
+    import shutil
+    import tempfile
+    from legacypipe.utils import fork_map
+    shm_dir = None
+    if os.path.isdir('/dev/shm'):
+        shm_dir = '/dev/shm'
+    tmpdir = tempfile.mkdtemp(dir=shm_dir, prefix='legacypipe-coadd-')
+    try:
+        groups = _split_tims(args, nchild)
+        info('Accumulating coadd of', len(args), 'images in', len(groups), 'processes')
+        R = fork_map(_accumulate_partial,
+                     [(g, tims, targetwcs, partargs, mjds, tmpdir, 'p%i' % i)
+                      for i,g in enumerate(groups)], nchild)
+        for files,psf_img in R:
+            maps = {}
+            for name,fn in files.items():
+                maps[name] = np.load(fn, mmap_mode='r')
+                # (the mapping stays valid)
+                os.unlink(fn)
+            part.merge(maps, psf_img, mjds=mjds)
+            del maps
+    finally:
+        shutil.rmtree(tmpdir, ignore_errors=True)
+
 def _make_coadds_plots_4(allresids, mods, ps):
     import pylab as plt
     I = np.argsort([a[0] for a in allresids])
@@ -916,8 +1096,7 @@ def _resample_one(args):
         imgs = []
 
     try:
-        Yo,Xo,Yi,Xi,rimgs = resample_with_wcs(
-            targetwcs, tim.subwcs, imgs, 3, intType=np.int16)
+        Yo,Xo,Yi,Xi,rimgs = resample_tim(tim, targetwcs, imgs, intType=np.int16)
     except OverlapError:
         return None
     if len(Yo) == 0:
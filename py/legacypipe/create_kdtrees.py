@@ -1,6 +1,7 @@
 import os
 from astrometry.libkd.spherematch import tree_build
 from astrometry.util.fits import fits_table
+from legacypipe.ccdfootprints import write_footprints
 import numpy as np
 import tempfile
 
@@ -46,6 +47,13 @@ def create_kdtree(infn, outfn, ccd_cuts):
     rtn = os.system(cmd)
     assert(rtn == 0)
 
+    # add the CCD footprints (in the same row order as the CCDs table)
+    T = fits_table(outfn, columns=['crval1', 'crval2', 'crpix1', 'crpix2',
+                                   'cd1_1', 'cd1_2', 'cd2_1', 'cd2_2',
+                                   'width', 'height'])
+    write_footprints(outfn, T)
+    print('Added', len(T), 'CCD footprints to', outfn)
+
 if __name__ == '__main__':
     import argparse
     parser = argparse.ArgumentParser()
@@ -478,7 +478,7 @@ def run_one_brick(X):
                          [(1,1),(W,1),(W,H),(1,H),(1,1)]])
     gitver = get_git_version()
 
-    ccds = survey.ccds_touching_wcs(targetwcs)
+    ccds = survey.ccds_touching_brick(brick, W=W, H=H, pixscale=pixscale)
     if ccds is None:
         print('No CCDs actually touching brick')
         return 0
@@ -1,3 +1,4 @@
+import os
 import numpy as np
 
 import logging
@@ -99,6 +100,186 @@ def detection_maps(tims, targetwcs, bands, mp, apodize=None, nsatur=None):
             print('Satmap:', np.sum(satmaps[i]), 'pixels set')
     return detmaps, detivs, satmaps
 
+class IncrementalDetectionMaps(object):
+    '''
+    The per-band detection maps, as computed by detection_maps(), for a
+    fixed list of *tims* and *targetwcs*, kept up to date as the tim
+    pixels change.
+
+    OneBlob computes detection maps once per source, while adding and
+    subtracting individual source models to/from the tims; between
+    calls, only small patches of the tims change.  The detection map is
+    linear in the (masked, sky-subtracted) pixels, so here we keep each
+    tim's smoothed image and re-smooth only the regions that changed
+    (padded by the Gaussian kernel radius), adding the difference into
+    the per-band inverse-variance-weighted sums.  The inverse-variance
+    maps do not depend on the pixel values, so are computed once.
+
+    A tim whose inverse-error map or sky model changes is recomputed in
+    full, as is (via the changed regions) the saturated-pixel fill value.
+    The smoothed pixels are identical to detection_maps(), but the
+    per-band sums are accumulated in a different order, so the
+    detection maps agree only to floating-point rounding.
+    '''
+    # changed pixels are grouped into tiles of this size
+    tilesize = 32
+
+    def __init__(self, tims, targetwcs, bands):
+        self.targetwcs = targetwcs
+        self.bands = bands
+        self.reset(tims)
+
+    def reset(self, tims):
+        H,W = self.targetwcs.shape
+        self.tims = list(tims)
+        self.detsums = [np.zeros((H,W), np.float32) for b in self.bands]
+        self.detivs  = [np.zeros((H,W), np.float32) for b in self.bands]
+        self.states = [self._init_tim(tim) for tim in self.tims]
+
+    def update(self, tims):
+        '''
+        Brings the maps up to date with the current pixels in *tims* (which
+        must be the same tim objects, or the maps are recomputed), and
+        returns (detmaps, detivs), as from detection_maps().  The *detivs*
+        are the cached arrays and must not be modified.
+        '''
+        if (len(tims) != len(self.tims) or
+            any([t1 is not t2 for t1,t2 in zip(tims, self.tims)])):
+            self.reset(tims)
+        for tim,st in zip(self.tims, self.states):
+            if st is None:
+                continue
+            if (st['ie'] is not tim.getInvError() or
+                st['sky'] != list(tim.getSky().getParams())):
+                self._recompute_tim(tim, st)
+            else:
+                self._update_tim(tim, st)
+        detmaps = [detsum / np.maximum(1e-16, detiv)
+                   for detsum,detiv in zip(self.detsums, self.detivs)]
+        return detmaps, self.detivs
+
+    def _init_tim(self, tim):
+        from legacypipe.survey import tim_get_resamp
+        R = tim_get_resamp(tim, self.targetwcs)
+        if R is None or tim.band not in self.bands:
+            return None
+        assert(tim.psf_sigma > 0)
+        (Yo,Xo,Yi,Xi) = R
+        sat = None
+        if tim.dq is not None:
+            I, = np.nonzero((tim.dq[Yi,Xi] & tim.dq_saturation_bits) > 0)
+            if len(I):
+                sat = (Yi[I], Xi[I])
+        subh,subw = tim.shape
+        # Sort the resampled pixels by tim pixel, to look up the ones
+        # that fall within a rectangle of tim pixels.
+        timpix = Yi.astype(np.int64) * subw + Xi
+        order = np.argsort(timpix, kind='stable')
+        st = dict(ib=self.bands.index(tim.band), Yo=Yo, Xo=Xo, Yi=Yi, Xi=Xi,
+                  sat=sat, order=order, timpix=timpix[order],
+                  psfnorm=1./(2. * np.sqrt(np.pi) * tim.psf_sigma),
+                  radius=int(4.0 * tim.psf_sigma + 0.5),
+                  ie=None, sky=None, raw=None, detim=None, iv=None)
+        self._recompute_tim(tim, st)
+        return st
+
+    def _raw_image(self, tim, st):
+        # The masked, sky-subtracted, saturation-filled image, as in _detmap
+        detim = tim.getImage().copy()
+        detim[tim.getInvError() == 0] = 0.
+        tim.getSky().addTo(detim, scale=-1.)
+        if st['sat'] is not None:
+            detim[st['sat']] = np.max(detim)
+        return detim
+
+    def _recompute_tim(self, tim, st):
+        from scipy.ndimage.filters import gaussian_filter
+        ie = tim.getInvError()
+        psfnorm = st['psfnorm']
+        Yo,Xo,Yi,Xi = st['Yo'], st['Xo'], st['Yi'], st['Xi']
+        raw = self._raw_image(tim, st)
+        detim = gaussian_filter(raw, tim.psf_sigma) / psfnorm**2
+
+        detsig1 = tim.sig1 / psfnorm
+        detiv = np.zeros(tim.shape, np.float32) + (1. / detsig1**2)
+        detiv[ie == 0] = 0.
+        if st['sat'] is not None:
+            detiv[st['sat']] = 1./detsig1**2
+        iv = gaussian_filter(detiv, tim.psf_sigma)[Yi,Xi]
+
+        ib = st['ib']
+        if st['detim'] is not None:
+            # remove the previous contribution
+            self.detsums[ib][Yo,Xo] -= st['detim'][Yi,Xi] * st['iv']
+            self.detivs [ib][Yo,Xo] -= st['iv']
+        self.detsums[ib][Yo,Xo] += detim[Yi,Xi] * iv
+        self.detivs [ib][Yo,Xo] += iv
+        st.update(ie=ie, sky=list(tim.getSky().getParams()),
+                  raw=raw, detim=detim, iv=iv)
+
+    def _update_tim(self, tim, st):
+        from scipy.ndimage.filters import gaussian_filter
+        raw = self._raw_image(tim, st)
+        changed = (raw != st['raw'])
+        if not np.any(changed):
+            return
+        st['raw'] = raw
+        detim = st['detim']
+        psfnorm = st['psfnorm']
+        r = st['radius']
+        subh,subw = tim.shape
+        ib = st['ib']
+        for y0,y1,x0,x1 in _changed_boxes(changed, self.tilesize):
+            # The smoothed pixels that change...
+            fy0,fy1 = max(0, y0-r), min(subh, y1+r)
+            fx0,fx1 = max(0, x0-r), min(subw, x1+r)
+            # ... depend on the raw pixels within this box.  (Where it is
+            # clipped at the image edge, the reflection is the same as
+            # when smoothing the whole image.)
+            wy0,wy1 = max(0, fy0-r), min(subh, fy1+r)
+            wx0,wx1 = max(0, fx0-r), min(subw, fx1+r)
+            sm = gaussian_filter(raw[wy0:wy1, wx0:wx1], tim.psf_sigma) / psfnorm**2
+            I = self._resampled_in_box(st, subw, fy0, fy1, fx0, fx1)
+            Yi,Xi = st['Yi'][I], st['Xi'][I]
+            old = detim[Yi,Xi]
+            detim[fy0:fy1, fx0:fx1] = sm[fy0-wy0:fy1-wy0, fx0-wx0:fx1-wx0]
+            self.detsums[ib][st['Yo'][I], st['Xo'][I]] += (
+                (detim[Yi,Xi] - old) * st['iv'][I])
+
+    @staticmethod
+    def _resampled_in_box(st, subw, y0, y1, x0, x1):
+        # Indices into Yo,Xo,Yi,Xi of the tim pixels in [y0,y1) x [x0,x1)
+        rows = np.arange(y0, y1, dtype=np.int64) * subw
+        timpix = st['timpix']
+        i0 = np.searchsorted(timpix, rows + x0)
+        i1 = np.searchsorted(timpix, rows + x1)
+        n = i1 - i0
+        if np.sum(n) == 0:
+            return np.zeros(0, int)
+        # concatenate the ranges [i0,i1)
+        I = np.arange(np.sum(n)) - np.repeat(np.cumsum(n) - n, n) + np.repeat(i0, n)
+        return st['order'][I]
+
+def _changed_boxes(changed, tilesize):
+    '''
+    Returns a list of (y0,y1,x0,x1) boxes covering the True pixels in
+    boolean image *changed*: the bounding boxes of connected groups of
+    *tilesize* tiles containing changes.
+    '''
+    from scipy.ndimage.measurements import label, find_objects
+    h,w = changed.shape
+    th = (h + tilesize-1) // tilesize
+    tw = (w + tilesize-1) // tilesize
+    padded = np.zeros((th*tilesize, tw*tilesize), bool)
+    padded[:h,:w] = changed
+    tiles = padded.reshape(th, tilesize, tw, tilesize).any(axis=(1,3))
+    tilemap,_ = label(tiles)
+    boxes = []
+    for sy,sx in find_objects(tilemap):
+        boxes.append((sy.start*tilesize, min(h, sy.stop*tilesize),
+                      sx.start*tilesize, min(w, sx.stop*tilesize)))
+    return boxes
+
 def sed_matched_filters(bands):
     '''
     Determines which SED-matched filters to run based on the available
@@ -165,6 +346,7 @@ def run_sed_matched_filters(SEDs, bands, detmaps, detivs, omit_xy,
                             blob_dilate=None,
                             veto_map=None,
                             mp=None,
+                            nprocs=1,
                             plots=False, ps=None, rgbimg=None):
     '''
     Runs a given set of SED-matched filters.
@@ -200,6 +382,8 @@ def run_sed_matched_filters(SEDs, bands, detmaps, detivs, omit_xy,
         Create plots?
     mp : multiproc object
         Multiprocessing
+    nprocs : int
+        Passed through to sed_matched_detection.
 
     Returns
     -------
@@ -241,7 +425,7 @@ def run_sed_matched_filters(SEDs, bands, detmaps, detivs, omit_xy,
             sedname, sed, detmaps, detivs, bands, xx, yy, rr,
             nsigma=nsigma, saddle_fraction=saddle_fraction, saddle_min=saddle_min,
             blob_dilate=blob_dilate, saturated_pix=saturated_pix, veto_map=veto_map,
-            ps=pps, rgbimg=rgbimg)
+            nprocs=nprocs, ps=pps, rgbimg=rgbimg)
         if sedhot is None:
             continue
         info('SED', sedname, ':', len(px), 'new peaks')
@@ -314,6 +498,8 @@ def sed_matched_detection(sedname, sed, detmaps, detivs, bands,
                           veto_map=None,
                           cutonaper=True,
                           hotmap_only=False,
+                          nprocs=1,
+                          saddle_method='tree',
                           ps=None, rgbimg=None):
     '''
     Runs a single SED-matched detection filter.
@@ -349,6 +535,13 @@ def sed_matched_detection(sedname, sed, detmaps, detivs, bands,
         Apply a cut that the source's detection strength must be greater
         than `nsigma` above the 16th percentile of the detection strength in
         an annulus (from 10 to 20 pixels) around the source.
+    nprocs : int, optional
+        Run the per-peak saddle tests in up to this many forked
+        processes (the results are the same as serially).
+    saddle_method : string, optional
+        How to find each peak's blob for the saddle test: "tree", a
+        sweep down the merge tree of the S/N map, or "loop", labelling
+        a cutout around each peak.  The results are the same.
     ps : PlotSequence object, optional
         Create plots?
 
@@ -371,6 +564,7 @@ def sed_matched_detection(sedname, sed, detmaps, detivs, bands,
     '''
     from scipy.ndimage.measurements import label, find_objects
     from scipy.ndimage import binary_dilation, binary_fill_holes, grey_dilation
+    from legacypipe.utils import fork_map
 
     H,W = detmaps[0].shape
     allzero = True
@@ -499,8 +693,6 @@ def sed_matched_detection(sedname, sed, detmaps, detivs, bands,
         saddlemap |= satur
     allblobs,_ = label(saddlemap)
     allslices = find_objects(allblobs)
-    ally0 = [sy.start for sy,sx in allslices]
-    allx0 = [sx.start for sy,sx in allslices]
 
     # brightest peaks first
     py,px = np.nonzero(peaks)
@@ -564,23 +756,20 @@ def sed_matched_detection(sedname, sed, detmaps, detivs, bands,
     # search within its "allblob", which is defined by the lowest
     # saddle.
     info('SED', sedname, ': found', len(px), 'potential peaks')
-    nveto = 0
-    nsaddle = 0
-    naper = 0
-    for i,(x,y) in enumerate(zip(px, py)):
-        if this_veto_map[y,x]:
-            nveto += 1
-            continue
-        level = saddle_level(sedsn[y,x])
+
+    # Only reject sources if there is another source within R pixels and not separated by
+    # a deep enough saddle.
+    R = 50
+
+    def peak_blob(i, x, y, level):
+        # The saddle test for peak *i* at *x*,*y*, by labelling the
+        # +-R pixel cutout.  Returns (cut, slc, saddlemap), where
+        # *saddlemap* is the peak's (hole-filled) blob within slice *slc*.
         ablob = allblobs[y,x]
         index = int(ablob - 1)
         slc = allslices[index]
-        x0,y0 = allx0[index], ally0[index]
         del index
 
-        # Only reject sources if there is another source within 50 pixels and not separated by
-        # a deep enough saddle.
-        R = 50
         sy,sx = slc
         sy0,sy1 = sy.start, sy.stop
         sx0,sx1 = sx.start, sx.stop
@@ -588,12 +777,9 @@ def sed_matched_detection(sedname, sed, detmaps, detivs, bands,
         ylo = max(y - R, sy0)
         xhi = min(x + R + 1, sx1)
         yhi = min(y + R + 1, sy1)
-        subslc = slice(ylo,yhi), slice(xlo,xhi)
-        subx0 = xlo
-        suby0 = ylo
-        # swap in the +-50 pixel slice
-        slc = subslc
-        x0,y0 = subx0,suby0
+        # the +-R pixel slice
+        slc = slice(ylo,yhi), slice(xlo,xhi)
+        x0,y0 = xlo,ylo
 
         saddlemap = (dilatedmap[slc] > level)
         saddlemap *= (allblobs[slc] == ablob)
@@ -601,7 +787,7 @@ def sed_matched_detection(sedname, sed, detmaps, detivs, bands,
         thisblob = blobs[y-y0, x-x0]
         saddlemap *= (blobs == thisblob)
 
-        oslcs = find_objects(saddlemap)
+        oslcs = find_objects(saddlemap.astype(np.int32))
         assert(len(oslcs) == 1)
         oslc = oslcs[0]
         saddlemap[oslc] = binary_fill_holes(saddlemap[oslc])
@@ -627,16 +813,11 @@ def sed_matched_detection(sedname, sed, detmaps, detivs, bands,
         if False and (not cut) and ps is not None:
             _peak_plot_3(sedsn, nsigma, x, y, x0, y0, slc, saddlemap,
                          xomit, yomit, px, py, keep, i, cut, ps)
+        return cut, slc, saddlemap
 
-        del blobs
-
-        if cut:
-            # in same blob as previously found source.
-            # update vetomap
-            this_veto_map[slc] |= saddlemap
-            nsaddle += 1
-            continue
-
+    def aperture(i, x, y):
+        if apvals is not None and not np.isnan(apvals[i]):
+            return apvals[i]
         # Measure in aperture...
         ap   =  sedsn[max(0, y-apout):min(H,y+apout+1),
                       max(0, x-apout):min(W,x+apout+1)]
@@ -653,16 +834,6 @@ def sed_matched_detection(sedname, sed, detmaps, detivs, bands,
         else:
             # fake
             m = -1.
-        if cutonaper:
-            if sedsn[y,x] - m < nsigma:
-                naper += 1
-                continue
-
-        aper.append(m)
-        peakval.append(sedsn[y,x])
-        keep[i] = True
-        this_veto_map[slc] |= saddlemap
-
         if False and ps is not None:
             plt.clf()
             plt.subplot(1,2,1)
@@ -674,6 +845,99 @@ def sed_matched_detection(sedname, sed, detmaps, detivs, bands,
                     extent=[apx0,apx0+apw,apy0,apy0+aph])
             plt.suptitle('peak %.1f vs ap %.1f' % (sedsn[y,x], m))
             ps.savefig()
+        return m
+
+    # The merge tree gives the same results as labelling a cutout
+    # around each peak; it is not used when making plots.
+    if saddle_method not in ['tree', 'loop']:
+        raise ValueError('Unknown saddle_method: %s' % saddle_method)
+    tree = None
+    apvals = None
+    if saddle_method == 'tree' and ps is None and len(px) and saddle_min >= 0:
+        tree = _SaddleTree(dilatedmap, lowest_saddle, xomit, yomit)
+        # and measure the apertures in bulk
+        apvals = _annulus_percentiles(sedsn, sediv, px, py, apin, apout,
+                                      np.logical_not(this_veto_map[py,px]))
+        # Without plots, the veto map is only checked at the peaks.
+        peakorder = np.empty((H,W), np.int32)
+        peakorder[:,:] = -1
+        peakorder[py,px] = np.arange(len(px))
+
+    def update_veto(i, comp, slc, saddlemap):
+        if comp is None:
+            this_veto_map[slc] |= saddlemap
+        elif np.any(peakorder[comp.slc] > i):
+            slc,blobmap = comp.filled_map()
+            this_veto_map[slc] |= blobmap
+
+    def run_peaks(I):
+        # Runs the peaks with indices *I* (in brightest-first order).
+        # Returns the kept peaks as (index, aper, peakval), and the
+        # number vetoed, cut by saddle, and cut by aperture.
+        nveto = 0
+        nsaddle = 0
+        naper = 0
+        kept = []
+        sweep = None
+        if tree is not None:
+            sweep = _SaddleSweep(tree)
+        for i in I:
+            x,y = px[i], py[i]
+            if this_veto_map[y,x]:
+                nveto += 1
+                continue
+            level = saddle_level(sedsn[y,x])
+            comp = None
+            if sweep is not None:
+                comp = sweep.component(x, y, level, R)
+            if comp is None:
+                cut,slc,saddlemap = peak_blob(i, x, y, level)
+            else:
+                cut = comp.hassrc
+                slc = saddlemap = None
+
+            if cut:
+                # in same blob as previously found source.
+                # update vetomap
+                update_veto(i, comp, slc, saddlemap)
+                nsaddle += 1
+                continue
+
+            m = aperture(i, x, y)
+            if cutonaper:
+                if sedsn[y,x] - m < nsigma:
+                    naper += 1
+                    continue
+
+            kept.append((i, m, sedsn[y,x]))
+            keep[i] = True
+            update_veto(i, comp, slc, saddlemap)
+            if sweep is not None:
+                sweep.add_source(x, y)
+        return kept, nveto, nsaddle, naper
+
+    groups = None
+    if nprocs > 1 and ps is None and len(px) >= 100 and hasattr(os, 'fork'):
+        groups = _independent_peak_groups(allblobs, allslices, px, py, nprocs)
+    if groups is not None and len(groups) > 1:
+        # Each child gets a copy-on-write snapshot of the maps
+        # (including this_veto_map, which it updates privately).
+        info('Running', len(px), 'peaks in', len(groups), 'processes')
+        R = fork_map(run_peaks, [(I,) for I in groups], nprocs)
+    else:
+        R = [run_peaks(range(len(px)))]
+    kept = []
+    nveto = nsaddle = naper = 0
+    for k,nv,ns,na in R:
+        kept.extend(k)
+        nveto += nv
+        nsaddle += ns
+        naper += na
+    kept.sort(key=lambda k: k[0])
+    for i,m,pv in kept:
+        keep[i] = True
+        aper.append(m)
+        peakval.append(pv)
 
     info('Of', len(px), 'potential peaks:', nveto, 'in veto map,', nsaddle, 'cut by saddle test,',
           naper, 'cut by aper test,', np.sum(keep), 'kept')
@@ -714,6 +978,332 @@ def sed_matched_detection(sedname, sed, detmaps, detivs, bands,
 
     return hotblobs, px, py, aper, peakval
 
+def _independent_peak_groups(allblobs, allslices, px, py, ngroups):
+    '''
+    Splits the peaks *px*, *py* into (at most) *ngroups* groups that
+    sed_matched_detection can process independently: a peak's saddle
+    test only looks at, and its veto-map update only touches, pixels
+    within the bounding box of its lowest-saddle blob (*allblobs*,
+    *allslices*), so peaks in blobs with non-overlapping bounding boxes
+    don't interact.  Returns a list of arrays of peak indices, each in
+    increasing order (so each group keeps the brightest-first order).
+    '''
+    from scipy.ndimage.measurements import label
+    H,W = allblobs.shape
+    # Paint the blobs' bounding boxes (via a 2-d cumulative sum), and
+    # find the connected groups of boxes.
+    corners = np.zeros((H+1, W+1), np.int32)
+    for sy,sx in allslices:
+        corners[sy.start, sx.start] += 1
+        corners[sy.start, sx.stop ] -= 1
+        corners[sy.stop,  sx.start] -= 1
+        corners[sy.stop,  sx.stop ] += 1
+    boxes = (np.cumsum(np.cumsum(corners, axis=0), axis=1)[:H,:W] > 0)
+    del corners
+    boxmap,nboxes = label(boxes)
+    del boxes
+    # (each peak is inside its own blob's box)
+    gpeak = boxmap[py, px]
+    del boxmap
+    # Assign the groups to bins, largest first.
+    npeaks = np.bincount(gpeak, minlength=nboxes+1)
+    binsize = np.zeros(ngroups, int)
+    gbin = np.zeros(nboxes+1, int)
+    for g in np.argsort(-npeaks, kind='stable'):
+        if npeaks[g] == 0:
+            break
+        b = np.argmin(binsize)
+        gbin[g] = b
+        binsize[b] += npeaks[g]
+    pbin = gbin[gpeak]
+    return [np.flatnonzero(pbin == b) for b in range(ngroups) if binsize[b] > 0]
+
+def _annulus_percentiles(sedsn, sediv, px, py, apin, apout, use):
+    '''
+    Returns the 16th percentile of *sedsn* in the annulus from *apin*
+    to *apout* pixels around each peak *px*, *py* where *use* is set,
+    as sed_matched_detection's aperture test computes, for the peaks
+    whose annulus is inside the image with all *sediv* > 0; NaN for
+    the others.
+    '''
+    H,W = sedsn.shape
+    apvals = np.empty(len(px), np.float32)
+    apvals[:] = np.nan
+    d = np.arange(-apout, apout+1)
+    R2 = d[:,np.newaxis]**2 + d[np.newaxis,:]**2
+    ay,ax = np.nonzero((R2 >= apin**2) * (R2 <= apout**2))
+    ay -= apout
+    ax -= apout
+    I = np.flatnonzero(use * (px >= apout) * (px < W-apout) *
+                       (py >= apout) * (py < H-apout))
+    chunk = 2000
+    for j in range(0, len(I), chunk):
+        J = I[j:j+chunk]
+        yy = py[J][:,np.newaxis] + ay[np.newaxis,:]
+        xx = px[J][:,np.newaxis] + ax[np.newaxis,:]
+        ok = np.all(sediv[yy, xx] > 0, axis=1)
+        if np.any(ok):
+            apvals[J[ok]] = np.percentile(sedsn[yy[ok], xx[ok]], 16., axis=1)
+    return apvals
+
+class _SaddleTree(object):
+    '''
+    The merge tree of the (dilated) S/N map *dmap* above level
+    *lowest*, for sed_matched_detection's saddle test, given the
+    previously known sources at integer pixel positions *xomit*,
+    *yomit*.
+
+    Each pixel above *lowest* belongs to the "basin" of the local
+    maximum that it reaches by steepest ascent through its
+    4-connected neighbours, so the part of a basin above any level is
+    connected.  Pixels above level L are then 4-connected above L iff
+    their basins are joined by boundaries whose saddles -- the highest
+    min(dmap) of adjacent pixel pairs across the boundary -- are above
+    L.  Sweeping down in level and merging basins (union-find) as their
+    saddles are passed (_SaddleSweep) gives each peak's blob without
+    labelling pixels.
+    '''
+    def __init__(self, dmap, lowest, xomit, yomit):
+        from scipy.ndimage import grey_dilation
+        H,W = dmap.shape
+        self.dmap = dmap
+        self.lowest = lowest
+        flat = dmap.ravel()
+        pix = np.flatnonzero(flat > lowest)
+        # Pixels in increasing (value, index) order -- a strict order,
+        # so that plateaus have ascent paths too.
+        order = pix[np.argsort(flat[pix], kind='stable')]
+        del pix
+        n = len(order)
+        rank = np.empty(H*W, np.int32)
+        rank[:] = -1
+        rank[order] = np.arange(n, dtype=np.int32)
+        F = np.array([[False,True,False],[True,True,True],[False,True,False]])
+        # The highest of each pixel and its neighbours; pointer-jump
+        # up to the local maxima.
+        up = grey_dilation(rank.reshape(H,W), footprint=F, mode='constant',
+                           cval=-1).ravel()[order]
+        del rank
+        while True:
+            nxt = up[up]
+            if np.array_equal(nxt, up):
+                break
+            up = nxt
+        _,basin = np.unique(up, return_inverse=True)
+        del up
+        nb = int(basin.max()) + 1 if n else 0
+        B = np.empty(H*W, np.int32)
+        B[:] = -1
+        B[order] = basin
+        B = B.reshape(H,W)
+        self.B = B
+
+        # Basin boundaries, with the highest saddle per pair of basins.
+        sad,ba,bb = [],[],[]
+        for b1,b2,d1,d2 in [(B[:,:-1], B[:,1:], dmap[:,:-1], dmap[:,1:]),
+                            (B[:-1,:], B[1:,:], dmap[:-1,:], dmap[1:,:])]:
+            K = (b1 >= 0) * (b2 >= 0) * (b1 != b2)
+            sad.append(np.minimum(d1[K], d2[K]))
+            ba.append(np.minimum(b1[K], b2[K]))
+            bb.append(np.maximum(b1[K], b2[K]))
+        sad = np.hstack(sad)
+        I = np.argsort(-sad, kind='stable')
+        _,J = np.unique(np.hstack(ba)[I].astype(np.int64) * nb + np.hstack(bb)[I],
+                        return_index=True)
+        I = I[np.sort(J)]
+        self.esaddle = sad[I].tolist()
+        self.ea = np.hstack(ba)[I].tolist()
+        self.eb = np.hstack(bb)[I].tolist()
+        del sad,ba,bb,I,J
+
+        # Previous sources, by the level at which they join the blobs.
+        xo = np.asarray(xomit).astype(int)
+        yo = np.asarray(yomit).astype(int)
+        K = np.flatnonzero((xo >= 0) * (xo < W) * (yo >= 0) * (yo < H))
+        xo,yo = xo[K],yo[K]
+        K = np.flatnonzero(B[yo,xo] >= 0)
+        xo,yo = xo[K],yo[K]
+        I = np.argsort(-dmap[yo,xo], kind='stable')
+        self.slevel = dmap[yo,xo][I].tolist()
+        self.sbasin = B[yo,xo][I].tolist()
+
+        # Each basin's pixels, in decreasing value, with their running
+        # bounding boxes, giving a basin's bounding box above any level.
+        I = np.lexsort((-np.arange(n), basin))
+        p = order[I]
+        bs = basin[I].astype(np.int64)
+        del order,basin,I
+        self.negval = -flat[p]
+        x = p % W
+        y = p // W
+        del p
+        big = H + W
+        self.xmin = bs*big - np.maximum.accumulate(bs*big - x)
+        self.xmax = np.maximum.accumulate(bs*big + x) - bs*big
+        self.ymin = bs*big - np.maximum.accumulate(bs*big - y)
+        self.ymax = np.maximum.accumulate(bs*big + y) - bs*big
+        self.seg = np.searchsorted(bs, np.arange(nb+1))
+        del bs,x,y
+        e = self.seg[1:] - 1
+        self.nbasins = nb
+        # (x0, x1, y0, y1), x1,y1 exclusive
+        self.boxes = list(zip(self.xmin[e].tolist(), (self.xmax[e]+1).tolist(),
+                              self.ymin[e].tolist(), (self.ymax[e]+1).tolist()))
+
+    def level_box(self, basins, level):
+        '''
+        Returns the bounding box (x0, x1, y0, y1) of the pixels in
+        *basins* above *level*.
+        '''
+        x0 = y0 = np.inf
+        x1 = y1 = -np.inf
+        for b in basins:
+            s0,s1 = self.seg[b], self.seg[b+1]
+            k = np.searchsorted(self.negval[s0:s1], -level)
+            if k == 0:
+                continue
+            k += s0 - 1
+            x0 = min(x0, self.xmin[k])
+            x1 = max(x1, self.xmax[k] + 1)
+            y0 = min(y0, self.ymin[k])
+            y1 = max(y1, self.ymax[k] + 1)
+        return x0, x1, y0, y1
+
+class _SaddleSweep(object):
+    '''
+    The state of a sweep down a _SaddleTree: basins merged into blobs
+    (union-find), with their bounding boxes and whether they contain a
+    source.  Peaks must be run in decreasing saddle level.
+    '''
+    # Blobs of more basins than this (whose basins' bounding boxes don't
+    # fit in the cutout) are left to the per-peak labelling.
+    max_basins = 100
+
+    def __init__(self, tree):
+        nb = tree.nbasins
+        self.tree = tree
+        self.parent = list(range(nb))
+        self.basins = [[b] for b in range(nb)]
+        self.box = list(tree.boxes)
+        self.hassrc = [False] * nb
+        self.iedge = 0
+        self.isrc = 0
+
+    def find(self, b):
+        parent = self.parent
+        r = b
+        while parent[r] != r:
+            r = parent[r]
+        while parent[b] != r:
+            parent[b],b = r,parent[b]
+        return r
+
+    def union(self, a, b):
+        a = self.find(a)
+        b = self.find(b)
+        if a == b:
+            return
+        if len(self.basins[a]) < len(self.basins[b]):
+            a,b = b,a
+        self.parent[b] = a
+        self.basins[a].extend(self.basins[b])
+        self.basins[b] = None
+        ax0,ax1,ay0,ay1 = self.box[a]
+        bx0,bx1,by0,by1 = self.box[b]
+        self.box[a] = (min(ax0,bx0), max(ax1,bx1), min(ay0,by0), max(ay1,by1))
+        self.hassrc[a] |= self.hassrc[b]
+
+    def advance(self, level):
+        # Merge basins whose saddles are above *level*, and add the
+        # previous sources above *level*.
+        t = self.tree
+        es = t.esaddle
+        i = self.iedge
+        n = len(es)
+        while i < n and es[i] > level:
+            self.union(t.ea[i], t.eb[i])
+            i += 1
+        self.iedge = i
+        sl = t.slevel
+        i = self.isrc
+        n = len(sl)
+        while i < n and sl[i] > level:
+            self.hassrc[self.find(t.sbasin[i])] = True
+            i += 1
+        self.isrc = i
+
+    def add_source(self, x, y):
+        '''
+        Adds a new source at pixel *x*,*y* (which must be above all
+        later levels).
+        '''
+        b = self.tree.B[y,x]
+        if b >= 0:
+            self.hassrc[self.find(b)] = True
+
+    def component(self, x, y, level, R):
+        '''
+        Returns the _SaddleBlob of pixels above *level* 4-connected to
+        pixel *x*,*y*, if it lies within +-*R* pixels of it, else None.
+        '''
+        t = self.tree
+        level = float(level)
+        if level < t.lowest:
+            return None
+        b = t.B[y,x]
+        if b < 0:
+            return None
+        self.advance(level)
+        r = self.find(b)
+        box = self.box[r]
+        if not _box_inside(box, x, y, R):
+            if len(self.basins[r]) > self.max_basins:
+                return None
+            box = t.level_box(self.basins[r], level)
+            if not _box_inside(box, x, y, R):
+                return None
+        return _SaddleBlob(t, list(self.basins[r]), level, box, self.hassrc[r])
+
+def _box_inside(box, x, y, R):
+    x0,x1,y0,y1 = box
+    return x0 >= x-R and x1 <= x+R+1 and y0 >= y-R and y1 <= y+R+1
+
+class _SaddleBlob(object):
+    '''
+    A peak's blob found by a _SaddleSweep: the pixels of *basins* above
+    *level*, within bounding box *box*; *hassrc*: does it contain a
+    previous source?
+    '''
+    def __init__(self, tree, basins, level, box, hassrc):
+        self.tree = tree
+        self.basins = basins
+        self.level = level
+        self.box = box
+        self.hassrc = hassrc
+        x0,x1,y0,y1 = [int(v) for v in box]
+        self.slc = slice(y0,y1), slice(x0,x1)
+
+    def filled_map(self):
+        '''
+        Returns (slc, blobmap): the blob, with holes filled, in image
+        slice *slc*.
+        '''
+        from scipy.ndimage.measurements import label
+        slc = self.slc
+        blob = (self.tree.dmap[slc] > self.level)
+        if len(self.basins) == 1:
+            blob *= (self.tree.B[slc] == self.basins[0])
+        else:
+            blob *= np.isin(self.tree.B[slc], self.basins)
+        # Fill holes (as binary_fill_holes, but faster for small
+        # blobs): the background not connected to the edges.
+        bg,nbg = label(np.logical_not(blob))
+        edge = np.unique(np.hstack((bg[0,:], bg[-1,:], bg[:,0], bg[:,-1])))
+        edge = edge[edge > 0]
+        if len(edge) < nbg:
+            blob = np.logical_not(np.isin(bg, edge))
+        return slc, blob
+
 def _peak_plot_1(vetomap, x, y, px, py, keep, i, xomit, yomit, sedsn, allblobs,
                  level, dilate, saturated_pix, satur, ps, rgbimg, cut):
     from scipy.ndimage import binary_dilation, binary_fill_holes
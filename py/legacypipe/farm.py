@@ -126,15 +126,24 @@ Bottlenecks in the current setup (as I understand them) are:
   Haswell node with input_threads.
 - last I profiled, it seemed like the network_thread was spending a
   significant fraction of its time popping items from the input_queue
-  -- perhaps due to contention for the lock.  It could be that we want
-  to use one input_queue per input_thread, rather than having all of
-  them share a single queue.  There is no particular reason they need
-  to share a queue; we would then have to implement a simple
-  round-robin scheme to pull work from the different input_queues.
-- currently, the worker.py processes are synchronous: they ask for
-  work, wait for the reply, do the work, and send in the result.  We
-  could keep a short queue (per worker or even for the set of workers
-  sharing a node) to reduce this latency.
+  -- perhaps due to contention for the lock.  Each input_thread has
+  its own inqueue, and the network_thread pulls from the fullest
+  queue first.  The queue depths and time spent popping from each
+  queue are reported in the network_thread's status.
+- by default, the worker.py processes are synchronous: they ask for
+  work, wait for the reply, do the work, and send in the result.
+  There is a short queue of work packets per node (worker.py
+  --prefetch); with worker.py --pipeline, each worker also unpickles
+  its next work packet while fitting the current one, and with
+  --batch, results finished at about the same time are sent to us in
+  a single message.
+
+With --zero-copy, work packets are pickled with protocol 5 and their
+image arrays are placed in a shared-memory segment, so that only a
+small header goes through the inqueue and the network_thread hands the
+image buffers straight to ZeroMQ without copying them.  Segments are
+removed once ZeroMQ has sent them; any left over (eg, queued packets
+when farm.py exits) are removed on shutdown.
 
 Last I checked, I could keep up with about 64 KNL nodes x 68 worker.py
 processes with 8 input_thread processes, but efficiency was starting
@@ -151,7 +160,8 @@ import multiprocessing as mp
 import queue
 import zmq
 
-from legacypipe.runbrick import _blob_iter, _write_checkpoint
+from legacypipe.runbrick import _blob_iter
+from legacypipe.checkpoint import CheckpointLog, read_checkpoint
 
 import logging
 logger = logging.getLogger('farm')
@@ -188,6 +198,12 @@ def main():
                         help='Network port (TCP) for big blobs, if --big=queue')
     parser.add_argument('--big-command-port', default=5566, type=int,
                         help='Network port (TCP) for big blob commands, if --big=queue')
+    parser.add_argument('--model-procs', type=int, default=0,
+                        help='For big blobs (see --big-pix), workers fit the candidate models for each source in parallel in this many (forked) processes; default off')
+    parser.add_argument('--blob-cost-order', default=False, action='store_true',
+                        help='Queue blobs in order of predicted CPU time, rather than size')
+    parser.add_argument('--zero-copy', default=False, action='store_true',
+                        help='Pass work packet image buffers from the input threads to the network thread via shared memory (requires worker.py to be up to date)')
     parser.add_argument('-v', '--verbose', dest='verbose', action='count',
                         default=0, help='Make more verbose')
     opt = parser.parse_args()
@@ -209,12 +225,6 @@ def main():
     #inqueue = mp.Queue(maxsize=opt.queuesize)
     # We instead are going to use one queue per input thread, below
 
-    # bigqueue: like inqueue, but for big blobs.
-    if opt.big == 'queue':
-        bigqueue = mp.Queue(maxsize=1000)
-    else:
-        bigqueue = None
-
     # outqueue: for holding blob results
     outqueue = mp.Queue()
 
@@ -231,13 +241,20 @@ def main():
     # that a brick has been finished.
     finished_bricks = mp.Queue()
 
+    inqueues = [mp.Queue(maxsize=opt.queuesize) for i in range(opt.inthreads)]
+    # bigqueue: like the inqueues, but for big blobs (with --big queue).
+    if opt.big == 'queue':
+        bigqueue = mp.Queue(maxsize=1000)
+    else:
+        bigqueue = None
+
+    # Name prefix for the --zero-copy shared-memory segments
+    opt.shm_prefix = 'lpfarm-%i-' % os.getpid()
+
     inthreads = []
-    inqueues = []
     for i in range(opt.inthreads):
-        inqueue = mp.Queue(maxsize=opt.queuesize)
-        inqueues.append(inqueue)
         inthread = mp.Process(target=input_thread,
-                              args=(queuename, inqueue, bigqueue, checkpointqueue,
+                              args=(queuename, inqueues[i], bigqueue, checkpointqueue,
                                     blobsizes, opt, i),
                               daemon=True)
         inthreads.append(inthread)
@@ -265,11 +282,15 @@ def main():
     else:
         bignetworkthread = None
 
-    inthread.join()
-    outthread.join()
-    networkthread.join()
-    if bignetworkthread is not None:
-        bignetworkthread.join()
+    try:
+        inthread.join()
+        outthread.join()
+        networkthread.join()
+        if bignetworkthread is not None:
+            bignetworkthread.join()
+    finally:
+        if opt.zero_copy:
+            remove_shared_packets(opt.shm_prefix)
 
 
 def network_thread(ctx, port, command_port, inqueues, outqueue, finished_bricks, qname):
@@ -321,6 +342,11 @@ def network_thread(ctx, port, command_port, inqueues, outqueue, finished_bricks,
     status_walltime = 0.
     status_overhead = 0.
     status_nblobs   = 0
+    # Worker-reported time waiting for work, unpickling work, and pickling results
+    status_wait     = 0.
+    status_unpickle = 0.
+    status_pickle   = 0.
+    status_nmsgs    = 0
 
     # Overall
     total_nblobs   = 0
@@ -334,6 +360,10 @@ def network_thread(ctx, port, command_port, inqueues, outqueue, finished_bricks,
     last_check_command = tnow
 
     nworkpackets = nworkbytes = 0
+    # Copies of work packet data made by farm.py, and bytes passed via shared memory
+    nworkcopies = nworkshm = 0
+    # Shared-memory work packets that ZeroMQ is still sending: [(tracker, shm, bufs)]
+    sending_shm = []
     nwaitingCounter = Counter()
 
     # For keeping track of how much time is spent in different parts of my job
@@ -349,7 +379,13 @@ def network_thread(ctx, port, command_port, inqueues, outqueue, finished_bricks,
     n_block = 0
     t_block = 0.
     n_nowork = 0
-    
+    # Per-inqueue number of items popped, time spent in get() (waiting
+    # for the queue lock and unpickling), and max depth seen.
+    nq = len(inqueues)
+    n_qget = [0] * nq
+    t_qget = [0.] * nq
+    max_qsize = [0] * nq
+
     while True:
         tnow = time.time()
         t1 = tnow
@@ -386,30 +422,42 @@ def network_thread(ctx, port, command_port, inqueues, outqueue, finished_bricks,
         if not havework:
 
             arg = None
-            # Round robin, non-blocking
-            for i in range(len(inqueues)):
+            # Non-blocking, fullest queue first (round-robin among ties)
+            order = [(i + next_inqueue) % nq for i in range(nq)]
+            try:
+                qsizes = [inqueues[i].qsize() for i in range(nq)]
+                for i in range(nq):
+                    max_qsize[i] = max(max_qsize[i], qsizes[i])
+                order.sort(key=lambda i: -qsizes[i])
+            except NotImplementedError:
+                # (qsize() is not available on Mac OS)
+                pass
+            for i in order:
                 try:
                     t_x = time.time()
-                    inq = inqueues[(i + next_inqueue) % len(inqueues)]
-                    arg = inq.get(block=False)
-                    next_inqueue += (i+1)
+                    arg = inqueues[i].get(block=False)
                     t_y = time.time()
+                    next_inqueue = i + 1
                     n_noblock += 1
                     t_noblock += (t_y - t_x)
+                    n_qget[i] += 1
+                    t_qget[i] += (t_y - t_x)
                     break
                 except queue.Empty:
                     pass
 
             if arg is None:
                 # Round robin, blocking
+                i = next_inqueue % nq
+                next_inqueue += 1
                 try:
                     t_x = time.time()
-                    inq = inqueues[next_inqueue % len(inqueues)]
-                    next_inqueue += 1
-                    arg = inq.get(block=True, timeout=1)
+                    arg = inqueues[i].get(block=True, timeout=1)
                     t_y = time.time()
                     n_block += 1
                     t_block += (t_y - t_x)
+                    n_qget[i] += 1
+                    t_qget[i] += (t_y - t_x)
                 except queue.Empty:
                     n_nowork += 1
                     work = nowork
@@ -453,7 +501,11 @@ def network_thread(ctx, port, command_port, inqueues, outqueue, finished_bricks,
             for n in nw:
                 print('  ', n, ':', nwaitingCounter[n])
             nwaitingCounter.clear()
-            #nworkpackets = nworkbytes = 0
+            if nworkpackets:
+                print(qname, 'Work packets sent: %i, %.1f MB (%.1f kB/packet, %.2f copies/packet), %.1f MB via shared memory' %
+                      (nworkpackets, nworkbytes/1e6, nworkbytes/1e3/nworkpackets,
+                       nworkcopies/nworkpackets, nworkshm/1e6))
+            nworkpackets = nworkbytes = nworkcopies = nworkshm = 0
             last_print_workqueue = tnow
 
         if tnow - last_printout > 15:
@@ -482,8 +534,8 @@ def network_thread(ctx, port, command_port, inqueues, outqueue, finished_bricks,
                     pass
 
             info()
-            info(qname, 'Work queues:', ', '.join(['%i'%q.qsize() for q in inqueues]), ', Output queue: %i.  Work packets sent: %i, Results received: %i, Outstanding work packets: %i' %
-                 (outqueue.qsize(), worksent, resultsreceived, worksent-resultsreceived))
+            info(qname, 'Work queues:', ', '.join(['%i'%_qsize(q) for q in inqueues]), ', Output queue: %i.  Work packets sent: %i, Results received: %i, Outstanding work packets: %i' %
+                 (_qsize(outqueue), worksent, resultsreceived, worksent-resultsreceived))
 
             # Outstanding work tallies
             brick_out_n = Counter()
@@ -506,6 +558,9 @@ def network_thread(ctx, port, command_port, inqueues, outqueue, finished_bricks,
             info('In this period, %5i finished blobs, total CPU time %8i, wall %8i, overhead %8i sec, %5.1f %% CPU use' %
                  (status_nblobs, int(status_cputime), int(status_walltime), int(status_overhead),
                   100. * (status_cputime / max(1, status_walltime + status_overhead))))
+            info('Worker-reported times: waiting for work %8i, unpickling %8i, pickling %8i sec; %5i results in %5i messages' %
+                 (int(status_wait), int(status_unpickle), int(status_pickle),
+                  status_nblobs, status_nmsgs))
             total_cputime  += status_cputime
             total_walltime += status_walltime
             total_overhead += status_overhead
@@ -514,6 +569,8 @@ def network_thread(ctx, port, command_port, inqueues, outqueue, finished_bricks,
             status_walltime = 0.
             status_overhead = 0.
             status_nblobs   = 0
+            status_wait = status_unpickle = status_pickle = 0.
+            status_nmsgs = 0
 
 
             info('Overall,        %5i finished blobs, total CPU time %8i, wall %8i, overhead %8i sec, %5.1f %% CPU use' %
@@ -545,8 +602,15 @@ def network_thread(ctx, port, command_port, inqueues, outqueue, finished_bricks,
             info('  %5i non-blocking reads, taking %5.1f sec' % (n_noblock, t_noblock))
             info('  %5i     blocking reads, taking %5.1f sec' % (n_block, t_block))
             info('  %5i times the blocking read timed out' % (n_nowork))
+            for i in range(nq):
+                info('  queue %2i: depth %5i (max %5i), %5i reads, %6.2f sec in get() (%.1f ms/read)' %
+                     (i, _qsize(inqueues[i]), max_qsize[i], n_qget[i], t_qget[i],
+                      1000. * t_qget[i] / max(1, n_qget[i])))
             n_noblock = n_block = n_nowork = 0
             t_noblock = t_block = 0.
+            n_qget = [0] * nq
+            t_qget = [0.] * nq
+            max_qsize = [0] * nq
 
             last_printout = tnow
 
@@ -574,16 +638,34 @@ def network_thread(ctx, port, command_port, inqueues, outqueue, finished_bricks,
 
         t2 = time.time()
 
-        assert(len(parts) == 3)
+        # [worker, meta, result], or with batched results,
+        # [worker, meta1, result1, meta2, result2, ...]
+        assert(len(parts) >= 3 and (len(parts) % 2) == 1)
         worker = parts[0]
-        meta   = parts[1]
-        result = parts[2]
-        debug('Request: from', worker, ':', len(result), 'bytes')
+        results = list(zip(parts[1::2], parts[2::2]))
+        debug('Request: from', worker, ':', len(results), 'results,',
+              sum([len(r) for _,r in results]), 'bytes')
         try:
-            sock.send(work) #, flags=zmq.NOBLOCK)
+            if isinstance(work, SharedPacket):
+                shm,bufs = work.attach()
+                try:
+                    tracker = sock.send_multipart([work.header] + bufs, copy=False, track=True)
+                except:
+                    # Keep the segment, so that the packet can be re-sent.
+                    SharedPacket.close(shm, bufs)
+                    raise
+                sending_shm.append((tracker, shm, bufs))
+                nworkbytes += work.nbytes()
+                nworkcopies += work.ncopies
+                nworkshm += work.nshared()
+            else:
+                sock.send(work) #, flags=zmq.NOBLOCK)
+                if havework:
+                    nworkbytes += len(work)
+                    # pickle.dumps, inqueue put & get, zmq send
+                    nworkcopies += 4
             if havework:
                 nworkpackets += 1
-                nworkbytes += len(work)
 
                 worksent += 1
                 tnow = time.time()
@@ -596,31 +678,47 @@ def network_thread(ctx, port, command_port, inqueues, outqueue, finished_bricks,
             import traceback
             traceback.print_exc()
 
+        # Release shared-memory segments that ZeroMQ has finished sending
+        if len(sending_shm):
+            sending_shm = [x for x in sending_shm if not SharedPacket.release(*x)]
+
         t3 = time.time()
 
-        if result == nowork:
+        if results[0][1] == nowork:
             debug('Empty result')
             continue
         else:
             debug('Non-empty result')
+        status_nmsgs += 1
+        t_decode_out = 0.
+        for meta,result in results:
             resultsreceived += 1
-        # Parse metadata of the result.
-        (brick,iblob,cpu,wall,overhead) = pickle.loads(meta)
-
-        brick_cputime[brick] += cpu
-        brick_nblobs [brick] += 1
-        status_cputime  += cpu
-        status_walltime += wall
-        status_overhead += overhead
-        status_nblobs   += 1
-        try:
-            del outstanding_work[(brick, iblob)]
-        except KeyError:
-            info('Failed to remove brick', brick, 'blob', iblob, 'from outstanding_work ?!')
-            pass
-        t4 = time.time()
-        outqueue.put((brick, iblob, result))
+            # Parse metadata of the result.
+            meta = pickle.loads(meta)
+            (brick,iblob,cpu,wall,overhead) = meta[:5]
+            if len(meta) > 5:
+                # Newer workers also report wait, unpickle & pickle times
+                (twait, tunpickle, tpickle) = meta[5:8]
+                status_wait     += twait
+                status_unpickle += tunpickle
+                status_pickle   += tpickle
+
+            brick_cputime[brick] += cpu
+            brick_nblobs [brick] += 1
+            status_cputime  += cpu
+            status_walltime += wall
+            status_overhead += overhead
+            status_nblobs   += 1
+            try:
+                del outstanding_work[(brick, iblob)]
+            except KeyError:
+                info('Failed to remove brick', brick, 'blob', iblob, 'from outstanding_work ?!')
+                pass
+            t3b = time.time()
+            outqueue.put((brick, iblob, result))
+            t_decode_out += (time.time() - t3b)
         t5 = time.time()
+        t4 = t5 - t_decode_out
 
         t_in += (t1a - t1)
         t_poll += (t1b - t1a)
@@ -629,6 +727,13 @@ def network_thread(ctx, port, command_port, inqueues, outqueue, finished_bricks,
         t_decode += (t4 - t3)
         t_out += (t5 - t4)
 
+def _qsize(q):
+    # (qsize() is not available on Mac OS)
+    try:
+        return q.qsize()
+    except NotImplementedError:
+        return -1
+
 def output_thread(queuename, outqueue, checkpointqueue, blobsizes,
                   finished_bricks, opt):
     try:
@@ -649,6 +754,30 @@ def output_thread(queuename, outqueue, checkpointqueue, blobsizes,
     # Local mapping of brickname -> [set of cancelled blob ids]
     brick_cancelled = {}
 
+    # Checkpoint files: brickname -> (CheckpointLog, set of blob ids written)
+    brick_checkpoints = {}
+
+    def write_checkpoint(brick):
+        # The first time, write all the results we have (including
+        # ones read from an existing checkpoint file); after that,
+        # append only new results.
+        brickresults = allresults[brick]
+        if not brick in brick_checkpoints:
+            checkpoint_fn = opt.checkpoint % dict(brick=brick, brickpre=brick[:3])
+            brick_checkpoints[brick] = (CheckpointLog(checkpoint_fn), set())
+        ckpt,written = brick_checkpoints[brick]
+        if ckpt.nrecords is None:
+            R = [dict(brickname=brick, iblob=iblob, result=res) for
+                 iblob,res in brickresults.items()]
+            ckpt.write(R)
+            written.update(brickresults.keys())
+        else:
+            new = [iblob for iblob in brickresults.keys() if not iblob in written]
+            ckpt.append([dict(brickname=brick, iblob=iblob, result=brickresults[iblob])
+                         for iblob in new])
+            written.update(new)
+        return ckpt.nrecords
+
     def get_brick_nblobs(brick, defnblobs=None):
         if not brick in brick_info:
             try:
@@ -684,16 +813,16 @@ def output_thread(queuename, outqueue, checkpointqueue, blobsizes,
         if ndone + ncancelled < nblobs:
             return
         # Done this brick!  Set qdo state=Succeeded
-        checkpoint_fn = opt.checkpoint % dict(brick=brick, brickpre=brick[:3])
-        R = [dict(brickname=brick, iblob=iblob, result=res) for
-             iblob,res in allresults[brick].items()]
-        info('Writing final checkpoint', checkpoint_fn)
-        _write_checkpoint(R, checkpoint_fn)
+        info('Writing final checkpoint', opt.checkpoint % dict(brick=brick, brickpre=brick[:3]))
+        write_checkpoint(brick)
+        nr = len(allresults[brick])
+        brick_checkpoints[brick][0].close()
+        del brick_checkpoints[brick]
         info('Setting QDO task to Succeeded:', brick)
         q.set_task_state(taskid, qdo.Task.SUCCEEDED)
         del allresults[brick]
-        finished_bricks.put((brick, len(R)))
-        status_bricks_finished.append((brick, len(R)))
+        finished_bricks.put((brick, nr))
+        status_bricks_finished.append((brick, nr))
         nonlocal n_bricks_finished
         n_bricks_finished += 1
 
@@ -715,13 +844,11 @@ def output_thread(queuename, outqueue, checkpointqueue, blobsizes,
                         #print('Brick', brick, 'has not changed since last checkpoint was written')
                         continue
                 checkpoint_fn = opt.checkpoint % dict(brick=brick, brickpre=brick[:3])
-                R = [dict(brickname=brick, iblob=iblob, result=res) for
-                     iblob,res in brickresults.items()]
                 last_checkpoint_size[brick] = len(brickresults)
                 nblobs,_ = get_brick_nblobs(brick, '(unknown)')
                 info('Writing interim checkpoint', checkpoint_fn, ':', len(brickresults), 'of',
                       nblobs, 'results')
-                _write_checkpoint(R, checkpoint_fn)
+                write_checkpoint(brick)
             last_checkpoint = tnow
 
         dt = tnow - last_status
@@ -817,6 +944,10 @@ def get_blob_iter(skipblobs=None,
                   T=None,
                   T_clusters=None,
                   custom_brick=False,
+                  blob_order=None,
+                  model_procs=0,
+                  model_procs_npix=250000,
+                  model_procs_nsrcs=100,
                   **kwargs):
     from legacypipe.runbrick import get_frozen_galaxies, get_blobiter_ref_map
     if skipblobs is None:
@@ -839,7 +970,10 @@ def get_blob_iter(skipblobs=None,
                           brick,
                           frozen_galaxies,
                           max_blobsize=max_blobsize, custom_brick=custom_brick,
-                          skipblobs=skipblobs)
+                          skipblobs=skipblobs, blob_order=blob_order,
+                          model_procs=model_procs,
+                          model_procs_npix=model_procs_npix,
+                          model_procs_nsrcs=model_procs_nsrcs)
     return blobiter
 
 class PrioritizedItem(object):
@@ -849,6 +983,136 @@ class PrioritizedItem(object):
     def __lt__(self, other):
         return self.priority < other.priority
 
+class _ContiguousPickler(pickle.Pickler):
+    # Makes non-contiguous numpy arrays (eg, sub-image slices)
+    # contiguous, so that they can be pickled out-of-band.
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.ncontig = 0
+    def reducer_override(self, obj):
+        import numpy as np
+        if (type(obj) is np.ndarray and not obj.dtype.hasobject and
+            not (obj.flags.c_contiguous or obj.flags.f_contiguous)):
+            self.ncontig += 1
+            return np.ascontiguousarray(obj).__reduce_ex__(5)
+        return NotImplemented
+
+class SharedPacket(object):
+    '''
+    A work packet pickled with protocol 5, with its out-of-band
+    buffers (the image, inverse-error and DQ arrays) copied into a
+    shared-memory segment.  Only this small object goes through the
+    inqueue; the network_thread attaches to the segment and passes
+    the buffers to ZeroMQ without copying them.
+
+    The segment is unlinked by the network_thread once ZeroMQ has
+    finished sending it (see release).  Segments are named with
+    *prefix*, so that those of packets that are never sent can be
+    removed on shutdown (see remove_shared_packets).
+    '''
+    def __init__(self, obj, prefix='lpfarm-'):
+        import secrets
+        from io import BytesIO
+        from multiprocessing import shared_memory
+        buffers = []
+        f = BytesIO()
+        p = _ContiguousPickler(f, protocol=5, buffer_callback=buffers.append)
+        p.dump(obj)
+        self.header = f.getvalue()
+        raws = [b.raw() for b in buffers]
+        self.sizes = [r.nbytes for r in raws]
+        # copies of the array data: into the segment, plus making them contiguous
+        self.ncopies = 1 + p.ncontig
+        self.shm_name = None
+        total = sum(self.sizes)
+        if total == 0:
+            return
+        shm = shared_memory.SharedMemory(name=prefix + secrets.token_hex(8),
+                                         create=True, size=total)
+        off = 0
+        for r,n in zip(raws, self.sizes):
+            shm.buf[off:off+n] = r
+            off += n
+        del raws, buffers
+        self.shm_name = shm.name
+        # The network_thread will unlink the segment; don't let this
+        # process's resource tracker remove it when we exit (unsent
+        # segments are removed by main()).
+        from multiprocessing import resource_tracker
+        resource_tracker.unregister(shm._name, 'shared_memory')
+        shm.close()
+
+    def nshared(self):
+        return sum(self.sizes)
+
+    def nbytes(self):
+        return len(self.header) + self.nshared()
+
+    def attach(self):
+        '''
+        Attaches to the shared-memory segment, returning (shm, list of
+        memoryviews, one per out-of-band buffer).
+        '''
+        from multiprocessing import shared_memory
+        if self.shm_name is None:
+            return None, []
+        shm = shared_memory.SharedMemory(name=self.shm_name)
+        bufs = []
+        off = 0
+        for n in self.sizes:
+            bufs.append(shm.buf[off:off+n])
+            off += n
+        return shm, bufs
+
+    @staticmethod
+    def close(shm, bufs):
+        '''
+        Detaches from the segment (without removing it); returns True
+        if closed.
+        '''
+        if shm is None:
+            return True
+        for b in bufs:
+            b.release()
+        try:
+            shm.close()
+        except BufferError:
+            # ZeroMQ has not yet dropped its references
+            return False
+        return True
+
+    @staticmethod
+    def release(tracker, shm, bufs):
+        '''
+        Closes and removes the segment once ZeroMQ is done sending from
+        it; returns True if released.
+        '''
+        if not tracker.done:
+            return False
+        if not SharedPacket.close(shm, bufs):
+            return False
+        if shm is not None:
+            try:
+                shm.unlink()
+            except FileNotFoundError:
+                pass
+        return True
+
+def remove_shared_packets(prefix):
+    '''
+    Removes any left-over shared-memory segments of SharedPackets
+    named with *prefix* (ie, packets that were never sent).
+    '''
+    import glob
+    fns = glob.glob(os.path.join('/dev/shm', prefix + '*'))
+    for fn in fns:
+        try:
+            os.remove(fn)
+        except OSError:
+            pass
+    if len(fns):
+        info('Removed', len(fns), 'unsent shared-memory work packets')
+
 # we switched to multiprocessing and mp.Queue, so don't need this any more
 # class ThreadSafeDict(object):
 #     def __init__(self):
@@ -873,11 +1137,17 @@ class PrioritizedItem(object):
 #         with self.lock:
 #             return self.d.copy()
 
-def queue_work(brickname, inqueue, bigqueue, checkpointqueue, opt):
+def queue_work(brickname, inqueue, bigqueue, checkpointqueue, opt,
+               cost_model=None):
     '''
     Called from the input thread to generate work packets for the given *brickname*.
+
+    With a *cost_model* (a BlobCostModel, which gets calibrated
+    against any checkpointed results we read), blobs are queued in
+    order of predicted CPU time, most expensive first.
     '''
     from astrometry.util.file import unpickle_from_file
+    from legacypipe.runbrick import get_blob_cost_order
 
     pickle_fn = opt.pickle % dict(brick=brickname, brickpre=brickname[:3])
     info('Looking for', pickle_fn)
@@ -888,12 +1158,13 @@ def queue_work(brickname, inqueue, bigqueue, checkpointqueue, opt):
 
     # Total blobs includes checkpointed ones.
     nchk = 0
+    R = []
 
     # Check for and read existing checkpoint file.
     checkpoint_fn = opt.checkpoint % dict(brick=brickname, brickpre=brickname[:3])
     if os.path.exists(checkpoint_fn):
         debug('Reading checkpoint file', checkpoint_fn)
-        R = unpickle_from_file(checkpoint_fn)
+        R = read_checkpoint(checkpoint_fn)
         info('Brick', brickname, ': Read', len(R), 'from checkpoint file')
 
         skipblobs = []
@@ -911,6 +1182,12 @@ def queue_work(brickname, inqueue, bigqueue, checkpointqueue, opt):
 
     # (brickname is in the kwargs read from the pickle!)
     assert(kwargs['brickname'] == brickname)
+    if cost_model is not None:
+        kwargs.update(blob_order=get_blob_cost_order(
+            R, kwargs.get('T'), kwargs['blobslices'], kwargs['blobsrcs'], kwargs['blobmap'],
+            kwargs.get('tims'), kwargs['targetwcs'], model=cost_model))
+    del R
+    kwargs.update(model_procs=opt.model_procs, model_procs_npix=opt.big_pix)
     blobiter = get_blob_iter(**kwargs)
 
     big_npix = opt.big_pix
@@ -944,7 +1221,10 @@ def queue_work(brickname, inqueue, bigqueue, checkpointqueue, opt):
             info('Blob of size', blobw, 'x', blobh, 'goes on big queue')
             dest_queue = bigqueue
 
-        picl = pickle.dumps(arg, -1)
+        if opt.zero_copy:
+            picl = SharedPacket(arg, prefix=opt.shm_prefix)
+        else:
+            picl = pickle.dumps(arg, -1)
 
         qitem = PrioritizedItem(priority=priority, item=(br, iblob, picl))
 
@@ -967,8 +1247,14 @@ def input_thread(queuename, inqueue, bigqueue, checkpointqueue, blobsizes, opt,
 
     #info('Input process', os.getpid(), 'starting')
     import qdo
+    from legacypipe.blobcost import BlobCostModel
     q = qdo.connect(queuename)
 
+    # Calibrated against the checkpointed results of all the bricks we read
+    cost_model = None
+    if opt.blob_cost_order:
+        cost_model = BlobCostModel()
+
     while True:
         task = q.get(timeout=10)
         if task is None:
@@ -978,7 +1264,8 @@ def input_thread(queuename, inqueue, bigqueue, checkpointqueue, blobsizes, opt,
             brickname = task.task
             debug('Brick', brickname)
             # WORK
-            nblobs = queue_work(brickname, inqueue, bigqueue, checkpointqueue, opt)
+            nblobs = queue_work(brickname, inqueue, bigqueue, checkpointqueue, opt,
+                                cost_model=cost_model)
             blobsizes.put((brickname, nblobs, task.id))
             #
             debug('Finished', brickname, 'with', nblobs, 'blobs')
@@ -0,0 +1,195 @@
+'''
+Fiber fluxes (FIBERFLUX, FIBERTOTFLUX) for runbrick.get_fiber_fluxes.
+
+The fluxes are aperture sums, over a fiber-sized circle, of the
+sources' models rendered in nominal seeing: FIBERFLUX of the source's
+own model, FIBERTOTFLUX of the sum of all models, at the source's
+position.  Rather than rendering each model into a full brick-sized
+image and calling photutils.aperture_photometry per source and band,
+each source's unit-flux patch is rendered once (the models differ
+between bands only by a scale) and multiplied by exact circle/pixel
+overlap weights -- the same weights as photutils' "exact" method --
+for its own aperture and for every other source's aperture it
+touches.  Those per-pair sums, scaled by the band fluxes, give both
+quantities in one pass, with no brick-sized buffers; sources can be
+split between forked processes.
+'''
+
+import os
+
+import numpy as np
+
+import logging
+logger = logging.getLogger('legacypipe.fiberflux')
+def info(*args):
+    from legacypipe.utils import log_info
+    log_info(logger, args)
+def debug(*args):
+    from legacypipe.utils import log_debug
+    log_debug(logger, args)
+
+def _segment_area(x0, x1, h, r):
+    # Area of the circle (radius r, at the origin) above the line y=h
+    # (h >= 0), between x=x0 and x=x1 (x0 <= x1).
+    s = np.sqrt(np.maximum(r*r - h*h, 0.))
+    def g(x):
+        # indefinite integral of sqrt(r^2 - x^2) - h
+        return 0.5 * (x * np.sqrt(np.maximum(r*r - x*x, 0.)) +
+                      r*r * np.arcsin(np.clip(x / r, -1., 1.)) - 2.*h*x)
+    return g(np.clip(x1, -s, s)) - g(np.clip(x0, -s, s))
+
+def circle_box_overlap(x0, x1, y0, y1, r):
+    '''
+    Returns the area of overlap of the circle of radius *r* at the
+    origin with the box(es) [*x0*,*x1*] x [*y0*,*y1*] (arrays broadcast).
+    '''
+    def upper(a, b):
+        # between horizontal lines y=a and y=b, 0 <= a <= b
+        return _segment_area(x0, x1, a, r) - _segment_area(x0, x1, b, r)
+    return (upper(np.maximum(y0, 0.), np.maximum(y1, 0.)) +
+            upper(np.maximum(-y1, 0.), np.maximum(-y0, 0.)))
+
+def aperture_weights(cx, cy, r, H=None, W=None):
+    '''
+    Exact pixel weights (overlap areas) of circular apertures of
+    radius *r* pixels centered at *cx*, *cy* (arrays; pixel i,j covers
+    [j-0.5, j+0.5] x [i-0.5, i+0.5]).  Pixels outside an *H* x *W*
+    image, if given, get zero weight; so does an aperture with a
+    non-finite center.
+
+    Returns (x0, y0, w): *w*, shape (N, n, n), holds the weights of
+    pixels x0..x0+n-1, y0..y0+n-1 of each aperture.
+    '''
+    cx = np.atleast_1d(np.asarray(cx, float))
+    cy = np.atleast_1d(np.asarray(cy, float))
+    n = int(np.ceil(2. * r)) + 2
+    ok = np.isfinite(cx) * np.isfinite(cy)
+    cx = np.where(ok, cx, 0.)
+    cy = np.where(ok, cy, 0.)
+    x0 = np.floor(cx - r + 0.5).astype(int)
+    y0 = np.floor(cy - r + 0.5).astype(int)
+    d = np.arange(n)
+    xx = x0[:,np.newaxis] + d[np.newaxis,:]
+    yy = y0[:,np.newaxis] + d[np.newaxis,:]
+    # pixel edges relative to the centers
+    xl = (xx - 0.5 - cx[:,np.newaxis])[:,np.newaxis,:]
+    yl = (yy - 0.5 - cy[:,np.newaxis])[:,:,np.newaxis]
+    w = circle_box_overlap(xl, xl + 1., yl, yl + 1., r)
+    w *= ok[:,np.newaxis,np.newaxis]
+    if W is not None:
+        w *= ((xx >= 0) * (xx < W))[:,np.newaxis,:]
+    if H is not None:
+        w *= ((yy >= 0) * (yy < H))[:,:,np.newaxis]
+    return x0, y0, w
+
+def patch_aperture_sums(patch, x0, y0, w):
+    '''
+    Returns the sums of tractor Patch *patch* times each of the
+    aperture weights *w* (at pixel offsets *x0*, *y0*; see
+    aperture_weights).
+    '''
+    p = patch.patch
+    n = w.shape[-1]
+    if len(x0) == 0 or p is None:
+        return np.zeros(len(x0))
+    ph,pw = p.shape
+    # Pad so that every aperture box touching the patch is in bounds;
+    # boxes that don't touch it are pointed at the zero padding.
+    padded = np.zeros((ph + 2*n, pw + 2*n), np.float64)
+    padded[n:n+ph, n:n+pw] = p
+    ox = np.clip(x0 - patch.x0 + n, 0, pw + n)
+    oy = np.clip(y0 - patch.y0 + n, 0, ph + n)
+    d = np.arange(n)
+    win = padded[oy[:,np.newaxis,np.newaxis] + d[np.newaxis,:,np.newaxis],
+                 ox[:,np.newaxis,np.newaxis] + d[np.newaxis,np.newaxis,:]]
+    return np.sum(win * w, axis=(1,2))
+
+def _touching(x0, y0, n, yorder, ysorted, ext):
+    # Indices of the apertures (boxes x0,y0 + n) overlapping extent ext
+    px0,px1,py0,py1 = ext
+    i0 = np.searchsorted(ysorted, py0 - n, side='right')
+    i1 = np.searchsorted(ysorted, py1, side='left')
+    I = yorder[i0:i1]
+    return I[(x0[I] + n > px0) * (x0[I] < px1)]
+
+def fiber_patch_sums(cat, isrcs, faketim, fiberrad, tot, H, W,
+                     fluxes=None, modimgs=None):
+    '''
+    Renders the unit-flux model patches of sources *isrcs* of *cat* in
+    *faketim*, and returns (u, pi, pj, pc):
+
+    *u*: each source's own (fiber) aperture sum, or 0.
+    *pi*, *pj*, *pc*: total-flux aperture *pi* of the (x0, y0, w)
+    apertures *tot* gets *pc* times the flux of source *pj*.
+
+    With *modimgs* (and per-band *fluxes*), also adds the models to
+    those images (for plots).
+    '''
+    tx0,ty0,tw = tot
+    n = tw.shape[-1]
+    yorder = np.argsort(ty0, kind='stable')
+    ysorted = ty0[yorder]
+    u = np.zeros(len(isrcs))
+    PI,PJ,PC = [],[],[]
+    for k,isrc in enumerate(isrcs):
+        src = cat[isrc]
+        if src is None:
+            continue
+        # This works even if bands[0] has zero flux (or no overlapping
+        # images)
+        ums = src.getUnitFluxModelPatches(faketim)
+        assert(len(ums) == 1)
+        patch = ums[0]
+        if patch is None:
+            continue
+        sx,sy = faketim.getWcs().positionToPixel(src.getPosition())
+        fx0,fy0,fw = aperture_weights(sx, sy, fiberrad, H=H, W=W)
+        u[k] = patch_aperture_sums(patch, fx0, fy0, fw)[0]
+        I = _touching(tx0, ty0, n, yorder, ysorted, patch.getExtent())
+        c = patch_aperture_sums(patch, tx0[I], ty0[I], tw[I])
+        keep = (c != 0)
+        PI.append(I[keep])
+        PJ.append(np.zeros(np.sum(keep), int) + isrc)
+        PC.append(c[keep])
+        if modimgs is not None:
+            for iband,modimg in enumerate(modimgs):
+                if fluxes[isrc, iband] != 0:
+                    patch.addTo(modimg, scale=fluxes[isrc, iband])
+    if len(PI) == 0:
+        return u, np.zeros(0, int), np.zeros(0, int), np.zeros(0)
+    return u, np.hstack(PI), np.hstack(PJ), np.hstack(PC)
+
+def fiber_fluxes(cat, fluxes, faketim, fiberrad, bx, by, H, W,
+                 nprocs=1, modimgs=None):
+    '''
+    Computes FIBERFLUX and FIBERTOTFLUX (see the module docstring).
+
+    *fluxes*: array (len(cat), nbands) of the source fluxes, zero for
+    source-bands to leave out.
+    *bx*, *by*: positions of the total-flux apertures.
+    *nprocs*: split the sources between this many forked processes.
+    *modimgs*: optional per-band images to add the models to (only
+    done in this process).
+
+    Returns fiberflux, fibertotflux: float32 arrays like *fluxes*.
+    '''
+    N = len(cat)
+    tot = aperture_weights(bx, by, fiberrad, H=H, W=W)
+    if (nprocs > 1 and modimgs is None and N >= 100 and
+        hasattr(os, 'fork')):
+        from legacypipe.utils import fork_map
+        chunks = np.array_split(np.arange(N), nprocs * 4)
+        info('Computing fiber fluxes for', N, 'sources in', nprocs, 'processes')
+        R = fork_map(lambda I: fiber_patch_sums(cat, I, faketim, fiberrad, tot, H, W),
+                     [(I,) for I in chunks if len(I)], nprocs)
+        u = np.hstack([r[0] for r in R])
+        pi,pj,pc = [np.hstack([r[i] for r in R]) for i in [1,2,3]]
+    else:
+        u,pi,pj,pc = fiber_patch_sums(cat, np.arange(N), faketim, fiberrad, tot,
+                                      H, W, fluxes=fluxes, modimgs=modimgs)
+    fiberflux = (fluxes * u[:,np.newaxis]).astype(np.float32)
+    fibertotflux = np.zeros(fluxes.shape, np.float32)
+    for iband in range(fluxes.shape[1]):
+        fibertotflux[:,iband] = np.bincount(pi, weights=pc * fluxes[pj, iband],
+                                            minlength=N)
+    return fiberflux, fibertotflux
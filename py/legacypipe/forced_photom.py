@@ -45,6 +45,8 @@ def get_parser():
     parser.add_argument('--catalog-dir-north', help='Set LEGACY_SURVEY_DIR to use to read Northern catalogs')
     parser.add_argument('--catalog-dir-south', help='Set LEGACY_SURVEY_DIR to use to read Southern catalogs')
     parser.add_argument('--catalog-resolve-dec-ngc', type=float, help='Dec at which to switch from Northern to Southern catalogs (NGC only)')
+    parser.add_argument('--exposure-catalog', default=False, action='store_true',
+                        help='Read the catalogs touching all the CCDs once, rather than once per CCD')
 
     parser.add_argument('--skip-calibs', dest='do_calib', default=True, action='store_false',
                         help='Do not try to run calibrations')
@@ -217,6 +219,24 @@ def main(survey=None, opt=None, args=None):
                 fnset.add(fn)
         copy_files_to_cache(fnset)
 
+    expcat = None
+    if opt.exposure_catalog and not opt.catalog:
+        tm = Time()
+        for catsurvey in [catsurvey_north, catsurvey_south]:
+            if catsurvey is None:
+                continue
+            try:
+                catsurvey.get_bricks_readonly()
+            except:
+                catsurvey.bricks = survey.get_bricks_readonly()
+        wcslist = [survey.get_approx_wcs(ccd) for ccd in ccds]
+        expcat = ExposureCatalog(wcslist, survey, catsurvey_north,
+                                 catsurvey_south=catsurvey_south,
+                                 resolve_dec=opt.catalog_resolve_dec_ngc,
+                                 bands=list(set(ccds.filter)))
+        print_timing('Reading exposure catalog:', Time()-tm)
+    set_exposure_catalog(expcat)
+
     args = []
     catalog = None
     for ccd in ccds:
@@ -227,7 +247,8 @@ def main(survey=None, opt=None, args=None):
     if opt.threads:
         from astrometry.util.multiproc import multiproc
         from astrometry.util.timingpool import TimingPool, TimingPoolMeas
-        pool = TimingPool(opt.threads)
+        pool = TimingPool(opt.threads, initializer=set_exposure_catalog,
+                          initargs=[expcat])
         poolmeas = TimingPoolMeas(pool, pickleTraffic=False)
         Time.add_measurement(poolmeas)
         mp = multiproc(None, pool=pool)
@@ -344,71 +365,36 @@ def main(survey=None, opt=None, args=None):
     print_timing('Total:', tnow-t0)
     return 0
 
+# The ExposureCatalog (--exposure-catalog) shared by all the CCDs; set
+# in worker processes via the pool initializer.
+exposure_catalog = None
+def set_exposure_catalog(expcat):
+    global exposure_catalog
+    exposure_catalog = expcat
+
 def bounce_one_ccd(X):
     # for multiprocessing
     return forced_photom_one_ccd(*X)
 
+catalog_columns = ['ra', 'dec', 'brick_primary', 'type', 'release',
+                   'brickid', 'brickname', 'objid',
+                   'sersic', 'shape_r', 'shape_e1', 'shape_e2',
+                   'ref_epoch', 'pmra', 'pmdec', 'parallax', 'ref_cat', 'ref_id',]
+
 def get_catalog_in_wcs(chipwcs, survey, catsurvey_north, catsurvey_south=None,
                        resolve_dec=None, margin=20, bands=None):
+    surveys = _catalog_surveys(catsurvey_north, catsurvey_south)
     TT = []
-    surveys = [(catsurvey_north, True)]
-    if catsurvey_south is not None:
-        surveys.append((catsurvey_south, False))
-    if bands is None:
-        bands = []
-
-    columns = ['ra', 'dec', 'brick_primary', 'type', 'release',
-               'brickid', 'brickname', 'objid',
-               'sersic', 'shape_r', 'shape_e1', 'shape_e2',
-               'ref_epoch', 'pmra', 'pmdec', 'parallax', 'ref_cat', 'ref_id',]
-    fluxcolumns = ['flux_%s' % b for b in bands]
-
     for catsurvey,north in surveys:
         bricks = bricks_touching_wcs(chipwcs, survey=catsurvey)
-
         if resolve_dec is not None:
             from astrometry.util.starutil_numpy import radectolb
             bricks.gal_l, bricks.gal_b = radectolb(bricks.ra, bricks.dec)
-
         for b in bricks:
-            # Skip bricks that are entirely on the wrong side of the resolve line (NGC only)
-            if resolve_dec is not None:
-                # Northern survey, brick too far south (max dec is below the resolve line)
-                if north and b.dec2 <= resolve_dec:
-                    continue
-                # Southern survey, brick too far north (min dec is above the resolve line), but only in the North Galactic Cap
-                if not(north) and b.dec1 >= resolve_dec and b.gal_b > 0:
-                     continue
-            # there is some overlap with this brick... read the catalog.
-            fn = catsurvey.find_file('tractor', brick=b.brickname)
-            if not os.path.exists(fn):
-                print('WARNING: catalog', fn, 'does not exist.  Skipping!')
+            T = read_brick_catalog(catsurvey, north, b, resolve_dec, bands)
+            if T is None:
                 continue
-            print('Reading', fn)
-            # Read first row to see what columns are available, add flux columns if exist
-            t0 = fits_table(fn, rows=[0])
-            cols = t0.get_columns()
-            fc = [c for c in fluxcolumns if c in cols]
-            T = fits_table(fn, columns=columns + fc)
-            if resolve_dec is not None:
-                if north:
-                    T.cut(T.dec >= resolve_dec)
-                    print('Cut to', len(T), 'north of the resolve line')
-                elif b.gal_b > 0:
-                    # Northern galactic cap only: cut Southern survey
-                    T.cut(T.dec <  resolve_dec)
-                    print('Cut to', len(T), 'south of the resolve line')
-            _,xx,yy = chipwcs.radec2pixelxy(T.ra, T.dec)
-            W,H = chipwcs.get_width(), chipwcs.get_height()
-            # Cut to sources that are inside the image+margin
-            T.cut((xx >= -margin) * (xx <= (W+margin)) *
-                  (yy >= -margin) * (yy <= (H+margin)))
-            T.cut(T.brick_primary)
-            #print('Cut to', len(T), 'on brick_primary')
-            # drop DUP & NUN sources (NUN: eg see DR10 brick 0043m717
-            I, = np.nonzero([t.strip() not in ['DUP','NUN'] for t in T.type])
-            T.cut(I)
-            #print('Cut to', len(T), 'after removing DUP and NUN')
+            T.cut(_in_wcs(chipwcs, T, margin))
             if len(T):
                 TT.append(T)
     if len(TT) == 0:
@@ -416,14 +402,149 @@ def get_catalog_in_wcs(chipwcs, survey, catsurvey_north, catsurvey_south=None,
     T = merge_tables(TT, columns='fillzero')
     T._header = TT[0]._header
     del TT
+    return _add_missing_sga(T, chipwcs, survey, surveys)
+
+def _catalog_surveys(catsurvey_north, catsurvey_south):
+    surveys = [(catsurvey_north, True)]
+    if catsurvey_south is not None:
+        surveys.append((catsurvey_south, False))
+    return surveys
 
-    SGA = find_missing_sga(T, chipwcs, survey, surveys, columns)
+def _in_wcs(chipwcs, T, margin):
+    # Cut to sources that are inside the image+margin
+    _,xx,yy = chipwcs.radec2pixelxy(T.ra, T.dec)
+    W,H = chipwcs.get_width(), chipwcs.get_height()
+    return ((xx >= -margin) * (xx <= (W+margin)) *
+            (yy >= -margin) * (yy <= (H+margin)))
+
+def _add_missing_sga(T, chipwcs, survey, surveys):
+    SGA = find_missing_sga(T, chipwcs, survey, surveys, catalog_columns)
     if SGA is not None:
         ## Add 'em in!
         T = merge_tables([T, SGA], columns='fillzero')
     print('Total of', len(T), 'catalog sources')
     return T
 
+def read_brick_catalog(catsurvey, north, b, resolve_dec, bands):
+    '''
+    Reads the tractor catalog for brick *b* from *catsurvey*, applying
+    the resolve-line, brick_primary, and DUP/NUN cuts.  Returns None
+    if the brick is entirely on the wrong side of the resolve line
+    (NGC only) or the catalog file does not exist.
+    '''
+    # Skip bricks that are entirely on the wrong side of the resolve line (NGC only)
+    if resolve_dec is not None:
+        # Northern survey, brick too far south (max dec is below the resolve line)
+        if north and b.dec2 <= resolve_dec:
+            return None
+        # Southern survey, brick too far north (min dec is above the resolve line), but only in the North Galactic Cap
+        if not(north) and b.dec1 >= resolve_dec and b.gal_b > 0:
+            return None
+    # there is some overlap with this brick... read the catalog.
+    fn = catsurvey.find_file('tractor', brick=b.brickname)
+    if not os.path.exists(fn):
+        print('WARNING: catalog', fn, 'does not exist.  Skipping!')
+        return None
+    print('Reading', fn)
+    # Check the header to see what columns are available, add flux columns if exist
+    with fitsio.FITS(fn) as F:
+        cols = [c.lower() for c in F[1].get_colnames()]
+    fc = ['flux_%s' % band for band in (bands or [])]
+    fc = [c for c in fc if c in cols]
+    T = fits_table(fn, columns=catalog_columns + fc)
+    if resolve_dec is not None:
+        if north:
+            T.cut(T.dec >= resolve_dec)
+            print('Cut to', len(T), 'north of the resolve line')
+        elif b.gal_b > 0:
+            # Northern galactic cap only: cut Southern survey
+            T.cut(T.dec <  resolve_dec)
+            print('Cut to', len(T), 'south of the resolve line')
+    T.cut(T.brick_primary)
+    # drop DUP & NUN sources (NUN: eg see DR10 brick 0043m717
+    I, = np.nonzero([t.strip() not in ['DUP','NUN'] for t in T.type])
+    T.cut(I)
+    return T
+
+class ExposureCatalog(object):
+    '''
+    The catalog sources touching a set of CCDs (typically all the
+    chips in one exposure).  Adjacent chips share most of their
+    bricks, so rather than having get_catalog_in_wcs() re-read each
+    tractor catalog for every chip, we read the union of the bricks
+    once (with the resolve-line, brick_primary, and DUP/NUN cuts
+    applied), and then pull out each chip's sources with a kd-tree
+    search.
+
+    The *wcslist* WCS headers (eg, from LegacySurveyData.get_approx_wcs)
+    need not exactly match the tims' WCSes; they are padded by
+    *margin* pixels.
+    '''
+    def __init__(self, wcslist, survey, catsurvey_north, catsurvey_south=None,
+                 resolve_dec=None, bands=None, margin=100):
+        self.surveys = _catalog_surveys(catsurvey_north, catsurvey_south)
+        self.kd = None
+        wcslist = [wcs.get_subimage(-margin, -margin, int(wcs.get_width())+2*margin,
+                                    int(wcs.get_height())+2*margin)
+                   for wcs in wcslist]
+        TT = []
+        for catsurvey,north in self.surveys:
+            bricknames = set()
+            for wcs in wcslist:
+                bricks = bricks_touching_wcs(wcs, survey=catsurvey)
+                if resolve_dec is not None:
+                    from astrometry.util.starutil_numpy import radectolb
+                    bricks.gal_l, bricks.gal_b = radectolb(bricks.ra, bricks.dec)
+                for b in bricks:
+                    if b.brickname in bricknames:
+                        continue
+                    bricknames.add(b.brickname)
+                    T = read_brick_catalog(catsurvey, north, b, resolve_dec, bands)
+                    if T is None:
+                        continue
+                    # Cut to the union of the chips (+margin)
+                    inside = np.zeros(len(T), bool)
+                    for w in wcslist:
+                        inside |= _in_wcs(w, T, 0)
+                    T.cut(inside)
+                    if len(T):
+                        TT.append(T)
+            print('Read', len(bricknames), 'brick catalogs for', len(wcslist), 'CCDs')
+        if len(TT) == 0:
+            self.cat = None
+            return
+        self.cat = merge_tables(TT, columns='fillzero')
+        self.cat._header = TT[0]._header
+        print('Exposure catalog:', len(self.cat), 'sources')
+
+    def __getstate__(self):
+        # kd-trees don't pickle; rebuild them in each process.
+        d = self.__dict__.copy()
+        d['kd'] = None
+        return d
+
+    def get_catalog_in_wcs(self, chipwcs, survey, margin=20):
+        '''
+        Returns the catalog sources within *chipwcs* (+ *margin* pixels),
+        equivalent to get_catalog_in_wcs().
+        '''
+        from astrometry.libkd.spherematch import tree_build_radec, tree_search_radec
+        if self.cat is None:
+            return None
+        if self.kd is None:
+            self.kd = tree_build_radec(self.cat.ra, self.cat.dec)
+        ra,dec = chipwcs.radec_center()
+        radius = chipwcs.radius() + margin * chipwcs.pixel_scale() / 3600.
+        I = tree_search_radec(self.kd, ra, dec, radius)
+        # Keep the catalog ordering
+        I = np.sort(I)
+        T = self.cat[I]
+        T.cut(_in_wcs(chipwcs, T, margin))
+        if len(T) == 0:
+            return None
+        T._header = self.cat._header
+        return _add_missing_sga(T, chipwcs, survey, self.surveys)
+
 def find_missing_sga(T, chipwcs, survey, surveys, columns):
     # Look up SGA large galaxies touching this chip.
     # The ones inside this chip(+margin) will already exist in the catalog;
@@ -615,8 +736,12 @@ def forced_photom_one_ccd(survey, catsurvey_north, catsurvey_south, resolve_dec,
                 catsurvey_north.bricks = survey.get_bricks_readonly()
 
         chipwcs = tim.subwcs
-        T = get_catalog_in_wcs(chipwcs, survey, catsurvey_north, catsurvey_south=catsurvey_south,
-                               resolve_dec=resolve_dec, bands=[tim.band])
+        if exposure_catalog is not None:
+            T = exposure_catalog.get_catalog_in_wcs(chipwcs, survey)
+        else:
+            T = get_catalog_in_wcs(chipwcs, survey, catsurvey_north,
+                                   catsurvey_south=catsurvey_south,
+                                   resolve_dec=resolve_dec, bands=[tim.band])
         if T is None:
             print('No sources to photometer.')
             return None
@@ -103,18 +103,13 @@ class GaiaCatalog(HealpixedCatalog):
         # Prepare RA,Dec grid to pick up overlapping healpixes
         rr,dd = np.meshgrid(np.linspace(ralo,  rahi,  2+int(( rahi- ralo)/0.1)),
                             np.linspace(declo, dechi, 2+int((dechi-declo)/0.1)))
-        healpixes = set()
-        for r,d in zip(rr.ravel(), dd.ravel()):
-            healpixes.add(self.healpix_for_radec(r, d))
+        healpixes = np.unique(self.healpix_for_radec(rr.ravel() % 360., dd.ravel()))
         # Read catalog in those healpixes
-        cat = self.get_healpix_catalogs(healpixes)
+        if wrap:
+            rahi -= 360.
+        cat = self.get_healpix_catalogs(healpixes, box=(ralo, rahi, declo, dechi))
         #print('Read', len(cat), 'Gaia catalog entries.  RA range', cat.ra.min(), cat.ra.max(),
         #      'Dec range', cat.dec.min(), cat.dec.max())
-        cat.cut((cat.dec >= declo) * (cat.dec <= dechi))
-        if wrap:
-            cat.cut(np.logical_or(cat.ra <= ralo, cat.ra >= (rahi - 360.)))
-        else:
-            cat.cut((cat.ra  >= ralo ) * (cat.ra  <= rahi))
         return cat
 
     @staticmethod
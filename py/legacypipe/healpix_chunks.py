@@ -0,0 +1,396 @@
+'''
+Reading the healpix-chunked reference catalogs (Gaia, PS1, SDSS; see
+ps1cat.HealpixedCatalog).
+
+- radec_to_healpix: vectorized healpix numbers (ring or nested).
+
+- read_chunk: reads (selected columns of) a chunk file.  Uncompressed
+  files are memory-mapped, and the maps are kept in a per-process LRU
+  cache, so repeated queries (one per CCD or brick) don't re-open and
+  re-decode whole files.  Given an RA,Dec box, only the rows that can
+  be inside it are copied out.
+
+- Chunk files converted by this script (run as
+  "python -m legacypipe.healpix_chunks indir outdir") are uncompressed,
+  have their rows sorted into small RA,Dec cells, and carry an index
+  of the cells (a "CHUNKINDEX" extension), so box queries touch only
+  the rows of the cells overlapping the box.  Point $GAIA_CAT_DIR,
+  $PS1CAT_DIR, etc at the converted directory to use them.
+'''
+
+import os
+import sys
+from collections import OrderedDict
+
+import numpy as np
+
+import logging
+logger = logging.getLogger('legacypipe.healpix_chunks')
+def info(*args):
+    from legacypipe.utils import log_info
+    log_info(logger, args)
+def debug(*args):
+    from legacypipe.utils import log_debug
+    log_debug(logger, args)
+
+def radec_to_healpix(ra, dec, nside, nested=False):
+    '''
+    Returns the healpix numbers (ring, or *nested*, indexing) of
+    *ra*, *dec* (degrees, scalars or arrays).
+    '''
+    scalar = np.isscalar(ra) and np.isscalar(dec)
+    ra,dec = np.broadcast_arrays(np.atleast_1d(np.asarray(ra, float)),
+                                 np.atleast_1d(np.asarray(dec, float)))
+    z = np.sin(np.deg2rad(dec))
+    za = np.abs(z)
+    # in [0,4)
+    tt = (ra % 360.) / 90.
+    tt[tt >= 4.] = 0.
+    hp = np.zeros(ra.shape, np.int64)
+    eq = (za <= 2./3.)
+    pol = np.logical_not(eq)
+    ns = np.int64(nside)
+    if nested:
+        face = np.zeros(ra.shape, np.int64)
+        ix = np.zeros(ra.shape, np.int64)
+        iy = np.zeros(ra.shape, np.int64)
+        # equatorial
+        t1 = nside * (0.5 + tt[eq])
+        t2 = nside * z[eq] * 0.75
+        jp = (t1 - t2).astype(np.int64)
+        jm = (t1 + t2).astype(np.int64)
+        ifp = jp // ns
+        ifm = jm // ns
+        face[eq] = np.where(ifp == ifm, ifp | 4, np.where(ifp < ifm, ifp, ifm + 8))
+        ix[eq] = jm & (ns - 1)
+        iy[eq] = ns - (jp & (ns - 1)) - 1
+        # polar caps
+        ntt = np.minimum(tt[pol].astype(np.int64), 3)
+        tp = tt[pol] - ntt
+        tmp = nside * np.sqrt(3. * (1. - za[pol]))
+        jp = np.minimum((tp * tmp).astype(np.int64), ns - 1)
+        jm = np.minimum(((1. - tp) * tmp).astype(np.int64), ns - 1)
+        north = (z[pol] >= 0)
+        face[pol] = np.where(north, ntt, ntt + 8)
+        ix[pol] = np.where(north, ns - jm - 1, jp)
+        iy[pol] = np.where(north, ns - jp - 1, jm)
+        hp = face * ns * ns + _interleave(ix) + (_interleave(iy) << 1)
+    else:
+        ncap = 2 * ns * (ns - 1)
+        npix = 12 * ns * ns
+        # equatorial
+        t1 = nside * (0.5 + tt[eq])
+        t2 = nside * z[eq] * 0.75
+        jp = (t1 - t2).astype(np.int64)
+        jm = (t1 + t2).astype(np.int64)
+        ir = ns + 1 + jp - jm
+        kshift = 1 - (ir & 1)
+        ip = ((jp + jm - ns + kshift + 1) // 2) % (4 * ns)
+        hp[eq] = ncap + (ir - 1) * 4 * ns + ip
+        # polar caps
+        tp = tt[pol] - np.floor(tt[pol])
+        tmp = nside * np.sqrt(3. * (1. - za[pol]))
+        jp = (tp * tmp).astype(np.int64)
+        jm = ((1. - tp) * tmp).astype(np.int64)
+        ir = jp + jm + 1
+        ip = (tt[pol] * ir).astype(np.int64) % (4 * ir)
+        hp[pol] = np.where(z[pol] > 0, 2 * ir * (ir - 1) + ip,
+                           npix - 2 * ir * (ir + 1) + ip)
+    if scalar:
+        return int(hp[0])
+    return hp
+
+def _interleave(x):
+    # Spreads the bits of x into the even bits of the result.
+    x = x.astype(np.int64)
+    r = np.zeros_like(x)
+    for b in range(30):
+        r |= ((x >> b) & 1) << (2 * b)
+    return r
+
+def radec_box(ra, dec, pad=0.):
+    '''
+    Returns an RA,Dec box (ralo, rahi, declo, dechi), padded by *pad*
+    degrees, containing the points *ra*, *dec* (eg, a grid over an
+    image).  ralo > rahi means the box wraps through RA=0; ralo,rahi =
+    0,360 for boxes including a pole.
+    '''
+    ra = np.asarray(ra, float).ravel()
+    dec = np.asarray(dec, float).ravel()
+    declo = max(dec.min() - pad, -90.)
+    dechi = min(dec.max() + pad,  90.)
+    r0 = ra[len(ra)//2]
+    dra = (ra - r0 + 180.) % 360. - 180.
+    cosd = np.cos(np.deg2rad(max(abs(declo), abs(dechi))))
+    if cosd <= 0:
+        return (0., 360., declo, dechi)
+    rpad = pad / cosd
+    lo = dra.min() - rpad
+    hi = dra.max() + rpad
+    if hi - lo >= 180.:
+        return (0., 360., declo, dechi)
+    return ((r0 + lo) % 360., (r0 + hi) % 360., declo, dechi)
+
+def in_radec_box(ra, dec, box):
+    '''
+    Returns a boolean array: are *ra*, *dec* inside *box* (see radec_box)?
+    '''
+    ralo,rahi,declo,dechi = box
+    ok = (dec >= declo) * (dec <= dechi)
+    if rahi - ralo >= 360.:
+        pass
+    elif ralo <= rahi:
+        ok *= (ra >= ralo) * (ra <= rahi)
+    else:
+        ok *= np.logical_or(ra >= ralo, ra <= rahi)
+    return ok
+
+# Per-process LRU cache of opened chunks: filename -> ChunkFile
+chunk_cache_size = 64
+_chunk_cache = OrderedDict()
+
+index_ext = 'CHUNKINDEX'
+
+class ChunkFile(object):
+    '''
+    A memory-mapped chunk file (first table extension), with its
+    cell index if it has one.  *rows* is None if the file can't be
+    memory-mapped.
+    '''
+    def __init__(self, fn):
+        import fitsio
+        st = os.stat(fn)
+        self.stamp = (st.st_mtime, st.st_size)
+        self.fn = fn
+        self.rows = None
+        self.index = None
+        with fitsio.FITS(fn) as F:
+            hdu = F[1]
+            self.nrows = hdu.get_nrows()
+            dtype,offsets,isvar = hdu.get_rec_dtype()
+            hdr = hdu.read_header()
+            colinfo = hdu._info['colinfo']
+            if (fn.endswith('.gz') or fn.endswith('.fz') or np.any(isvar) or
+                dtype.itemsize != hdr['NAXIS1']):
+                return
+            # Raw (on-disk) column types, and how to convert them
+            self.convert = {}
+            names = []
+            formats = []
+            for name,ci in zip(dtype.names, colinfo):
+                dt,shape = dtype.fields[name][0], dtype.fields[name][0].shape
+                base = dt.base
+                conv = None
+                if ci['tform'].endswith('L'):
+                    base = np.dtype('S1')
+                    conv = 'bool'
+                elif ci['tscale'] != 1. or ci['tzero'] != 0.:
+                    if (base.kind == 'u' and ci['tscale'] == 1. and
+                        ci['tzero'] == 2.**(8 * base.itemsize - 1)):
+                        # unsigned, stored as signed + offset
+                        conv = 'unsigned'
+                    else:
+                        return
+                elif base.kind == 'S':
+                    conv = 'str'
+                self.convert[name.lower()] = conv
+                names.append(name.lower())
+                formats.append((base, shape) if len(shape) else base)
+            raw = np.dtype(dict(names=names, formats=formats,
+                                offsets=[int(o) for o in offsets],
+                                itemsize=dtype.itemsize))
+            if self.nrows > 0:
+                self.rows = np.memmap(fn, dtype=raw, mode='r',
+                                      offset=hdu.get_offsets()['data_start'],
+                                      shape=(self.nrows,))
+            else:
+                self.rows = np.zeros(0, raw)
+            if index_ext in F:
+                ihdr = F[index_ext].read_header()
+                I = F[index_ext].read()
+                self.index = (ihdr['STRIPH'], I['key'], np.append(I['offset'], self.nrows))
+
+    def columns(self):
+        return list(self.rows.dtype.names)
+
+    def row_ranges(self, box):
+        '''
+        Returns a list of (lo,hi) row ranges that may be inside *box*,
+        using the cell index.
+        '''
+        striph,keys,offsets = self.index
+        ralo,rahi,declo,dechi = box
+        s0,s1 = dec_strip(np.array([declo, dechi]), striph)
+        ranges = []
+        for s in range(s0, s1+1):
+            nra = strip_nra(s, striph)
+            if rahi - ralo >= 360.:
+                cells = [(0, nra-1)]
+            elif ralo <= rahi:
+                cells = [(ra_cell(ralo, nra), ra_cell(rahi, nra))]
+            else:
+                cells = [(ra_cell(ralo, nra), nra-1), (0, ra_cell(rahi, nra))]
+            for c0,c1 in cells:
+                k0 = cell_key(s, c0, striph)
+                k1 = cell_key(s, c1, striph)
+                i0 = np.searchsorted(keys, k0, side='left')
+                i1 = np.searchsorted(keys, k1, side='right')
+                if i1 > i0:
+                    ranges.append((offsets[i0], offsets[i1]))
+        return ranges
+
+    def read(self, columns=None, box=None, rows=None):
+        '''
+        Returns a fits_table of the given *columns* (default all) of all
+        rows, or the given *rows*, or those inside RA,Dec *box*.
+        '''
+        from astrometry.util.fits import fits_table
+        if columns is None:
+            columns = self.columns()
+        columns = [c.lower() for c in columns]
+        if rows is not None:
+            data = self.rows[np.asarray(rows, dtype=np.intp)]
+        elif box is not None and self.index is not None:
+            ranges = self.row_ranges(box)
+            if len(ranges):
+                data = np.concatenate([self.rows[lo:hi] for lo,hi in ranges])
+            else:
+                data = self.rows[:0]
+        else:
+            data = self.rows
+        if box is not None:
+            data = data[in_radec_box(data['ra'], data['dec'], box)]
+        T = fits_table()
+        for c in columns:
+            T.set(c, _convert(data[c], self.convert[c]))
+        return T
+
+def dec_strip(dec, striph):
+    return np.clip(np.floor((np.asarray(dec) + 90.) / striph), 0,
+                   int(np.ceil(180. / striph)) - 1).astype(int)
+
+def strip_nra(s, striph):
+    # number of RA cells in strip s: ~square cells
+    d0 = -90. + s * striph
+    d1 = min(d0 + striph, 90.)
+    cosd = max(np.cos(np.deg2rad(d0)), np.cos(np.deg2rad(d1)))
+    return max(1, int(360. * cosd / striph))
+
+def ra_cell(ra, nra):
+    return np.clip((np.asarray(ra) % 360. / 360. * nra).astype(int), 0, nra-1)
+
+def cell_key(s, c, striph):
+    return np.asarray(s, np.int64) * (int(360. / striph) + 1) + c
+
+def _convert(a, conv):
+    if conv == 'bool':
+        return (a == b'T')
+    if conv == 'unsigned':
+        # stored as signed, minus 2**(bits-1): flip the top bit
+        a = a.astype(a.dtype.newbyteorder('='))
+        return a ^ a.dtype.type(1 << (8 * a.dtype.itemsize - 1))
+    if conv == 'str':
+        return a.astype(str)
+    return a.astype(a.dtype.newbyteorder('='))
+
+def read_chunk(fn, columns=None, box=None, rows=None):
+    '''
+    Reads chunk file *fn*, as a fits_table: all columns or the given
+    *columns* (which must include ra,dec if *box* is given), and all
+    rows, the given *rows*, or those inside RA,Dec *box* (see radec_box).
+    '''
+    from astrometry.util.fits import fits_table
+    chunk = _chunk_cache.pop(fn, None)
+    if chunk is not None:
+        st = os.stat(fn)
+        if chunk.stamp != (st.st_mtime, st.st_size):
+            chunk = None
+    if chunk is None:
+        chunk = ChunkFile(fn)
+    _chunk_cache[fn] = chunk
+    while len(_chunk_cache) > chunk_cache_size:
+        _chunk_cache.popitem(last=False)
+    if chunk.rows is None:
+        # compressed, or not a simple table: read it all.
+        T = fits_table(fn, columns=columns, rows=rows)
+        if box is not None:
+            T.cut(in_radec_box(T.ra, T.dec, box))
+        return T
+    return chunk.read(columns=columns, box=box, rows=rows)
+
+def convert_chunk(infn, outfn, striph=0.1):
+    '''
+    Writes chunk file *infn* to *outfn*, uncompressed, with rows
+    sorted into RA,Dec cells (strips of height *striph* degrees,
+    split in RA into about-square cells) and with the cell index.
+    '''
+    import fitsio
+    with fitsio.FITS(infn) as F:
+        hdr = F[1].read_header()
+        data = F[1].read(lower=True)
+    s = dec_strip(data['dec'], striph)
+    nra = np.array([strip_nra(i, striph) for i in range(s.max()+1)]) if len(s) else []
+    c = ra_cell(data['ra'], nra[s]) if len(s) else np.zeros(0, int)
+    key = cell_key(s, c, striph)
+    I = np.lexsort((data['dec'], key))
+    data = data[I]
+    key = key[I]
+    ukey,offset = np.unique(key, return_index=True)
+    ihdr = fitsio.FITSHDR()
+    ihdr.add_record(dict(name='STRIPH', value=striph, comment='Dec strip height of index cells (deg)'))
+    tmpfn = os.path.join(os.path.dirname(outfn), 'tmp-' + os.path.basename(outfn))
+    with fitsio.FITS(tmpfn, 'rw', clobber=True) as F:
+        F.write(data, header=_table_header(hdr))
+        F.write([ukey.astype(np.int64), offset.astype(np.int64)], names=['key', 'offset'],
+                header=ihdr, extname=index_ext)
+    os.rename(tmpfn, outfn)
+
+def _table_header(hdr):
+    # Keep the non-structural header cards
+    import fitsio
+    skip = ['XTENSION', 'BITPIX', 'NAXIS', 'NAXIS1', 'NAXIS2', 'PCOUNT', 'GCOUNT',
+            'TFIELDS', 'EXTNAME']
+    out = fitsio.FITSHDR()
+    for r in hdr.records():
+        name = r['name']
+        if name in skip or any(name.startswith(p) for p in
+                               ['TTYPE', 'TFORM', 'TUNIT', 'TDIM', 'TZERO', 'TSCAL', 'TNULL']):
+            continue
+        out.add_record(r)
+    return out
+
+def main():
+    import argparse
+    from glob import glob
+    parser = argparse.ArgumentParser(description='Convert healpix-chunked reference catalog files (eg, Gaia, PS1) to indexed, uncompressed files for fast reading')
+    parser.add_argument('--threads', type=int, default=1, help='Number of processes')
+    parser.add_argument('--strip-height', type=float, default=0.1,
+                        help='Size of the index cells, in degrees')
+    parser.add_argument('indir', help='Input directory of chunk files')
+    parser.add_argument('outdir', help='Output directory')
+    opt = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format='%(message)s', stream=sys.stdout)
+
+    fns = sorted(glob(os.path.join(opt.indir, '*.fits')) +
+                 glob(os.path.join(opt.indir, '*.fits.gz')))
+    os.makedirs(opt.outdir, exist_ok=True)
+    args = []
+    for fn in fns:
+        base = os.path.basename(fn)
+        if base.endswith('.gz'):
+            base = base[:-3]
+        outfn = os.path.join(opt.outdir, base)
+        if os.path.exists(outfn):
+            continue
+        args.append((fn, outfn, opt.strip_height))
+    info(len(fns), 'chunk files;', len(args), 'to convert')
+    if opt.threads > 1:
+        from legacypipe.utils import fork_map
+        fork_map(convert_chunk, args, opt.threads)
+    else:
+        for a in args:
+            convert_chunk(*a)
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
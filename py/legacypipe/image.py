@@ -71,6 +71,8 @@ class LegacySurveyImage(object):
         self._fits = None
         self._primary_header = None
         self._image_header = None
+        # legacypipe.pixelcache.PixelCache, if reading via one
+        self.pixel_cache = None
 
         if camera_setup:
             # new-camera-setup.py script -- don't read stuff yet!
@@ -218,6 +220,7 @@ class LegacySurveyImage(object):
         # Can't pickle our cached _fits item.
         d = self.__dict__.copy()
         d['_fits'] = None
+        d['pixel_cache'] = None
         return d
 
     def get_base_name(self):
@@ -1063,6 +1066,15 @@ class LegacySurveyImage(object):
         return galnorm
 
     def _read_fits(self, fn, hdu, slc=None, header=None, fitsobj=None, **kwargs):
+        if self.pixel_cache is not None and len(kwargs) == 0:
+            pix,hdr = self.pixel_cache.read(fn, hdu, fitsobj=fitsobj)
+            if slc is not None:
+                pix = pix[slc]
+            # (a copy: callers modify it)
+            img = np.array(pix, dtype=pix.dtype.newbyteorder('='))
+            if header:
+                return (img,hdr)
+            return img
         if slc is not None:
             if fitsobj is None:
                 fitsobj = fitsio.FITS(fn)
@@ -1243,6 +1255,8 @@ class LegacySurveyImage(object):
         Reads the sky model, returning a Tractor Sky object.
         '''
         from tractor.utils import get_class_from_name
+        from legacypipe.calibcache import get_calib_cache
+        cache = get_calib_cache()
         tryfns = [(self.survey.find_file('sky-single', img=self), 'single'),
                   (self.survey.find_file('sky', img=self), 'merged'),
                   ] + [(fn,'old') for fn in self.old_merged_skyfns]
@@ -1250,10 +1264,7 @@ class LegacySurveyImage(object):
         for fn,skytype in tryfns:
             if not os.path.exists(fn):
                 continue
-            T = fits_table(fn)
-            I, = np.nonzero((T.expnum == self.expnum) *
-                            np.array([c.strip() == self.ccdname
-                                      for c in T.ccdname]))
+            T,I = cache.get_rows(fn, self.expnum, self.ccdname)
             debug('Found', len(I), 'matching CCDs (expnum %i, ccdname %s) in sky file (%s) %s' % (self.expnum, self.ccdname, skytype, fn))
             if len(I) != 1:
                 continue
@@ -1336,6 +1347,8 @@ class LegacySurveyImage(object):
 
         # spatially varying pixelized PsfEx
         from tractor import PsfExModel
+        from legacypipe.calibcache import get_calib_cache
+        cache = get_calib_cache()
         tryfns = [self.survey.find_file('psf', img=self),
                   self.survey.find_file('psf-single', img=self)] + self.old_merged_psffns
         Ti = None
@@ -1343,11 +1356,8 @@ class LegacySurveyImage(object):
         for fn in tryfns:
             if not os.path.exists(fn):
                 continue
-            T = fits_table(fn)
+            T,I = cache.get_rows(fn, self.expnum, self.ccdname)
             header = T.get_header()
-            I, = np.nonzero((T.expnum == self.expnum) *
-                            np.array([c.strip() == self.ccdname
-                                      for c in T.ccdname]))
             debug('Found', len(I), 'matching CCDs')
             if len(I) != 1:
                 continue
@@ -1413,6 +1423,13 @@ class LegacySurveyImage(object):
     def funpack_files(self, imgfn, maskfn, imghdu, maskhdu, todelete):
         '''Source Extractor can't handle .fz files, so unpack them.'''
         from legacypipe.survey import create_temp
+        if self.pixel_cache is not None:
+            # Write them from the already-decompressed pixels.
+            tmpimgfn = self.pixel_cache.write_temp(imgfn, imghdu, todelete)
+            tmpmaskfn = None
+            if maskfn is not None:
+                tmpmaskfn = self.pixel_cache.write_temp(maskfn, maskhdu, todelete)
+            return tmpimgfn,tmpmaskfn
         tmpimgfn = None
         tmpmaskfn = None
         # For FITS files that are not actually fpack'ed, funpack -E
@@ -2161,9 +2178,13 @@ class LegacySurveyImage(object):
                    splinesky=True, ps=None, survey=None,
                    gaia=True, old_calibs_ok=False,
                    survey_blob_mask=None, halos=True,
-                   subtract_largegalaxies=True):
+                   subtract_largegalaxies=True, pixel_cache=False):
         '''
         Run calibration pre-processing steps.
+
+        *pixel_cache*: decompress each image HDU once, for both the sky
+        and SourceExtractor, rather than funpacking it again (unless the
+        caller has attached its own *pixel_cache*).
         '''
         if psfex and not force:
             # Check whether PSF model already exists
@@ -2196,45 +2217,56 @@ class LegacySurveyImage(object):
         sky_kwargs = dict(splinesky=splinesky, git_version=git_version, ps=ps, survey=survey, gaia=gaia, survey_blob_mask=survey_blob_mask, halos=halos, subtract_largegalaxies=subtract_largegalaxies)
 
         from legacypipe.utils import ZeroWeightError
-        if sky and self.sky_before_psfex:
-            try:
-                self.run_sky(**sky_kwargs)
-            except ZeroWeightError as zwe:
-                # PsfEx isn't going to succeed either, so bail out now
-                print('ZeroWeightError running sky:', zwe)
-                raise zwe
-            except Exception as ex:
-                print('Exception running sky:', ex)
-                import traceback
-                traceback.print_exc()
-                skyexc = ex
-
-        if se:
-            # The image & mask files to process (funpacked if necessary)
-            todelete = []
-            imgfn,maskfn = self.funpack_files(self.imgfn, self.dqfn,
-                                              self.hdu, self.dq_hdu, todelete)
-            self.run_se(imgfn, maskfn)
-            #print('Not deleting temp files for SE!')
-            for fn in todelete:
-                os.unlink(fn)
+        # Decompress each image HDU once, for both sky and SourceExtractor?
+        # (unless our caller is managing a cache).
+        own_cache = pixel_cache and (sky or se) and self.pixel_cache is None
+        if own_cache:
+            from legacypipe.pixelcache import PixelCache
+            self.pixel_cache = PixelCache()
+        try:
+            if sky and self.sky_before_psfex:
+                try:
+                    self.run_sky(**sky_kwargs)
+                except ZeroWeightError as zwe:
+                    # PsfEx isn't going to succeed either, so bail out now
+                    print('ZeroWeightError running sky:', zwe)
+                    raise zwe
+                except Exception as ex:
+                    print('Exception running sky:', ex)
+                    import traceback
+                    traceback.print_exc()
+                    skyexc = ex
+
+            if se:
+                # The image & mask files to process (funpacked if necessary)
+                todelete = []
+                imgfn,maskfn = self.funpack_files(self.imgfn, self.dqfn,
+                                                  self.hdu, self.dq_hdu, todelete)
+                self.run_se(imgfn, maskfn)
+                #print('Not deleting temp files for SE!')
+                for fn in todelete:
+                    os.unlink(fn)
         
-        if psfex:
-            try:
-                self.run_psfex(**psfex_kwargs)
-            except Exception as ex:
-                psfexc = ex
+            if psfex:
+                try:
+                    self.run_psfex(**psfex_kwargs)
+                except Exception as ex:
+                    psfexc = ex
 
-        if sky and not self.sky_before_psfex:
-            try:
-                self.run_sky(**sky_kwargs)
-            except Exception as ex:
-                skyexc = ex
-
-        if psfexc is not None:
-            raise psfexc
-        if skyexc is not None:
-            raise skyexc
+            if sky and not self.sky_before_psfex:
+                try:
+                    self.run_sky(**sky_kwargs)
+                except Exception as ex:
+                    skyexc = ex
+
+            if psfexc is not None:
+                raise psfexc
+            if skyexc is not None:
+                raise skyexc
+        finally:
+            if own_cache:
+                self.pixel_cache.release()
+                self.pixel_cache = None
 
 def _read_one_ext(args):
     fn,ext = args
@@ -1,5 +1,7 @@
+import os
 import numpy as np
 import time
+import threading
 
 from astrometry.util.ttime import Time
 from astrometry.util.resample import resample_with_wcs, OverlapError
@@ -17,7 +19,7 @@ from legacypipe.survey import (RexGalaxy,
 from legacypipe.bits import IN_BLOB
 from legacypipe.coadds import quick_coadds
 from legacypipe.runbrick_plots import _plot_mods
-from legacypipe.utils import get_cpu_arch
+from legacypipe.utils import get_cpu_arch, get_fork_slots
 
 rgbkwargs_resid = dict(resids=True)
 
@@ -43,7 +45,8 @@ def one_blob(X):
         return None
     (nblob, iblob, Isrcs, brickwcs, bx0, by0, blobw, blobh, blobmask, timargs,
      srcs, bands, plots, ps, reoptimize, iterative, use_ceres, refmap,
-     large_galaxies_force_pointsource, less_masking, frozen_galaxies) = X
+     large_galaxies_force_pointsource, less_masking, frozen_galaxies,
+     model_procs) = X
 
     debug('Fitting blob %s: blobid %i, nsources %i, size %i x %i, %i images, %i frozen galaxies' %
           (nblob, iblob, len(Isrcs), blobw, blobh, len(timargs), len(frozen_galaxies)))
@@ -74,7 +77,7 @@ def one_blob(X):
     ob = OneBlob(nblob, blobwcs, blobmask, timargs, srcs, bands,
                  plots, ps, use_ceres, refmap,
                  large_galaxies_force_pointsource,
-                 less_masking, frozen_galaxies)
+                 less_masking, frozen_galaxies, model_procs=model_procs)
     B = ob.init_table(Isrcs)
     B = ob.run(B, reoptimize=reoptimize, iterative_detection=iterative)
     ob.finalize_table(B, bx0, by0)
@@ -89,7 +92,7 @@ class OneBlob(object):
     def __init__(self, name, blobwcs, blobmask, timargs, srcs, bands,
                  plots, ps, use_ceres, refmap,
                  large_galaxies_force_pointsource,
-                 less_masking, frozen_galaxies):
+                 less_masking, frozen_galaxies, model_procs=0):
         self.name = name
         self.blobwcs = blobwcs
         self.pixscale = self.blobwcs.pixel_scale()
@@ -108,6 +111,8 @@ class OneBlob(object):
         self.deblend = False
         self.large_galaxies_force_pointsource = large_galaxies_force_pointsource
         self.less_masking = less_masking
+        # Number of processes for fitting candidate models in parallel
+        self.model_procs = model_procs
         self.tims = create_tims(self.blobwcs, self.blobmask, timargs)
         self.total_pix = sum([np.sum(t.getInvError() > 0) for t in self.tims])
         self.plots2 = False
@@ -117,6 +122,8 @@ class OneBlob(object):
         self.blobh,self.blobw = blobmask.shape
         self.trargs = dict()
         self.frozen_galaxy_mods = []
+        # Per-source detection maps, used in model selection
+        self.detection_maps = None
 
         if len(frozen_galaxies):
             debug('Subtracting frozen galaxy models...')
@@ -666,6 +673,7 @@ class OneBlob(object):
         models = SourceModels()
         # Remember original tim images
         models.save_images(self.tims)
+        self.detection_maps = None
 
         # Create initial models for each tim x each source
         # (model sizes are determined at this point)
@@ -1014,14 +1022,15 @@ class OneBlob(object):
         # finding symmetrized blobs of significant pixels
         mask_others = True
         if mask_others:
-            from legacypipe.detection import detection_maps
-            from astrometry.util.multiproc import multiproc
+            from legacypipe.detection import IncrementalDetectionMaps
             from scipy.ndimage import binary_dilation, binary_fill_holes
             from scipy.ndimage.measurements import label
-            # Compute per-band detection maps
-            mp = multiproc()
-            detmaps,detivs,_ = detection_maps(
-                srctims, srcwcs, self.bands, mp)
+            # Compute per-band detection maps -- updating the ones from
+            # the previous source, since only the model patches changed.
+            if self.detection_maps is None:
+                self.detection_maps = IncrementalDetectionMaps(
+                    srctims, srcwcs, self.bands)
+            detmaps,detivs = self.detection_maps.update(srctims)
             # Compute the symmetric area that fits in this 'srcblobmask' region
             pos = src.getPosition()
             _,xx,yy = srcwcs.radec2pixelxy(pos.ra, pos.dec)
@@ -1364,53 +1373,13 @@ class OneBlob(object):
             trymodels.extend([('rex', rex), ('dev', dev), ('exp', exp),
                               ('ser', None)])
 
-        cputimes = {}
-        for name,newsrc in trymodels:
+        def fit_model(name, newsrc):
+            # Fits one candidate model, returning a dict of results for
+            # record_model(), or None if the source exits the blob.
+            # (With self.model_procs, this runs in a forked process.)
             cpum0 = time.process_time()
-
-            if name == 'gals':
-                # If 'rex' was better than 'psf', or the source is
-                # bright, try the galaxy models.
-                chi_rex = chisqs.get('rex', 0)
-                chi_psf = chisqs.get('psf', 0)
-                margin = 1. # 1 parameter
-                if chi_rex > (chi_psf+margin) or max(chi_psf, chi_rex) > 400:
-                    trymodels.extend([
-                        ('dev', dev), ('exp', exp), ('ser', None)])
-                continue
-
-            if name == 'ser' and newsrc is None:
-                # Start at the better of exp or dev.
-                smod = _select_model(chisqs, nparams, galaxy_margin)
-                if smod not in ['dev', 'exp']:
-                    continue
-                if smod == 'dev':
-                    newsrc = ser = SersicGalaxy(
-                        dev.getPosition().copy(), dev.getBrightness().copy(),
-                        dev.getShape().copy(), LegacySersicIndex(4.))
-                elif smod == 'exp':
-                    newsrc = ser = SersicGalaxy(
-                        exp.getPosition().copy(), exp.getBrightness().copy(),
-                        exp.getShape().copy(), LegacySersicIndex(1.))
-                #print('Initialized SER model:', newsrc)
-
             srccat[0] = newsrc
 
-            # Set maximum galaxy model sizes
-            if is_galaxy:
-                # This is a known large galaxy -- set max size based on initial size.
-                logrmax = known_galaxy_logrmax
-                if name in ('rex', 'exp', 'dev', 'ser'):
-                    newsrc.shape.setMaxLogRadius(logrmax)
-            else:
-                # FIXME -- could use different fractions for deV vs exp (or comp)
-                fblob = 0.8
-                sh,sw = srcwcs.shape
-                logrmax = np.log(fblob * max(sh, sw) * self.pixscale)
-                if name in ['rex', 'exp', 'dev', 'ser']:
-                    if logrmax < newsrc.shape.getMaxLogRadius():
-                        newsrc.shape.setMaxLogRadius(logrmax)
-
             # Use the same modelMask shapes as the original source ('src').
             # Need to create newsrc->mask mappings though:
             mm = remap_modelmask(modelMasks, src, newsrc)
@@ -1431,7 +1400,6 @@ class OneBlob(object):
                 import traceback
                 traceback.print_exc()
                 raise(e)
-                continue
             #print('OneBlob after model selection:', newsrc)
             #print('Fit result:', newsrc)
             #print('Steps:', R['steps'])
@@ -1474,10 +1442,7 @@ class OneBlob(object):
             elif ix < 0 or iy < 0 or ix >= sw or iy >= sh or not srcblobmask[iy,ix]:
                 # Exited blob!
                 debug('Source exited sub-blob!')
-                if mask_others:
-                    for ie,tim in zip(saved_srctim_ies, srctims):
-                        tim.inverr = ie
-                continue
+                return None
 
             disable_galaxy_cache()
 
@@ -1547,9 +1512,9 @@ class OneBlob(object):
                 ivars = _compute_invvars(allderivs)
                 assert(len(ivars) == nsrcparams)
 
-            B.all_model_ivs[srci][name] = np.array(ivars).astype(np.float32)
-            B.all_models[srci][name] = newsrc.copy()
-            assert(B.all_models[srci][name].numberOfParams() == nsrcparams)
+            result = dict(ivs=np.array(ivars).astype(np.float32),
+                          model=newsrc.copy())
+            assert(result['model'].numberOfParams() == nsrcparams)
 
             # Now revert the ellipses!
             if isinstance(newsrc, (DevGalaxy, ExpGalaxy, SersicGalaxy)):
@@ -1558,15 +1523,121 @@ class OneBlob(object):
             # Use the original 'srctractor' here so that the different
             # models are evaluated on the same pixels.
             ch = _per_band_chisqs(srctractor, self.bands)
-            chisqs[name] = _chisq_improvement(newsrc, ch, chisqs_none)
-            cpum1 = time.process_time()
-            B.all_model_cpu[srci][name] = cpum1 - cpum0
-            cputimes[name] = cpum1 - cpum0
-            B.all_model_hit_limit  [srci][name] = hit_limit
-            B.all_model_hit_r_limit[srci][name] = hit_r_limit
-            B.all_model_opt_steps  [srci][name] = opt_steps
+            result.update(src=newsrc,
+                          chisq=_chisq_improvement(newsrc, ch, chisqs_none),
+                          cpu=time.process_time() - cpum0,
+                          hit_limit=hit_limit, hit_r_limit=hit_r_limit,
+                          hit_ser_limit=hit_ser_limit, opt_steps=opt_steps)
+            return result
+
+        def record_model(name, result):
+            B.all_model_ivs[srci][name] = result['ivs']
+            B.all_models[srci][name] = result['model']
+            chisqs[name] = result['chisq']
+            B.all_model_cpu[srci][name] = result['cpu']
+            B.all_model_hit_limit  [srci][name] = result['hit_limit']
+            B.all_model_hit_r_limit[srci][name] = result['hit_r_limit']
+            B.all_model_opt_steps  [srci][name] = result['opt_steps']
             if name == 'ser':
-                B.hit_ser_limit[srci] = hit_ser_limit
+                B.hit_ser_limit[srci] = result['hit_ser_limit']
+
+        # For big blobs, we can fit the candidate models that don't
+        # depend on each other's results in parallel, in forked
+        # processes (each with its own copy of the tims).  The extra
+        # processes only run on CPUs that our worker pool has idle
+        # (see fork_map), so only with a pool that counts them; and
+        # never while other threads are running, since they would
+        # not survive the fork.
+        nprocs = self.model_procs
+        slots = get_fork_slots()
+        if (self.plots_per_source or not hasattr(os, 'fork') or
+            slots is None or threading.active_count() > 1):
+            nprocs = 0
+
+        itry = 0
+        while itry < len(trymodels):
+            name,newsrc = trymodels[itry]
+            itry += 1
+
+            if name == 'gals':
+                # If 'rex' was better than 'psf', or the source is
+                # bright, try the galaxy models.
+                chi_rex = chisqs.get('rex', 0)
+                chi_psf = chisqs.get('psf', 0)
+                margin = 1. # 1 parameter
+                if chi_rex > (chi_psf+margin) or max(chi_psf, chi_rex) > 400:
+                    trymodels.extend([
+                        ('dev', dev), ('exp', exp), ('ser', None)])
+                continue
+
+            if name == 'ser' and newsrc is None:
+                # Start at the better of exp or dev.
+                smod = _select_model(chisqs, nparams, galaxy_margin)
+                if smod not in ['dev', 'exp']:
+                    continue
+                if smod == 'dev':
+                    newsrc = ser = SersicGalaxy(
+                        dev.getPosition().copy(), dev.getBrightness().copy(),
+                        dev.getShape().copy(), LegacySersicIndex(4.))
+                elif smod == 'exp':
+                    newsrc = ser = SersicGalaxy(
+                        exp.getPosition().copy(), exp.getBrightness().copy(),
+                        exp.getShape().copy(), LegacySersicIndex(1.))
+                #print('Initialized SER model:', newsrc)
+
+            batch = [(name, newsrc)]
+            while (nprocs > 1 and itry < len(trymodels) and
+                   trymodels[itry][1] is not None):
+                batch.append(trymodels[itry])
+                itry += 1
+
+            for name,newsrc in batch:
+                # Set maximum galaxy model sizes
+                if is_galaxy:
+                    # This is a known large galaxy -- set max size based on initial size.
+                    logrmax = known_galaxy_logrmax
+                    if name in ('rex', 'exp', 'dev', 'ser'):
+                        newsrc.shape.setMaxLogRadius(logrmax)
+                else:
+                    # FIXME -- could use different fractions for deV vs exp (or comp)
+                    fblob = 0.8
+                    sh,sw = srcwcs.shape
+                    logrmax = np.log(fblob * max(sh, sw) * self.pixscale)
+                    if name in ['rex', 'exp', 'dev', 'ser']:
+                        if logrmax < newsrc.shape.getMaxLogRadius():
+                            newsrc.shape.setMaxLogRadius(logrmax)
+
+            if len(batch) == 1:
+                results = [fit_model(*batch[0])]
+            else:
+                debug('Fitting models', [name for name,_ in batch], 'in',
+                      min(nprocs, len(batch)), 'processes')
+                from legacypipe.utils import fork_map
+                results = fork_map(fit_model, batch, nprocs, slots=slots)
+
+            for k,((name,_),result) in enumerate(zip(batch, results)):
+                if result is None:
+                    # Exited blob!
+                    if mask_others:
+                        for ie,tim in zip(saved_srctim_ies, srctims):
+                            tim.inverr = ie
+                    # The remaining models must be re-fit with the
+                    # un-masked tims, as they would have been serially.
+                    itry -= len(batch) - (k+1)
+                    break
+                # (If fit in a forked process, this is a fitted copy.)
+                newsrc = result['src']
+                if name == 'psf':
+                    psf = newsrc
+                elif name == 'rex':
+                    rex = newsrc
+                elif name == 'dev':
+                    dev = newsrc
+                elif name == 'exp':
+                    exp = newsrc
+                elif name == 'ser':
+                    ser = newsrc
+                record_model(name, result)
 
         if mask_others:
             for tim,ie in zip(srctims, saved_srctim_ies):
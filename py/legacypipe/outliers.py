@@ -19,7 +19,8 @@ def get_bits_to_mask():
 # Creates the outliers-masked-{pos,neg} JPEGs and also applies the mask.
 # (does not create -pre and -post jpegs!)
 def recreate_outlier_jpegs(survey, tims, bands, targetwcs, brickname):
-    from astrometry.util.resample import resample_with_wcs, OverlapError
+    from astrometry.util.resample import OverlapError
+    from legacypipe.resampcache import resample_tim
     from legacypipe.bits import DQ_BITS
     from legacypipe.survey import imsave_jpeg
 
@@ -47,8 +48,7 @@ def recreate_outlier_jpegs(survey, tims, bands, targetwcs, brickname):
         for tim in btims:
             # Resample
             try:
-                Yo,Xo,Yi,Xi,_ = resample_with_wcs(
-                    targetwcs, tim.subwcs, [], intType=np.int16)
+                Yo,Xo,Yi,Xi,_ = resample_tim(tim, targetwcs, [], intType=np.int16)
             except OverlapError:
                 continue
 
@@ -199,6 +199,27 @@ def read_outlier_mask_file(survey, tims, brickname, subimage=True, output=True,
         return headers
     return True
 
+def star_veto_map(shape, bx, by, pixrad):
+    '''
+    Returns a boolean map of *shape* marking the pixels near the stars at
+    pixel positions *bx*, *by*: (squared!) distance < *pixrad*.
+    '''
+    from legacypipe.rasterize import or_circles
+    H,W = shape
+    star_veto = np.zeros(shape, bool)
+    bx = np.atleast_1d(bx)
+    by = np.atleast_1d(by)
+    # Bounding boxes (inclusive, clipped to the image); skip ones that
+    # are clipped to zero width.
+    xlo = np.clip(np.floor(bx - pixrad), 0, W-1).astype(int)
+    xhi = np.clip(np.ceil (bx + pixrad), 0, W-1).astype(int)
+    ylo = np.clip(np.floor(by - pixrad), 0, H-1).astype(int)
+    yhi = np.clip(np.ceil (by + pixrad), 0, H-1).astype(int)
+    K = np.flatnonzero((xlo != xhi) & (ylo != yhi))
+    or_circles(star_veto, True, bx[K], by[K], xlo[K], xhi[K]+1, ylo[K], yhi[K]+1,
+               pixrad, strict=True)
+    return star_veto
+
 def mask_outlier_pixels(survey, tims, bands, targetwcs, brickname, version_header,
                         mp=None, plots=False, ps=None, make_badcoadds=True,
                         refstars=None):
@@ -224,16 +245,7 @@ def mask_outlier_pixels(survey, tims, bands, targetwcs, brickname, version_heade
         # Radius to mask around Gaia stars, in arcsec
         radius = 1.0
         pixrad = radius / targetwcs.pixel_scale()
-        for x,y in zip(bx,by):
-            xlo = int(np.clip(np.floor(x - pixrad), 0, W-1))
-            xhi = int(np.clip(np.ceil (x + pixrad), 0, W-1))
-            ylo = int(np.clip(np.floor(y - pixrad), 0, H-1))
-            yhi = int(np.clip(np.ceil (y + pixrad), 0, H-1))
-            if xlo == xhi or ylo == yhi:
-                continue
-            r2 = (((np.arange(ylo,yhi+1) - y)**2)[:,np.newaxis] +
-                  ((np.arange(xlo,xhi+1) - x)**2)[np.newaxis,:])
-            star_veto[ylo:yhi+1, xlo:xhi+1] |= (r2 < pixrad)
+        star_veto = star_veto_map((H,W), bx, by, pixrad)
 
     # if plots:
     #     import pylab as plt
@@ -371,6 +383,7 @@ def compare_one(X):
     from scipy.ndimage.filters import gaussian_filter
     from scipy.ndimage import binary_dilation
     from astrometry.util.resample import resample_with_wcs,OverlapError
+    from legacypipe.resampcache import resample_tim
 
     (i_tim,tim,sig,targetwcs, coimg,cow, veto, make_badcoadds, plots,ps) = X
 
@@ -381,8 +394,7 @@ def compare_one(X):
 
     img = gaussian_filter(tim.getImage(), sig)
     try:
-        Yo,Xo,Yi,Xi,[rimg] = resample_with_wcs(
-            targetwcs, tim.subwcs, [img], intType=np.int16)
+        Yo,Xo,Yi,Xi,[rimg] = resample_tim(tim, targetwcs, [img], intType=np.int16)
     except OverlapError:
         return i_tim,None
     del img
@@ -522,7 +534,8 @@ def compare_one(X):
         badco = badhot,badcold
 
     # Actually do the masking!
-    # Resample "hot" (in brick coords) back to tim coords.
+    # Resample "hot" (in brick coords) back to tim coords.  (This is the
+    # inverse mapping, which the resampling cache does not hold.)
     try:
         mYo,mXo,mYi,mXi,_ = resample_with_wcs(
             tim.subwcs, targetwcs, intType=np.int16)
@@ -539,14 +552,14 @@ def compare_one(X):
 
 def blur_resample_one(X):
     from scipy.ndimage.filters import gaussian_filter
-    from astrometry.util.resample import resample_with_wcs,OverlapError
+    from astrometry.util.resample import OverlapError
+    from legacypipe.resampcache import resample_tim
 
     i_tim,tim,sig,targetwcs = X
 
     img = gaussian_filter(tim.getImage(), sig)
     try:
-        Yo,Xo,Yi,Xi,[rimg] = resample_with_wcs(
-            targetwcs, tim.subwcs, [img], intType=np.int16)
+        Yo,Xo,Yi,Xi,[rimg] = resample_tim(tim, targetwcs, [img], intType=np.int16)
     except OverlapError:
         return i_tim, None
     del img
@@ -0,0 +1,148 @@
+'''
+Decompress-once pixel cache for the calibration steps.
+
+Calibrating one CCD reads its image, weight and DQ HDUs several times:
+run_sky reads them, run_calibs then funpacks (or imcopies) the image
+and DQ again to temp files for SourceExtractor, and
+legacy_zeropoints.run_zeropoints reads them yet again.  For fpacked
+images the decompression dominates.
+
+A PixelCache attached to a LegacySurveyImage (as *pixel_cache*) reads
+each HDU once: LegacySurveyImage._read_fits (and so read_image,
+read_dq, read_invvar) returns copies of (slices of) the cached arrays,
+and funpack_files writes SourceExtractor's input files from them
+rather than decompressing again.  run_calibs(pixel_cache=True)
+attaches an in-memory cache for its duration and releases it at the
+end.
+
+With a *scratch_dir*, each HDU is also written there, uncompressed, the
+first time it is read; later readers -- in any process, eg the
+run_zeropoints step after the calibs -- memory-map that file.  The
+owner of the directory deletes it when the exposure is done.
+'''
+
+import os
+
+import numpy as np
+import fitsio
+
+import logging
+logger = logging.getLogger('legacypipe.pixelcache')
+def info(*args):
+    from legacypipe.utils import log_info
+    log_info(logger, args)
+def debug(*args):
+    from legacypipe.utils import log_debug
+    log_debug(logger, args)
+
+class PixelCache(object):
+    '''
+    Decompressed image HDUs, keyed by (filename, hdu); see the module
+    docstring.
+    '''
+    def __init__(self, scratch_dir=None):
+        self.scratch_dir = scratch_dir
+        self.pixels = {}
+        self.stats = dict(reads=0, hits=0, mapped=0)
+
+    def __str__(self):
+        return 'PixelCache(%i HDUs%s)' % (
+            len(self.pixels), '' if self.scratch_dir is None else
+            ', scratch dir %s' % self.scratch_dir)
+
+    def __getstate__(self):
+        # Don't ship the pixels between processes (a scratch
+        # directory is shared through the filesystem).
+        d = self.__dict__.copy()
+        d['pixels'] = {}
+        return d
+
+    def read(self, fn, hdu, fitsobj=None):
+        '''
+        Returns (pixels, header) for HDU *hdu* of FITS file *fn*
+        (reading through the open fitsio.FITS *fitsobj*, if given).
+        The pixels are shared: don't modify them.
+        '''
+        key = (fn, hdu)
+        if key in self.pixels:
+            self.stats['hits'] += 1
+            return self.pixels[key]
+        sfn = self._scratch_filename(fn, hdu)
+        if sfn is not None and os.path.exists(sfn):
+            debug('Mapping', fn, 'hdu', hdu, 'from', sfn)
+            pix = _map_image(sfn)
+            self.stats['mapped'] += 1
+        else:
+            debug('Reading', fn, 'hdu', hdu, 'into the pixel cache')
+            if fitsobj is None:
+                with fitsio.FITS(fn) as F:
+                    pix = (F[hdu].read(), F[hdu].read_header())
+            else:
+                pix = (fitsobj[hdu].read(), fitsobj[hdu].read_header())
+            self.stats['reads'] += 1
+            if sfn is not None:
+                _write_image(sfn, *pix)
+        self.pixels[key] = pix
+        return pix
+
+    def write_temp(self, fn, hdu, todelete, fitsobj=None):
+        '''
+        Writes HDU *hdu* of *fn*, uncompressed, to a new temp file (as
+        funpack_files does), appends it to *todelete* and returns its
+        name.  The caller may modify or delete the file.
+        '''
+        from legacypipe.survey import create_temp
+        pix,hdr = self.read(fn, hdu, fitsobj=fitsobj)
+        tmpfn = create_temp(suffix='.fits')
+        todelete.append(tmpfn)
+        _write_image(tmpfn, pix, hdr)
+        return tmpfn
+
+    def release(self):
+        '''
+        Drops the cached pixels (but not the scratch files).
+        '''
+        debug('Releasing', self, ': %(reads)i reads, %(hits)i hits, %(mapped)i mapped'
+              % self.stats)
+        self.pixels = {}
+
+    def _scratch_filename(self, fn, hdu):
+        if self.scratch_dir is None:
+            return None
+        base = os.path.basename(fn)
+        for ext in ['.fz', '.gz']:
+            if base.endswith(ext):
+                base = base[:-len(ext)]
+        if base.endswith('.fits'):
+            base = base[:-len('.fits')]
+        return os.path.join(self.scratch_dir, '%s-%s.fits' % (base, hdu))
+
+def _write_image(fn, pix, hdr):
+    # Writes via a temp file and rename, so that readers in other
+    # processes never see a partial file.
+    hdr = fitsio.FITSHDR(hdr)
+    # (memory-mapped pixels are big-endian; fitsio wants native)
+    pix = np.ascontiguousarray(pix, dtype=pix.dtype.newbyteorder('='))
+    # fitsio has already applied any scaling (eg, BZERO=32768 images
+    # read as uint16), and writes its own for unsigned types.
+    for key in ['BSCALE', 'BZERO', 'BLANK']:
+        if key in hdr:
+            hdr.delete(key)
+    dirnm,base = os.path.split(fn)
+    tmpfn = os.path.join(dirnm, 'tmp-%i-%s' % (os.getpid(), base))
+    fitsio.write(tmpfn, pix, header=hdr, clobber=True)
+    os.rename(tmpfn, fn)
+
+def _map_image(fn):
+    # Returns (pixels, header) of a file written by _write_image,
+    # memory-mapped if it is unscaled.
+    with fitsio.FITS(fn) as F:
+        hdr = F[0].read_header()
+        if 'BSCALE' in hdr or 'BZERO' in hdr or hdr['NAXIS'] != 2:
+            return F[0].read(), hdr
+        dtype = {8: 'u1', 16: '>i2', 32: '>i4', 64: '>i8',
+                 -32: '>f4', -64: '>f8'}[hdr['BITPIX']]
+        offset = F[0].get_offsets()['data_start']
+    pix = np.memmap(fn, dtype=dtype, mode='r', offset=offset,
+                    shape=(hdr['NAXIS2'], hdr['NAXIS1']))
+    return pix, hdr
@@ -4,70 +4,286 @@ Find all the PS1 stars in a given DECaLS CCD.
 """
 
 import os
+import collections
 import numpy as np
 
 class HealpixedCatalog(object):
-    def __init__(self, fnpattern, nside=32, indexing='ring'):
+    def __init__(self, fnpattern, nside=32, indexing='ring', columns=None):
         '''
         fnpattern: string formatter with key "hp", eg
         'dir/fn-%(hp)05i.fits'
+
+        columns: list of columns to read (default all).
+
+        Chunk files are read with legacypipe.healpix_chunks.read_chunk,
+        which memory-maps and caches them, and reads only the rows
+        needed if they have been indexed.
         '''
         self.fnpattern = fnpattern
         self.nside = nside
         self.indexing = indexing
+        self.columns = columns
 
     def healpix_for_radec(self, ra, dec):
         '''
-        Returns the healpix number for a given single (scalar) RA,Dec.
+        Returns the healpix number(s) for a given RA,Dec (scalars or arrays).
         '''
-        from astrometry.util.util import radecdegtohealpix, healpix_xy_to_ring, healpix_xy_to_nested
-        hpxy = radecdegtohealpix(ra, dec, self.nside)
-        if self.indexing == 'ring':
-            hp = healpix_xy_to_ring(hpxy, self.nside)
-        elif self.indexing == 'nested':
-            hp = healpix_xy_to_nested(hpxy, self.nside)
-        else:
-            # assume XY!
-            hp = hpxy
-        return hp
+        if self.indexing in ['ring', 'nested']:
+            from legacypipe.healpix_chunks import radec_to_healpix
+            return radec_to_healpix(ra, dec, self.nside,
+                                    nested=(self.indexing == 'nested'))
+        from astrometry.util.util import radecdegtohealpix
+        # assume XY!
+        if np.isscalar(ra) and np.isscalar(dec):
+            return radecdegtohealpix(ra, dec, self.nside)
+        return np.array([radecdegtohealpix(r, d, self.nside)
+                         for r,d in zip(np.ravel(ra), np.ravel(dec))])
 
-    def get_healpix_catalog(self, healpix):
-        from astrometry.util.fits import fits_table
+    def get_healpix_catalog(self, healpix, box=None):
+        '''
+        Reads the catalog in *healpix* -- all of it, or the entries in
+        RA,Dec *box* (see healpix_chunks.radec_box).
+        '''
+        from legacypipe.healpix_chunks import read_chunk
         fname = self.fnpattern % dict(hp=healpix)
-        #print('Reading', fname)
-        return fits_table(fname)
+        columns = self.columns
+        if columns is not None and box is not None:
+            columns = list(columns) + [c for c in ['ra','dec'] if not c in columns]
+        return read_chunk(fname, columns=columns, box=box)
 
-    def get_healpix_catalogs(self, healpixes):
+    def get_healpix_catalogs(self, healpixes, box=None):
         from astrometry.util.fits import merge_tables
         cats = []
         for hp in healpixes:
-            cats.append(self.get_healpix_catalog(hp))
+            cats.append(self.get_healpix_catalog(hp, box=box))
         if len(cats) == 1:
             return cats[0]
         return merge_tables(cats)
 
     def get_catalog_in_wcs(self, wcs, step=100., margin=10):
-        # Grid the CCD in pixel space
-        W,H = wcs.get_width(), wcs.get_height()
-        xx,yy = np.meshgrid(
-            np.linspace(1-margin, W+margin, 2+int((W+2*margin)/step)),
-            np.linspace(1-margin, H+margin, 2+int((H+2*margin)/step)))
-        # Convert to RA,Dec and then to unique healpixes
-        ra,dec = wcs.pixelxy2radec(xx.ravel(), yy.ravel())
-        healpixes = set()
-        for r,d in zip(ra,dec):
-            healpixes.add(self.healpix_for_radec(r, d))
+        ra,dec = _wcs_grid(wcs, step, margin)
+        healpixes = np.unique(self.healpix_for_radec(ra, dec))
         # Read catalog in those healpixes
-        cat = self.get_healpix_catalogs(healpixes)
+        cat = self.get_healpix_catalogs(healpixes, box=_grid_box([(ra,dec)]))
         # Cut to sources actually within the CCD.
-        _,xx,yy = wcs.radec2pixelxy(cat.ra, cat.dec)
-        cat.x = xx
-        cat.y = yy
-        onccd = np.flatnonzero((xx >= 1.-margin) * (xx <= W+margin) *
-                               (yy >= 1.-margin) * (yy <= H+margin))
-        cat.cut(onccd)
+        cat.cut(_cut_to_wcs(cat, wcs, margin))
+        return self._finish_catalog(cat)
+
+    def _finish_catalog(self, cat):
+        # Hook for subclasses to add derived columns.
         return cat
 
+    def prefetch(self, wcslist, step=100., margin=10):
+        '''
+        Reads the catalog for a set of CCDs (typically all the chips in
+        one exposure) at once; returns a PrefetchedCatalog whose
+        get_catalog_in_wcs(wcs) gives the same results as this object's
+        for each of the *wcslist*.
+        '''
+        from astrometry.util.fits import merge_tables
+        grids = [_wcs_grid(wcs, step, margin) for wcs in wcslist]
+        ra = np.hstack([r for r,_ in grids])
+        dec = np.hstack([d for _,d in grids])
+        healpixes = np.unique(self.healpix_for_radec(ra, dec))
+        box = _grid_box(grids)
+        cats = []
+        hps = []
+        missing = []
+        for hp in healpixes:
+            try:
+                cat = self.get_healpix_catalog(hp, box=box)
+            except OSError as e:
+                # Only an error for the CCDs that need it.
+                print('Failed to read catalog healpix', hp, ':', e)
+                missing.append(hp)
+                continue
+            cats.append(cat)
+            hps.append(np.zeros(len(cat), np.int64) + hp)
+        cat = None
+        if len(cats):
+            cat = merge_tables(cats)
+            hps = np.hstack(hps)
+            print('Prefetched', len(cat), 'catalog entries in', len(cats),
+                  'healpixes for', len(wcslist), 'CCDs')
+        return PrefetchedCatalog(self, cat, hps, healpixes, missing, box,
+                                 step, margin)
+
+def _wcs_grid(wcs, step, margin):
+    # Grid the CCD in pixel space and convert to RA,Dec
+    W,H = wcs.get_width(), wcs.get_height()
+    xx,yy = np.meshgrid(
+        np.linspace(1-margin, W+margin, 2+int((W+2*margin)/step)),
+        np.linspace(1-margin, H+margin, 2+int((H+2*margin)/step)))
+    return wcs.pixelxy2radec(xx.ravel(), yy.ravel())
+
+def _grid_box(grids):
+    # RA,Dec box around the grid(s) (padded by a grid step, for the
+    # curvature of the edges)
+    from legacypipe.healpix_chunks import radec_box
+    from legacypipe.ccdfootprints import radec_to_xyz
+    pad = max(np.rad2deg(np.arccos(np.clip(np.sum(
+        radec_to_xyz(ra[0], dec[0]) * radec_to_xyz(ra[1], dec[1])), -1., 1.)))
+              for ra,dec in grids)
+    return radec_box(np.hstack([r for r,_ in grids]),
+                     np.hstack([d for _,d in grids]), pad=pad)
+
+def _box_contains(outer, inner):
+    # Is RA,Dec box *inner* inside *outer*?  (see radec_box)
+    olo,ohi,odlo,odhi = outer
+    ilo,ihi,idlo,idhi = inner
+    if idlo < odlo or idhi > odhi:
+        return False
+    if ohi - olo >= 360.:
+        return True
+    if ihi - ilo >= 360.:
+        return False
+    owidth = (ohi - olo) % 360.
+    return ((ilo - olo) % 360.) + ((ihi - ilo) % 360.) <= owidth
+
+def _cut_to_wcs(cat, wcs, margin):
+    # Sets cat.x,y; returns the indices of the entries within the CCD.
+    W,H = wcs.get_width(), wcs.get_height()
+    _,xx,yy = wcs.radec2pixelxy(cat.ra, cat.dec)
+    cat.x = xx
+    cat.y = yy
+    return np.flatnonzero((xx >= 1.-margin) * (xx <= W+margin) *
+                          (yy >= 1.-margin) * (yy <= H+margin))
+
+# Per-process cache of shared PrefetchedCatalog files:
+# filename -> (ChunkFile, ra, dec, kd-tree)
+_shared_cache = collections.OrderedDict()
+_shared_cache_size = 4
+
+class PrefetchedCatalog(object):
+    '''
+    A HealpixedCatalog read once for a set of CCDs (see
+    HealpixedCatalog.prefetch).  Adjacent chips share most of their
+    healpixes, so rather than re-reading them for every chip, each
+    chip's entries are pulled out of the union with a kd-tree search,
+    then cut exactly as HealpixedCatalog.get_catalog_in_wcs would, so
+    the results (rows and order) are the same.  A WCS the prefetch did
+    not cover is read directly.
+
+    For multiprocessing, share() writes the table to a file (in
+    /dev/shm) that the worker processes memory-map, so that it is not
+    pickled to them for every CCD.
+    '''
+    def __init__(self, catalog, cat, healpix, healpixes, missing, box,
+                 step, margin):
+        self.catalog = catalog
+        self.cat = cat
+        self.healpix = healpix
+        self.healpixes = set(healpixes)
+        self.missing = set(missing)
+        self.box = box
+        self.step = step
+        self.margin = margin
+        self.fn = None
+        self.kd = None
+
+    def __getstate__(self):
+        # kd-trees don't pickle; rebuild them in each process.
+        d = self.__dict__.copy()
+        d['kd'] = None
+        return d
+
+    def share(self, dirnm=None):
+        '''
+        Moves the table to a temp file in *dirnm* (default /dev/shm, if
+        it exists); call cleanup() when done.  Returns False (and keeps
+        the table in memory) if that fails.
+        '''
+        import tempfile
+        import fitsio
+        from legacypipe.healpix_chunks import ChunkFile
+        if self.cat is None or len(self.cat) == 0:
+            return False
+        if dirnm is None and os.path.isdir('/dev/shm'):
+            dirnm = '/dev/shm'
+        fn = None
+        try:
+            fd,fn = tempfile.mkstemp(dir=dirnm, prefix='legacypipe-refcat-',
+                                     suffix='.fits')
+            os.close(fd)
+            cols = self.cat.get_columns()
+            fitsio.write(fn, [self.cat.get(c) for c in cols], names=cols,
+                         clobber=True)
+            if ChunkFile(fn).rows is None:
+                raise OSError('cannot memory-map ' + fn)
+        except OSError as e:
+            print('Failed to write shared catalog:', e)
+            if fn is not None and os.path.exists(fn):
+                os.unlink(fn)
+            return False
+        self.fn = fn
+        self.cat = None
+        return True
+
+    def cleanup(self):
+        if self.fn is not None:
+            _shared_cache.pop(self.fn, None)
+            if os.path.exists(self.fn):
+                os.unlink(self.fn)
+
+    def _lookup(self):
+        # Returns (ChunkFile or None, ra, dec, kd-tree) for the table.
+        from astrometry.libkd.spherematch import tree_build_radec
+        if self.fn is None:
+            if len(self.cat) == 0:
+                return None, self.cat.ra, self.cat.dec, None
+            if self.kd is None:
+                self.kd = tree_build_radec(self.cat.ra, self.cat.dec)
+            return None, self.cat.ra, self.cat.dec, self.kd
+        t = _shared_cache.get(self.fn)
+        if t is None:
+            from legacypipe.healpix_chunks import ChunkFile
+            chunk = ChunkFile(self.fn)
+            radec = chunk.read(columns=['ra','dec'])
+            t = (chunk, radec.ra, radec.dec, tree_build_radec(radec.ra, radec.dec))
+            _shared_cache[self.fn] = t
+            while len(_shared_cache) > _shared_cache_size:
+                _shared_cache.popitem(last=False)
+        else:
+            _shared_cache.move_to_end(self.fn)
+        return t
+
+    def get_catalog_in_wcs(self, wcs):
+        from astrometry.libkd.spherematch import tree_search_radec
+        from legacypipe.healpix_chunks import in_radec_box
+        from legacypipe.ccdfootprints import radec_to_xyz, xyz_to_radec
+        ra,dec = _wcs_grid(wcs, self.step, self.margin)
+        healpixes = np.unique(self.catalog.healpix_for_radec(ra, dec))
+        box = _grid_box([(ra,dec)])
+        if (not self.healpixes.issuperset(healpixes) or
+            not _box_contains(self.box, box)):
+            return self.catalog.get_catalog_in_wcs(wcs, step=self.step,
+                                                   margin=self.margin)
+        bad = self.missing.intersection(healpixes)
+        if len(bad):
+            raise OSError('Failed to read catalog healpix(es) %s' %
+                          ', '.join(str(hp) for hp in sorted(bad)))
+        # Search a circle around the grid (which contains the CCD + margin)
+        xyz = radec_to_xyz(ra, dec)
+        c = xyz.sum(axis=0)
+        c /= np.linalg.norm(c)
+        radius = np.rad2deg(np.arccos(np.clip(xyz.dot(c), -1., 1.).min())) + 1e-6
+        rc,dc = xyz_to_radec(c)
+        chunk,cra,cdec,kd = self._lookup()
+        if kd is None:
+            I = np.zeros(0, int)
+        else:
+            I = tree_search_radec(kd, rc, dc, radius)
+        # Keep the catalog ordering
+        I = np.sort(I)
+        I = I[np.isin(self.healpix[I], healpixes)]
+        I = I[in_radec_box(cra[I], cdec[I], box)]
+        if chunk is None:
+            cat = self.cat[I]
+        else:
+            cat = chunk.read(rows=I)
+        cat.cut(_cut_to_wcs(cat, wcs, self.margin))
+        return self.catalog._finish_catalog(cat)
+
 class ps1cat(HealpixedCatalog):
     ps1band = dict(g=0,r=1,i=2,z=3,Y=4,
                    # ODIN
@@ -154,8 +370,7 @@ class sdsscat(HealpixedCatalog):
         else:
             self.ccdwcs = ccdwcs
 
-    def get_catalog_in_wcs(self, wcs, **kwargs):
-        cat = super().get_catalog_in_wcs(wcs, **kwargs)
+    def _finish_catalog(self, cat):
         cat.psfmag = -2.5 * (np.log10(cat.psfflux) - 9.)
         return cat
 
@@ -62,6 +62,51 @@ from legacypipe.survey import LegacySurveyData, wcs_for_brick, ccds_touching_wcs
 def log(*s):
     print(' '.join([str(ss) for ss in s]), file=sys.stderr)
 
+def overlaps_touching(ov, B, T, W=3600, H=3600, pixscale=0.262):
+    '''
+    Finds the overlapping (brick, CCD) pairs of bricks table *B* and
+    CCDs table *T*, from the precomputed BrickCcdOverlaps *ov*.  Bricks
+    and CCDs that are not in *ov* are checked geometrically.
+
+    Returns (IB, IC), index arrays into *B* and *T*.
+    '''
+    from legacypipe.ccdfootprints import CcdFootprints
+    if (ov.W, ov.H) != (W, H) or not np.isclose(ov.pixscale, pixscale):
+        raise RuntimeError(('Brick-CCD overlaps were computed for %i x %i bricks at '
+                            '%g arcsec/pixel, not %i x %i at %g') %
+                           (ov.W, ov.H, ov.pixscale, W, H, pixscale))
+    IB,IC = ov.pairs()
+    # Map overlap rows to rows of our bricks and CCDs tables
+    bmap = np.zeros(len(ov.bricknames), int) - 1
+    ib = ov.match_bricks(B)
+    bmap[ib[ib >= 0]] = np.flatnonzero(ib >= 0)
+    cmap = np.zeros(len(ov.expnum), int) - 1
+    ic = ov.match_ccds(T)
+    cmap[ic[ic >= 0]] = np.flatnonzero(ic >= 0)
+    IB = bmap[IB]
+    IC = cmap[IC]
+    K = np.flatnonzero((IB >= 0) * (IC >= 0))
+    IB = [IB[K]]
+    IC = [IC[K]]
+    # Bricks not in the overlaps file, against all the CCDs...
+    Bmiss = np.flatnonzero(ib < 0)
+    # ... and CCDs not in the file, against the other bricks.
+    Cmiss = np.flatnonzero(ic < 0)
+    log(len(Bmiss), 'bricks and', len(Cmiss), 'CCDs not in the overlaps file;',
+        'checking them geometrically')
+    if len(Bmiss) and len(T):
+        jb,jc = CcdFootprints.from_ccds(T).touching_bricks(
+            B[Bmiss], W=W, H=H, pixscale=pixscale)
+        IB.append(Bmiss[jb])
+        IC.append(jc)
+    Bhit = np.flatnonzero(ib >= 0)
+    if len(Cmiss) and len(Bhit):
+        jb,jc = CcdFootprints.from_ccds(T[Cmiss]).touching_bricks(
+            B[Bhit], W=W, H=H, pixscale=pixscale)
+        IB.append(Bhit[jb])
+        IC.append(Cmiss[jc])
+    return np.hstack(IB).astype(int), np.hstack(IC).astype(int)
+
 def main(args):
     """Main program.
     """
@@ -88,6 +133,8 @@ def main(args):
                       help='Cut to only CCDs touching selected bricks')
     parser.add_argument('--near', action='store_true',
                       help='Quick cut to only CCDs near selected bricks')
+    parser.add_argument('--overlaps', action='store_true',
+                      help='With --touching, use the precomputed brick-CCD overlaps (survey-brick-ccd-overlaps.fits; see brick_ccd_overlaps.py)')
 
     parser.add_argument('--check-coadd', action='store_true',
                       help='Check which coadds actually need to run.')
@@ -520,7 +567,17 @@ def main(args):
         # f2.close()
         # log('Wrote *-names.txt')
 
-    if opt.touching:
+    if opt.touching and opt.overlaps:
+        ov = survey.get_brick_ccd_overlaps()
+        if ov is None:
+            log('No brick-CCD overlaps file found')
+            return -1
+        IB,IC = overlaps_touching(ov, B, T)
+        allI = np.unique(IC)
+        B.cut(np.unique(IB))
+        log('Cut to', len(B), 'bricks touching CCDs')
+
+    elif opt.touching:
 
         if want_bricks:
             # Shortcut the list of bricks that are definitely touching CCDs --
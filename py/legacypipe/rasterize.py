@@ -0,0 +1,179 @@
+'''
+Vectorized rasterization of many (mostly small) circles and ellipses
+(eg, masks around reference stars) into an image.
+
+Rather than a Python loop over objects, each building its own
+bounding-box array, the objects are grouped by bounding-box size, and
+each group is evaluated as one (n, h, w) array; only big regions,
+where the per-object overhead doesn't matter, are done one at a
+time.  The callers keep
+their own bounding-box and inside-the-region conventions, so the
+resulting masks are identical to those from the per-object loops.
+
+Run as a script for a benchmark on a dense (Galactic-plane-like) star
+field:
+
+    python -m legacypipe.rasterize
+'''
+
+import numpy as np
+
+import logging
+logger = logging.getLogger('legacypipe.rasterize')
+def info(*args):
+    from legacypipe.utils import log_info
+    log_info(logger, args)
+def debug(*args):
+    from legacypipe.utils import log_debug
+    log_debug(logger, args)
+
+def or_regions(img, value, xlo, xhi, ylo, yhi, inside, maxpix=4000000,
+               bigbox=1024):
+    '''
+    ORs *value* into the pixels of image *img* inside any of a set of
+    regions.
+
+    The regions have pixel bounding boxes [ylo:yhi, xlo:xhi] (arrays;
+    *hi* exclusive, already clipped to the image), and
+    *inside(I, gx, gy)* -- where *I* are region indices and *gx*, *gy*
+    the integer pixel coordinates of their boxes, broadcastable to
+    shape (len(I), h, w) -- returns a boolean array of that shape.
+
+    *maxpix*: maximum number of pixels evaluated at once.
+    *bigbox*: boxes with more pixels than this are done one at a time
+    (the per-region overhead is small compared to the work).
+    '''
+    _,W = img.shape
+    xlo = np.asarray(xlo, dtype=np.intp)
+    xhi = np.asarray(xhi, dtype=np.intp)
+    ylo = np.asarray(ylo, dtype=np.intp)
+    yhi = np.asarray(yhi, dtype=np.intp)
+    bw = xhi - xlo
+    bh = yhi - ylo
+    K = np.flatnonzero((bw > 0) & (bh > 0))
+    if len(K) == 0:
+        return
+    big = (bw[K] * bh[K] > bigbox)
+    for i in K[big]:
+        gy = np.arange(ylo[i], yhi[i])[np.newaxis,:,np.newaxis]
+        gx = np.arange(xlo[i], xhi[i])[np.newaxis,np.newaxis,:]
+        m = inside(np.array([i]), gx, gy)[0]
+        img[ylo[i]:yhi[i], xlo[i]:xhi[i]][m] |= value
+    K = K[np.logical_not(big)]
+    if len(K) == 0:
+        return
+    # Group by box size
+    K = K[np.lexsort((bw[K], bh[K]))]
+    breaks = np.flatnonzero((np.diff(bh[K]) != 0) | (np.diff(bw[K]) != 0)) + 1
+    flat = img.reshape(-1)
+    assert(np.shares_memory(flat, img))
+    for group in np.split(K, breaks):
+        h = bh[group[0]]
+        w = bw[group[0]]
+        step = max(1, maxpix // (h*w))
+        for j in range(0, len(group), step):
+            I = group[j:j+step]
+            gy = ylo[I][:,np.newaxis,np.newaxis] + np.arange(h)[np.newaxis,:,np.newaxis]
+            gx = xlo[I][:,np.newaxis,np.newaxis] + np.arange(w)[np.newaxis,np.newaxis,:]
+            m = inside(I, gx, gy)
+            # (duplicate indices all get the same value)
+            pix = (gy * W + gx)[m]
+            flat[pix] = flat[pix] | value
+
+def or_circles(img, value, x, y, xlo, xhi, ylo, yhi, r2max, strict=False):
+    '''
+    ORs *value* into the pixels of *img* within circles centered at
+    pixel positions *x*, *y*, in bounding boxes as for or_regions:
+    pixels with squared distance <= *r2max* (< if *strict*), which may
+    be a scalar or per-circle array.
+    '''
+    x = np.asarray(x)
+    y = np.asarray(y)
+    r2max = np.broadcast_to(r2max, x.shape)
+    def inside(I, gx, gy):
+        r2 = ((gy - y[I][:,np.newaxis,np.newaxis])**2 +
+              (gx - x[I][:,np.newaxis,np.newaxis])**2)
+        rm = r2max[I][:,np.newaxis,np.newaxis]
+        if strict:
+            return r2 < rm
+        return r2 <= rm
+    or_regions(img, value, xlo, xhi, ylo, yhi, inside)
+
+def or_ellipses(img, value, x, y, xlo, xhi, ylo, yhi, cd, ct, st, r1, r2):
+    '''
+    ORs *value* into the pixels of *img* within ellipses centered at
+    pixel positions *x*, *y*, in bounding boxes as for or_regions.
+    Pixel offsets are rotated by the (unit-scaled) CD matrix *cd* and
+    by angle cos,sin = *ct*, *st*; pixels with
+    v1^2/r1^2 + v2^2/r2^2 < 1 are inside.
+    '''
+    x,y,ct,st,r1,r2 = [np.asarray(a) for a in (x,y,ct,st,r1,r2)]
+    def inside(I, gx, gy):
+        e = lambda a: a[I][:,np.newaxis,np.newaxis]
+        dx = gx - e(x)
+        dy = gy - e(y)
+        du = cd[0][0] * dx + cd[0][1] * dy
+        dv = cd[1][0] * dx + cd[1][1] * dy
+        v1 = e(ct) * du + -e(st) * dv
+        v2 = e(st) * du +  e(ct) * dv
+        return (v1**2 / e(r1)**2 + v2**2 / e(r2)**2 < 1.)
+    or_regions(img, value, xlo, xhi, ylo, yhi, inside)
+
+def main():
+    import time
+    from legacypipe.outliers import star_veto_map
+    W = H = 3600
+    rng = np.random.RandomState(42)
+    nstars = 50000
+    bx = rng.uniform(-10, W+10, nstars)
+    by = rng.uniform(-10, H+10, nstars)
+    pixrad = 1.0 / 0.262
+
+    t0 = time.time()
+    loop = np.zeros((H,W), bool)
+    for x,y in zip(bx,by):
+        xlo = int(np.clip(np.floor(x - pixrad), 0, W-1))
+        xhi = int(np.clip(np.ceil (x + pixrad), 0, W-1))
+        ylo = int(np.clip(np.floor(y - pixrad), 0, H-1))
+        yhi = int(np.clip(np.ceil (y + pixrad), 0, H-1))
+        if xlo == xhi or ylo == yhi:
+            continue
+        r2 = (((np.arange(ylo,yhi+1) - y)**2)[:,np.newaxis] +
+              ((np.arange(xlo,xhi+1) - x)**2)[np.newaxis,:])
+        loop[ylo:yhi+1, xlo:xhi+1] |= (r2 < pixrad)
+    t1 = time.time()
+    vec = star_veto_map((H,W), bx, by, pixrad)
+    t2 = time.time()
+    print('Star veto, %i stars: loop %.3f s, vectorized %.3f s; identical: %s' %
+          (nstars, t1-t0, t2-t1, np.all(loop == vec)))
+
+    # BRIGHT-star-like circles with a spread of radii
+    nbright = 20000
+    rx = rng.uniform(-50, W+50, nbright)
+    ry = rng.uniform(-50, H+50, nbright)
+    rpix = rng.randint(2, 40, nbright).astype(np.int32)
+    t0 = time.time()
+    loop = np.zeros((H,W), np.uint8)
+    for x,y,r in zip(rx, ry, rpix):
+        xlo = int(np.clip(np.floor(x   - r), 0, W))
+        xhi = int(np.clip(np.ceil (x+1 + r), 0, W))
+        ylo = int(np.clip(np.floor(y   - r), 0, H))
+        yhi = int(np.clip(np.ceil (y+1 + r), 0, H))
+        if xlo == xhi or ylo == yhi:
+            continue
+        rr = ((np.arange(ylo,yhi)[:,np.newaxis] - y)**2 +
+              (np.arange(xlo,xhi)[np.newaxis,:] - x)**2)
+        loop[ylo:yhi, xlo:xhi] |= (np.uint8(1) * (rr <= r**2))
+    t1 = time.time()
+    vec = np.zeros((H,W), np.uint8)
+    xlo = np.clip(np.floor(rx   - rpix), 0, W).astype(int)
+    xhi = np.clip(np.ceil (rx+1 + rpix), 0, W).astype(int)
+    ylo = np.clip(np.floor(ry   - rpix), 0, H).astype(int)
+    yhi = np.clip(np.ceil (ry+1 + rpix), 0, H).astype(int)
+    or_circles(vec, np.uint8(1), rx, ry, xlo, xhi, ylo, yhi, rpix**2)
+    t2 = time.time()
+    print('Reference circles, %i stars: loop %.3f s, vectorized %.3f s; identical: %s' %
+          (nbright, t1-t0, t2-t1, np.all(loop == vec)))
+
+if __name__ == '__main__':
+    main()
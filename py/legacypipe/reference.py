@@ -693,6 +693,7 @@ def read_star_clusters(targetwcs):
 
 def get_reference_map(wcs, refs):
     from legacypipe.bits import IN_BLOB
+    from legacypipe.rasterize import or_circles, or_ellipses
 
     H,W = wcs.shape
     H = int(H)
@@ -727,36 +728,23 @@ def get_reference_map(wcs, refs):
         _,xx,yy = wcs.radec2pixelxy(thisrefs.ra, thisrefs.dec)
         xx -= 1.
         yy -= 1.
-        for x,y,rpix,ref in zip(xx,yy,radius_pix,thisrefs):
-            # Cut to bounding square
-            xlo = int(np.clip(np.floor(x   - rpix), 0, W))
-            xhi = int(np.clip(np.ceil (x+1 + rpix), 0, W))
-            ylo = int(np.clip(np.floor(y   - rpix), 0, H))
-            yhi = int(np.clip(np.ceil (y+1 + rpix), 0, H))
-            if xlo == xhi or ylo == yhi:
-                continue
-            bitval = np.uint8(IN_BLOB[bit])
-            if not ellipse:
-                rr = ((np.arange(ylo,yhi)[:,np.newaxis] - y)**2 +
-                      (np.arange(xlo,xhi)[np.newaxis,:] - x)**2)
-                masked = (rr <= rpix**2)
-            else:
-                # *should* have ba and pa if we got here...
-                xgrid,ygrid = np.meshgrid(np.arange(xlo,xhi), np.arange(ylo,yhi))
-                dx = xgrid - x
-                dy = ygrid - y
-                # Rotate to "intermediate world coords" via the unit-scaled CD matrix
-                du = cd[0][0] * dx + cd[0][1] * dy
-                dv = cd[1][0] * dx + cd[1][1] * dy
-                debug('Object: PA', ref.pa, 'BA', ref.ba, 'Radius', ref.radius, 'pix', rpix)
-                if not np.isfinite(ref.pa):
-                    ref.pa = 0.
-                ct = np.cos(np.deg2rad(90.+ref.pa))
-                st = np.sin(np.deg2rad(90.+ref.pa))
-                v1 = ct * du + -st * dv
-                v2 = st * du +  ct * dv
-                r1 = rpix
-                r2 = rpix * ref.ba
-                masked = (v1**2 / r1**2 + v2**2 / r2**2 < 1.)
-            refmap[ylo:yhi, xlo:xhi] |= (bitval * masked)
+        # Cut to bounding squares
+        xlo = np.clip(np.floor(xx   - radius_pix), 0, W).astype(int)
+        xhi = np.clip(np.ceil (xx+1 + radius_pix), 0, W).astype(int)
+        ylo = np.clip(np.floor(yy   - radius_pix), 0, H).astype(int)
+        yhi = np.clip(np.ceil (yy+1 + radius_pix), 0, H).astype(int)
+        bitval = np.uint8(IN_BLOB[bit])
+        if not ellipse:
+            or_circles(refmap, bitval, xx, yy, xlo, xhi, ylo, yhi, radius_pix**2)
+        else:
+            # *should* have ba and pa if we got here...
+            pa = thisrefs.pa.copy()
+            pa[np.logical_not(np.isfinite(pa))] = 0.
+            # (element-wise, to keep the scalar arithmetic of the per-object version)
+            theta = np.array([np.deg2rad(90.+p) for p in pa])
+            ct = np.cos(theta)
+            st = np.sin(theta)
+            r2 = np.array([r * ba for r,ba in zip(radius_pix, thisrefs.ba)])
+            or_ellipses(refmap, bitval, xx, yy, xlo, xhi, ylo, yhi, cd, ct, st,
+                        radius_pix, r2)
     return refmap
@@ -0,0 +1,160 @@
+'''
+Caching of the mapping from tim pixels onto the brick (target) WCS.
+
+runbrick resamples each tim onto the brick several times -- in
+stage_outliers (twice for the before/after coadds, plus the blurred
+images compared against the coadd), stage_image_coadds, stage_srcs
+(detection maps), and stage_coadds.  Each of these calls
+resample_with_wcs, which computes the same pixel mapping every time.
+Here we compute it once per tim and attach it to the tim (as
+*tim.resamp*, which tim_get_resamp already looks for), so it gets
+reused by every stage and is saved in the stage pickles.
+
+Only the tim-to-brick direction is cached: stage_outliers' mapping of
+the outlier mask from the brick back onto each tim still calls
+resample_with_wcs.
+'''
+
+import numpy as np
+
+import logging
+logger = logging.getLogger('legacypipe.resampcache')
+def info(*args):
+    from legacypipe.utils import log_info
+    log_info(logger, args)
+def debug(*args):
+    from legacypipe.utils import log_debug
+    log_debug(logger, args)
+
+# Bytes per overlapping pixel: int16 Yo,Xo,Yi,Xi + float32 dx,dy
+bytes_per_pixel = 4*2 + 2*4
+
+def wcs_key(wcs):
+    '''
+    Returns a hashable summary of a (Tan) WCS, used to check that a
+    cached resampling was computed for the same WCS.
+    '''
+    try:
+        return (tuple(wcs.get_crval()), tuple(wcs.get_crpix()),
+                tuple(wcs.get_cd()), tuple(wcs.shape))
+    except AttributeError:
+        return None
+
+def resamp_key(targetwcs, tim):
+    tkey = wcs_key(targetwcs)
+    skey = wcs_key(tim.subwcs)
+    if tkey is None or skey is None:
+        return None
+    return (tkey, skey, tim.shape)
+
+class TimResampling(object):
+    '''
+    The mapping of a tim's pixels onto a target WCS, as returned by
+    resample_with_wcs -- target pixels (Yo,Xo) take the nearest
+    neighbour (Yi,Xi) in the tim -- plus the sub-pixel offsets (dx,dy)
+    of the exact tim coordinates relative to (Xi,Yi), for Lanczos
+    interpolation.
+    '''
+    def __init__(self, targetwcs, tim):
+        from astrometry.util.resample import resample_with_wcs
+        # (raises OverlapError)
+        Yo,Xo,Yi,Xi,_ = resample_with_wcs(targetwcs, tim.subwcs, intType=np.int16)
+        self.key = resamp_key(targetwcs, tim)
+        self.Yo = Yo
+        self.Xo = Xo
+        self.Yi = Yi
+        self.Xi = Xi
+        if len(Yo) == 0:
+            self.dx = self.dy = np.zeros(0, np.float32)
+            return
+        rd = targetwcs.pixelxy2radec(Xo+1., Yo+1.)[-2:]
+        _,fx,fy = tim.subwcs.radec2pixelxy(*rd)
+        del rd
+        self.dx = (fx - 1. - Xi).astype(np.float32)
+        self.dy = (fy - 1. - Yi).astype(np.float32)
+
+    def nbytes(self):
+        return sum([a.nbytes for a in [self.Yo, self.Xo, self.Yi, self.Xi,
+                                       self.dx, self.dy]])
+
+    def matches(self, targetwcs, tim):
+        '''
+        Was this resampling computed for this target WCS and tim?  (It
+        may have been copied along with the tim's attributes into a
+        sub-image, for example.)
+        '''
+        return self.key is not None and self.key == resamp_key(targetwcs, tim)
+
+    def resample(self, imgs):
+        '''
+        Lanczos3-resamples the given list of tim-shaped images,
+        returning a list of arrays aligned with (Yo,Xo).
+        '''
+        from astrometry.util.util import lanczos3_interpolate
+        ix = self.Xi.astype(np.int32)
+        iy = self.Yi.astype(np.int32)
+        rimgs = [np.zeros(len(ix), np.float32) for img in imgs]
+        lanczos3_interpolate(ix, iy, self.dx, self.dy, rimgs,
+                             [img.astype(np.float32) for img in imgs])
+        return rimgs
+
+def _resamp_one(X):
+    from astrometry.util.resample import OverlapError
+    (itim, tim, targetwcs) = X
+    try:
+        R = TimResampling(targetwcs, tim)
+    except OverlapError:
+        return itim, None
+    if len(R.Yo) == 0:
+        return itim, None
+    return itim, R
+
+def cache_tim_resampling(tims, targetwcs, mp, max_gb):
+    '''
+    Computes and attaches *tim.resamp* (a TimResampling object) for
+    as many of the *tims* as fit within *max_gb* gigabytes; the
+    remaining tims will compute their resampling as needed.
+    '''
+    pixscale = targetwcs.pixel_scale()
+    H,W = targetwcs.shape
+    budget = max_gb * 1e9
+    total = 0
+    args = []
+    for itim,tim in enumerate(tims):
+        # Upper-bound estimate of the number of overlapping pixels
+        h,w = tim.shape
+        npix = min(H*W, h*w * (tim.subwcs.pixel_scale() / pixscale)**2)
+        nb = npix * bytes_per_pixel
+        if total + nb > budget:
+            continue
+        total += nb
+        args.append((itim, tim, targetwcs))
+    info('Caching resampling for', len(args), 'of', len(tims), 'tims',
+         '(estimated %.1f of %.1f GB)' % (total/1e9, max_gb))
+    nbytes = 0
+    for itim,R in mp.imap_unordered(_resamp_one, args):
+        if R is None:
+            continue
+        tims[itim].resamp = R
+        nbytes += R.nbytes()
+    info('Resampling cache: %.1f GB' % (nbytes/1e9))
+
+def resample_tim(tim, targetwcs, imgs, intType=np.int16):
+    '''
+    A drop-in replacement for resample_with_wcs(targetwcs, tim.subwcs,
+    imgs, 3, intType=intType) that uses the tim's cached resampling, if
+    present.
+    '''
+    from astrometry.util.resample import resample_with_wcs, OverlapError
+    R = getattr(tim, 'resamp', None)
+    if isinstance(R, TimResampling) and R.matches(targetwcs, tim):
+        if len(R.Yo) == 0:
+            raise OverlapError('No overlap')
+        if len(imgs):
+            rimgs = R.resample(imgs)
+        else:
+            rimgs = []
+        return (R.Yo.astype(intType, copy=False), R.Xo.astype(intType, copy=False),
+                R.Yi.astype(intType, copy=False), R.Xi.astype(intType, copy=False),
+                rimgs)
+    return resample_with_wcs(targetwcs, tim.subwcs, imgs, 3, intType=intType)
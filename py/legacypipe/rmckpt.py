@@ -18,6 +18,8 @@ def removeckpt(brick, rundir):
         rundir+='/'
     filename =  rundir + "checkpoints/" + subdir + "/checkpoint-" + brick + ".pickle"
     silentremove(filename)
+    # (partially-written checkpoint)
+    silentremove(filename + ".tmp")
     filename = rundir + "pickles/" + subdir + "/runbrick-" + brick + "-coadds.pickle"
     silentremove(filename)
     filename = rundir + "pickles/" + subdir + "/runbrick-" + brick + "-fitblobs.pickle"
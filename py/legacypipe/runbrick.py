@@ -60,10 +60,13 @@ def formatwarning(message, category, filename, lineno, line=None):
 
 warnings.formatwarning = formatwarning
 
-def runbrick_global_init():
+def runbrick_global_init(fork_slots=None):
     from tractor.galaxy import disable_galaxy_cache
     info('Starting process', os.getpid(), Time()-Time())
     disable_galaxy_cache()
+    if fork_slots is not None:
+        from legacypipe.utils import set_fork_slots
+        set_fork_slots(fork_slots)
 
 def stage_tims(W=3600, H=3600, pixscale=0.262, brickname=None,
                survey=None,
@@ -93,6 +96,9 @@ def stage_tims(W=3600, H=3600, pixscale=0.262, brickname=None,
                command_line=None,
                read_parallel=True,
                max_memory_gb=None,
+               resample_cache_gb=None,
+               tim_cache_dir=None,
+               tim_cache_gb=None,
                **kwargs):
     '''
     This is the first stage in the pipeline.  It
@@ -246,9 +252,10 @@ def stage_tims(W=3600, H=3600, pixscale=0.262, brickname=None,
 
     if max_memory_gb:
         # Estimate total memory required for tim pixels
-        mem = sum([im.estimate_memory_required(radecpoly=targetrd,
-                                               mywcs=survey.get_approx_wcs(ccd))
-                                               for im,ccd in zip(ims,ccds)])
+        mems = [im.estimate_memory_required(radecpoly=targetrd,
+                                            mywcs=survey.get_approx_wcs(ccd))
+                for im,ccd in zip(ims,ccds)]
+        mem = sum(mems)
         info('Estimated memory required: %.1f GB' % (mem/1e9))
         if mem / 1e9 > max_memory_gb:
             raise RuntimeError('Too much memory required: %.1f > %.1f GB' % (mem/1e9, max_memory_gb))
@@ -284,9 +291,28 @@ def stage_tims(W=3600, H=3600, pixscale=0.262, brickname=None,
                                 for im in ims]
     record_event and record_event('stage_tims: starting read_tims')
     if read_parallel:
-        tims = list(mp.map(read_one_tim, args))
+        mapfunc = mp.map
     else:
-        tims = list(map(read_one_tim, args))
+        mapfunc = map
+    if max_memory_gb:
+        # Stream the CCDs through the workers within the memory budget.
+        from legacypipe.timreader import TimReader
+        est = dict([(id(im), m) for im,m in zip(ims, mems)])
+        reader = TimReader(mp if read_parallel else None, max_bytes=max_memory_gb * 1e9,
+                           estimate=lambda X: est[id(X[0])])
+        info('Using', reader)
+        mapfunc = reader.map
+    if tim_cache_gb:
+        from legacypipe.timcache import TimCache, read_tims
+        if tim_cache_dir is None:
+            if survey.cache_dir is None:
+                raise RuntimeError('Tim cache needs a directory: --tim-cache-dir or --cache-dir')
+            tim_cache_dir = os.path.join(survey.cache_dir, 'tim-cache')
+        tim_cache = TimCache(tim_cache_dir, tim_cache_gb * 1e9)
+        info('Using', tim_cache)
+        tims = read_tims(tim_cache, args, lambda f,a: list(mapfunc(f, a)))
+    else:
+        tims = list(mapfunc(read_one_tim, args))
     record_event and record_event('stage_tims: done read_tims')
 
     tnow = Time()
@@ -345,6 +371,14 @@ def stage_tims(W=3600, H=3600, pixscale=0.262, brickname=None,
         from legacypipe.runbrick_plots import tim_plots
         tim_plots(tims, bands, ps)
 
+    if resample_cache_gb:
+        # Compute the tim-to-brick resampling once, for all later stages.
+        from legacypipe.resampcache import cache_tim_resampling
+        cache_tim_resampling(tims, targetwcs, mp, resample_cache_gb)
+        tnow = Time()
+        debug('Caching resampling:', tnow-tlast)
+        tlast = tnow
+
     # Add header cards about the survey-ccds files that were used.
     fns = survey.find_file('ccd-kds')
     fns = survey.filter_ccd_kd_files(fns)
@@ -835,6 +869,7 @@ def stage_srcs(pixscale=None, targetwcs=None,
                large_galaxies=True,
                gaia_stars=True,
                blob_dilate=None,
+               detection_procs=0,
                **kwargs):
     '''
     In this stage we run SED-matched detection to find objects in the
@@ -842,6 +877,9 @@ def stage_srcs(pixscale=None, targetwcs=None,
     created, initially a `tractor.PointSource`.  In this stage, the
     sources are also split into "blobs" of overlapping pixels.  Each
     of these blobs will be processed independently.
+
+    With *detection_procs* > 1, the per-peak tests of the SED-matched
+    detection run in that many forked processes.
     '''
     from tractor import Catalog
     from legacypipe.detection import (detection_maps, merge_hot_satur,
@@ -948,7 +986,7 @@ def stage_srcs(pixscale=None, targetwcs=None,
         SEDs, bands, detmaps, detivs, (avoid_x,avoid_y,avoid_r), targetwcs,
         nsigma=nsigma, saddle_fraction=saddle_fraction, saddle_min=saddle_min,
         saturated_pix=saturated_pix, veto_map=avoid_map, blob_dilate=blob_dilate,
-        plots=plots, ps=ps, mp=mp, **kwa)
+        nprocs=detection_procs, plots=plots, ps=ps, mp=mp, **kwa)
 
     if Tnew is not None:
         assert(len(Tnew) == len(newcat))
@@ -1095,6 +1133,10 @@ def stage_fitblobs(T=None,
                    large_galaxies_force_pointsource=True,
                    less_masking=False,
                    sub_blobs=False,
+                   blob_cost_order=False,
+                   model_procs=0,
+                   model_procs_npix=250000,
+                   model_procs_nsrcs=100,
                    use_ceres=True, mp=None,
                    checkpoint_filename=None,
                    checkpoint_period=600,
@@ -1201,12 +1243,15 @@ def stage_fitblobs(T=None,
 
     skipblobs = []
     R = []
+    ckpt = None
+    if checkpoint_filename:
+        from legacypipe.checkpoint import CheckpointLog
+        ckpt = CheckpointLog(checkpoint_filename)
     # Check for existing checkpoint file.
     if checkpoint_filename and os.path.exists(checkpoint_filename):
-        from astrometry.util.file import unpickle_from_file
         info('Reading', checkpoint_filename)
         try:
-            R = unpickle_from_file(checkpoint_filename)
+            R = ckpt.read()
             debug('Read', len(R), 'results from checkpoint file', checkpoint_filename)
         except:
             import traceback
@@ -1214,6 +1259,15 @@ def stage_fitblobs(T=None,
             traceback.print_exc()
         keepR = _check_checkpoints(R, blobslices, brickname)
         info('Keeping', len(keepR), 'of', len(R), 'checkpointed results')
+        if len(keepR) < len(R) and ckpt.nrecords is not None:
+            # Drop the stale results from the file, so that appending
+            # new results keeps it in step with R.
+            try:
+                ckpt.write(keepR)
+            except:
+                import traceback
+                print('Failed to write checkpoint file ' + checkpoint_filename)
+                traceback.print_exc()
         R = keepR
         skipblobs = [r['iblob'] for r in R]
 
@@ -1271,6 +1325,12 @@ def stage_fitblobs(T=None,
     if sub_blobs:
         ran_sub_blobs = []
 
+    # Start the blobs predicted to be most expensive first.
+    blob_order = None
+    if blob_cost_order:
+        blob_order = get_blob_cost_order(R, T, blobslices, blobsrcs, blobmap,
+                                         tims, targetwcs)
+
     # Create the iterator over blobs to process
     blobiter = _blob_iter(brickname, blobslices, blobsrcs, blobmap, targetwcs, tims,
                           cat, T, bands, plots, ps, reoptimize, iterative, use_ceres,
@@ -1280,7 +1340,11 @@ def stage_fitblobs(T=None,
                           single_thread=(mp is None or mp.pool is None),
                           max_blobsize=max_blobsize, custom_brick=custom_brick,
                           enable_sub_blobs=sub_blobs,
-                          ran_sub_blobs=ran_sub_blobs)
+                          ran_sub_blobs=ran_sub_blobs,
+                          blob_order=blob_order,
+                          model_procs=model_procs,
+                          model_procs_npix=model_procs_npix,
+                          model_procs_nsrcs=model_procs_nsrcs)
 
     if checkpoint_filename is None:
         R.extend(mp.map(_bounce_one_blob, blobiter))
@@ -1301,7 +1365,7 @@ def stage_fitblobs(T=None,
                 # Write checkpoint!
                 debug('Writing', n_finished, 'new results; total for this run', n_finished_total)
                 try:
-                    _write_checkpoint(R, checkpoint_filename)
+                    ckpt.update(R)
                     last_checkpoint = tnow
                     dt = 0.
                     n_finished = 0
@@ -1324,7 +1388,8 @@ def stage_fitblobs(T=None,
             except multiprocessing.TimeoutError:
                 continue
         # Write checkpoint when done!
-        _write_checkpoint(R, checkpoint_filename)
+        ckpt.update(R)
+        ckpt.close()
         debug('Got', n_finished_total, 'results; wrote', len(R), 'to checkpoint')
     debug('Fitting sources:', Time()-tlast)
 
@@ -1739,19 +1804,48 @@ def _check_checkpoints(R, blobslices, brickname):
         keepR.append(ri)
     return keepR
 
+def get_blob_cost_order(R, T, blobslices, blobsrcs, blobmap, tims, targetwcs,
+                        model=None):
+    '''
+    Returns the blob numbers ordered by predicted CPU time, most
+    expensive first, using a BlobCostModel calibrated against the
+    checkpointed results *R*, if there are enough of them.
+    '''
+    from legacypipe.blobcost import BlobCostModel, blob_costs, cost_order
+    if model is None:
+        model = BlobCostModel()
+    if R is not None and len(R):
+        model.add_results(R, T)
+        model.calibrate()
+    costs = blob_costs(model, blobslices, blobsrcs, blobmap, T, tims, targetwcs)
+    order = cost_order(costs)
+    if len(order):
+        info('Blob cost model: predicted %.0f CPU-seconds for %i blobs; most expensive %.0f s' %
+             (np.sum(costs), len(order), costs[order[0]]))
+    debug(model)
+    return order
+
 def _blob_iter(brickname, blobslices, blobsrcs, blobmap, targetwcs, tims, cat, T, bands,
                plots, ps, reoptimize, iterative, use_ceres, refmap,
                large_galaxies_force_pointsource, less_masking,
                brick, frozen_galaxies, single_thread=False,
                skipblobs=None, max_blobsize=None, custom_brick=False,
                enable_sub_blobs=False,
-               ran_sub_blobs=None):
+               ran_sub_blobs=None,
+               blob_order=None,
+               model_procs=0, model_procs_npix=250000, model_procs_nsrcs=100):
     '''
     *blobmap*: integer image map, with -1 indicating no-blob, other values indexing
         into *blobslices*,*blobsrcs*.
     *blobsrcs*: a list of numpy arrays of integers -- indices into *cat* -- of the sources in
         this blob.
     *T*: a fits table parallel to *cat* with some extra info (very little used)
+    *blob_order*: the order in which to yield blobs; default is by size, largest first.
+    *model_procs*: for blobs with at least *model_procs_npix* pixels or
+        *model_procs_nsrcs* sources, fit each source's candidate models in
+        (up to) this many forked processes.  The extra processes only
+        use CPUs of the *threads* pool (or the farm's worker.py) that
+        are not busy fitting other blobs.
     '''
     from legacypipe.bits import IN_BLOB
     from collections import Counter
@@ -1802,10 +1896,11 @@ def _blob_iter(brickname, blobslices, blobsrcs, blobmap, targetwcs, tims, cat, T
     if skipblobs is None:
         skipblobs = []
 
-    # sort blobs by size so that larger ones start running first
-    blobvals = Counter(blobmap[blobmap>=0])
-    blob_order = np.array([b for b,npix in blobvals.most_common()])
-    del blobvals
+    if blob_order is None:
+        # sort blobs by size so that larger ones start running first
+        blobvals = Counter(blobmap[blobmap>=0])
+        blob_order = np.array([b for b,npix in blobvals.most_common()])
+        del blobvals
 
     # HACK -- reverse!
     #blob_order = blob_order[-1::-1]
@@ -1910,6 +2005,13 @@ def _blob_iter(brickname, blobslices, blobsrcs, blobmap, targetwcs, tims, cat, T
 
         if not do_sub_blobs:
             # Regular blob.
+            # Fit candidate models in parallel for the biggest blobs?
+            blob_model_procs = 0
+            if model_procs > 1 and (npix >= model_procs_npix or
+                                    len(Isrcs) >= model_procs_nsrcs):
+                info('Fitting candidate models for blob', nblob+1, 'in up to',
+                     model_procs, 'processes')
+                blob_model_procs = model_procs
             # Here we cut out subimages for the blob...
             subtimargs = get_subtim_args(tims, targetwcs, bx0,bx1, by0,by1, single_thread)
             yield (brickname, iblob, None,
@@ -1917,7 +2019,7 @@ def _blob_iter(brickname, blobslices, blobsrcs, blobmap, targetwcs, tims, cat, T
                     blobmask, subtimargs, [cat[i] for i in Isrcs], bands, plots, ps,
                     reoptimize, iterative, use_ceres, refmap[bslc],
                     large_galaxies_force_pointsource, less_masking,
-                    frozen_galaxies.get(iblob, [])))
+                    frozen_galaxies.get(iblob, []), blob_model_procs))
             continue
 
         # Sub-blob.
@@ -1984,14 +2086,21 @@ def _blob_iter(brickname, blobslices, blobsrcs, blobmap, targetwcs, tims, cat, T
                         subtimargs, [cat[i] for i in Isubsrcs], bands,
                         plots, ps,
                         reoptimize, iterative, use_ceres, refmap[sub_slc],
-                        large_galaxies_force_pointsource, less_masking, fro_gals))
+                        large_galaxies_force_pointsource, less_masking, fro_gals,
+                        # (sub-blobs already run in parallel)
+                        0))
 
 def _bounce_one_blob(X):
     '''This wraps the one_blob function for multiprocessing purposes (and
     now also does some post-processing).
     '''
     from legacypipe.oneblob import one_blob
+    from legacypipe.utils import get_fork_slots
     (brickname, iblob, blob_unique, X) = X
+    # This worker's CPU is busy (see fork_map)
+    slots = get_fork_slots()
+    if slots is not None:
+        slots.acquire()
     try:
         result = one_blob(X)
         if result is not None:
@@ -2013,6 +2122,9 @@ def _bounce_one_blob(X):
         print('Exception in one_blob: brick %s, iblob %s' % (brickname, iblob))
         traceback.print_exc()
         raise
+    finally:
+        if slots is not None:
+            slots.release()
 
 def _get_mod(X):
     from tractor import Tractor
@@ -2154,6 +2266,8 @@ def stage_coadds(survey=None, bands=None, version_header=None, targetwcs=None,
                  bailout_mask=None,
                  sub_blob_mask=None,
                  coadd_headers={},
+                 coadd_procs=0,
+                 coadd_memory_gb=None,
                  mp=None,
                  record_event=None,
                  **kwargs):
@@ -2277,7 +2391,10 @@ def stage_coadds(survey=None, bands=None, version_header=None, targetwcs=None,
                     callback=write_coadd_images,
                     callback_args=(survey, brickname, version_header, tims,
                                    targetwcs, co_sky, coadd_headers),
-                    plots=plots, ps=ps, mp=mp)
+                    plots=plots, ps=ps, mp=mp,
+                    nprocs=coadd_procs,
+                    max_partial_bytes=(None if coadd_memory_gb is None
+                                       else coadd_memory_gb * 1e9))
     record_event and record_event('stage_coadds: extras')
 
     # Coadds of galaxy sims only, image only
@@ -2548,14 +2665,14 @@ def _add_bit_description(header, BITS, bits, bnpat, bitpat, bitmapname):
 
 def get_fiber_fluxes(cat, T, targetwcs, H, W, pixscale, bands,
                      fibersize=1.5, seeing=1., year=2020.0,
-                     plots=False, ps=None):
+                     plots=False, ps=None, nprocs=1):
     from tractor import GaussianMixturePSF
     from legacypipe.survey import LegacySurveyWcs
+    from legacypipe.fiberflux import fiber_fluxes
     import astropy.time
     from tractor.tractortime import TAITime
     from tractor.image import Image
     from tractor.basics import LinearPhotoCal
-    from photutils.aperture import CircularAperture, aperture_photometry
 
     # Create a fake tim for each band to construct the models in 1" seeing
     # For Gaia stars, we need to give a time for evaluating the models.
@@ -2570,62 +2687,30 @@ def get_fiber_fluxes(cat, T, targetwcs, H, W, pixscale, bands,
     faketim = Image(data=data, inverr=inverr, psf=psf,
                     wcs=wcs, photocal=LinearPhotoCal(1., bands[0]))
 
-    # A model image (containing all sources) for each band
-    modimgs = [np.zeros((H,W), np.float32) for b in bands]
-    # A blank image that we'll use for rendering the flux from a single model
-    onemod = data
-
-    # Results go here!
-    fiberflux    = np.zeros((len(cat),len(bands)), np.float32)
-    fibertotflux = np.zeros((len(cat),len(bands)), np.float32)
-
     # Fiber diameter in arcsec -> radius in pix
     fiberrad = (fibersize / pixscale) / 2.
 
-    # For each source, compute and measure its model, and accumulate
+    # Source fluxes, zero for the source-bands we skip
+    fluxes = np.zeros((len(cat),len(bands)))
     for isrc,src in enumerate(cat):
         if src is None:
             continue
-        # This works even if bands[0] has zero flux (or no overlapping
-        # images)
-        ums = src.getUnitFluxModelPatches(faketim)
-        assert(len(ums) == 1)
-        patch = ums[0]
-        if patch is None:
-            continue
         br = src.getBrightness()
-        for iband,(modimg,band) in enumerate(zip(modimgs,bands)):
+        for iband,band in enumerate(bands):
             flux = br.getFlux(band)
-            flux_iv = T.flux_ivar[isrc, iband]
-            if flux <= 0 or flux_iv <= 0:
-                continue
-            # Accumulate into image containing all models
-            patch.addTo(modimg, scale=flux)
-            # Add to blank image & photometer
-            patch.addTo(onemod, scale=flux)
-            sx,sy = faketim.getWcs().positionToPixel(src.getPosition())
-            aper = CircularAperture((sx, sy), fiberrad)
-            p = aperture_photometry(onemod, aper)
-            f = p.field('aperture_sum')[0]
-            if not np.isfinite(f):
-                # If the source is off the brick (eg, ref sources), can be NaN
-                continue
-            fiberflux[isrc,iband] = f
-            # Blank out the image again
-            x0,x1,y0,y1 = patch.getExtent()
-            onemod[y0:y1, x0:x1] = 0.
+            if flux > 0 and T.flux_ivar[isrc, iband] > 0:
+                fluxes[isrc, iband] = flux
 
-    # Now photometer the accumulated images
-    # Aperture photometry locations
-    apxy = np.vstack((T.bx, T.by)).T
-    aper = CircularAperture(apxy, fiberrad)
-    for iband,modimg in enumerate(modimgs):
-        p = aperture_photometry(modimg, aper)
-        f = p.field('aperture_sum')
-        # If the source is off the brick (eg, ref sources), can be NaN
-        I = np.isfinite(f)
-        if len(I):
-            fibertotflux[I, iband] = f[I]
+    # A model image (containing all sources) for each band, for plots
+    modimgs = None
+    if plots:
+        modimgs = [np.zeros((H,W), np.float32) for b in bands]
+
+    # Each source's fiber flux from its own model, and the fiber flux
+    # from all models at each source's (catalog) position
+    fiberflux, fibertotflux = fiber_fluxes(cat, fluxes, faketim, fiberrad,
+                                           T.bx, T.by, H, W, nprocs=nprocs,
+                                           modimgs=modimgs)
 
     if plots:
         import pylab as plt
@@ -2710,12 +2795,18 @@ def stage_wise_forced(
     record_event=None,
     wise_checkpoint_filename=None,
     wise_checkpoint_period=600,
+    unwise_cache_dir=None,
+    unwise_cache_gb=None,
     ps=None,
     plots=False,
     **kwargs):
     '''
     After the model fits are finished, we can perform forced
     photometry of the unWISE coadds.
+
+    With *unwise_cache_gb*, the unWISE tiles, PSFs and time-resolved
+    atlas are read through a node-local UnwiseTileCache in
+    *unwise_cache_dir*, so that neighbouring bricks can re-use them.
     '''
     from legacypipe.unwise import unwise_phot, collapse_unwise_bitmask, unwise_tiles_touching_wcs
     from legacypipe.survey import wise_apertures_arcsec
@@ -2731,6 +2822,16 @@ def stage_wise_forced(
     tiles = unwise_tiles_touching_wcs(targetwcs)
     info('Cut to', len(tiles), 'unWISE tiles')
 
+    tile_cache = None
+    if unwise_cache_gb:
+        from legacypipe.unwisecache import UnwiseTileCache
+        if unwise_cache_dir is None:
+            if survey.cache_dir is None:
+                raise RuntimeError('unWISE cache needs a directory: --unwise-cache-dir or --cache-dir')
+            unwise_cache_dir = os.path.join(survey.cache_dir, 'unwise-cache')
+        tile_cache = UnwiseTileCache(unwise_cache_dir, unwise_cache_gb * 1e9)
+        info('Using', tile_cache)
+
     # the way the roiradec box is used, the min/max order doesn't matter
     roiradec = [targetrd[0,0], targetrd[2,0], targetrd[0,1], targetrd[2,1]]
 
@@ -2782,16 +2883,18 @@ def stage_wise_forced(
             args.append(((-1,band),
                          (wcat, wtiles, band, roiradec, wise_ceres, wpixpsf,
                           unwise_coadds, get_masks, ps, True,
-                          unwise_modelsky_dir, 'Full-depth W%i' % (band))))
+                          unwise_modelsky_dir, 'Full-depth W%i' % (band),
+                          tile_cache)))
 
     # Add time-resolved WISE coadds
     # Skip if $UNWISE_COADDS_TIMERESOLVED_DIR or --unwise-tr-dir not set.
     eargs = []
     if unwise_tr_dir is not None:
+        from legacypipe.unwisecache import read_time_resolved_atlas
         tdir = unwise_tr_dir
-        TR = fits_table(os.path.join(tdir, 'time_resolved_atlas.fits'))
-        debug('Read', len(TR), 'time-resolved WISE coadd tiles')
-        TR.cut(np.array([t in tiles.coadd_id for t in TR.coadd_id]))
+        atlas = read_time_resolved_atlas(tdir, cache=tile_cache)
+        debug('Read', len(atlas), 'time-resolved WISE coadd tiles')
+        TR = atlas.get_tiles(tiles.coadd_id)
         debug('Cut to', len(TR), 'time-resolved vs', len(tiles), 'full-depth')
         assert(len(TR) == len(tiles))
         # Ugly -- we need to look up the "{ra,dec}[12]" fields from the non-TR
@@ -2838,10 +2941,14 @@ def stage_wise_forced(
                 eargs.append(((ie,band),
                               (wcat, eptiles, band, roiradec,
                                wise_ceres, wpixpsf, False, None, ps, False,
-                               unwise_modelsky_dir, 'Epoch %i W%i' % (ie+1, band))))
+                               unwise_modelsky_dir, 'Epoch %i W%i' % (ie+1, band),
+                               tile_cache)))
 
     runargs = args + eargs
     info('unWISE forced phot: total of', len(runargs), 'images to photometer')
+    if tile_cache is not None:
+        # (the photometry results include the stats for their reads)
+        cache_stats = dict(tile_cache.stats)
     photresults = {}
     # Check for existing checkpoint file.
     if wise_checkpoint_filename and os.path.exists(wise_checkpoint_filename):
@@ -2927,6 +3034,12 @@ def stage_wise_forced(
 
     phots = [photresults[k] for k,a in (args + eargs)]
     record_event and record_event('stage_wise_forced: results')
+    if tile_cache is not None:
+        from legacypipe.unwisecache import merge_stats, format_stats
+        for p in phots:
+            if p is not None and getattr(p, 'cache_stats', None) is not None:
+                merge_stats(cache_stats, p.cache_stats)
+        info('unWISE tile cache:', format_stats(cache_stats))
 
     # Unpack results...
     WISE = None
@@ -3077,6 +3190,7 @@ def stage_writecat(
     gaia_stars=True,
     co_sky=None,
     record_event=None,
+    fiber_procs=0,
     **kwargs):
     '''
     Final stage in the pipeline: format results for the output
@@ -3143,7 +3257,8 @@ def stage_writecat(
 
     # Compute fiber fluxes
     T.fiberflux, T.fibertotflux = get_fiber_fluxes(
-        cat, T, targetwcs, H, W, pixscale, bands, plots=plots, ps=ps)
+        cat, T, targetwcs, H, W, pixscale, bands, plots=plots, ps=ps,
+        nprocs=fiber_procs)
 
     # For reference *stars* only, plug in the reference-catalog inverse-variances.
     if 'ref_cat' in T.get_columns() and 'ra_ivar' in T_orig.get_columns():
@@ -3376,6 +3491,10 @@ def run_brick(brick, survey, radec=None, pixscale=0.262,
               saddle_fraction=0.1,
               saddle_min=2.,
               blob_dilate=None,
+              detection_procs=0,
+              fiber_procs=0,
+              coadd_procs=0,
+              coadd_memory_gb=None,
               subsky_radii=None,
               reoptimize=False,
               iterative=False,
@@ -3406,6 +3525,10 @@ def run_brick(brick, survey, radec=None, pixscale=0.262,
               fitoncoadds_reweight_ivar=True,
               less_masking=False,
               sub_blobs=False,
+              blob_cost_order=False,
+              model_procs=0,
+              model_procs_npix=250000,
+              model_procs_nsrcs=100,
               nsatur=None,
               fit_on_coadds=False,
               coadd_tiers=None,
@@ -3426,6 +3549,11 @@ def run_brick(brick, survey, radec=None, pixscale=0.262,
               command_line=None,
               read_parallel=True,
               max_memory_gb=None,
+              resample_cache_gb=None,
+              tim_cache_dir=None,
+              tim_cache_gb=None,
+              unwise_cache_dir=None,
+              unwise_cache_gb=None,
               record_event=None,
     # These are for the 'stages' infrastructure
               pickle_pat='pickles/runbrick-%(brick)s-%%(stage)s.pickle',
@@ -3506,6 +3634,18 @@ def run_brick(brick, survey, radec=None, pixscale=0.262,
 
     - *nsigma*: float; detection threshold in sigmas.
 
+    - *detection_procs*: int; run the source-detection peak tests in
+      this many (forked) processes.
+
+    - *fiber_procs*: int; compute the fiber fluxes in this many
+      (forked) processes.
+
+    - *coadd_procs*: int; accumulate the coadds in this many (forked)
+      processes, each into its own partial coadd maps.
+
+    - *coadd_memory_gb*: float; limit the number of *coadd_procs* so
+      that their partial coadd maps fit in this much memory, in GB.
+
     - *wise*: boolean; run WISE forced photometry?
 
     - *do_calibs*: boolean; run the calibration preprocessing steps?
@@ -3644,6 +3784,10 @@ def run_brick(brick, survey, radec=None, pixscale=0.262,
     kwargs.update(ps=ps, nsigma=nsigma, saddle_fraction=saddle_fraction,
                   saddle_min=saddle_min,
                   blob_dilate=blob_dilate,
+                  detection_procs=detection_procs,
+                  fiber_procs=fiber_procs,
+                  coadd_procs=coadd_procs,
+                  coadd_memory_gb=coadd_memory_gb,
                   subsky_radii=subsky_radii,
                   survey_blob_mask=survey_blob_mask,
                   gaussPsf=gaussPsf, pixPsf=pixPsf, hybridPsf=hybridPsf,
@@ -3661,6 +3805,10 @@ def run_brick(brick, survey, radec=None, pixscale=0.262,
                   fitoncoadds_reweight_ivar=fitoncoadds_reweight_ivar,
                   less_masking=less_masking,
                   sub_blobs=sub_blobs,
+                  blob_cost_order=blob_cost_order,
+                  model_procs=model_procs,
+                  model_procs_npix=model_procs_npix,
+                  model_procs_nsrcs=model_procs_nsrcs,
                   min_mjd=min_mjd, max_mjd=max_mjd,
                   coadd_tiers=coadd_tiers,
                   nsatur=nsatur,
@@ -3687,6 +3835,11 @@ def run_brick(brick, survey, radec=None, pixscale=0.262,
                   command_line=command_line,
                   read_parallel=read_parallel,
                   max_memory_gb=max_memory_gb,
+                  resample_cache_gb=resample_cache_gb,
+                  tim_cache_dir=tim_cache_dir,
+                  tim_cache_gb=tim_cache_gb,
+                  unwise_cache_dir=unwise_cache_dir,
+                  unwise_cache_gb=unwise_cache_gb,
                   plots=plots, plots2=plots2, coadd_bw=coadd_bw,
                   force=forceStages, write=write_pickles,
                   record_event=record_event)
@@ -3704,8 +3857,12 @@ def run_brick(brick, survey, radec=None, pixscale=0.262,
         from astrometry.util.timingpool import TimingPool, TimingPoolMeas
         from astrometry.util.ttime import MemMeas
         if pool is None:
+            # The pool's workers count the CPUs that are idle (not
+            # fitting a blob), for --model-procs.
+            import multiprocessing
+            fork_slots = multiprocessing.Semaphore(threads)
             pool = TimingPool(threads, initializer=runbrick_global_init,
-                              initargs=[])
+                              initargs=[fork_slots])
         poolmeas = TimingPoolMeas(pool, pickleTraffic=False)
         StageTime.add_measurement(poolmeas)
         StageTime.add_measurement(MemMeas)
@@ -4024,6 +4181,14 @@ python -u legacypipe/runbrick.py --plots --brick 2440p070 --zoom 1900 2400 450 9
                         help='Saddle-point depth from existing sources down to new sources (sigma).')
     parser.add_argument('--blob-dilate', type=int, default=None,
                         help='How many pixels to dilate detection pixels (default: 8)')
+    parser.add_argument('--detection-procs', type=int, default=0,
+                        help='Run the per-peak tests of source detection in this many (forked) processes; default off')
+    parser.add_argument('--fiber-procs', type=int, default=0,
+                        help='Compute fiber fluxes in this many (forked) processes; default off')
+    parser.add_argument('--coadd-procs', type=int, default=0,
+                        help='Accumulate the coadds in this many (forked) processes, merging partial coadds (the floating-point maps may differ from the serial ones by rounding); default off')
+    parser.add_argument('--coadd-memory-gb', type=float, default=None,
+                        help='Memory limit for the --coadd-procs partial coadds, in GB; default none')
 
     parser.add_argument(
         '--reoptimize', action='store_true', default=False,
@@ -4115,6 +4280,14 @@ python -u legacypipe/runbrick.py --plots --brick 2440p070 --zoom 1900 2400 450 9
 
     parser.add_argument('--sub-blobs', default=False, action='store_true',
                         help='Split large blobs into sub-blobs that can be processed in parallel.')
+    parser.add_argument('--blob-cost-order', default=False, action='store_true',
+                        help='Fit blobs in order of predicted CPU time, rather than size.')
+    parser.add_argument('--model-procs', type=int, default=0,
+                        help='For big blobs, fit the candidate models for each source in parallel in up to this many (forked) processes, using --threads CPUs that are not busy with other blobs; default off')
+    parser.add_argument('--model-procs-npix', type=int, default=250000,
+                        help='Minimum number of blob pixels for --model-procs; default %(default)s')
+    parser.add_argument('--model-procs-nsrcs', type=int, default=100,
+                        help='Minimum number of blob sources for --model-procs (either threshold applies); default %(default)s')
 
     parser.add_argument('--fit-on-coadds', default=False, action='store_true',
                         help='Fit to coadds rather than individual CCDs (e.g., large galaxies).')
@@ -4141,7 +4314,18 @@ python -u legacypipe/runbrick.py --plots --brick 2440p070 --zoom 1900 2400 450 9
     parser.add_argument('--read-serial', dest='read_parallel', default=True,
                         action='store_false', help='Read images in series, not in parallel?')
     parser.add_argument('--max-memory-gb', type=float, default=None,
-                        help='Maximum (estimated) memory to allow for tim pixels, in GB')
+                        help='Maximum (estimated) memory to allow for tim pixels, in GB; '
+                        'also limits the CCDs read at once')
+    parser.add_argument('--resample-cache-gb', type=float, default=None,
+                        help='Compute the tim-to-brick resampling once and reuse it in later stages, using up to this much memory, in GB')
+    parser.add_argument('--tim-cache-gb', type=float, default=None,
+                        help='Cache calibrated tim pixels on disk (uncompressed, memory-mapped) for re-use by later runs, up to this size in GB')
+    parser.add_argument('--tim-cache-dir', default=None,
+                        help='Directory for --tim-cache-gb; default is "tim-cache" in --cache-dir')
+    parser.add_argument('--unwise-cache-gb', type=float, default=None,
+                        help='Cache uncompressed unWISE tiles, PSFs and the time-resolved atlas on local disk, up to this many GB, for re-use by neighbouring bricks')
+    parser.add_argument('--unwise-cache-dir', default=None,
+                        help='Directory for --unwise-cache-gb; default is "unwise-cache" in --cache-dir')
     parser.add_argument('--rgb-stretch', type=float, help='Stretch RGB jpeg plots by this factor.')
     return parser
 
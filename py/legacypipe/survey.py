@@ -494,8 +494,16 @@ def get_dependency_versions(unwise_dir, unwise_tr_dir, unwise_modelsky_dir, gale
 def tim_get_resamp(tim, targetwcs):
     from astrometry.util.resample import resample_with_wcs,OverlapError
 
+    from legacypipe.resampcache import TimResampling
+
     if hasattr(tim, 'resamp'):
-        return tim.resamp
+        R = tim.resamp
+        if not isinstance(R, TimResampling):
+            return R
+        if R.matches(targetwcs, tim):
+            if len(R.Yo) == 0:
+                return None
+            return R.Yo,R.Xo,R.Yi,R.Xi
     try:
         Yo,Xo,Yi,Xi,_ = resample_with_wcs(targetwcs, tim.subwcs, intType=np.int16)
     except OverlapError:
@@ -839,8 +847,6 @@ def ccds_touching_wcs(targetwcs, ccds, ccdrad=None, polygons=True):
 
     Returns: index array I of CCDs within range.
     '''
-    from astrometry.util.util import Tan
-    from astrometry.util.miscutils import polygons_intersect
     from astrometry.util.starutil_numpy import degrees_between
 
     trad = targetwcs.radius()
@@ -856,34 +862,17 @@ def ccds_touching_wcs(targetwcs, ccds, ccdrad=None, polygons=True):
     if not polygons:
         return I
     # now check actual polygon intersection
+    from legacypipe.ccdfootprints import ccd_corners, convex_polygons_overlap
+    if len(I) == 0:
+        return I
+    cr,cd = ccd_corners(ccds[I])
+    _,xx,yy = targetwcs.radec2pixelxy(cr.ravel(), cd.ravel())
+    xx = np.reshape(xx, cr.shape)
+    yy = np.reshape(yy, cr.shape)
     tw,th = targetwcs.imagew, targetwcs.imageh
-    targetpoly = [(0.5,0.5),(tw+0.5,0.5),(tw+0.5,th+0.5),(0.5,th+0.5)]
-    cd = targetwcs.get_cd()
-    tdet = cd[0]*cd[3] - cd[1]*cd[2]
-    if tdet > 0:
-        targetpoly = list(reversed(targetpoly))
-    targetpoly = np.array(targetpoly)
-
-    keep = []
-    for i in I:
-        W,H = ccds.width[i],ccds.height[i]
-        wcs = Tan(*[float(x) for x in
-                    [ccds.crval1[i], ccds.crval2[i], ccds.crpix1[i], ccds.crpix2[i],
-                     ccds.cd1_1[i], ccds.cd1_2[i], ccds.cd2_1[i], ccds.cd2_2[i], W, H]])
-        cd = wcs.get_cd()
-        wdet = cd[0]*cd[3] - cd[1]*cd[2]
-        poly = []
-        for x,y in [(0.5,0.5),(W+0.5,0.5),(W+0.5,H+0.5),(0.5,H+0.5)]:
-            rr,dd = wcs.pixelxy2radec(x,y)
-            _,xx,yy = targetwcs.radec2pixelxy(rr,dd)
-            poly.append((xx,yy))
-        if wdet > 0:
-            poly = list(reversed(poly))
-        poly = np.array(poly)
-        if polygons_intersect(targetpoly, poly):
-            keep.append(i)
-    I = np.array(keep)
-    return I
+    keep = convex_polygons_overlap(xx, yy, np.array([0.5, tw+0.5, tw+0.5, 0.5]),
+                                   np.array([0.5, 0.5, th+0.5, th+0.5]))
+    return I[keep]
 
 def create_temp(**kwargs):
     f,fn = tempfile.mkstemp(dir=tempdir, **kwargs)
@@ -920,6 +909,76 @@ def clean_band_name(band):
     '''
     return band.upper().replace('-','_')
 
+def write_gzip(f, data, name=None, level=9, threads=1, blocksize=1<<22, sha=None):
+    '''
+    Writes *data* (a bytes-like object) to open file *f* in gzip
+    format.
+
+    The data are compressed in *blocksize* chunks, on *threads*
+    threads, in the same way as "pigz": each chunk is compressed as a
+    raw deflate stream primed with the preceding 32 kB and ending with
+    a sync flush, so that together they form a single standard gzip
+    member.  Compressed chunks are written (and passed to
+    *sha.update*, if given) in order as they finish, so at most a few
+    chunks of compressed data are held in memory.
+
+    *name*: file name to record in the gzip header (without ".gz").
+    '''
+    import zlib
+    import struct
+    import time
+    from collections import deque
+    from concurrent.futures import ThreadPoolExecutor
+
+    data = memoryview(data).cast('B')
+    n = len(data)
+    window = 32768
+
+    def compress_block(off):
+        if off > 0:
+            c = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS,
+                                 zdict=data[max(0, off-window):off])
+        else:
+            c = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS)
+        last = (off + blocksize >= n)
+        return (c.compress(data[off:off+blocksize]) +
+                c.flush(zlib.Z_FINISH if last else zlib.Z_SYNC_FLUSH))
+
+    def emit(b):
+        f.write(b)
+        if sha is not None:
+            sha.update(b)
+
+    # gzip header (RFC 1952), with the file name as gzip.GzipFile does.
+    fname = b''
+    if name is not None:
+        fname = os.path.basename(name)
+        if fname.endswith('.gz'):
+            fname = fname[:-3]
+        fname = fname.encode('latin-1', 'replace')
+    flags = 0x08 if len(fname) else 0
+    xfl = 2 if level == 9 else (4 if level == 1 else 0)
+    hdr = struct.pack('<BBBBIBB', 0x1f, 0x8b, 8, flags, int(time.time()), xfl, 255)
+    if len(fname):
+        hdr += fname + b'\0'
+    emit(hdr)
+
+    crc = 0
+    pending = deque()
+    with ThreadPoolExecutor(max(1, threads)) as pool:
+        for off in range(0, max(n, 1), blocksize):
+            pending.append((off, pool.submit(compress_block, off)))
+            # Limit the number of chunks in flight
+            while len(pending) > 2 * max(1, threads):
+                off0,fut = pending.popleft()
+                crc = zlib.crc32(data[off0:off0+blocksize], crc)
+                emit(fut.result())
+        while len(pending):
+            off0,fut = pending.popleft()
+            crc = zlib.crc32(data[off0:off0+blocksize], crc)
+            emit(fut.result())
+    emit(struct.pack('<II', crc & 0xffffffff, n & 0xffffffff))
+
 class LegacySurveyData(object):
     '''
     A class describing the contents of a LEGACY_SURVEY_DIR directory --
@@ -992,6 +1051,8 @@ class LegacySurveyData(object):
             self.output_dir = output_dir
 
         self.output_file_hashes = OrderedDict()
+        # Number of threads used to gzip output files in write_output
+        self.output_threads = 4
         self.ccds = None
         self.bricks = None
         self.ccds_index = None
@@ -1007,6 +1068,8 @@ class LegacySurveyData(object):
         # Cached CCD kd-tree --
         # - initially None, then a list of (fn, kd)
         self.ccd_kdtrees = None
+        # Cached brick-CCD overlaps -- None, then BrickCcdOverlaps or False
+        self.brick_ccd_overlaps = None
 
         self.image_typemap = {
             'decam'  : DecamImage,
@@ -1178,6 +1241,9 @@ class LegacySurveyData(object):
             return swaplist(
                 glob(os.path.join(basedir, 'survey-ccds*.kd.fits')))
 
+        elif filetype == 'brick-ccd-overlaps':
+            return swap(os.path.join(basedir, 'survey-brick-ccd-overlaps.fits'))
+
         elif filetype == 'tycho2':
             dirnm = os.environ.get('TYCHO2_KD_DIR')
             if dirnm is not None:
@@ -1391,8 +1457,9 @@ class LegacySurveyData(object):
             ccds.writeto(out.fn, primheader=primhdr)
 
         For FITS output, out.fits is a fitsio.FITS object.  The file
-        contents will actually be written in memory, and then a
-        sha256sum computed before the file contents are written out to
+        contents will actually be written in memory, and then
+        (gzipped, in parallel, with *self.output_threads* threads, and)
+        a sha256sum computed as the file contents are written out to
         the real disk file.  The 'out.fn' member variable is NOT set.
 
         ::
@@ -1452,29 +1519,19 @@ class LegacySurveyData(object):
                     # close the fitsio file
                     self.fits.close()
 
+                    f = open(self.tmpfn, 'wb')
                     # If gzip, we now have to actually do the
-                    # compression to gzip format...
+                    # compression to gzip format.  We compress in
+                    # blocks (in parallel), hashing and writing each
+                    # compressed block as it becomes available.
                     if self.tmpfn.endswith('.gz'):
-                        from io import BytesIO
-                        import gzip
-                        #ulength = len(rawdata)
-                        # We gzip to a memory file (BytesIO) so we can compute
-                        # the hashcode before writing to disk for real
-                        gzipped = BytesIO()
-                        gzf = gzip.GzipFile(self.real_fn, 'wb', 9, gzipped)
-                        gzf.write(rawdata)
-                        gzf.close()
-                        rawdata = gzipped.getvalue()
-                        gzipped.close()
-                        del gzipped
-                        #clength = len(rawdata)
-                        #print('Gzipped', ulength, 'to', clength)
-
-                    if self.hashsum:
-                        sha.update(rawdata)
-
-                    f = open(self.tmpfn, 'wb')
-                    f.write(rawdata)
+                        write_gzip(f, rawdata, name=self.real_fn, level=9,
+                                   threads=getattr(self.survey, 'output_threads', 1),
+                                   sha=(sha if self.hashsum else None))
+                    else:
+                        if self.hashsum:
+                            sha.update(rawdata)
+                        f.write(rawdata)
                     f.close()
                     debug('Wrote', self.tmpfn)
                     del rawdata
@@ -1482,7 +1539,11 @@ class LegacySurveyData(object):
                     # Non-FITS file -- read the temp file and compute the checksum (hash)
                     if self.hashsum:
                         f = open(self.tmpfn, 'rb')
-                        sha.update(f.read())
+                        while True:
+                            block = f.read(1 << 22)
+                            if len(block) == 0:
+                                break
+                            sha.update(block)
                         f.close()
                         del f
                 if self.hashsum:
@@ -1536,6 +1597,7 @@ class LegacySurveyData(object):
         d['bricks'] = None
         d['bricktree'] = None
         d['ccd_kdtrees'] = None
+        d['brick_ccd_overlaps'] = None
         d['ccds_index'] = None
         return d
 
@@ -1551,6 +1613,7 @@ class LegacySurveyData(object):
             tree_free(self.bricktree)
         self.bricktree = None
         self.ccds_index = None
+        self.brick_ccd_overlaps = None
 
     def get_calib_dir(self):
         return self.calib_dir
@@ -1784,17 +1847,24 @@ class LegacySurveyData(object):
             ccds.filter = np.array([f.strip() for f in ccds.filter])
         return ccds
 
-    def ccds_touching_wcs(self, wcs, **kwargs):
+    def ccds_touching_wcs(self, wcs, polygons=True, ccdrad=None):
         '''
-        Returns a table of the CCDs touching the given *wcs* region.
+        Returns a table of the CCDs touching the given *wcs* region
+        (*polygons*, *ccdrad*: as for the ccds_touching_wcs function).
+
+        Where the kd-tree files have CCD footprints (written by
+        create_kdtrees.py), only the rows of the CCDs that overlap are
+        read -- unless a *ccdrad* is given, which the footprints don't
+        use.
         '''
         kdfns = self.get_ccd_kdtrees()
 
         if len(kdfns):
             from astrometry.libkd.spherematch import tree_search_radec
+            from legacypipe.ccdfootprints import read_footprints
             # MAGIC number: we'll search a 1-degree radius for CCDs
-            # roughly in range, then refine using the
-            # ccds_touching_wcs() function.
+            # roughly in range, then refine using the CCD footprints
+            # or the ccds_touching_wcs() function.
             radius = 1.
             ra,dec = wcs.radec_center()
             TT = []
@@ -1804,20 +1874,152 @@ class LegacySurveyData(object):
                            '(%.3f, %.3f)' % (ra,dec))
                 if len(I) == 0:
                     continue
+                fp = None
+                if ccdrad is None:
+                    fp = read_footprints(fn, rows=I)
+                if fp is not None:
+                    I = I[fp.touching_wcs(wcs, polygons=polygons)]
+                    debug(len(I), 'CCD footprints overlap')
+                    if len(I) == 0:
+                        continue
                 # Read only the CCD-table rows within range.
-                TT.append(fits_table(fn, rows=I))
+                T = fits_table(fn, rows=I)
+                if fp is None:
+                    T.cut(ccds_touching_wcs(wcs, T, polygons=polygons, ccdrad=ccdrad))
+                    if len(T) == 0:
+                        continue
+                TT.append(T)
             if len(TT) == 0:
                 return None
             ccds = merge_tables(TT, columns='fillzero')
             ccds = self.cleanup_ccds_table(ccds)
             ccds = self.filter_ccds(ccds)
-        else:
-            ccds = self.get_ccds_readonly()
-        I = ccds_touching_wcs(wcs, ccds, **kwargs)
+            if len(ccds) == 0:
+                return None
+            return ccds
+        ccds = self.get_ccds_readonly()
+        I = ccds_touching_wcs(wcs, ccds, polygons=polygons, ccdrad=ccdrad)
         if len(I) == 0:
             return None
         return ccds[I]
 
+    def ccds_touching_bricks(self, bricks, W=3600, H=3600, pixscale=0.262):
+        '''
+        Finds the CCDs touching each of many bricks (each with WCS
+        wcs_for_brick(brick, W, H, pixscale)), at once.
+
+        Returns (ccds, IB, IC): the table of CCDs touching any of the
+        *bricks* (or None), and index arrays of the overlapping (brick, CCD)
+        pairs, into *bricks* and *ccds*, sorted by brick.
+        '''
+        from legacypipe.ccdfootprints import CcdFootprints, read_footprints
+        kdfns = self.get_ccd_kdtrees()
+        fps = [read_footprints(fn) for fn,_ in kdfns]
+        if len(kdfns) and all([fp is not None for fp in fps]):
+            TT = []
+            IB,IC = [],[]
+            n = 0
+            for (fn,_),fp in zip(kdfns, fps):
+                ib,ic = fp.touching_bricks(bricks, W=W, H=H, pixscale=pixscale)
+                debug(len(np.unique(ic)), 'of', len(fp), 'CCDs in', fn, 'touch',
+                      len(np.unique(ib)), 'bricks')
+                if len(ib) == 0:
+                    continue
+                rows,ic = np.unique(ic, return_inverse=True)
+                T = fits_table(fn, rows=rows)
+                T.fp_index = n + np.arange(len(T))
+                IB.append(ib)
+                IC.append(n + ic)
+                n += len(T)
+                TT.append(T)
+            if len(TT) == 0:
+                return None, np.zeros(0, int), np.zeros(0, int)
+            ccds = merge_tables(TT, columns='fillzero')
+            ccds = self.cleanup_ccds_table(ccds)
+            ccds = self.filter_ccds(ccds)
+            IB = np.hstack(IB)
+            IC = np.hstack(IC)
+            # Map to the rows that survived filter_ccds.
+            imap = np.empty(n, int)
+            imap[:] = -1
+            imap[ccds.fp_index] = np.arange(len(ccds))
+            ccds.delete_column('fp_index')
+            IC = imap[IC]
+            K = np.flatnonzero(IC >= 0)
+            IB,IC = IB[K],IC[K]
+            I = np.lexsort((IC, IB))
+            return ccds, IB[I], IC[I]
+        ccds = self.get_ccds_readonly()
+        fp = CcdFootprints.from_ccds(ccds)
+        IB,IC = fp.touching_bricks(bricks, W=W, H=H, pixscale=pixscale)
+        if len(IB) == 0:
+            return None, IB, IC
+        rows,IC = np.unique(IC, return_inverse=True)
+        return ccds[rows], IB, IC
+
+    def get_brick_ccd_overlaps(self):
+        '''
+        Returns the BrickCcdOverlaps for this survey (written by
+        legacypipe/brick_ccd_overlaps.py), or None if it does not exist.
+        '''
+        if self.brick_ccd_overlaps is None:
+            from legacypipe.brick_ccd_overlaps import read_overlaps
+            fn = self.find_file('brick-ccd-overlaps')
+            if os.path.exists(fn):
+                self.brick_ccd_overlaps = read_overlaps(fn)
+            else:
+                self.brick_ccd_overlaps = False
+        if self.brick_ccd_overlaps is False:
+            return None
+        return self.brick_ccd_overlaps
+
+    def ccds_touching_brick(self, brick, W=3600, H=3600, pixscale=0.262):
+        '''
+        Returns a table of the CCDs touching *brick* (one row of the
+        bricks table, with WCS wcs_for_brick(brick, W, H, pixscale); or
+        None), from the precomputed brick-CCD overlaps if they exist
+        and match, otherwise with ccds_touching_wcs().
+        '''
+        ov = self.get_brick_ccd_overlaps()
+        I = None
+        if ov is not None:
+            if (ov.W, ov.H) != (W, H) or not np.isclose(ov.pixscale, pixscale):
+                info('Brick-CCD overlaps were computed for %i x %i bricks at %g arcsec/pixel,'
+                     % (ov.W, ov.H, ov.pixscale), 'not %i x %i at %g' % (W, H, pixscale))
+            else:
+                I = ov.ccds_for_brick(brick.brickname)
+        if I is None:
+            return self.ccds_touching_wcs(wcs_for_brick(brick, W=W, H=H, pixscale=pixscale))
+        if len(I) == 0:
+            return None
+        # Read just those rows of the CCDs tables
+        fns = self.find_file('ccd-kds') + self.find_file('ccds')
+        fnmap = dict([(os.path.basename(fn), fn) for fn in fns])
+        TT = []
+        for ifile in np.unique(ov.ccd_file[I]):
+            J = I[ov.ccd_file[I] == ifile]
+            fn = fnmap.get(ov.filenames[ifile])
+            if fn is None:
+                raise RuntimeError('CCDs table %s (from the brick-CCD overlaps) not found' %
+                                   ov.filenames[ifile])
+            J = J[np.argsort(ov.ccd_row[J])]
+            T = fits_table(fn, rows=ov.ccd_row[J])
+            # Check that the file still has the CCDs the overlaps were
+            # computed for (it may have been re-written since).
+            if not (np.all(np.char.strip(T.camera.astype(str)) == ov.camera[J]) and
+                    np.all(T.expnum == ov.expnum[J]) and
+                    np.all(np.char.strip(T.ccdname.astype(str)) == ov.ccdname[J])):
+                info('CCDs table', fn, 'does not match the brick-CCD overlaps;',
+                     'searching for the CCDs touching brick', brick.brickname)
+                return self.ccds_touching_wcs(wcs_for_brick(brick, W=W, H=H, pixscale=pixscale))
+            TT.append(T)
+        ccds = merge_tables(TT, columns='fillzero')
+        ccds = self.cleanup_ccds_table(ccds)
+        ccds = self.filter_ccds(ccds)
+        if len(ccds) == 0:
+            return None
+        return ccds
+
     def get_ccd_kdtrees(self):
         # check cache...
         if self.ccd_kdtrees is not None:
@@ -1893,6 +2095,7 @@ class LegacySurveyData(object):
         return wcs
 
     def tims_touching_wcs(self, targetwcs, mp, bands=None,
+                          max_memory_gb=None,
                           **kwargs):
         '''
         Creates tractor.Image objects for CCDs touching the given
@@ -1900,6 +2103,9 @@ class LegacySurveyData(object):
 
         mp: multiprocessing object
 
+        max_memory_gb: if set, read the CCDs within this memory budget
+        (see legacypipe.timreader).
+
         kwargs are passed to LegacySurveyImage.get_tractor_image() and
         may include:
 
@@ -1921,6 +2127,15 @@ class LegacySurveyData(object):
         targetrd = np.array([targetwcs.pixelxy2radec(x,y) for x,y in
                              [(1,1),(W,1),(W,H),(1,H),(1,1)]])
         args = [(im, targetrd, kwargs) for im in ims]
+        if max_memory_gb:
+            from legacypipe.timreader import TimReader
+            # (with the CCDs-table WCS, so as not to read the headers)
+            est = dict([(id(im), im.estimate_memory_required(
+                radecpoly=targetrd, mywcs=self.get_approx_wcs(ccd)))
+                        for im,ccd in zip(ims, C)])
+            reader = TimReader(mp, max_bytes=max_memory_gb * 1e9,
+                               estimate=lambda X: est[id(X[0])])
+            return reader.map(read_one_tim, args)
         tims = mp.map(read_one_tim, args)
         return tims
 
@@ -2044,6 +2259,8 @@ def read_one_tim(X):
     if tim is not None:
         th,tw = tim.shape
         print('Time to read %i x %i image, hdu %i:' % (tw,th, im.hdu), Time()-t0)
+    from legacypipe.calibcache import get_calib_cache
+    debug(get_calib_cache())
     return tim
 
 
@@ -0,0 +1,258 @@
+'''
+An on-node cache of the tims (tractor Images) read by stage_tims.
+
+Reading a tim means decompressing the fpack'd image, weight and DQ
+HDUs and evaluating the sky and PSF models; neighbouring bricks read
+the same CCDs again.  Here we store each tim's calibrated pixels
+(image, inverse-error and DQ) as uncompressed .npy files, which are
+memory-mapped (copy-on-write) when read back, plus a pickle of the
+rest of the tim (WCS, PSF, sky, metadata).
+
+Entries are keyed by the image HDU, the requested sky region, the
+get_tractor_image arguments, the CCDs-table calibration and astrometric
+offset values, and the paths, sizes and modification times of the image
+and calibration files -- so a re-run calibration invalidates its
+entries.  (The key doesn't need the image's WCS, which would mean
+reading its header for every CCD.)  Entries are evicted,
+least-recently-used first, to keep the total under a size limit; the
+total is tracked as entries are added, so the directory is only
+re-scanned when it goes over the limit.
+'''
+
+import os
+import pickle
+import hashlib
+
+import numpy as np
+
+import logging
+logger = logging.getLogger('legacypipe.timcache')
+def info(*args):
+    from legacypipe.utils import log_info
+    log_info(logger, args)
+def debug(*args):
+    from legacypipe.utils import log_debug
+    log_debug(logger, args)
+
+# Bump this to invalidate all existing cache entries.
+cache_version = 1
+
+class TimCache(object):
+    '''
+    A directory of cached tims; see the module docstring.
+
+    *cache_dir*: directory to store cached tims in (eg, on node-local
+    storage).
+    *max_bytes*: size limit.
+    '''
+    def __init__(self, cache_dir, max_bytes):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        # Total size of the entries, once known.
+        self.nbytes = None
+
+    def __str__(self):
+        return 'TimCache(%s, %.1f GB)' % (self.cache_dir, self.max_bytes/1e9)
+
+    def get_key(self, im, targetrd, kwargs):
+        '''
+        Returns the cache key (a hex string) for reading a tim from
+        LegacySurveyImage *im*, with the *radecpoly* and
+        get_tractor_image *kwargs* that read_one_tim would use.
+        '''
+        # The pixel extent is determined by the region and the WCS,
+        # and the WCS by the image header (covered by the image file's
+        # size and time below) and the astrometric offsets.
+        region = None
+        if targetrd is not None:
+            region = np.round(np.asarray(targetrd, float), 10).tolist()
+        files = []
+        for k,fn in sorted(vars(im).items()):
+            if not (k.endswith('fn') and isinstance(fn, str)):
+                continue
+            try:
+                st = os.stat(fn)
+                files.append((k, fn, st.st_size, st.st_mtime))
+            except OSError:
+                files.append((k, fn))
+        key = (cache_version, type(im).__name__, im.name, im.hdu,
+               region, sorted(kwargs.items()),
+               getattr(im, 'ccdzpt', None), getattr(im, 'sig1', None),
+               getattr(im, 'dradec', None), files)
+        return hashlib.sha1(repr(key).encode()).hexdigest()
+
+    def entry_dir(self, key):
+        return os.path.join(self.cache_dir, key[:2], key)
+
+    def get(self, key, im):
+        '''
+        Returns (hit, tim) -- *tim* may be None, for images that
+        get_tractor_image() skipped.  Pixel arrays are memory-mapped.
+        '''
+        d = self.entry_dir(key)
+        fn = os.path.join(d, 'tim.pickle')
+        try:
+            with open(fn, 'rb') as f:
+                tim = pickle.load(f)
+            if tim is not None:
+                arrs = {}
+                for name in ['data', 'inverr', 'dq']:
+                    afn = os.path.join(d, name + '.npy')
+                    if os.path.exists(afn):
+                        arrs[name] = np.load(afn, mmap_mode='c').view(np.ndarray)
+                    else:
+                        arrs[name] = None
+                tim.data = arrs['data']
+                tim.inverr = arrs['inverr']
+                tim.dq = arrs['dq']
+                tim.imobj = im
+            # Mark as recently used
+            os.utime(d)
+        except (OSError, EOFError, pickle.UnpicklingError, ValueError):
+            return False, None
+        debug('Tim cache hit:', im, '->', d)
+        return True, tim
+
+    def put(self, key, tim):
+        '''
+        Stores *tim* (which may be None) in the cache.  (The caller
+        reports the new entries' sizes to added(); see read_tims.)
+        '''
+        import shutil
+        import tempfile
+        from astrometry.util.file import trymakedirs
+        d = self.entry_dir(key)
+        if os.path.exists(d):
+            return
+        pdir = os.path.dirname(d)
+        trymakedirs(pdir)
+        # Write to a temp dir and rename, in case other processes
+        # are reading or writing the same entry.
+        tmpdir = tempfile.mkdtemp(dir=pdir, prefix='tmp-')
+        try:
+            t = None
+            if tim is not None:
+                import copy
+                for name,arr in [('data', tim.getImage()), ('inverr', tim.getInvError()),
+                                 ('dq', tim.dq)]:
+                    if arr is not None:
+                        np.save(os.path.join(tmpdir, name + '.npy'), arr)
+                t = copy.copy(tim)
+                t.data = t.inverr = t.dq = None
+                t.imobj = None
+            with open(os.path.join(tmpdir, 'tim.pickle'), 'wb') as f:
+                pickle.dump(t, f, -1)
+            os.rename(tmpdir, d)
+        except OSError:
+            # (eg, another process beat us to it, or the disk is full)
+            shutil.rmtree(tmpdir, ignore_errors=True)
+            return
+        debug('Tim cache: wrote', d)
+
+    def added(self, nb):
+        '''
+        Records that new entries totalling *nb* bytes were stored,
+        evicting entries if the cache is now over its size limit.
+        '''
+        if self.nbytes is not None:
+            self.nbytes += nb
+        # (the first time, scan the directory to find its size)
+        if self.nbytes is None or self.nbytes > self.max_bytes:
+            self.evict()
+
+    def evict(self):
+        '''
+        Removes least-recently-used entries until the cache is under
+        its size limit -- with some room to spare, so that it is not
+        re-scanned after every new entry.
+        '''
+        self.nbytes = evict_lru(self.cache_dir, self.max_bytes,
+                                target_bytes=0.9 * self.max_bytes)
+
+def entry_bytes(path):
+    '''
+    Returns the total size of the files in directory *path* (recursively).
+    '''
+    nb = 0
+    for f in os.scandir(path):
+        if f.is_dir(follow_symlinks=False):
+            nb += entry_bytes(f.path)
+        else:
+            nb += f.stat().st_size
+    return nb
+
+def evict_lru(cache_dir, max_bytes, target_bytes=None):
+    '''
+    For a cache directory laid out as *cache_dir*/xx/KEY/, where each
+    KEY directory is one entry whose modification time records when it
+    was last used, removes least-recently-used entries if the total
+    size is over *max_bytes*, until it is under *target_bytes*
+    (default *max_bytes*).  Returns the remaining total size.
+    '''
+    if target_bytes is None:
+        target_bytes = max_bytes
+    import shutil
+    entries = []
+    total = 0
+    for sub in os.scandir(cache_dir):
+        if not sub.is_dir():
+            continue
+        for e in os.scandir(sub.path):
+            if not e.is_dir() or e.name.startswith('tmp-'):
+                continue
+            try:
+                nb = entry_bytes(e.path)
+                entries.append((e.stat().st_mtime, nb, e.path))
+            except OSError:
+                continue
+            total += nb
+    if total <= max_bytes:
+        return total
+    entries.sort()
+    for _,nb,path in entries:
+        if total <= target_bytes:
+            break
+        debug('Cache: evicting', path)
+        shutil.rmtree(path, ignore_errors=True)
+        total -= nb
+    return total
+
+def read_one_tim_cached(X):
+    '''
+    Like survey.read_one_tim, but also stores the result in the TimCache.
+    '''
+    from legacypipe.survey import read_one_tim
+    (im, targetrd, kwargs, cache, key) = X
+    tim = read_one_tim((im, targetrd, kwargs))
+    cache.put(key, tim)
+    return tim
+
+def read_tims(cache, args, mp_map):
+    '''
+    Reads tims for the read_one_tim() argument tuples *args*, reading
+    cached ones from *cache* in this process and the rest via
+    *mp_map* (which are then added to the cache, evicting old entries
+    if necessary).
+    '''
+    tims = [None] * len(args)
+    misses = []
+    for i,(im,targetrd,kwargs) in enumerate(args):
+        key = cache.get_key(im, targetrd, kwargs)
+        hit,tim = cache.get(key, im)
+        if hit:
+            tims[i] = tim
+        else:
+            misses.append((i, (im, targetrd, kwargs, cache, key)))
+    info('Tim cache:', len(args)-len(misses), 'hits,', len(misses), 'misses')
+    if len(misses):
+        I,margs = zip(*misses)
+        for i,tim in zip(I, mp_map(read_one_tim_cached, margs)):
+            tims[i] = tim
+        nb = 0
+        for (_,_,_,_,key) in margs:
+            try:
+                nb += entry_bytes(cache.entry_dir(key))
+            except OSError:
+                pass
+        cache.added(nb)
+    return tims
@@ -0,0 +1,251 @@
+'''
+A memory-budgeted reader for the tims of stage_tims.
+
+mp.map(read_one_tim, ...) starts reading every CCD at once, and each
+tim is pickled back from its worker -- the worker's copy, the pickle,
+and the unpickled copy here are all alive at once.  On deep fields that
+peaks far above the memory the tims finally need.
+
+Here, a CCD is handed to a worker only when the tims already read plus
+an allowance for the reads in flight (a multiple of
+LegacySurveyImage.estimate_memory_required) stay within the budget; as
+each read finishes, its allowance is released and more CCDs are
+started.  Workers on this node pass the pixel arrays back out-of-band:
+they write them to files in shared memory (/dev/shm), which are
+memory-mapped (copy-on-write, as for the TimCache) and unlinked here,
+rather than pickled.  The per-CCD resident sizes, the peak of the
+budgeted memory and the workers' peak RSS are logged.
+'''
+
+import os
+
+import numpy as np
+
+import logging
+logger = logging.getLogger('legacypipe.timreader')
+def info(*args):
+    from legacypipe.utils import log_info
+    log_info(logger, args)
+def debug(*args):
+    from legacypipe.utils import log_debug
+    log_debug(logger, args)
+
+_pixel_arrays = ['data', 'inverr', 'dq']
+
+class TimReader(object):
+    '''
+    Reads tims, like mp.map(read_one_tim, args), within a memory budget;
+    see the module docstring.
+
+    *mp*: multiproc object, or None to read in this process.
+    *max_bytes*: memory budget for the tims, or None for no limit.
+    *estimate*: function returning the estimated size in bytes of the
+    tim for a read_one_tim argument tuple (or None).
+    *overhead*: reads in flight are charged this multiple of their
+    estimate.  By default, 2 when the pixels come back through shared
+    memory (the worker's copy plus the file, which becomes the tim's
+    pixels here), and 3 when they are pickled (the worker's copy, the
+    pickle, and the unpickled copy).
+    *shm_dir*: directory for passing pixels back; default /dev/shm if
+    it exists; pixels are pickled if it is not usable.
+    '''
+    def __init__(self, mp, max_bytes=None, estimate=None, overhead=None,
+                 shm_dir=None):
+        self.mp = mp
+        self.max_bytes = max_bytes
+        self.estimate = estimate
+        self.overhead = overhead
+        if shm_dir is None and os.path.isdir('/dev/shm'):
+            shm_dir = '/dev/shm'
+        self.shm_dir = shm_dir
+        self.stats = dict(ccds=0, max_reads=0, est_bytes=0, resident_bytes=0,
+                          max_ccd_bytes=0, peak_bytes=0, worker_rss=0,
+                          shared=0)
+
+    def __str__(self):
+        if self.max_bytes is None:
+            return 'TimReader(no limit)'
+        return 'TimReader(%.1f GB)' % (self.max_bytes/1e9)
+
+    def map(self, func, args):
+        '''
+        Returns [func(a) for a in args], where *func* is read_one_tim
+        (or similar) and returns a tim or None.
+        '''
+        import shutil
+        import tempfile
+        n = len(args)
+        if self.estimate is None:
+            est = [0] * n
+        else:
+            est = [self.estimate(a) for a in args]
+        tims = [None] * n
+        tmpdir = None
+        if self.shm_dir is not None and self._parallel():
+            try:
+                tmpdir = tempfile.mkdtemp(dir=self.shm_dir, prefix='legacypipe-tims-')
+            except OSError as e:
+                info('Not passing tim pixels via', self.shm_dir, ':', e)
+        overhead = self.overhead
+        if overhead is None:
+            overhead = 2. if tmpdir is not None else 3.
+        cost = [overhead * e for e in est]
+        st = self.stats
+        todo = list(range(n))
+        running = set()
+        host = _hostname()
+        resident = 0
+        inflight = 0
+        parallel = self._parallel()
+        try:
+            if parallel:
+                results = _PoolReads(self.mp.pool)
+            else:
+                results = _SerialReads()
+            while len(todo) or len(running):
+                # Start reads while they fit in the budget -- always
+                # at least one.
+                while len(todo):
+                    i = todo[0]
+                    if len(running) and (not parallel or
+                                         (self.max_bytes is not None and
+                                          resident + inflight + cost[i] > self.max_bytes)):
+                        break
+                    todo.pop(0)
+                    running.add(i)
+                    inflight += cost[i]
+                    results.start((i, func, args[i], tmpdir, host))
+                st['max_reads'] = max(st['max_reads'], len(running))
+                st['peak_bytes'] = max(st['peak_bytes'], resident + inflight)
+                i,tim,files,rss = results.next()
+                running.remove(i)
+                inflight -= cost[i]
+                if files is not None:
+                    _attach_pixels(tim, files)
+                    st['shared'] += 1
+                tims[i] = tim
+                nb = tim_bytes(tim)
+                resident += nb
+                st['ccds'] += 1
+                st['est_bytes'] += est[i]
+                st['resident_bytes'] += nb
+                st['max_ccd_bytes'] = max(st['max_ccd_bytes'], nb)
+                st['worker_rss'] = max(st['worker_rss'], rss)
+                st['peak_bytes'] = max(st['peak_bytes'], resident + inflight)
+                if tim is not None:
+                    debug('Read', tim.name, ': resident %.1f MB, estimated %.1f MB;' %
+                          (nb/1e6, est[i]/1e6), len(running), 'reads in flight,',
+                          len(todo), 'to go')
+        finally:
+            if tmpdir is not None:
+                shutil.rmtree(tmpdir, ignore_errors=True)
+        info('Read', n, 'CCDs:', self.format_stats())
+        return tims
+
+    def _parallel(self):
+        return self.mp is not None and getattr(self.mp, 'pool', None) is not None
+
+    def format_stats(self):
+        st = self.stats
+        s = ('resident %.2f GB (estimated %.2f GB), largest CCD %.1f MB, '
+             'peak budgeted %.2f GB' %
+             (st['resident_bytes']/1e9, st['est_bytes']/1e9,
+              st['max_ccd_bytes']/1e6, st['peak_bytes']/1e9))
+        if self.max_bytes is not None:
+            s += ' of %.2f GB' % (self.max_bytes/1e9)
+        s += (', up to %i reads at once, worker peak RSS %.2f GB, %i via shared memory' %
+              (st['max_reads'], st['worker_rss']/1e9, st['shared']))
+        return s
+
+class _SerialReads(object):
+    # Runs the (one) read in this process when its result is asked for.
+    def __init__(self):
+        self.todo = []
+    def start(self, X):
+        self.todo.append(X)
+    def next(self):
+        return _read_one(self.todo.pop(0))
+
+class _PoolReads(object):
+    # Runs the reads in a multiprocessing pool, returning the results
+    # in the order they finish.
+    def __init__(self, pool):
+        import queue
+        self.pool = pool
+        self.done = queue.Queue()
+    def start(self, X):
+        self.pool.apply_async(_read_one, (X,), callback=self._finished,
+                              error_callback=self._finished)
+    def _finished(self, r):
+        self.done.put(r)
+    def next(self):
+        r = self.done.get()
+        if isinstance(r, BaseException):
+            raise r
+        return r
+
+def _hostname():
+    import socket
+    return socket.gethostname()
+
+def tim_bytes(tim):
+    '''
+    Returns the size of the pixel arrays of *tim* (which may be None).
+    '''
+    if tim is None:
+        return 0
+    nb = 0
+    for name in _pixel_arrays:
+        arr = getattr(tim, name, None)
+        if arr is not None:
+            nb += arr.nbytes
+    return nb
+
+def _read_one(X):
+    import resource
+    (i, func, args, tmpdir, host) = X
+    tim = func(args)
+    files = None
+    if tim is not None and tmpdir is not None and _hostname() == host:
+        files = _write_pixels(tim, tmpdir)
+    # (kilobytes, on Linux)
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+    return i, tim, files, rss
+
+def _write_pixels(tim, tmpdir):
+    '''
+    Writes the pixel arrays of *tim* to files in *tmpdir* and removes
+    them from *tim*.  Returns a dict of name -> filename, or None if
+    writing failed (eg, the shared-memory filesystem is full).
+    '''
+    import tempfile
+    files = {}
+    try:
+        for name in _pixel_arrays:
+            arr = getattr(tim, name, None)
+            if arr is None:
+                continue
+            fd,fn = tempfile.mkstemp(dir=tmpdir, suffix='-%s.npy' % name)
+            files[name] = fn
+            with os.fdopen(fd, 'wb') as f:
+                np.save(f, arr)
+    except OSError as e:
+        debug('Failed to write tim pixels to', tmpdir, ':', e)
+        for fn in files.values():
+            try:
+                os.unlink(fn)
+            except OSError:
+                pass
+        return None
+    for name in files.keys():
+        setattr(tim, name, None)
+    return files
+
+def _attach_pixels(tim, files):
+    for name,fn in files.items():
+        try:
+            arr = np.load(fn, mmap_mode='c').view(np.ndarray)
+        finally:
+            # (the mapping stays valid)
+            os.unlink(fn)
+        setattr(tim, name, arr)
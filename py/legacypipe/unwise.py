@@ -29,14 +29,20 @@ def unwise_forcedphot(cat, tiles, band=1, roiradecbox=None,
                       get_masks=None,
                       move_crpix=False,
                       modelsky_dir=None,
-                      tag=None):
+                      tag=None,
+                      tile_cache=None):
     '''
     Given a list of tractor sources *cat*
     and a list of unWISE tiles *tiles* (a fits_table with RA,Dec,coadd_id)
     runs forced photometry, returning a FITS table the same length as *cat*.
 
     *get_masks*: the WCS to resample mask bits into.
+
+    *tile_cache*: an UnwiseTileCache to read the tiles through.
     '''
+    from legacypipe.unwisecache import get_psf_image
+    if tile_cache is not None:
+        cache_stats0 = dict(tile_cache.stats)
     from tractor import PointSource, Tractor, ExpGalaxy, DevGalaxy
     from tractor.sersic import SersicGalaxy
 
@@ -88,7 +94,10 @@ def unwise_forcedphot(cat, tiles, band=1, roiradecbox=None,
     tims = []
     for tile in tiles:
         info(tag + 'Reading WISE tile', tile.coadd_id, 'band', band)
-        tim = get_unwise_tractor_image(tile.unwise_dir, tile.coadd_id, band,
+        unwise_dir = tile.unwise_dir
+        if tile_cache is not None:
+            unwise_dir = tile_cache.get_tile_dir(unwise_dir, tile.coadd_id, band)
+        tim = get_unwise_tractor_image(unwise_dir, tile.coadd_id, band,
                                        bandname=wanyband, roiradecbox=roiradecbox)
         if tim is None:
             debug('Actually, no overlap with WISE coadd tile', tile.coadd_id)
@@ -124,6 +133,8 @@ def unwise_forcedphot(cat, tiles, band=1, roiradecbox=None,
             fn = os.path.join(modelsky_dir, '%s.%i.mod.fits' % (tile.coadd_id, band))
             if not os.path.exists(fn):
                 raise RuntimeError('WARNING: does not exist:', fn)
+            if tile_cache is not None:
+                fn = tile_cache.get_file(fn)
             x0,x1,y0,y1 = tim.roi
             bg = fitsio.FITS(fn)[2][y0:y1, x0:x1]
             assert(bg.shape == tim.shape)
@@ -207,6 +218,8 @@ def unwise_forcedphot(cat, tiles, band=1, roiradecbox=None,
                                   'unwise-%s-msk.fits.gz' % tile.coadd_id)
                 if os.path.exists(fn):
                     debug('Reading unWISE mask file', fn)
+                    if tile_cache is not None:
+                        fn = tile_cache.get_file(fn)
                     x0,x1,y0,y1 = tim.roi
                     tilemask = fitsio.FITS(fn)[0][y0:y1,x0:x1]
                     break
@@ -270,48 +283,57 @@ def unwise_forcedphot(cat, tiles, band=1, roiradecbox=None,
             ps.savefig()
 
         if pixelized_psf:
-            from unwise_psf import unwise_psf
+            psf_model = None
             if (band == 1) or (band == 2):
                 # we only have updated PSFs for W1 and W2
-                psfimg = unwise_psf.get_unwise_psf(band, tile.coadd_id,
-                                                   modelname='neo6_unwisecat')
-            else:
-                psfimg = unwise_psf.get_unwise_psf(band, tile.coadd_id)
-
-            if band == 4:
-                # oversample (the unwise_psf models are at native W4 5.5"/pix,
-                # while the unWISE coadds are made at 2.75"/pix.
-                ph,pw = psfimg.shape
-                subpsf = np.zeros((ph*2-1, pw*2-1), np.float32)
-                from astrometry.util.util import lanczos3_interpolate
-                xx,yy = np.meshgrid(np.arange(0., pw-0.51, 0.5, dtype=np.float32),
-                                    np.arange(0., ph-0.51, 0.5, dtype=np.float32))
-                xx = xx.ravel()
-                yy = yy.ravel()
-                ix = xx.astype(np.int32)
-                iy = yy.astype(np.int32)
-                dx = (xx - ix).astype(np.float32)
-                dy = (yy - iy).astype(np.float32)
-                psfimg = psfimg.astype(np.float32)
-                lanczos3_interpolate(ix, iy, dx, dy, [subpsf.flat], [psfimg])
-
-                if plots:
-                    plt.clf()
-                    plt.imshow(psfimg, interpolation='nearest', origin='lower')
-                    plt.title('Original PSF model')
-                    ps.savefig()
-                    plt.clf()
-                    plt.imshow(subpsf, interpolation='nearest', origin='lower')
-                    plt.title('Subsampled PSF model')
-                    ps.savefig()
-
-                psfimg = subpsf
-                del xx, yy, ix, iy, dx, dy
+                psf_model = 'neo6_unwisecat'
+            def read_psf(band=band, coadd_id=tile.coadd_id, psf_model=psf_model):
+                from unwise_psf import unwise_psf
+                if psf_model is not None:
+                    psfimg = unwise_psf.get_unwise_psf(band, coadd_id,
+                                                       modelname=psf_model)
+                else:
+                    psfimg = unwise_psf.get_unwise_psf(band, coadd_id)
+
+                if band == 4:
+                    # oversample (the unwise_psf models are at native W4 5.5"/pix,
+                    # while the unWISE coadds are made at 2.75"/pix.
+                    ph,pw = psfimg.shape
+                    subpsf = np.zeros((ph*2-1, pw*2-1), np.float32)
+                    from astrometry.util.util import lanczos3_interpolate
+                    xx,yy = np.meshgrid(np.arange(0., pw-0.51, 0.5, dtype=np.float32),
+                                        np.arange(0., ph-0.51, 0.5, dtype=np.float32))
+                    xx = xx.ravel()
+                    yy = yy.ravel()
+                    ix = xx.astype(np.int32)
+                    iy = yy.astype(np.int32)
+                    dx = (xx - ix).astype(np.float32)
+                    dy = (yy - iy).astype(np.float32)
+                    psfimg = psfimg.astype(np.float32)
+                    lanczos3_interpolate(ix, iy, dx, dy, [subpsf.flat], [psfimg])
+
+                    if plots:
+                        plt.clf()
+                        plt.imshow(psfimg, interpolation='nearest', origin='lower')
+                        plt.title('Original PSF model')
+                        ps.savefig()
+                        plt.clf()
+                        plt.imshow(subpsf, interpolation='nearest', origin='lower')
+                        plt.title('Subsampled PSF model')
+                        ps.savefig()
+
+                    psfimg = subpsf
+                    del xx, yy, ix, iy, dx, dy
+
+                psfimg /= psfimg.sum()
+                fluxrescales = {1: 1.04, 2: 1.005, 3: 1.0, 4: 1.0}
+                psfimg *= fluxrescales[band]
+                return psfimg
 
             from tractor.psf import PixelizedPSF
-            psfimg /= psfimg.sum()
-            fluxrescales = {1: 1.04, 2: 1.005, 3: 1.0, 4: 1.0}
-            psfimg *= fluxrescales[band]
+            # (evaluated once per tile and band)
+            psfimg = get_psf_image(band, tile.coadd_id, read_psf, cache=tile_cache,
+                                   model=psf_model)
             tim.psf = PixelizedPSF(psfimg)
 
         if psf_broadening is not None and not pixelized_psf:
@@ -567,6 +589,11 @@ def unwise_forcedphot(cat, tiles, band=1, roiradecbox=None,
     rtn.phot = phot
     rtn.models = None
     rtn.maskmap = None
+    rtn.cache_stats = None
+    if tile_cache is not None:
+        # (just the stats for this call)
+        rtn.cache_stats = dict([(k, v - cache_stats0.get(k, 0))
+                                for k,v in tile_cache.stats.items()])
     if get_models:
         rtn.models = models
     if get_masks:
@@ -595,10 +622,10 @@ def unwise_phot(X):
     This is the entry-point from runbrick.py, called via mp.map()
     '''
     (key, (wcat, tiles, band, roiradec, wise_ceres, pixelized_psf, get_mods,
-           get_masks, ps, move_crpix, modelsky_dir, tag)) = X
+           get_masks, ps, move_crpix, modelsky_dir, tag, tile_cache)) = X
     kwargs = dict(roiradecbox=roiradec, band=band, pixelized_psf=pixelized_psf,
                   get_masks=get_masks, ps=ps, move_crpix=move_crpix,
-                  modelsky_dir=modelsky_dir, tag=tag)
+                  modelsky_dir=modelsky_dir, tag=tag, tile_cache=tile_cache)
     if get_mods:
         kwargs.update(get_models=get_mods)
 
@@ -668,6 +695,9 @@ def collapse_unwise_bitmask(bitmask, band):
         result += ((2**i)*(np.bitwise_and(bitmask, bits[feat]) != 0)).astype(np.uint8)
     return result.astype('uint8')
 
+# The unWISE tile atlas, read once per process
+_wise_tiles = None
+
 ###
 # This is taken directly from tractor/wise.py, replacing only the filename.
 ###
@@ -678,10 +708,12 @@ def unwise_tiles_touching_wcs(wcs, polygons=True):
     from astrometry.util.miscutils import polygons_intersect
     from astrometry.util.starutil_numpy import degrees_between
 
-    from pkg_resources import resource_filename
-    atlasfn = resource_filename('legacypipe', 'data/wise-tiles.fits')
-
-    T = fits_table(atlasfn)
+    global _wise_tiles
+    if _wise_tiles is None:
+        from pkg_resources import resource_filename
+        atlasfn = resource_filename('legacypipe', 'data/wise-tiles.fits')
+        _wise_tiles = fits_table(atlasfn)
+    T = _wise_tiles
     trad = wcs.radius()
     wrad = np.sqrt(2.) / 2. * 2048 * 2.75 / 3600.
     rad = trad + wrad
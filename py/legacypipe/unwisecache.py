@@ -0,0 +1,338 @@
+'''
+A node-local cache of the unWISE inputs read by stage_wise_forced.
+
+An unWISE tile covers ~40-50 bricks, and for each brick
+unwise_forcedphot reads the tile's image, inverse-variance, std and
+n-map files (mostly gzipped, so the whole 2048x2048 tile gets
+decompressed just to cut out the brick's region), the mask and sky
+files, and the unwise_psf model, and stage_wise_forced re-reads the
+time-resolved atlas.  Here we keep:
+
+- an uncompressed copy of each tile's files, so that a brick's region
+  is read with a seek, and the (page-cached, memory-mapped by the OS)
+  file is shared by all processes on the node;
+- the final PSF image for each tile, band and unwise_psf model (and
+  version of the unwise_psf package);
+- the time-resolved atlas table, with an index by coadd_id.
+
+Entries are keyed by the source file paths, sizes and modification
+times, and evicted least-recently-used first (as for the TimCache).
+The PSF images and atlases are also memoized in each process.
+'''
+
+import os
+import pickle
+import hashlib
+
+import numpy as np
+
+import logging
+logger = logging.getLogger('legacypipe.unwisecache')
+def info(*args):
+    from legacypipe.utils import log_info
+    log_info(logger, args)
+def debug(*args):
+    from legacypipe.utils import log_debug
+    log_debug(logger, args)
+
+# Bump this to invalidate all existing cache entries.
+cache_version = 1
+
+# In-process memos
+_psf_memo = {}
+_atlas_memo = {}
+_psf_version = None
+
+class UnwiseTileCache(object):
+    '''
+    A directory of cached unWISE tiles, PSFs and atlases; see the
+    module docstring.
+
+    *cache_dir*: directory to store files in (eg, on node-local storage).
+    *max_bytes*: size limit.
+    '''
+    def __init__(self, cache_dir, max_bytes):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        # Total size of the entries, once known.
+        self.nbytes = None
+        self.stats = dict(hits=0, misses=0, bytes_copied=0)
+
+    def __str__(self):
+        return 'UnwiseTileCache(%s, %.1f GB)' % (self.cache_dir, self.max_bytes/1e9)
+
+    def entry_dir(self, key):
+        return os.path.join(self.cache_dir, key[:2], key)
+
+    @staticmethod
+    def get_key(*args):
+        return hashlib.sha1(repr((cache_version,) + args).encode()).hexdigest()
+
+    def _fetch(self, key, files):
+        '''
+        Returns the entry directory for *key*, creating it if necessary
+        by copying (and decompressing) the *files*, a list of
+        (source path, path relative to the entry directory).
+        '''
+        import shutil
+        import tempfile
+        from astrometry.util.file import trymakedirs
+        d = self.entry_dir(key)
+        if os.path.exists(d):
+            self.stats['hits'] += 1
+            try:
+                # Mark as recently used
+                os.utime(d)
+            except OSError:
+                pass
+            return d
+        self.stats['misses'] += 1
+        pdir = os.path.dirname(d)
+        trymakedirs(pdir)
+        # Write to a temp dir and rename, in case other processes are
+        # reading or writing the same entry.
+        tmpdir = tempfile.mkdtemp(dir=pdir, prefix='tmp-')
+        nb = 0
+        try:
+            for src,rel in files:
+                dst = os.path.join(tmpdir, rel)
+                trymakedirs(os.path.dirname(dst))
+                nb += _copy_uncompressed(src, dst)
+            self.stats['bytes_copied'] += nb
+            os.rename(tmpdir, d)
+        except OSError:
+            # (eg, another process beat us to it, or the disk is full)
+            shutil.rmtree(tmpdir, ignore_errors=True)
+            if os.path.exists(d):
+                return d
+            return None
+        debug('unWISE cache: wrote', d)
+        self.added(nb)
+        return d
+
+    def added(self, nb):
+        '''
+        Records that a new entry of *nb* bytes was stored, evicting
+        entries if the cache is now over its size limit (as
+        TimCache.added).
+        '''
+        if self.nbytes is not None:
+            self.nbytes += nb
+        # (the first time, scan the directory to find its size)
+        if self.nbytes is None or self.nbytes > self.max_bytes:
+            self.evict()
+
+    def evict(self):
+        from legacypipe.timcache import evict_lru
+        self.nbytes = evict_lru(self.cache_dir, self.max_bytes,
+                                target_bytes=0.9 * self.max_bytes)
+
+    def get_tile_dir(self, unwise_dir, coadd_id, band):
+        '''
+        Returns a directory to use in place of *unwise_dir* (which may
+        be a colon-separated list) when reading band *band* of tile
+        *coadd_id* -- a cache directory laid out the same way, holding
+        uncompressed copies of the tile's files.  Returns *unwise_dir*
+        if the tile is not found.
+        '''
+        from glob import glob
+        for basedir in unwise_dir.split(':'):
+            tiledir = os.path.join(basedir, coadd_id[:3], coadd_id)
+            fns = sorted(glob(os.path.join(tiledir, 'unwise-%s-w%i-*' % (coadd_id, band))))
+            if len(fns):
+                break
+        else:
+            return unwise_dir
+        rel = os.path.join(coadd_id[:3], coadd_id)
+        key = self.get_key('tile', os.path.abspath(tiledir), band,
+                           [_stat_key(fn) for fn in fns])
+        d = self._fetch(key, [(fn, os.path.join(rel, os.path.basename(fn)))
+                              for fn in fns])
+        if d is None:
+            return unwise_dir
+        return d
+
+    def get_file(self, fn):
+        '''
+        Returns the path of an uncompressed cached copy of file *fn*
+        (or *fn* itself, if caching fails).  The file name is
+        unchanged, even if it ends in ".gz" -- CFITSIO checks the file
+        contents, not its name, for compression.
+        '''
+        key = self.get_key('file', os.path.abspath(fn), _stat_key(fn))
+        base = os.path.basename(fn)
+        d = self._fetch(key, [(fn, base)])
+        if d is None:
+            return fn
+        return os.path.join(d, base)
+
+    def get_array(self, name, func):
+        '''
+        Returns the array computed by *func()*, cached under the
+        (string) *name*.
+        '''
+        key = self.get_key('array', name)
+        d = self.entry_dir(key)
+        fn = os.path.join(d, 'array.npy')
+        try:
+            arr = np.load(fn)
+            self.stats['hits'] += 1
+            os.utime(d)
+            return arr
+        except (OSError, ValueError):
+            pass
+        self.stats['misses'] += 1
+        arr = func()
+        self._put(key, 'array.npy', lambda f: np.save(f, arr))
+        return arr
+
+    def get_pickle(self, name, func):
+        '''
+        Returns the object computed by *func()*, cached (pickled)
+        under the (string) *name*.
+        '''
+        key = self.get_key('pickle', name)
+        d = self.entry_dir(key)
+        fn = os.path.join(d, 'data.pickle')
+        try:
+            with open(fn, 'rb') as f:
+                obj = pickle.load(f)
+            self.stats['hits'] += 1
+            os.utime(d)
+            return obj
+        except (OSError, EOFError, pickle.UnpicklingError):
+            pass
+        self.stats['misses'] += 1
+        obj = func()
+        self._put(key, 'data.pickle', lambda f: pickle.dump(obj, f, -1))
+        return obj
+
+    def _put(self, key, name, write):
+        import shutil
+        import tempfile
+        from astrometry.util.file import trymakedirs
+        d = self.entry_dir(key)
+        pdir = os.path.dirname(d)
+        trymakedirs(pdir)
+        tmpdir = tempfile.mkdtemp(dir=pdir, prefix='tmp-')
+        try:
+            fn = os.path.join(tmpdir, name)
+            with open(fn, 'wb') as f:
+                write(f)
+            nb = os.path.getsize(fn)
+            os.rename(tmpdir, d)
+        except OSError:
+            shutil.rmtree(tmpdir, ignore_errors=True)
+            return
+        self.added(nb)
+
+def _stat_key(fn):
+    try:
+        st = os.stat(fn)
+        return (os.path.basename(fn), st.st_size, st.st_mtime)
+    except OSError:
+        return (os.path.basename(fn),)
+
+def _copy_uncompressed(src, dst):
+    '''
+    Copies file *src* to *dst*, gunzipping it if it is gzipped.
+    Returns the number of bytes written.
+    '''
+    import gzip
+    import shutil
+    with open(src, 'rb') as f:
+        magic = f.read(2)
+    opener = gzip.open if magic == b'\037\213' else open
+    with opener(src, 'rb') as fin, open(dst, 'wb') as fout:
+        shutil.copyfileobj(fin, fout, 1 << 22)
+        return fout.tell()
+
+def merge_stats(stats, more):
+    '''
+    Adds the UnwiseTileCache.stats dict *more* into *stats*.
+    '''
+    for k,v in more.items():
+        stats[k] = stats.get(k, 0) + v
+    return stats
+
+def format_stats(stats):
+    n = stats.get('hits', 0) + stats.get('misses', 0)
+    return ('%i hits, %i misses (hit rate %.0f%%), %.1f MB copied' %
+            (stats.get('hits', 0), stats.get('misses', 0),
+             100. * stats.get('hits', 0) / max(n, 1),
+             stats.get('bytes_copied', 0) / 1e6))
+
+def unwise_psf_version():
+    '''
+    Returns a string identifying the installed unwise_psf package (its
+    version, if it has one, and the size and time of its module file
+    and data directory), so that cached PSF images are recomputed when
+    it changes.
+    '''
+    global _psf_version
+    if _psf_version is None:
+        try:
+            from unwise_psf import unwise_psf
+        except ImportError:
+            _psf_version = 'none'
+        else:
+            fn = unwise_psf.__file__
+            _psf_version = repr((getattr(unwise_psf, '__version__', None),
+                                 _stat_key(fn), _stat_key(os.path.dirname(fn))))
+    return _psf_version
+
+def get_psf_image(band, coadd_id, func, cache=None, model=None):
+    '''
+    Returns the unWISE PSF image for *band* and tile *coadd_id*, as
+    computed by *func()* with unwise_psf model *model* (None for the
+    default), memoized in this process and (if *cache* is given) in
+    the UnwiseTileCache.
+    '''
+    key = (band, coadd_id, model)
+    psf = _psf_memo.get(key)
+    if psf is None:
+        if cache is not None:
+            psf = cache.get_array('psf-%s-w%i-%s-%s' % (coadd_id, band, model,
+                                                        unwise_psf_version()), func)
+        else:
+            psf = func()
+        _psf_memo[key] = psf
+    # callers modify it
+    return psf.copy()
+
+class TimeResolvedAtlas(object):
+    '''
+    The time-resolved unWISE atlas table ("time_resolved_atlas.fits"),
+    with an index by coadd_id.
+    '''
+    def __init__(self, fn):
+        from astrometry.util.fits import fits_table
+        self.T = fits_table(fn)
+        self.index = dict([(c.strip(),i) for i,c in enumerate(self.T.coadd_id)])
+
+    def __len__(self):
+        return len(self.T)
+
+    def get_tiles(self, coadd_ids):
+        '''
+        Returns the rows of the atlas for the given tiles (in atlas order).
+        '''
+        I = [self.index[c.strip()] for c in coadd_ids if c.strip() in self.index]
+        return self.T[np.array(sorted(I), dtype=int)]
+
+def read_time_resolved_atlas(tdir, cache=None):
+    '''
+    Returns the TimeResolvedAtlas in directory *tdir*, memoized in this
+    process and (if *cache* is given) in the UnwiseTileCache.
+    '''
+    fn = os.path.join(tdir, 'time_resolved_atlas.fits')
+    key = (os.path.abspath(fn),) + _stat_key(fn)
+    atlas = _atlas_memo.get(key)
+    if atlas is not None:
+        return atlas
+    if cache is not None:
+        atlas = cache.get_pickle('atlas-%s' % repr(key), lambda: TimeResolvedAtlas(fn))
+    else:
+        atlas = TimeResolvedAtlas(fn)
+    _atlas_memo[key] = atlas
+    return atlas
@@ -441,3 +441,102 @@ def run_ps_thread(parent_pid, parent_ppid, fn, shutdown, event_queue):
         print('ps -- writing', fn)
         T = merge_tables(TT, columns='fillzero')
         write_results(fn, T, events, fitshdr)
+
+# singleton: a multiprocessing semaphore counting the idle CPUs of
+# this process's worker pool (shared by all its workers); see fork_map.
+fork_slots = None
+def set_fork_slots(slots):
+    global fork_slots
+    fork_slots = slots
+
+def get_fork_slots():
+    return fork_slots
+
+def fork_map(func, args, nprocs, slots=None):
+    '''
+    Returns [func(*a) for a in args], running each call in a forked
+    child process (at most *nprocs* at once).  Each child sees a
+    copy-on-write snapshot of this process, so it can modify objects
+    (eg, tims) freely; results are pickled back through a pipe.
+    Exceptions in the children are re-raised here.
+
+    The first child runs on this process's own CPU (we just wait for
+    it).  If *slots* (a semaphore counting idle CPUs; see
+    set_fork_slots) is given, each additional child must take one,
+    giving it back when it finishes; if none is free, the calls run
+    one at a time.
+    '''
+    import sys
+    import pickle
+    import traceback
+    results = [None] * len(args)
+    running = []
+    todo = list(enumerate(args))
+    # Is our own CPU free for a child?
+    own_cpu = True
+    # Don't duplicate buffered output in the children
+    sys.stdout.flush()
+    sys.stderr.flush()
+    while len(todo) or len(running):
+        while len(todo) and len(running) < max(1, nprocs):
+            if own_cpu:
+                own_cpu = False
+                slot = False
+            elif slots is None or slots.acquire(False):
+                slot = (slots is not None)
+            else:
+                break
+            i,a = todo.pop(0)
+            rfd,wfd = os.pipe()
+            pid = os.fork()
+            if pid == 0:
+                # child
+                os.close(rfd)
+                status = 1
+                try:
+                    try:
+                        r = (True, func(*a))
+                    except BaseException as e:
+                        r = (False, (e, traceback.format_exc()))
+                    try:
+                        data = pickle.dumps(r, -1)
+                    except Exception:
+                        data = pickle.dumps((False, (None, traceback.format_exc())), -1)
+                    with os.fdopen(wfd, 'wb') as f:
+                        f.write(data)
+                    sys.stdout.flush()
+                    sys.stderr.flush()
+                    status = 0
+                finally:
+                    os._exit(status)
+            os.close(wfd)
+            running.append((i, pid, rfd, slot))
+        # Collect the oldest child's result (reading it all, so that
+        # it doesn't block writing to the pipe)
+        i,pid,rfd,slot = running.pop(0)
+        with os.fdopen(rfd, 'rb') as f:
+            data = f.read()
+        os.waitpid(pid, 0)
+        if slot:
+            slots.release()
+        else:
+            own_cpu = True
+        if len(data) == 0:
+            ok,r = False, (RuntimeError('Forked process %i died without a result' % pid), '')
+        else:
+            ok,r = pickle.loads(data)
+        if not ok:
+            # Let the other children finish
+            for _,pid,rfd,slot in running:
+                os.close(rfd)
+                os.waitpid(pid, 0)
+                if slot:
+                    slots.release()
+            e,tb = r
+            print('Exception in forked process:')
+            print(tb)
+            if e is None:
+                raise RuntimeError('Failed to pickle result of forked process')
+            raise e
+        results[i] = r
+    return results
@@ -7,26 +7,50 @@ import zmq
 
 from legacypipe.oneblob import one_blob
 
-def worker(workq, resultq):
+def worker(workq, resultq, pipeline=False, fork_slots=None):
+    '''
+    Runs one_blob() on work packets from *workq*, putting results on
+    *resultq*.
+
+    If *pipeline* is set, a background thread fetches and unpickles
+    the next work packet while one_blob() runs on the current one.
+
+    *fork_slots*: a semaphore, shared by the node's workers, counting
+    their idle CPUs (for the blobs' *model_procs*; see fork_map).
+    '''
     import socket
+    from legacypipe.utils import set_fork_slots
     myid = '%s-pid%05i' % (socket.gethostname(), os.getpid())
+    set_fork_slots(fork_slots)
+
+    if pipeline:
+        import threading
+        import queue
+        # Hold (at most) one unpickled work packet, ready to go.
+        localq = queue.Queue(maxsize=1)
+        thread = threading.Thread(target=unpickle_thread, args=(workq, localq),
+                                  daemon=True)
+        thread.start()
 
-    req = None
-    meta = None
     tprev_wall = time.time()
     while True:
         qsize = workq.qsize()
         ta_wall = time.time()
-        work = workq.get()
-        tb_wall = time.time()
-        work = pickle.loads(work)
-        tc_wall = time.time()
+        if pipeline:
+            work,tunpickle = localq.get()
+            tb_wall = time.time()
+        else:
+            work = workq.get()
+            tb_wall = time.time()
+            work = unpickle_work(work)
+            tunpickle = time.time() - tb_wall
         (brickname, iblob, args) = work
 
         # DEBUG -- unpack "args" to print the following...
         # (nblob, iblob, Isrcs, brickwcs, bx0, by0, blobw, blobh, blobmask, timargs,
         #  srcs, bands, plots, ps, reoptimize, iterative, use_ceres, refmap,
-        #  large_galaxies_force_pointsource, less_masking, frozen_galaxies) = args
+        #  large_galaxies_force_pointsource, less_masking, frozen_galaxies,
+        #  model_procs) = args
         # (_, iblob, Isrcs, _, _, _, blobw, blobh, _, timargs,
         #  _, _, _, _, _, _, _, _,
         #  _, _, _) = args
@@ -36,30 +60,66 @@ def worker(workq, resultq):
         t0_wall = time.time()
         t0_cpu  = time.process_time()
 
-        result = one_blob(args)
+        if fork_slots is not None:
+            fork_slots.acquire()
+        try:
+            result = one_blob(args)
+        finally:
+            if fork_slots is not None:
+                fork_slots.release()
 
         t1_cpu  = time.process_time()
         t1_wall = time.time()
         overhead = t0_wall - tprev_wall
         tprev_wall = t1_wall
-        # metadata about this blob
-        meta = (brickname, iblob, t1_cpu-t0_cpu, t1_wall-t0_wall, overhead)
         # pickle
         t2_wall = time.time()
         msg = pickle.dumps(result, -1)
-        meta_msg = pickle.dumps(meta, -1)
         t3_wall = time.time()
+        tget = tb_wall - ta_wall
+        tpickle = t3_wall - t2_wall
+        # metadata about this blob
+        meta = (brickname, iblob, t1_cpu-t0_cpu, t1_wall-t0_wall, overhead,
+                tget, tunpickle, tpickle)
+        meta_msg = pickle.dumps(meta, -1)
         resultq.put((msg, meta_msg, brickname, iblob))
         t4_wall = time.time()
 
-        tunpickle = tc_wall - tb_wall
-        tget = tb_wall - ta_wall
-        tpickle = t3_wall - t2_wall
         tput = t4_wall - t3_wall
         if max([tget, tpickle, tput, tunpickle]) > 1:
             print('Worker', myid, ': work %5.2f, unpickle %5.2f, get work %5.2f (queue size %i), pickle %5.2f, put results %5.2f' % (t1_wall-t0_wall, tunpickle, tget, qsize, tpickle, tput))
 
-def queue_feeder(server, workq, resultq):
+def unpickle_work(parts):
+    '''
+    Unpickles a work packet, received as a list of message parts:
+    either a single pickle, or (from farm.py --zero-copy) a protocol-5
+    pickle followed by its out-of-band buffers.
+    '''
+    if len(parts) == 1:
+        return pickle.loads(parts[0])
+    # Copy the buffers so that the arrays are writable, as with in-band pickles.
+    return pickle.loads(parts[0], buffers=[bytearray(b) for b in parts[1:]])
+
+def unpickle_thread(workq, localq):
+    '''
+    For worker(pipeline=True): pulls work packets off the node's
+    *workq* and unpickles them, placing (work, unpickle time) on
+    *localq*.
+    '''
+    while True:
+        work = workq.get()
+        t0 = time.time()
+        work = unpickle_work(work)
+        localq.put((work, time.time() - t0))
+
+def queue_feeder(server, workq, resultq, batch=1, batch_bytes=1000000):
+    '''
+    Talks to the farm.py server: sends results from *resultq* and puts
+    the work packets it receives in reply onto *workq*.
+
+    Up to *batch* results (totalling up to *batch_bytes*) that are
+    waiting in *resultq* are sent together in one message.
+    '''
     from queue import Empty
 
     # Build job id string to identify myself to the farm.py server.
@@ -114,24 +174,31 @@ def queue_feeder(server, workq, resultq):
         # was_full = False
 
         t_0 = time.time()
-        # Check for a result produced by worker processes
-        try:
-            result,rmeta,brick,iblob = resultq.get_nowait()
-            #print('Completed work: brick', brick, 'blob', iblob)
-        except Empty:
-            result,rmeta = nonemsg,nonemsg
+        # Check for results produced by worker processes
+        parts = [jobid]
+        nbytes = 0
+        while len(parts) < 1 + 2*batch and nbytes < batch_bytes:
+            try:
+                result,rmeta,brick,iblob = resultq.get_nowait()
+                #print('Completed work: brick', brick, 'blob', iblob)
+            except Empty:
+                break
+            parts.extend([rmeta, result])
+            nbytes += len(result)
+        if len(parts) == 1:
+            parts.extend([nonemsg, nonemsg])
         #print('Work queue contains ~%i items.  Results queue contains ~%i items.' %
         #      (workq.qsize(), resultq.qsize()))
 
-        # Send result (if any) to server (and get back work item)
+        # Send results (if any) to server (and get back work item)
         t_a = time.time()
-        sock.send_multipart([jobid, rmeta, result])
+        sock.send_multipart(parts)
         t_b = time.time()
-        work = sock.recv()
+        work = sock.recv_multipart()
         t_c = time.time()
         # only unpickle very short work packets to check for None.
-        if len(work) < 10:
-            realwork = pickle.loads(work)
+        if len(work) == 1 and len(work[0]) < 10:
+            realwork = pickle.loads(work[0])
             if realwork is None:
                 print('No work assigned!')
                 time.sleep(1)
@@ -147,6 +214,12 @@ def main():
     parser = argparse.ArgumentParser()
     parser.add_argument('server', nargs=1, help='Server URL, eg tcp://edison08:5555')
     parser.add_argument('--threads', type=int, help='Number of processes to run')
+    parser.add_argument('--prefetch', type=int, default=8,
+                        help='Number of work packets to queue up on this node')
+    parser.add_argument('--pipeline', default=False, action='store_true',
+                        help='Fetch and unpickle the next work packet while fitting the current one')
+    parser.add_argument('--batch', type=int, default=1,
+                        help='Maximum number of results to send to the server in one message')
 
     opt = parser.parse_args()
 
@@ -154,6 +227,7 @@ def main():
 
     from multiprocessing import Process
     from multiprocessing import Queue
+    from multiprocessing import Semaphore
 
     # We have one "feeder" process that talks to the server to
     # fetch work and put it on a local (multi-process) queue --
@@ -161,25 +235,30 @@ def main():
     # server and to provide a short local buffer of work to reduce
     # overheads.  There is also a "results" queue where the
     # workers place their finished results.
-    nqueued = 8
-    workq = Queue(nqueued)
+    workq = Queue(opt.prefetch)
     resultq = Queue()
 
-    p_feeder = Process(target=queue_feeder, args=(server, workq, resultq))
+    p_feeder = Process(target=queue_feeder, args=(server, workq, resultq),
+                       kwargs=dict(batch=opt.batch))
     p_feeder.start()
 
+    # The workers' CPUs, while they are not fitting a blob
+    fork_slots = Semaphore(opt.threads or 1)
+
     if opt.threads:
         procs = []
         for i in range(opt.threads):
             #p = Process(target=run, args=(server,))
-            p = Process(target=worker, args=(workq, resultq))
+            p = Process(target=worker, args=(workq, resultq),
+                        kwargs=dict(pipeline=opt.pipeline,
+                                    fork_slots=fork_slots))
             p.start()
             procs.append(p)
         for i,p in enumerate(procs):
             p.join()
             print('Joined process', (i+1), 'of', len(procs))
     else:
-        worker(workq, resultq)
+        worker(workq, resultq, pipeline=opt.pipeline, fork_slots=fork_slots)
 
     p_feeder.kill()
     p_feeder.close()
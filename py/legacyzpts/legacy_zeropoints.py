@@ -289,6 +289,9 @@ def measure_image(img_fn, mp, image_dir='images',
         survey_zeropoints = LegacySurveyData(survey_dir=zptdir)
 
     plots = measureargs.get('plots', False)
+    # Scratch directory for decompressed pixels shared by the calib and
+    # zeropoint steps (see legacypipe.pixelcache)
+    pixel_dir = measureargs.get('pixel_dir', None)
 
     if run_psf_only:
         splinesky = False
@@ -311,7 +314,8 @@ def measure_image(img_fn, mp, image_dir='images',
     if splinesky or psfex:
         git_version = get_git_version(dirnm=os.path.dirname(legacypipe.__file__))
         imgs = mp.map(run_one_calib, [(img_fn, camera, survey, ext, psfex, splinesky,
-                                       plots, survey_blob_mask, survey_zeropoints, git_version)
+                                       plots, survey_blob_mask, survey_zeropoints, git_version,
+                                       pixel_dir)
                                       for ext in extlist])
         from legacyzpts.merge_calibs import merge_splinesky, merge_psfex
         class FakeOpts(object):
@@ -378,10 +382,26 @@ def measure_image(img_fn, mp, image_dir='images',
     if run_calibs_only or run_psf_only or run_sky_only:
         return
 
-    rtns = mp.map(run_one_ext, [(img, ext, survey, splinesky,
-                                 measureargs['sdss_photom'],
-                                 measureargs['gaia_photom'], plots)
-                                for ext in extlist])
+    # Read the reference catalogs once for the whole exposure
+    refcats = None
+    if measureargs.get('prefetch_refs', True) and len(extlist) > 1:
+        refcats = prefetch_reference_catalogs(img, extlist, survey,
+                                              measureargs['sdss_photom'],
+                                              measureargs['gaia_photom'])
+        if refcats is not None and getattr(mp, 'pool', None) is not None:
+            # Let the workers memory-map them rather than receiving a copy per CCD
+            for cat in refcats.values():
+                cat.share()
+    try:
+        rtns = mp.map(run_one_ext, [(img, ext, survey, splinesky,
+                                     measureargs['sdss_photom'],
+                                     measureargs['gaia_photom'], plots, refcats,
+                                     pixel_dir)
+                                    for ext in extlist])
+    finally:
+        if refcats is not None:
+            for cat in refcats.values():
+                cat.cleanup()
 
     for ccd,photom in rtns:
         if ccd is not None:
@@ -411,10 +431,14 @@ def measure_image(img_fn, mp, image_dir='images',
 
 def run_one_calib(X):
     (img_fn, camera, survey, ext, psfex, splinesky, plots, survey_blob_mask,
-     survey_zeropoints, git_version) = X
+     survey_zeropoints, git_version, pixel_dir) = X
     img = survey.get_image_object(None, camera=camera,
                                   image_fn=img_fn, image_hdu=ext)
     img.check_for_cached_files(survey)
+    if pixel_dir is not None:
+        # Leave the decompressed pixels for run_one_ext
+        from legacypipe.pixelcache import PixelCache
+        img.pixel_cache = PixelCache(scratch_dir=pixel_dir)
 
     do_psf = False
     do_sky = False
@@ -475,10 +499,48 @@ def run_one_calib(X):
     except ZeroWeightError:
         print('Got ZeroWeightError running calibs for', img, 'but continuing')
     # Otherwise, let the exception propagate.
+    if img.pixel_cache is not None:
+        img.pixel_cache.release()
+        img.pixel_cache = None
     return img
 
+def prefetch_reference_catalogs(img, extlist, survey, sdss_photom=False,
+                                gaia_photom=False):
+    '''
+    Reads the Gaia and photometric reference catalogs once for all the
+    CCDs *extlist* of exposure *img*, for run_zeropoints.  Returns a
+    dict of PrefetchedCatalogs (keys 'gaia' and 'sdss' or 'ps1'), or
+    None if no CCD WCS could be read.
+    '''
+    wcslist = []
+    for ext in extlist:
+        try:
+            im = survey.get_image_object(None, camera=img.camera,
+                                         image_fn=img.image_filename, image_hdu=ext,
+                                         prime_cache=False)
+            wcs = im.get_wcs(hdr=im.read_image_header(ext=im.hdu))
+            slc = im.get_good_image_slice(None)
+        except Exception as e:
+            # run_zeropoints will read this CCD's catalogs itself.
+            print('Not prefetching reference catalogs for', img, 'ext', ext, ':', e)
+            continue
+        if slc is not None:
+            sy,sx = slc
+            wcs = wcs.get_subimage(sx.start, sy.start, int(sx.stop-sx.start),
+                                   int(sy.stop-sy.start))
+        wcslist.append(wcs)
+    if len(wcslist) == 0:
+        return None
+    refcats = dict(gaia=GaiaCatalog().prefetch(wcslist))
+    if sdss_photom:
+        refcats['sdss'] = sdsscat(ccdwcs=wcslist[0]).prefetch(wcslist)
+    elif not gaia_photom:
+        refcats['ps1'] = ps1cat(ccdwcs=wcslist[0]).prefetch(wcslist)
+    return refcats
+
 def run_one_ext(X):
-    img, ext, survey, splinesky, sdss_photom, gaia_photom, plots = X
+    (img, ext, survey, splinesky, sdss_photom, gaia_photom, plots, refcats,
+     pixel_dir) = X
 
     ps = None
     if plots:
@@ -488,8 +550,11 @@ def run_one_ext(X):
     img = survey.get_image_object(None, camera=img.camera,
                                   image_fn=img.image_filename, image_hdu=ext,
                                   prime_cache=False)
+    if pixel_dir is not None:
+        from legacypipe.pixelcache import PixelCache
+        img.pixel_cache = PixelCache(scratch_dir=pixel_dir)
     return run_zeropoints(img, splinesky=splinesky, sdss_photom=sdss_photom,
-                          gaia_photom=gaia_photom, ps=ps)
+                          gaia_photom=gaia_photom, ps=ps, refcats=refcats)
 
 class outputFns(object):
     def __init__(self, imgfn, outdir, camera, image_dir='images', debug=False):
@@ -551,11 +616,22 @@ def runit(imgfn, photomfn, annfn, mp, bad_expid=None,
     '''
     t0 = Time()
 
-    results = measure_image(imgfn, mp, survey=survey,
-                            run_calibs_only=run_calibs_only,
-                            run_psf_only=run_psf_only,
-                            run_sky_only=run_sky_only,
-                            **measureargs)
+    pixel_dir = None
+    scratch_dir = measureargs.pop('pixel_scratch_dir', None)
+    if scratch_dir is not None:
+        import tempfile
+        pixel_dir = tempfile.mkdtemp(dir=scratch_dir, prefix='zpt-pixels-')
+    try:
+        results = measure_image(imgfn, mp, survey=survey,
+                                run_calibs_only=run_calibs_only,
+                                run_psf_only=run_psf_only,
+                                run_sky_only=run_sky_only,
+                                pixel_dir=pixel_dir,
+                                **measureargs)
+    finally:
+        if pixel_dir is not None:
+            import shutil
+            shutil.rmtree(pixel_dir, ignore_errors=True)
     if run_calibs_only or run_psf_only or run_sky_only:
         return
 
@@ -664,6 +740,11 @@ def get_parser():
                         help='Use SDSS rather than PS-1 for photometric cal.')
     parser.add_argument('--gaia-photom', default=False, action='store_true',
                         help='Use Gaia rather than PS-1 for photometric cal.')
+    parser.add_argument('--pixel-scratch-dir', default=None,
+                        help='Directory (eg, /dev/shm) in which to keep each exposure\'s decompressed pixels, to share them between the calibration and zeropoint steps')
+    parser.add_argument('--no-prefetch-refs', dest='prefetch_refs', default=True,
+                        action='store_false',
+                        help='Read the reference catalogs separately for each CCD, rather than once per exposure')
     parser.add_argument('--debug', action='store_true', default=False, help='Write additional files and plots for debugging')
     parser.add_argument('--choose_ccd', action='store', default=None, help='forced to use only the specified ccd')
     parser.add_argument('--force-cfht-ccds', action='store_true', default=False,
@@ -883,10 +964,13 @@ def main(args=None):
     tnow = Time()
     print("TIMING:total %s" % (tnow-tbegin,))
 
-def run_zeropoints(imobj, splinesky=False, sdss_photom=False, gaia_photom=False, ps=None):
+def run_zeropoints(imobj, splinesky=False, sdss_photom=False, gaia_photom=False, ps=None,
+                   refcats=None):
     """Computes photometric and astrometric zeropoints for one CCD.
 
     Args:
+        refcats: optional dict of reference catalogs prefetched for the
+        whole exposure (see prefetch_reference_catalogs).
 
     Returns:
         ccds, stars_photom, stars_astrom
@@ -1015,7 +1099,12 @@ def run_zeropoints(imobj, splinesky=False, sdss_photom=False, gaia_photom=False,
 
     # Load Gaia & photometric calibrator catalogues
 
-    gaia = GaiaCatalog().get_catalog_in_wcs(wcs)
+    if refcats is None:
+        refcats = {}
+    if 'gaia' in refcats:
+        gaia = refcats['gaia'].get_catalog_in_wcs(wcs)
+    else:
+        gaia = GaiaCatalog().get_catalog_in_wcs(wcs)
     assert(gaia is not None)
     assert(len(gaia) > 0)
     gaia = GaiaCatalog.catalog_nantozero(gaia)
@@ -1025,7 +1114,11 @@ def run_zeropoints(imobj, splinesky=False, sdss_photom=False, gaia_photom=False,
     phot = None
     if sdss_photom:
         try:
-            phot = sdsscat(ccdwcs=wcs).get_stars(magrange=None)
+            if 'sdss' in refcats:
+                phot = refcats['sdss'].get_catalog_in_wcs(wcs)
+                print('Found {} good SDSS stars'.format(len(phot)))
+            else:
+                phot = sdsscat(ccdwcs=wcs).get_stars(magrange=None)
         except OSError as e:
             print('No SDSS stars found for this image -- outside the SDSS footprint?', e)
     elif gaia_photom:
@@ -1033,7 +1126,11 @@ def run_zeropoints(imobj, splinesky=False, sdss_photom=False, gaia_photom=False,
         phot = gaia
     else:
         try:
-            phot = ps1cat(ccdwcs=wcs).get_stars(magrange=None)
+            if 'ps1' in refcats:
+                phot = refcats['ps1'].get_catalog_in_wcs(wcs)
+                print('Found {} good PS1 stars'.format(len(phot)))
+            else:
+                phot = ps1cat(ccdwcs=wcs).get_stars(magrange=None)
         except OSError as e:
             print('No PS1 stars found for this image -- outside the PS1 footprint, or in the Galactic plane?', e)
 
@@ -21,6 +21,8 @@ def main():
     parser.add_argument('--no-sky', dest='sky', action='store_false',
                       help='Do not compute sky models')
     parser.add_argument('--run-se', action='store_true', help='Run SourceExtractor')
+    parser.add_argument('--pixel-cache', action='store_true',
+                        help='Decompress each image once for both the sky and SourceExtractor')
 
     parser.add_argument('--no-splinesky', dest='splinesky', default=True, action='store_false',
                         help='Use constant, not splinesky')
@@ -95,6 +97,8 @@ def main():
             kwargs.update(force=True)
         if opt.run_se:
             kwargs.update(se=True)
+        if opt.pixel_cache:
+            kwargs.update(pixel_cache=True)
         if opt.splinesky:
             kwargs.update(splinesky=True)
         if opt.cont:
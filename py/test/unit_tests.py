@@ -56,6 +56,1063 @@ class TestOneblob(unittest.TestCase):
         mod = _select_model(chisqs, nparams, galaxy_margin)
         self.assertTrue(mod == 'dev')
 
+    def test_model_procs(self):
+        # Fitting the candidate models in forked processes must give
+        # the same results as fitting them serially.
+        import numpy as np
+        from astrometry.util.util import Tan
+        from tractor import (Image, PixelizedPSF, ConstantFitsWcs,
+                             LinearPhotoCal, ConstantSky, PointSource,
+                             RaDecPos, NanoMaggies)
+        from tractor.galaxy import ExpGalaxy
+        from tractor.ellipses import EllipseE
+        from legacypipe.oneblob import one_blob
+
+        class Meta(object):
+            fwhm = 4.
+
+        H,W = 60,60
+        ps = 0.262 / 3600.
+        wcs = Tan(10., 0., W/2.+0.5, H/2.+0.5, -ps, 0., 0., ps,
+                  float(W), float(H))
+        yy,xx = np.mgrid[-12:13, -12:13]
+        psfimg = np.exp(-0.5 * (xx**2 + yy**2) / 1.7**2)
+        psfimg /= psfimg.sum()
+        sig1 = 0.01
+        rng = np.random.RandomState(42)
+        timargs = []
+        for band in ['g', 'r']:
+            tim = Image(data=np.zeros((H,W), np.float32),
+                        inverr=np.ones((H,W), np.float32) / sig1,
+                        wcs=ConstantFitsWcs(wcs), psf=PixelizedPSF(psfimg),
+                        photocal=LinearPhotoCal(1., band=band),
+                        sky=ConstantSky(0.))
+            srcs = [PointSource(RaDecPos(*wcs.pixelxy2radec(20., 25.)),
+                                NanoMaggies(**{band: 3.})),
+                    ExpGalaxy(RaDecPos(*wcs.pixelxy2radec(40., 35.)),
+                              NanoMaggies(**{band: 10.}),
+                              EllipseE(1., 0.2, 0.1))]
+            img = np.zeros((H,W), np.float32)
+            for src in srcs:
+                src.getModelPatch(tim).addTo(img)
+            img += sig1 * rng.normal(size=img.shape)
+            timargs.append((img.astype(np.float32), tim.inverr,
+                            np.zeros((H,W), np.int16), ConstantFitsWcs(wcs),
+                            wcs, tim.getPhotoCal(), ConstantSky(0.),
+                            tim.getPsf(), 'tim-'+band, band, sig1, Meta()))
+
+        def run(model_procs):
+            cat = [PointSource(RaDecPos(*wcs.pixelxy2radec(x, y)),
+                               NanoMaggies(g=1., r=1.))
+                   for x,y in [(20.,25.), (40.,35.)]]
+            X = ('1', 0, np.arange(len(cat)), wcs, 0, 0, W, H,
+                 np.ones((H,W), bool), timargs, cat, ['g','r'], False, None,
+                 True, False, False, np.zeros((H,W), np.uint8),
+                 False, False, [], model_procs)
+            return one_blob(X)
+
+        B0 = run(0)
+        # One idle CPU for the second forked process
+        import multiprocessing
+        from legacypipe.utils import set_fork_slots
+        set_fork_slots(multiprocessing.Semaphore(1))
+        try:
+            B2 = run(2)
+        finally:
+            set_fork_slots(None)
+        self.assertEqual(list(B0.type), list(B2.type))
+        for col in ['ra', 'dec', 'flux', 'flux_ivar', 'dchisq']:
+            self.assertTrue(np.array_equal(B0.get(col), B2.get(col)), col)
+
+    def test_fork_map_slots(self):
+        # fork_map only runs extra processes on idle slots, and gives
+        # them back.
+        import os
+        import multiprocessing
+        from legacypipe.utils import fork_map
+
+        def f(x):
+            return x * x, os.getpid()
+
+        args = [(x,) for x in range(6)]
+        for nfree in [0, 2]:
+            slots = multiprocessing.Semaphore(nfree)
+            R = fork_map(f, args, 4, slots=slots)
+            self.assertEqual([r for r,_ in R], [x*x for x in range(6)])
+            self.assertNotIn(os.getpid(), [pid for _,pid in R])
+            self.assertEqual(slots.get_value(), nfree)
+        # No slot free: the calls still run, one at a time.
+        slots = multiprocessing.Semaphore(0)
+        def g(x):
+            return slots.get_value()
+        self.assertEqual(fork_map(g, args, 4, slots=slots), [0] * 6)
+
+class TestDetection(unittest.TestCase):
+
+    def test_saddle_tree(self):
+        # The merge-tree saddle test must give the same results as the
+        # per-peak loop.
+        import numpy as np
+        from scipy.ndimage import gaussian_filter
+        from legacypipe.detection import sed_matched_detection
+
+        for seed in range(4):
+            rng = np.random.RandomState(seed)
+            H,W = 500,400
+            img = rng.normal(size=(H,W)).astype(np.float32)
+            # crowded point sources
+            n = 2000
+            src = np.zeros((H,W))
+            np.add.at(src, (rng.randint(0,H,n), rng.randint(0,W,n)),
+                      rng.lognormal(3., 1.5, n))
+            img += 10. * gaussian_filter(src, 2.)
+            # a big galaxy (with blobs bigger than the 50-pixel
+            # cutouts), and a ring with an island in it
+            yy,xx = np.mgrid[:H,:W]
+            img += 30. * np.exp(-0.5 * ((xx-100)**2 + (yy-300)**2) / 40.**2)
+            rr = np.hypot(xx-300, yy-100)
+            img += 30. * (np.abs(rr - 30) < 2) + 20. * (rr < 4)
+            iv = np.ones((H,W), np.float32)
+            iv[:, :10] = 0.
+            no = 20
+            xo = rng.randint(-5, W+5, no)
+            yo = rng.randint(-5, H+5, no)
+            ro = np.zeros(no, int) + 4
+            satur = None
+            if seed % 2:
+                satur = [img > 200.]
+            R = [sed_matched_detection('r', [1.], [img], [iv], ['r'], xo, yo, ro,
+                                       nsigma=6., saturated_pix=satur,
+                                       saddle_method=method)
+                 for method in ['loop', 'tree']]
+            self.assertTrue(len(R[0][1]) > 100)
+            for a,b in zip(*R):
+                self.assertTrue(np.array_equal(a, b))
+
+    def test_forked_peaks(self):
+        # Running the peak tests in forked processes must give the same
+        # results as running them serially.
+        import numpy as np
+        from scipy.ndimage import gaussian_filter
+        from legacypipe.detection import (sed_matched_detection,
+                                          _independent_peak_groups)
+        import legacypipe.detection as detection
+
+        rng = np.random.RandomState(7)
+        H,W = 400,500
+        img = rng.normal(size=(H,W)).astype(np.float32)
+        n = 1500
+        src = np.zeros((H,W))
+        np.add.at(src, (rng.randint(0,H,n), rng.randint(0,W,n)),
+                  rng.lognormal(3., 1.5, n))
+        img += 10. * gaussian_filter(src, 2.)
+        # a big galaxy, whose blob spans many peaks
+        yy,xx = np.mgrid[:H,:W]
+        img += 30. * np.exp(-0.5 * ((xx-150)**2 + (yy-200)**2) / 40.**2)
+        iv = np.ones((H,W), np.float32)
+        no = 20
+        xo = rng.randint(-5, W+5, no)
+        yo = rng.randint(-5, H+5, no)
+        ro = np.zeros(no, int) + 4
+
+        # Count the groups the peaks are split into
+        ngroups = []
+        real = detection._independent_peak_groups
+        def groups(*args):
+            G = real(*args)
+            ngroups.append(len(G))
+            return G
+        detection._independent_peak_groups = groups
+        try:
+            R = [sed_matched_detection('r', [1.], [img], [iv], ['r'], xo, yo, ro,
+                                       nsigma=6., nprocs=nprocs)
+                 for nprocs in [1, 4]]
+        finally:
+            detection._independent_peak_groups = real
+        self.assertEqual(ngroups, [4])
+        self.assertTrue(len(R[0][1]) > 100)
+        for a,b in zip(*R):
+            self.assertTrue(np.array_equal(a, b))
+
+    def test_incremental_maps(self):
+        # The incrementally-updated detection maps must match the ones
+        # computed from scratch as the tim pixels change.
+        import numpy as np
+        from legacypipe.detection import (detection_maps,
+                                          IncrementalDetectionMaps)
+
+        class Sky(object):
+            def __init__(self, v):
+                self.v = v
+            def addTo(self, img, scale=1.):
+                img += scale * self.v
+            def getParams(self):
+                return [self.v]
+
+        class Tim(object):
+            dq_saturation_bits = 1
+            def __init__(self, name, band, img, ie, dq, sky, psf_sigma, resamp):
+                self.name = name
+                self.band = band
+                self.data = img
+                self.inverr = ie
+                self.dq = dq
+                self.sky = sky
+                self.psf_sigma = psf_sigma
+                self.sig1 = 1. / np.median(ie[ie > 0])
+                self.shape = img.shape
+                self.resamp = resamp
+            def getImage(self):
+                return self.data
+            def getInvError(self):
+                return self.inverr
+            def getSky(self):
+                return self.sky
+
+        class WCS(object):
+            shape = (90, 110)
+
+        class MP(object):
+            def imap_unordered(self, func, args):
+                return map(func, args)
+
+        rng = np.random.RandomState(17)
+        H,W = WCS.shape
+        tims = []
+        for i,(band,sigma,dy,dx) in enumerate([('g', 1.5, 0, 0), ('r', 2.2, 10, -5),
+                                              ('r', 1.8, -3, 12), ('g', 2., 0, 0)]):
+            th,tw = 80, 95
+            img = rng.normal(size=(th,tw)).astype(np.float32)
+            ie = np.ones((th,tw), np.float32)
+            ie[rng.uniform(size=(th,tw)) < 0.02] = 0.
+            dq = np.zeros((th,tw), np.int16)
+            dq[40:43, 50:52] = 1
+            yi,xi = np.mgrid[:th, :tw]
+            yo,xo = yi + dy, xi + dx
+            K = (yo >= 0) * (yo < H) * (xo >= 0) * (xo < W)
+            R = (yo[K].astype(np.int16), xo[K].astype(np.int16),
+                 yi[K].astype(np.int16), xi[K].astype(np.int16))
+            tims.append(Tim('tim%i' % i, band, img, ie, dq, Sky(0.1 * i), sigma, R))
+        bands = ['g', 'r']
+
+        def check(inc):
+            detmaps,detivs = inc.update(tims)
+            dm,di,_ = detection_maps(tims, WCS(), bands, MP())
+            for a,b in zip(detmaps + detivs, dm + di):
+                self.assertTrue(np.allclose(a, b, rtol=1e-5, atol=1e-5))
+
+        inc = IncrementalDetectionMaps(tims, WCS(), bands)
+        check(inc)
+        # add and subtract "source models" in small patches, as OneBlob does
+        for k in range(6):
+            tim = tims[k % 3]
+            y,x = rng.randint(0, 70), rng.randint(0, 85)
+            tim.data[y:y+8, x:x+10] += rng.uniform(-5, 20)
+            check(inc)
+        # touch the saturated-pixel fill value
+        tims[1].data[0,0] = 1000.
+        check(inc)
+        # a new inverse-error map (as when masking other sources) ...
+        ie = tims[0].inverr.copy()
+        ie[10:30, 10:30] = 0.
+        tims[0].inverr = ie
+        check(inc)
+        # ... and a new sky level
+        tims[2].sky = Sky(0.5)
+        check(inc)
+
+class TestCheckpoint(unittest.TestCase):
+
+    def test_drop_then_append(self):
+        # Dropping stale records after reading a checkpoint log, then
+        # appending new ones, must leave exactly the current records.
+        import os
+        import tempfile
+        import shutil
+        from legacypipe.checkpoint import CheckpointLog, read_checkpoint
+
+        tempdir = tempfile.mkdtemp()
+        try:
+            fn = os.path.join(tempdir, 'checkpoint.log')
+            ckpt = CheckpointLog(fn)
+            ckpt.write([dict(iblob=i) for i in range(5)])
+            ckpt.close()
+
+            ckpt = CheckpointLog(fn)
+            R = ckpt.read()
+            R = [r for r in R if r['iblob'] not in [1, 2]]
+            R.extend([dict(iblob=i) for i in [10, 11, 12]])
+            ckpt.update(R)
+            ckpt.close()
+            self.assertEqual([r['iblob'] for r in read_checkpoint(fn)],
+                             [0, 3, 4, 10, 11, 12])
+
+            # Pure appends after that stay appends.
+            ckpt = CheckpointLog(fn)
+            R = ckpt.read()
+            R.append(dict(iblob=13))
+            ckpt.update(R)
+            ckpt.close()
+            self.assertEqual([r['iblob'] for r in read_checkpoint(fn)],
+                             [0, 3, 4, 10, 11, 12, 13])
+        finally:
+            shutil.rmtree(tempdir)
+
+class TestBrickCcdOverlaps(unittest.TestCase):
+
+    def make_ccds(self, ras, decs):
+        import numpy as np
+        from astrometry.util.fits import fits_table
+        T = fits_table()
+        n = len(ras)
+        T.camera = np.array(['decam'] * n)
+        T.expnum = 1000 + np.arange(n)
+        T.ccdname = np.array(['N%i' % (i+1) for i in range(n)])
+        T.filter = np.array(['r'] * n)
+        T.ra = T.crval1 = np.array(ras, float)
+        T.dec = T.crval2 = np.array(decs, float)
+        T.width = np.zeros(n, np.int32) + 2046
+        T.height = np.zeros(n, np.int32) + 4094
+        T.crpix1 = T.width / 2. + 0.5
+        T.crpix2 = T.height / 2. + 0.5
+        T.cd1_1 = np.zeros(n) - 0.262 / 3600.
+        T.cd2_2 = np.zeros(n) + 0.262 / 3600.
+        T.cd1_2 = np.zeros(n)
+        T.cd2_1 = np.zeros(n)
+        return T
+
+    def test_queue_calibs_overlaps(self):
+        # queue_calibs --touching --overlaps must check the bricks and
+        # CCDs that are not in the overlaps file geometrically, and
+        # refuse overlaps computed for a different brick geometry.
+        import numpy as np
+        from astrometry.util.fits import fits_table
+        from legacypipe.ccdfootprints import CcdFootprints
+        from legacypipe.brick_ccd_overlaps import (BrickCcdOverlaps,
+                                                   compute_overlaps)
+        from legacypipe.queue_calibs import overlaps_touching
+
+        B = fits_table()
+        B.brickname = np.array(['0100p000', '0200p000', '0300p000'])
+        B.ra = np.array([10., 20., 30.])
+        B.dec = np.array([0., 0., 0.])
+        T = self.make_ccds([10., 20., 10.1, 30., 30.1, 50.],
+                           [0., 0., 0.1, 0., 0., 0.])
+        # The overlaps file knows only the first two bricks and CCDs
+        ib,ic = compute_overlaps(B[:2], CcdFootprints.from_ccds(T[:2]))
+        ov = BrickCcdOverlaps(B.brickname[:2], T.camera[:2], T.expnum[:2],
+                              T.ccdname[:2], np.zeros(2, int), np.arange(2),
+                              ['ccds.fits'], ib, ic)
+        IB,IC = overlaps_touching(ov, B, T)
+        EB,EC = compute_overlaps(B, CcdFootprints.from_ccds(T))
+        self.assertEqual(sorted(zip(IB, IC)), sorted(zip(EB, EC)))
+        self.assertEqual(sorted(set(IC)), [0, 1, 2, 3, 4])
+
+        with self.assertRaises(RuntimeError):
+            overlaps_touching(ov, B, T, W=400, H=400)
+
+    def test_ccds_touching_brick(self):
+        # ccds_touching_brick with the precomputed overlaps must agree
+        # with ccds_touching_wcs, and fall back to it when the overlaps
+        # don't match the CCDs tables or the brick geometry.
+        import os
+        import tempfile
+        import numpy as np
+        from astrometry.util.fits import fits_table
+        from legacypipe.survey import LegacySurveyData, wcs_for_brick
+        from legacypipe.ccdfootprints import CcdFootprints
+        from legacypipe.brick_ccd_overlaps import (BrickCcdOverlaps,
+                                                   compute_overlaps)
+
+        B = fits_table()
+        B.brickname = np.array(['0100p000', '0200p000'])
+        B.ra = np.array([10., 20.])
+        B.dec = np.array([0., 0.])
+        brick = B[0]
+        # on the brick center; overlapping only the full-sized brick;
+        # on the other brick
+        ccds = self.make_ccds([10., 10.15, 20.], [0., 0.2, 0.])
+        expected = [1000, 1001]
+
+        with tempfile.TemporaryDirectory() as d:
+            ccdfn = os.path.join(d, 'survey-ccds-test.fits.gz')
+            ccds.writeto(ccdfn)
+            IB,IC = compute_overlaps(B, CcdFootprints.from_ccds(ccds))
+            ov = BrickCcdOverlaps(B.brickname, ccds.camera, ccds.expnum,
+                                  ccds.ccdname, np.zeros(len(ccds), int),
+                                  np.arange(len(ccds)), [os.path.basename(ccdfn)],
+                                  IB, IC)
+            ov.writeto(os.path.join(d, 'survey-brick-ccd-overlaps.fits'))
+
+            survey = LegacySurveyData(survey_dir=d)
+            self.assertTrue(survey.get_brick_ccd_overlaps() is not None)
+            C = survey.ccds_touching_brick(brick)
+            self.assertEqual(sorted(C.expnum), expected)
+            C = survey.ccds_touching_wcs(wcs_for_brick(brick))
+            self.assertEqual(sorted(C.expnum), expected)
+
+            # A smaller brick than the overlaps were computed for
+            survey = LegacySurveyData(survey_dir=d)
+            C = survey.ccds_touching_brick(brick, W=400, H=400)
+            self.assertEqual(list(C.expnum), [1000])
+
+            # The CCDs table has been re-written in a different order
+            ccds[::-1].writeto(ccdfn)
+            survey = LegacySurveyData(survey_dir=d)
+            C = survey.ccds_touching_brick(brick)
+            self.assertEqual(sorted(C.expnum), expected)
+
+class TestPixelCache(unittest.TestCase):
+
+    def test_write_temp(self):
+        # The SourceExtractor inputs written from the pixel cache must
+        # hold the same pixels as the (fpacked) originals, with only
+        # the scaling keywords fitsio writes for the array type.
+        import os
+        import tempfile
+        import numpy as np
+        import fitsio
+        from legacypipe.pixelcache import PixelCache
+
+        with tempfile.TemporaryDirectory() as d:
+            for dtype in [np.uint16, np.int16, np.int32, np.float32]:
+                img = (np.arange(200*100).reshape(200,100) % 50000).astype(dtype)
+                fn = os.path.join(d, 'img-%s.fits.fz' % np.dtype(dtype).name)
+                fitsio.write(fn, img, compress='RICE', header=[
+                    dict(name='FOO', value=42)], clobber=True)
+                for cache in [PixelCache(), PixelCache(scratch_dir=d)]:
+                    todelete = []
+                    tmpfn = cache.write_temp(fn, 1, todelete)
+                    self.assertEqual(todelete, [tmpfn])
+                    pix,hdr = fitsio.read(tmpfn, header=True)
+                    self.assertEqual(pix.dtype, img.dtype)
+                    self.assertTrue(np.all(pix == img))
+                    self.assertEqual(hdr['FOO'], 42)
+                    self.assertEqual('BZERO' in hdr, dtype == np.uint16)
+                    os.unlink(tmpfn)
+                    # (from the scratch file, the second time)
+                    if cache.scratch_dir is not None:
+                        cache.release()
+                        pix,hdr = cache.read(fn, 1)
+                        self.assertTrue(np.all(pix == img))
+
+class TestCoadds(unittest.TestCase):
+
+    def test_forked_coadds(self):
+        # Coadds accumulated in forked processes and merged must match
+        # the serial ones.
+        import numpy as np
+        import legacypipe.coadds as coadds
+        from legacypipe.bits import DQ_BITS
+
+        H,W = 120,100
+        class Wcs(object):
+            def get_width(self):
+                return W
+            def get_height(self):
+                return H
+            def pixel_scale(self):
+                return 0.262
+        class Tim(object):
+            pass
+        class Time(object):
+            def __init__(self, mjd):
+                self.mjd = mjd
+            def toMjd(self):
+                return self.mjd
+        rng = np.random.RandomState(42)
+        tims = []
+        for k in range(12):
+            tim = Tim()
+            h,w = rng.randint(30,80), rng.randint(30,80)
+            tim.shape = (h,w)
+            tim.band = 'gr'[k % 2]
+            tim.name = 'tim%i' % k
+            img = rng.normal(size=(h,w)).astype(np.float32)
+            iv = rng.uniform(0, 2, size=(h,w)).astype(np.float32)
+            iv[rng.uniform(size=(h,w)) < 0.1] = 0
+            tim.getImage = lambda img=img: img
+            tim.getInvvar = lambda iv=iv: iv
+            tim.getInvError = lambda iv=iv: np.sqrt(iv)
+            tim.dq = rng.choice([0, 0, DQ_BITS['satur'], DQ_BITS['cr']],
+                                size=(h,w)).astype(np.int16)
+            tim.subwcs = tim.wcs = Wcs()
+            tim.x0,tim.y0 = rng.randint(-20, W), rng.randint(-20, H)
+            tim.time = Time(58000. + rng.randint(0, 5))
+            tim.psfnorm = rng.uniform(0.1, 0.2)
+            tim.galnorm = rng.uniform(0.05, 0.1)
+            tim.sig1 = rng.uniform(0.5, 1.)
+            tims.append(tim)
+        mods = [rng.normal(size=tim.shape).astype(np.float32) for tim in tims]
+        ix = rng.randint(0, W, 50)
+        iy = rng.randint(0, H, 50)
+
+        def resample_tim(tim, targetwcs, imgs, intType=None):
+            # (tims are shifted by x0,y0 on the coadd)
+            h,w = tim.shape
+            yi,xi = np.mgrid[:h,:w]
+            yo,xo = yi + tim.y0, xi + tim.x0
+            K = (yo >= 0) * (yo < H) * (xo >= 0) * (xo < W)
+            if not np.any(K):
+                raise coadds.OverlapError()
+            return (yo[K].astype(np.int16), xo[K].astype(np.int16),
+                    yi[K].astype(np.int16), xi[K].astype(np.int16), [])
+
+        real = coadds.resample_tim
+        coadds.resample_tim = resample_tim
+        try:
+            for get_max in [False, True]:
+                kw = dict(mods=mods, xy=(ix,iy), ngood=True, detmaps=True,
+                          psfsize=True, allmasks=True, anymasks=True,
+                          nsatur=2, lanczos=False, get_max=get_max)
+                nexp = [], []
+                def callback(band, k, **kwargs):
+                    nexp[k].append(kwargs['congood'].copy())
+                C1 = coadds.make_coadds(tims, 'gr', Wcs(), callback=callback,
+                                        callback_args=[0], **kw)
+                C2 = coadds.make_coadds(tims, 'gr', Wcs(), nprocs=3, callback=callback,
+                                        callback_args=[1], **kw)
+                self.assertEqual(hasattr(C1, 'maximgs'), get_max)
+                # The integer, mask, MJD and max maps are identical...
+                for attr in ['allmasks', 'anymasks', 'satmaps'] + (
+                        ['maximgs'] if get_max else []):
+                    for a,b in zip(getattr(C1, attr), getattr(C2, attr)):
+                        self.assertTrue(np.array_equal(a, b), attr)
+                for a,b in zip(*nexp):
+                    self.assertTrue(np.array_equal(a, b))
+                for c in ['ngood', 'nobs', 'anymask', 'allmask', 'mjd_min', 'mjd_max']:
+                    self.assertTrue(np.array_equal(C1.T.get(c), C2.T.get(c)), c)
+                # ... and the floating-point sums agree to rounding.
+                for attr in ['coimgs', 'comods', 'psfdetivs', 'galdetivs']:
+                    for a,b in zip(getattr(C1, attr), getattr(C2, attr)):
+                        self.assertTrue(np.allclose(a, b, rtol=1e-5, atol=1e-6), attr)
+                for c in ['psfsize', 'psfdepth', 'galdepth']:
+                    self.assertTrue(np.allclose(C1.T.get(c), C2.T.get(c),
+                                                rtol=1e-5, atol=1e-6), c)
+            self.assertEqual(len(nexp[0]), 2)
+        finally:
+            coadds.resample_tim = real
+
+        # The max image is only allocated when requested.
+        n0 = coadds._CoaddPartial(1, 1).nbytes()
+        n1 = coadds._CoaddPartial(1, 1, maximg=True).nbytes()
+        self.assertEqual(n1 - n0, 4)
+
+class TestTimCache(unittest.TestCase):
+
+    def test_key_and_eviction(self):
+        import os
+        import tempfile
+        import numpy as np
+        import legacypipe.timcache as timcache
+
+        class Im(object):
+            name = 'decam-00123456-N4'
+            hdu = 3
+            ccdzpt = 25.
+            sig1 = 0.01
+            dradec = (0., 0.)
+            def get_wcs(self):
+                raise RuntimeError('get_key should not need the WCS')
+
+        with tempfile.TemporaryDirectory() as d:
+            im = Im()
+            im.imgfn = os.path.join(d, 'img.fits.fz')
+            with open(im.imgfn, 'wb') as f:
+                f.write(b'x' * 100)
+            cache = timcache.TimCache(os.path.join(d, 'cache'), 1000)
+            rd = np.array([[10., 0.], [10.1, 0.], [10.1, 0.1], [10., 0.1]])
+            key = cache.get_key(im, rd, dict(pixPsf=True))
+            self.assertEqual(key, cache.get_key(im, rd.copy(), dict(pixPsf=True)))
+            self.assertNotEqual(key, cache.get_key(im, rd + 0.01, dict(pixPsf=True)))
+            self.assertNotEqual(key, cache.get_key(im, rd, dict(pixPsf=False)))
+            im.dradec = (0.1, 0.)
+            self.assertNotEqual(key, cache.get_key(im, rd, dict(pixPsf=True)))
+
+            # The directory is only scanned the first time, and when
+            # the cache goes over its size limit (here, 10.5 entries;
+            # it is then trimmed to 9).
+            import pickle
+            nb = len(pickle.dumps(None, -1))
+            cache.max_bytes = 10.5 * nb
+            scans = []
+            real = timcache.evict_lru
+            def evict_lru(cache_dir, max_bytes, **kwargs):
+                scans.append(cache_dir)
+                return real(cache_dir, max_bytes, **kwargs)
+            timcache.evict_lru = evict_lru
+            try:
+                keys = []
+                for i in range(20):
+                    key = '%040x' % i
+                    cache.put(key, None)
+                    keys.append(key)
+                    cache.added(timcache.entry_bytes(cache.entry_dir(key)))
+                    self.assertTrue(cache.nbytes <= cache.max_bytes)
+            finally:
+                timcache.evict_lru = real
+            # (the first put, the 11th, 13th, ..., 19th)
+            self.assertEqual(len(scans), 1 + 5)
+            self.assertEqual(cache.nbytes, 10 * nb)
+            self.assertEqual(cache.nbytes, real(cache.cache_dir, cache.max_bytes))
+            # The most recent entries survive
+            self.assertTrue(os.path.exists(cache.entry_dir(keys[-1])))
+            self.assertFalse(os.path.exists(cache.entry_dir(keys[0])))
+
+class TestUnwiseCache(unittest.TestCase):
+
+    def test_psf_key(self):
+        # Cached PSF images must be keyed by the unwise_psf model and
+        # package version.
+        import sys
+        import types
+        import tempfile
+        import numpy as np
+        import legacypipe.unwisecache as uc
+
+        pkg = types.ModuleType('unwise_psf')
+        mod = types.ModuleType('unwise_psf.unwise_psf')
+        mod.__file__ = uc.__file__
+        pkg.unwise_psf = mod
+        saved = dict([(k, sys.modules.get(k))
+                      for k in ['unwise_psf', 'unwise_psf.unwise_psf']])
+        sys.modules.update({'unwise_psf': pkg, 'unwise_psf.unwise_psf': mod})
+        calls = []
+        def psf_func(value):
+            def func():
+                calls.append(value)
+                return np.zeros((5,5), np.float32) + value
+            return func
+        try:
+            with tempfile.TemporaryDirectory() as d:
+                cache = uc.UnwiseTileCache(d, 1e9)
+                def get(model, value):
+                    # (as in a new process)
+                    uc._psf_memo.clear()
+                    uc._psf_version = None
+                    return uc.get_psf_image(1, '0001p000', psf_func(value),
+                                            cache=cache, model=model)[0,0]
+                mod.__version__ = '1.0'
+                self.assertEqual(get('neo6_unwisecat', 1.), 1.)
+                self.assertEqual(get(None, 2.), 2.)
+                self.assertEqual(get('neo6_unwisecat', 3.), 1.)
+                self.assertEqual(calls, [1., 2.])
+                mod.__version__ = '1.1'
+                self.assertEqual(get('neo6_unwisecat', 4.), 4.)
+                self.assertEqual(calls, [1., 2., 4.])
+        finally:
+            uc._psf_memo.clear()
+            uc._psf_version = None
+            for k,v in saved.items():
+                if v is None:
+                    del sys.modules[k]
+                else:
+                    sys.modules[k] = v
+
+    def test_eviction(self):
+        # The cache directory is only scanned the first time, and when
+        # the cache goes over its size limit (as for the TimCache).
+        import os
+        import tempfile
+        import numpy as np
+        import legacypipe.timcache as timcache
+        import legacypipe.unwisecache as uc
+
+        with tempfile.TemporaryDirectory() as d:
+            cache = uc.UnwiseTileCache(d, 1e9)
+            cache.get_array('first', lambda: np.zeros(100))
+            nb = timcache.entry_bytes(d)
+            # 10.5 entries; trimmed to 9
+            cache.max_bytes = 10.5 * nb
+            scans = []
+            real = timcache.evict_lru
+            def evict_lru(cache_dir, max_bytes, **kwargs):
+                scans.append(cache_dir)
+                return real(cache_dir, max_bytes, **kwargs)
+            timcache.evict_lru = evict_lru
+            try:
+                for i in range(19):
+                    a = cache.get_array('a%i' % i, lambda: np.zeros(100) + i)
+                    self.assertEqual(a[0], i)
+                    self.assertTrue(cache.nbytes <= cache.max_bytes)
+            finally:
+                timcache.evict_lru = real
+            # (the 11th entry, 13th, ..., 19th)
+            self.assertEqual(len(scans), 5)
+            self.assertEqual(cache.nbytes, 10 * nb)
+            self.assertEqual(cache.nbytes, real(d, cache.max_bytes))
+            self.assertFalse(os.path.exists(cache.entry_dir(cache.get_key('array', 'first'))))
+            self.assertTrue(os.path.exists(cache.entry_dir(cache.get_key('array', 'a18'))))
+
+class TestRasterize(unittest.TestCase):
+
+    def test_star_veto(self):
+        # The vectorized star veto must match the old per-star loop.
+        import numpy as np
+        from legacypipe.outliers import star_veto_map
+        H,W = 300,400
+        rng = np.random.RandomState(42)
+        bx = rng.uniform(-10, W+10, 2000)
+        by = rng.uniform(-10, H+10, 2000)
+        for pixrad in [0.5, 1.0 / 0.262, 7.3]:
+            veto = np.zeros((H,W), bool)
+            for x,y in zip(bx,by):
+                xlo = int(np.clip(np.floor(x - pixrad), 0, W-1))
+                xhi = int(np.clip(np.ceil (x + pixrad), 0, W-1))
+                ylo = int(np.clip(np.floor(y - pixrad), 0, H-1))
+                yhi = int(np.clip(np.ceil (y + pixrad), 0, H-1))
+                if xlo == xhi or ylo == yhi:
+                    continue
+                r2 = (((np.arange(ylo,yhi+1) - y)**2)[:,np.newaxis] +
+                      ((np.arange(xlo,xhi+1) - x)**2)[np.newaxis,:])
+                veto[ylo:yhi+1, xlo:xhi+1] |= (r2 < pixrad)
+            self.assertTrue(np.all(veto == star_veto_map((H,W), bx, by, pixrad)))
+
+    def test_reference_regions(self):
+        # or_circles and or_ellipses must match the old per-object
+        # loops of get_reference_map.
+        import numpy as np
+        from legacypipe.rasterize import or_circles, or_ellipses
+        H,W = 300,400
+        rng = np.random.RandomState(43)
+        n = 500
+        xx = rng.uniform(-50, W+50, n)
+        yy = rng.uniform(-50, H+50, n)
+        # (including some big enough to be done one at a time)
+        rpix = np.append(rng.uniform(1, 20, n-5), rng.uniform(30, 60, 5))
+        pa = rng.uniform(0, 180, n)
+        ba = rng.uniform(0.2, 1, n)
+        cd = [[-0.9, 0.1], [0.1, 0.9]]
+        cd = np.array(cd) / np.sqrt(np.abs(np.linalg.det(cd)))
+        bit1,bit2 = np.uint8(1), np.uint8(4)
+        refmap = np.zeros((H,W), np.uint8)
+        for i,(x,y,r) in enumerate(zip(xx, yy, rpix)):
+            xlo = int(np.clip(np.floor(x   - r), 0, W))
+            xhi = int(np.clip(np.ceil (x+1 + r), 0, W))
+            ylo = int(np.clip(np.floor(y   - r), 0, H))
+            yhi = int(np.clip(np.ceil (y+1 + r), 0, H))
+            if xlo == xhi or ylo == yhi:
+                continue
+            rr = ((np.arange(ylo,yhi)[:,np.newaxis] - y)**2 +
+                  (np.arange(xlo,xhi)[np.newaxis,:] - x)**2)
+            refmap[ylo:yhi, xlo:xhi] |= (bit1 * (rr <= r**2))
+            xgrid,ygrid = np.meshgrid(np.arange(xlo,xhi), np.arange(ylo,yhi))
+            dx = xgrid - x
+            dy = ygrid - y
+            du = cd[0][0] * dx + cd[0][1] * dy
+            dv = cd[1][0] * dx + cd[1][1] * dy
+            ct = np.cos(np.deg2rad(90.+pa[i]))
+            st = np.sin(np.deg2rad(90.+pa[i]))
+            v1 = ct * du + -st * dv
+            v2 = st * du +  ct * dv
+            r1 = r
+            r2 = r * ba[i]
+            refmap[ylo:yhi, xlo:xhi] |= (bit2 * (v1**2 / r1**2 + v2**2 / r2**2 < 1.))
+
+        vec = np.zeros((H,W), np.uint8)
+        xlo = np.clip(np.floor(xx   - rpix), 0, W).astype(int)
+        xhi = np.clip(np.ceil (xx+1 + rpix), 0, W).astype(int)
+        ylo = np.clip(np.floor(yy   - rpix), 0, H).astype(int)
+        yhi = np.clip(np.ceil (yy+1 + rpix), 0, H).astype(int)
+        or_circles(vec, bit1, xx, yy, xlo, xhi, ylo, yhi, rpix**2)
+        theta = np.array([np.deg2rad(90.+p) for p in pa])
+        r2 = np.array([r * b for r,b in zip(rpix, ba)])
+        or_ellipses(vec, bit2, xx, yy, xlo, xhi, ylo, yhi, cd,
+                    np.cos(theta), np.sin(theta), rpix, r2)
+        self.assertTrue(np.any(refmap & bit2))
+        self.assertTrue(np.all(refmap == vec))
+
+class TestCcdFootprints(unittest.TestCase):
+
+    def test_touching(self):
+        # The vectorized footprint overlap tests must agree with the old
+        # per-CCD Tan / polygons_intersect loop.
+        import numpy as np
+        from astrometry.util.util import Tan
+        from astrometry.util.miscutils import polygons_intersect
+        from astrometry.util.fits import fits_table
+        from legacypipe.survey import ccds_touching_wcs, wcs_for_brick
+        from legacypipe.ccdfootprints import CcdFootprints
+
+        def old_touching(targetwcs, ccds):
+            tw,th = targetwcs.imagew, targetwcs.imageh
+            targetpoly = [(0.5,0.5),(tw+0.5,0.5),(tw+0.5,th+0.5),(0.5,th+0.5)]
+            cd = targetwcs.get_cd()
+            if cd[0]*cd[3] - cd[1]*cd[2] > 0:
+                targetpoly = list(reversed(targetpoly))
+            targetpoly = np.array(targetpoly)
+            keep = []
+            for i in range(len(ccds)):
+                W,H = ccds.width[i],ccds.height[i]
+                wcs = Tan(*[float(x) for x in
+                            [ccds.crval1[i], ccds.crval2[i], ccds.crpix1[i], ccds.crpix2[i],
+                             ccds.cd1_1[i], ccds.cd1_2[i], ccds.cd2_1[i], ccds.cd2_2[i], W, H]])
+                cd = wcs.get_cd()
+                poly = []
+                for x,y in [(0.5,0.5),(W+0.5,0.5),(W+0.5,H+0.5),(0.5,H+0.5)]:
+                    rr,dd = wcs.pixelxy2radec(x,y)
+                    _,xx,yy = targetwcs.radec2pixelxy(rr,dd)
+                    poly.append((xx,yy))
+                if cd[0]*cd[3] - cd[1]*cd[2] > 0:
+                    poly = list(reversed(poly))
+                if polygons_intersect(targetpoly, np.array(poly)):
+                    keep.append(i)
+            return np.array(keep, int)
+
+        rng = np.random.RandomState(44)
+        n = 400
+        T = fits_table()
+        T.ra = T.crval1 = 180. + rng.uniform(-0.6, 0.6, n)
+        T.dec = T.crval2 = 30. + rng.uniform(-0.6, 0.6, n)
+        T.width = rng.choice([2046, 4096], n).astype(np.int32)
+        T.height = rng.choice([4094, 4096], n).astype(np.int32)
+        T.crpix1 = rng.uniform(-100, T.width+100)
+        T.crpix2 = rng.uniform(-100, T.height+100)
+        scale = rng.choice([0.262, 0.454], n) / 3600.
+        rot = np.deg2rad(rng.uniform(-10, 10, n))
+        flip = rng.choice([-1., 1.], n)
+        T.cd1_1 = -scale * np.cos(rot) * flip
+        T.cd1_2 = scale * np.sin(rot)
+        T.cd2_1 = -scale * np.sin(rot) * flip
+        T.cd2_2 = -scale * np.cos(rot)
+        # (the CCD centers, for the radius cut)
+        r,d = [],[]
+        for i in range(n):
+            wcs = Tan(*[float(x) for x in
+                        [T.crval1[i], T.crval2[i], T.crpix1[i], T.crpix2[i],
+                         T.cd1_1[i], T.cd1_2[i], T.cd2_1[i], T.cd2_2[i],
+                         T.width[i], T.height[i]]])
+            rd = wcs.pixelxy2radec((T.width[i]+1)/2., (T.height[i]+1)/2.)
+            r.append(rd[0])
+            d.append(rd[1])
+        T.ra = np.array(r)
+        T.dec = np.array(d)
+        fp = CcdFootprints.from_ccds(T)
+
+        B = fits_table()
+        B.ra = np.repeat(180. + np.arange(-0.5, 0.51, 0.25), 3)
+        B.dec = np.tile([29.8, 30., 30.3], 5)
+        IB,IC = fp.touching_bricks(B)
+        nmatch = 0
+        for ib in range(len(B)):
+            wcs = wcs_for_brick(B[ib])
+            old = old_touching(wcs, T)
+            nmatch += len(old)
+            self.assertEqual(sorted(ccds_touching_wcs(wcs, T)), list(old))
+            self.assertEqual(sorted(fp.touching_wcs(wcs)), list(old))
+            self.assertEqual(sorted(IC[IB == ib]), list(old))
+        self.assertTrue(nmatch > 0)
+
+class TestFiberFlux(unittest.TestCase):
+
+    def test_fiber_fluxes(self):
+        # fiber_fluxes must agree with the old per-source
+        # photutils.aperture_photometry loop of get_fiber_fluxes.
+        import numpy as np
+        from photutils.aperture import CircularAperture, aperture_photometry
+        from legacypipe.fiberflux import fiber_fluxes
+
+        H,W = 150,200
+        fiberrad = (1.5 / 0.262) / 2.
+
+        class Patch(object):
+            def __init__(self, x0, y0, patch):
+                self.x0,self.y0,self.patch = x0,y0,patch
+            def getExtent(self):
+                h,w = self.patch.shape
+                return self.x0, self.x0 + w, self.y0, self.y0 + h
+            def addTo(self, img, scale=1.):
+                x0,x1,y0,y1 = self.getExtent()
+                ih,iw = img.shape
+                cx0,cx1 = max(x0, 0), min(x1, iw)
+                cy0,cy1 = max(y0, 0), min(y1, ih)
+                if cx0 >= cx1 or cy0 >= cy1:
+                    return
+                img[cy0:cy1, cx0:cx1] += scale * self.patch[cy0-y0:cy1-y0, cx0-x0:cx1-x0]
+        class Src(object):
+            def __init__(self, x, y, sigma):
+                self.pos = (x, y)
+                ix,iy = int(np.round(x)), int(np.round(y))
+                yy,xx = np.mgrid[iy-12:iy+13, ix-12:ix+13]
+                p = np.exp(-0.5 * ((xx-x)**2 + (yy-y)**2) / sigma**2)
+                self.patch = Patch(ix-12, iy-12, p / p.sum())
+            def getUnitFluxModelPatches(self, tim):
+                return [self.patch]
+            def getPosition(self):
+                return self.pos
+        class Wcs(object):
+            def positionToPixel(self, pos):
+                return pos
+        class Tim(object):
+            def getWcs(self):
+                return Wcs()
+
+        rng = np.random.RandomState(45)
+        n = 300
+        # (a blended cluster, and some sources near or past the edges)
+        x = np.append(rng.uniform(0, W, n-40), rng.normal(100, 3, 40))
+        y = np.append(rng.uniform(0, H, n-40), rng.normal(75, 3, 40))
+        x[:5] = [-3., -1., W-0.5, W+1., 50.]
+        y[:5] = [20., H+1., 40., H-2., -2.]
+        cat = [Src(xi, yi, rng.uniform(1.5, 3.)) for xi,yi in zip(x, y)]
+        cat[10] = None
+        fluxes = rng.lognormal(1., 1., (n, 3))
+        fluxes[rng.uniform(size=fluxes.shape) < 0.1] = 0.
+        fluxes[10,:] = 0.
+
+        # The old loop
+        modimgs = [np.zeros((H,W), np.float32) for i in range(3)]
+        onemod = np.zeros((H,W), np.float32)
+        oldflux = np.zeros((n,3), np.float32)
+        oldtot = np.zeros((n,3), np.float32)
+        for isrc,src in enumerate(cat):
+            if src is None:
+                continue
+            patch = src.getUnitFluxModelPatches(Tim())[0]
+            for iband,modimg in enumerate(modimgs):
+                flux = fluxes[isrc,iband]
+                if flux <= 0:
+                    continue
+                patch.addTo(modimg, scale=flux)
+                patch.addTo(onemod, scale=flux)
+                sx,sy = src.getPosition()
+                p = aperture_photometry(onemod, CircularAperture((sx, sy), fiberrad))
+                f = p.field('aperture_sum')[0]
+                if not np.isfinite(f):
+                    continue
+                oldflux[isrc,iband] = f
+                x0,x1,y0,y1 = patch.getExtent()
+                onemod[max(y0,0):max(y1,0), max(x0,0):max(x1,0)] = 0.
+        aper = CircularAperture(np.vstack((x, y)).T, fiberrad)
+        for iband,modimg in enumerate(modimgs):
+            f = np.array(aperture_photometry(modimg, aper).field('aperture_sum'))
+            I = np.isfinite(f)
+            oldtot[I,iband] = f[I]
+
+        for nprocs in [1, 3]:
+            fiberflux,fibertotflux = fiber_fluxes(cat, fluxes, Tim(), fiberrad,
+                                                  x, y, H, W, nprocs=nprocs)
+            self.assertTrue(np.allclose(fiberflux, oldflux, rtol=1e-4, atol=1e-5))
+            self.assertTrue(np.allclose(fibertotflux, oldtot, rtol=1e-4, atol=1e-5))
+        self.assertTrue(np.all(fiberflux[10] == 0))
+
+class _FakeTim(object):
+    def __init__(self, name, n):
+        import numpy as np
+        self.name = name
+        self.data = np.arange(n, dtype=np.float32)
+        self.inverr = np.ones(n, np.float32)
+        self.dq = np.zeros(n, np.int16)
+
+def _read_fake_tim(X):
+    (name, n) = X
+    if n == 0:
+        return None
+    return _FakeTim(name, n)
+
+class TestTimReader(unittest.TestCase):
+
+    def check_tims(self, args, tims):
+        import numpy as np
+        self.assertEqual(len(tims), len(args))
+        for (name,n),tim in zip(args, tims):
+            if n == 0:
+                self.assertIsNone(tim)
+                continue
+            self.assertEqual(tim.name, name)
+            self.assertTrue(np.array_equal(tim.data, np.arange(n)))
+            self.assertTrue(np.array_equal(tim.inverr, np.ones(n)))
+            self.assertTrue(np.array_equal(tim.dq, np.zeros(n)))
+
+    def test_budget(self):
+        # The reads in flight plus the tims already read stay within
+        # the budget (apart from the one read that is always allowed).
+        import os
+        import shutil
+        import tempfile
+        import multiprocessing
+        from legacypipe.timreader import TimReader, tim_bytes
+
+        class MP(object):
+            pass
+        args = [('tim%i' % i, 1000 * (1 + i % 3)) for i in range(12)]
+        args[4] = ('tim4', 0)
+        # pixel bytes per element
+        est = lambda X: 10 * X[1]
+        total = sum([est(a) for a in args])
+        budget = 1.5 * total
+        tempdir = tempfile.mkdtemp()
+        pool = multiprocessing.Pool(3)
+        try:
+            mp = MP()
+            mp.pool = pool
+            for m in [None, mp]:
+                reader = TimReader(m, max_bytes=budget, estimate=est,
+                                   shm_dir=tempdir)
+                tims = reader.map(_read_fake_tim, args)
+                self.check_tims(args, tims)
+                st = reader.stats
+                self.assertEqual(st['ccds'], len(args))
+                self.assertEqual(st['resident_bytes'],
+                                 sum([tim_bytes(t) for t in tims]))
+                self.assertEqual(st['resident_bytes'], total)
+                self.assertLessEqual(st['peak_bytes'], budget)
+                if m is None:
+                    self.assertEqual(st['max_reads'], 1)
+                    self.assertEqual(st['shared'], 0)
+                else:
+                    # Reads overlap, but not all of them fit at once.
+                    self.assertGreater(st['max_reads'], 1)
+                    self.assertLess(st['max_reads'], len(args))
+                    self.assertEqual(st['shared'], len(args) - 1)
+                # The shared-memory files are gone
+                self.assertEqual(os.listdir(tempdir), [])
+            # A CCD bigger than the budget is still read, alone.
+            reader = TimReader(mp, max_bytes=1, estimate=est, shm_dir=tempdir)
+            self.check_tims(args, reader.map(_read_fake_tim, args))
+            self.assertEqual(reader.stats['max_reads'], 1)
+        finally:
+            pool.close()
+            pool.join()
+            shutil.rmtree(tempdir)
+
+    def test_shm_fallback(self):
+        # Without a usable shared-memory directory, the pixels are
+        # pickled back instead.
+        import os
+        import shutil
+        import tempfile
+        import multiprocessing
+        from legacypipe.timreader import TimReader, _write_pixels, _attach_pixels
+
+        class MP(object):
+            pass
+        args = [('tim%i' % i, 100 * (i+1)) for i in range(5)]
+        tempdir = tempfile.mkdtemp()
+        pool = multiprocessing.Pool(2)
+        try:
+            mp = MP()
+            mp.pool = pool
+            reader = TimReader(mp, shm_dir=os.path.join(tempdir, 'nonexistent'))
+            self.check_tims(args, reader.map(_read_fake_tim, args))
+            self.assertEqual(reader.stats['shared'], 0)
+
+            # Failing to write leaves the pixels in the tim...
+            tim = _read_fake_tim(args[0])
+            self.assertIsNone(_write_pixels(tim, os.path.join(tempdir, 'nonexistent')))
+            self.check_tims(args[:1], [tim])
+            # ... writing moves them to files, and attaching maps them
+            # back and removes the files.
+            files = _write_pixels(tim, tempdir)
+            self.assertIsNone(tim.data)
+            self.assertEqual(len(os.listdir(tempdir)), 3)
+            _attach_pixels(tim, files)
+            self.check_tims(args[:1], [tim])
+            self.assertEqual(os.listdir(tempdir), [])
+        finally:
+            pool.close()
+            pool.join()
+            shutil.rmtree(tempdir)
 
 if __name__ == '__main__':
     unittest.main()